@@ -0,0 +1,299 @@
+"""
+Cold start benchmark for chaos.py.
+
+Each trial runs in a fresh interpreter and measures the time to import the
+chaos module, the latency of the first handler call (which includes
+importing boto3 and creating clients) and the median latency of the calls
+after it.  AWS is stubbed at the HTTP layer with a botocore before-send
+hook, so request signing and response parsing are real but nothing leaves
+the machine.  Trials are run with lazy client creation and with the
+"prewarm" setting, which creates clients while the module is imported (the
+lambda init phase).
+
+    PYTHONPATH=src/ python3 bench/bench_cold_start.py [--trials N]
+
+With --artifacts, it instead compares the time taken to import the handler
+from each kind of deployment artifact built by tools/package.py: the source
+zip, the precompiled zip and the standalone template's inline index.py.
+Bytecode isn't cached between trials, as the lambda's code directory is
+read only.  The precompiled zip can only be built by the Python version of
+the lambda runtime.
+
+    python3.11 bench/bench_cold_start.py --artifacts [--trials N]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from urllib.parse import parse_qs
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+TOOLS = os.path.join(BENCH, "..", "tools")
+REGION = "eu-west-1"
+
+
+class RawResponse:
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def describe_auto_scaling_groups(params, asg_count):
+    members = []
+    for i in range(asg_count):
+        members.append(
+            "<member>"
+            "<AutoScalingGroupName>asg-%d</AutoScalingGroupName>"
+            "<Instances><member>"
+            "<InstanceId>i-%08d</InstanceId>"
+            "<AvailabilityZone>eu-west-1a</AvailabilityZone>"
+            "<LifecycleState>InService</LifecycleState>"
+            "<HealthStatus>Healthy</HealthStatus>"
+            "</member></Instances>"
+            "<Tags><member>"
+            "<Key>chaos-lambda-termination</Key><Value>1.0</Value>"
+            "</member></Tags>"
+            "</member>" % (i, i)
+        )
+    return (
+        '<DescribeAutoScalingGroupsResponse '
+        'xmlns="http://autoscaling.amazonaws.com/doc/2011-01-01/">'
+        "<DescribeAutoScalingGroupsResult><AutoScalingGroups>%s"
+        "</AutoScalingGroups></DescribeAutoScalingGroupsResult>"
+        "<ResponseMetadata><RequestId>r</RequestId></ResponseMetadata>"
+        "</DescribeAutoScalingGroupsResponse>" % "".join(members)
+    )
+
+
+def terminate_instances(params, asg_count):
+    items = [
+        "<item><instanceId>%s</instanceId>"
+        "<currentState><code>32</code><name>shutting-down</name>"
+        "</currentState><previousState><code>16</code><name>running</name>"
+        "</previousState></item>" % values[0]
+        for key, values in sorted(params.items())
+        if key.startswith("InstanceId.")
+    ]
+    return (
+        '<TerminateInstancesResponse '
+        'xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+        "<requestId>r</requestId><instancesSet>%s</instancesSet>"
+        "</TerminateInstancesResponse>" % "".join(items)
+    )
+
+
+def publish(params, asg_count):
+    return (
+        '<PublishResponse xmlns="http://sns.amazonaws.com/doc/2010-03-31/">'
+        "<PublishResult><MessageId>m</MessageId></PublishResult>"
+        "<ResponseMetadata><RequestId>r</RequestId></ResponseMetadata>"
+        "</PublishResponse>"
+    )
+
+
+def publish_batch(params, asg_count):
+    members = [
+        "<member><Id>%s</Id><MessageId>m</MessageId></member>" % values[0]
+        for key, values in sorted(params.items())
+        if key.startswith("PublishBatchRequestEntries.member.")
+        and key.endswith(".Id")
+    ]
+    return (
+        '<PublishBatchResponse '
+        'xmlns="http://sns.amazonaws.com/doc/2010-03-31/">'
+        "<PublishBatchResult><Successful>%s</Successful><Failed/>"
+        "</PublishBatchResult>"
+        "<ResponseMetadata><RequestId>r</RequestId></ResponseMetadata>"
+        "</PublishBatchResponse>" % "".join(members)
+    )
+
+
+RESPONSES = {
+    "DescribeAutoScalingGroups": describe_auto_scaling_groups,
+    "TerminateInstances": terminate_instances,
+    "Publish": publish,
+    "PublishBatch": publish_batch,
+}
+
+
+def stub_client(client, asg_count):
+    from botocore.awsrequest import AWSResponse
+
+    def before_send(request, event_name, **kwargs):
+        operation = event_name.split(".")[-1]
+        body = request.body or b""
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        body = RESPONSES[operation](parse_qs(body), asg_count)
+        return AWSResponse(
+            request.url, 200, {}, RawResponse(body.encode("utf-8"))
+        )
+
+    client.meta.events.register("before-send", before_send)
+
+
+def child(mode, asg_count, calls):
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "AKIDEXAMPLE",
+        "AWS_SECRET_ACCESS_KEY": "secret",
+        "AWS_EC2_METADATA_DISABLED": "true",
+        "AWS_REGION": REGION,
+        "regions": REGION,
+        "probability": "1.0",
+        "termination_topic_arn": "arn:aws:sns:%s:123456789012:t" % REGION,
+        "prewarm": "true" if mode == "prewarm" else "false",
+    })
+    sys.path.insert(0, SRC)
+
+    start = time.perf_counter()
+    import chaos
+    import_time = time.perf_counter() - start
+
+    stubbed = set()
+
+    def stub_all():
+        for client in list(chaos.clients.values()):
+            if id(client) not in stubbed:
+                stub_client(client, asg_count)
+                stubbed.add(id(client))
+
+    get_client = chaos.get_client
+
+    def stubbing_get_client(service, region, account=None):
+        client = get_client(service, region, account)
+        stub_all()
+        return client
+
+    stub_all()
+    chaos.get_client = stubbing_get_client
+
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(calls):
+            start = time.perf_counter()
+            chaos.handler({}, None)
+            latencies.append(time.perf_counter() - start)
+
+    json.dump({
+        "import": import_time,
+        "first": latencies[0],
+        "steady": statistics.median(latencies[1:]),
+    }, sys.stdout)
+
+
+def import_child(directory, module):
+    sys.path.insert(0, directory)
+    start = time.perf_counter()
+    __import__(module)
+    json.dump({"import": time.perf_counter() - start}, sys.stdout)
+
+
+def build_artifacts(directory):
+    # Returns (name, directory, module) for each artifact, unpacked as the
+    # lambda runtime would
+    sys.path.insert(0, TOOLS)
+    import package
+    builds = [
+        ("source", package.build_source_zip, "chaos"),
+        ("inline", package.build_inline, "index"),
+    ]
+    if sys.version_info[:2] == package.RUNTIME:
+        builds.insert(1, ("zip", package.build_zip, "chaos"))
+    else:
+        print("Skipping zip, which needs Python %d.%d" % package.RUNTIME)
+    artifacts = []
+    for name, build, module in builds:
+        path = os.path.join(directory, name)
+        os.mkdir(path)
+        if module == "index":
+            build(os.path.join(path, "index.py"))
+        else:
+            build(path + ".zip")
+            with zipfile.ZipFile(path + ".zip") as z:
+                z.extractall(path)
+        artifacts.append((name, path, module))
+    return artifacts
+
+
+def run_import_trials(artifacts, trials):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    env.pop("PYTHONPATH", None)
+    print("Handler import time, median of %d trials, milliseconds" % trials)
+    print("%-8s %10s" % ("artifact", "import"))
+    for name, directory, module in artifacts:
+        results = []
+        for i in range(trials):
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__),
+                "--import-child", directory, module,
+            ], env=env)
+            results.append(json.loads(output)["import"])
+        print("%-8s %10.1f" % (name, statistics.median(results) * 1000))
+
+
+def run_trials(mode, trials, asg_count, calls):
+    results = []
+    for i in range(trials):
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__),
+            "--child", mode,
+            "--asgs", str(asg_count),
+            "--calls", str(calls),
+        ])
+        results.append(json.loads(output))
+    return dict(
+        (key, statistics.median(r[key] for r in results))
+        for key in results[0]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--asgs", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=10)
+    parser.add_argument("--artifacts", action="store_true")
+    parser.add_argument("--child", choices=["lazy", "prewarm"])
+    parser.add_argument("--import-child", nargs=2)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        return child(args.child, args.asgs, args.calls)
+    if args.import_child is not None:
+        return import_child(*args.import_child)
+    if args.artifacts:
+        directory = tempfile.mkdtemp()
+        try:
+            run_import_trials(build_artifacts(directory), args.trials)
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    print("%d ASGs, median of %d trials, milliseconds" % (
+        args.asgs, args.trials
+    ))
+    print("%-8s %10s %10s %10s %12s" % (
+        "mode", "import", "first", "steady", "import+first"
+    ))
+    for mode in ("lazy", "prewarm"):
+        r = run_trials(mode, args.trials, args.asgs, args.calls)
+        print("%-8s %10.1f %10.1f %10.1f %12.1f" % (
+            mode, r["import"] * 1000, r["first"] * 1000,
+            r["steady"] * 1000, (r["import"] + r["first"]) * 1000
+        ))
+
+
+if __name__ == "__main__":
+    main()
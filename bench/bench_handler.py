@@ -0,0 +1,247 @@
+"""
+Synthetic estate benchmark for chaos.handler.
+
+Runs the full handler against bench/fake_aws.py for estates of increasing
+size and reports wall time, API calls, peak traced memory and the time spent
+in each phase.  Each estate size runs in a fresh interpreter.  The API calls
+and peak memory are compared with the stored baselines in
+bench/baselines.json, and the exit status is non-zero if the calls differ or
+the memory grows beyond the tolerance.  Wall and phase times depend on the
+machine, so they are reported but not compared.
+
+    PYTHONPATH=src/ python3 bench/bench_handler.py [--sizes 1000,10000]
+    PYTHONPATH=src/ python3 bench/bench_handler.py --update-baselines
+
+Settings for chaos.py can be given with --env, eg --env concurrency=4.
+Baselines are only compared for runs with the default estate shape,
+latency and settings.
+
+A capture of a real estate (see src/chaos_capture.py) can be run instead of
+a synthetic one, at full speed or with its recorded latencies:
+
+    PYTHONPATH=src/ python3 bench/bench_handler.py --replay capture.ndjson.gz \
+        [--recorded-latency]
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+BASELINES = os.path.join(BENCH, "baselines.json")
+
+# Results that are the same on any machine, and so kept as baselines
+BASELINE_KEYS = ("calls", "peak_kb")
+
+# Functions in chaos.py whose cumulative time is reported as a phase
+PHASES = (
+    "get_targets",
+    "terminate_targets",
+    "send_notifications",
+    "terminate_instances",
+)
+
+
+class PhaseTimer:
+
+    def __init__(self, module, names):
+        self.times = collections.Counter()
+        self.lock = threading.Lock()
+        for name in names:
+            setattr(module, name, self.wrap(name, getattr(module, name)))
+
+    def wrap(self, name, f):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.times[name] += time.perf_counter() - start
+        return timed
+
+
+class Context:
+
+    invoked_function_arn = "arn:aws:lambda:eu-west-1:123456789012:function:x"
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def child(args):
+    sys.path.insert(0, SRC)
+    sys.path.insert(0, BENCH)
+    import chaos
+    import fake_aws
+
+    if args.replay is not None:
+        import replay_aws
+        capture = replay_aws.Capture(args.replay)
+        regions = capture.regions
+        aws = replay_aws.ReplayAWS(capture, args.recorded_latency)
+    else:
+        regions = ["bench-region-%d" % i for i in range(args.regions)]
+        estate = fake_aws.Estate(
+            regions=regions,
+            asgs=args.size // args.regions,
+            instances=args.instances,
+            tags=args.tags,
+        )
+        aws = fake_aws.FakeAWS(estate, latency=args.latency)
+    os.environ.update({
+        "regions": ",".join(regions),
+        "termination_topic_arn":
+            "arn:aws:sns:%s:123456789012:topic" % regions[0],
+    })
+    os.environ.update(dict(e.split("=", 1) for e in args.env))
+    chaos.boto3 = aws
+    # Only botocore's Config is left to import; do it outside the timings
+    chaos.import_boto3()
+    phases = PhaseTimer(chaos, PHASES)
+
+    def run():
+        random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            chaos.handler({}, Context())
+
+    start = time.perf_counter()
+    run()
+    wall = time.perf_counter() - start
+    calls = dict(aws.calls)
+    times = dict(phases.times)
+
+    # Traced memory is measured on a second run, as tracing slows it down
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    json.dump({
+        "wall": round(wall, 4),
+        "calls": calls,
+        "peak_kb": peak // 1024,
+        "phases": dict((k, round(v, 4)) for k, v in times.items()),
+    }, sys.stdout)
+
+
+def run_size(args, size):
+    command = [
+        sys.executable, os.path.abspath(__file__), "--child",
+        "--size", str(size),
+        "--regions", str(args.regions),
+        "--instances", str(args.instances),
+        "--tags", str(args.tags),
+        "--latency", str(args.latency),
+    ]
+    for e in args.env:
+        command += ["--env", e]
+    if args.replay is not None:
+        command += ["--replay", args.replay]
+        if args.recorded_latency:
+            command += ["--recorded-latency"]
+    return json.loads(subprocess.check_output(command))
+
+
+def is_default_shape(args):
+    return (args.regions, args.instances, args.tags, args.latency,
+            args.env, args.replay) == (1, 3, 10, 0.0, [], None)
+
+
+def compare(size, result, baseline, tolerance):
+    problems = []
+    if result["calls"] != baseline["calls"]:
+        problems.append("API calls %s, baseline %s" % (
+            result["calls"], baseline["calls"]
+        ))
+    if result["peak_kb"] > baseline["peak_kb"] * (1 + tolerance):
+        problems.append("peak_kb %s, baseline %s" % (
+            result["peak_kb"], baseline["peak_kb"]
+        ))
+    return ["%d ASGs: %s" % (size, p) for p in problems]
+
+
+def report(size, result):
+    calls = sum(result["calls"].values())
+    print("%8d %10.3f %8d %10d   %s" % (
+        size, result["wall"], calls, result["peak_kb"],
+        " ".join("%s=%.3f" % (name, result["phases"].get(name, 0.0))
+                 for name in PHASES)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", default="1000,10000,50000",
+                        help="comma separated total numbers of ASGs")
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--instances", type=int, default=3,
+                        help="instances per ASG")
+    parser.add_argument("--tags", type=int, default=10, help="tags per ASG")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every API call")
+    parser.add_argument("--env", action="append", default=[],
+                        help="NAME=VALUE setting for chaos.py")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--replay", metavar="CAPTURE",
+                        help="run a capture instead of a synthetic estate")
+    parser.add_argument("--recorded-latency", action="store_true",
+                        help="delay replayed calls by their recorded time")
+    parser.add_argument("--update-baselines", action="store_true")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    print("%8s %10s %8s %10s   %s" % (
+        "ASGs", "wall (s)", "calls", "peak (KB)", "phase times (s)"
+    ))
+    if args.replay is not None:
+        import replay_aws
+        size = replay_aws.Capture(args.replay).count()
+        report(size, run_size(args, size))
+        return 0
+
+    problems = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        result = run_size(args, size)
+        report(size, result)
+        if args.update_baselines:
+            baselines[str(size)] = dict(
+                (key, result[key]) for key in BASELINE_KEYS
+            )
+        elif is_default_shape(args) and str(size) in baselines:
+            problems += compare(size, result, baselines[str(size)],
+                                args.tolerance)
+
+    if args.update_baselines:
+        with open(BASELINES, "w") as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write("\n")
+    for problem in problems:
+        print("REGRESSION", problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Target selection benchmark for chaos.py.
+
+Compares the time taken by get_targets to select targets from a synthetic
+estate with a default probability of zero, listing every ASG, listing only
+tagged ASGs (the "tag_filter" setting) and with two-phase selection (the
+"two_phase" setting).  Responses are real XML served to boto3 through a
+botocore before-send hook, so the cost of parsing them is included.
+
+    PYTHONPATH=src/ python3 bench/bench_selection.py [--asgs N]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+from bench_cold_start import RawResponse
+
+REGION = "eu-west-1"
+NAMESPACE = "http://autoscaling.amazonaws.com/doc/2011-01-01/"
+PAGE_SIZE = 100
+
+
+class Estate:
+
+    def __init__(self, asgs, instances, tags, tagged_every, probability):
+        self.names = ["asg-%06d" % i for i in range(asgs)]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.instances = instances
+        self.tags = tags
+        self.tagged_every = tagged_every
+        self.probability = probability
+        self.bytes = 0
+
+    def is_tagged(self, i):
+        return i % self.tagged_every == 0
+
+    def tag_xml(self, i, key, value):
+        return (
+            "<member><ResourceId>%s</ResourceId>"
+            "<ResourceType>auto-scaling-group</ResourceType>"
+            "<Key>%s</Key><Value>%s</Value>"
+            "<PropagateAtLaunch>false</PropagateAtLaunch></member>"
+            % (self.names[i], escape(key), escape(value))
+        )
+
+    def asg_tags(self, i):
+        tags = [("tag-%d" % t, "value-%d" % t) for t in range(self.tags)]
+        if self.is_tagged(i):
+            tags[-1] = ("chaos-lambda-termination", self.probability)
+        return tags
+
+    def asg_xml(self, i):
+        return (
+            "<member><AutoScalingGroupName>%s</AutoScalingGroupName>"
+            "<MinSize>%d</MinSize><MaxSize>%d</MaxSize>"
+            "<DesiredCapacity>%d</DesiredCapacity>"
+            "<Instances>%s</Instances><Tags>%s</Tags></member>" % (
+                self.names[i], self.instances, self.instances,
+                self.instances,
+                "".join(
+                    "<member><InstanceId>i-%08x%03x</InstanceId>"
+                    "<AvailabilityZone>eu-west-1a</AvailabilityZone>"
+                    "<LifecycleState>InService</LifecycleState>"
+                    "<HealthStatus>Healthy</HealthStatus></member>" % (i, n)
+                    for n in range(self.instances)
+                ),
+                "".join(self.tag_xml(i, k, v) for k, v in self.asg_tags(i)),
+            )
+        )
+
+    def page(self, indexes, params):
+        start = int(params.get("NextToken", ["0"])[0])
+        size = int(params.get("MaxRecords", [str(PAGE_SIZE)])[0])
+        token = ""
+        if start + size < len(indexes):
+            token = "<NextToken>%d</NextToken>" % (start + size)
+        return indexes[start:start + size], token
+
+    def describe_auto_scaling_groups(self, params):
+        names = [
+            values[0] for key, values in sorted(params.items())
+            if key.startswith("AutoScalingGroupNames.member.")
+        ]
+        tagged = "Filters.member.1.Name" in params
+        if len(names) != 0:
+            indexes = [self.index[name] for name in names]
+        elif tagged:
+            indexes = range(0, len(self.names), self.tagged_every)
+        else:
+            indexes = range(len(self.names))
+        page, token = self.page(indexes, params)
+        return self.response("DescribeAutoScalingGroups", (
+            "<AutoScalingGroups>%s</AutoScalingGroups>%s" % (
+                "".join(self.asg_xml(i) for i in page), token
+            )
+        ))
+
+    def describe_tags(self, params):
+        indexes = range(0, len(self.names), self.tagged_every)
+        page, token = self.page(indexes, params)
+        return self.response("DescribeTags", "<Tags>%s</Tags>%s" % (
+            "".join(
+                self.tag_xml(i, "chaos-lambda-termination", self.probability)
+                for i in page
+            ),
+            token
+        ))
+
+    def response(self, operation, result):
+        body = (
+            '<%sResponse xmlns="%s"><%sResult>%s</%sResult>'
+            "<ResponseMetadata><RequestId>r</RequestId></ResponseMetadata>"
+            "</%sResponse>" % (
+                operation, NAMESPACE, operation, result, operation, operation
+            )
+        ).encode("utf-8")
+        self.bytes += len(body)
+        return body
+
+
+def make_client(estate):
+    import boto3
+    from botocore.awsrequest import AWSResponse
+
+    client = boto3.client(
+        "autoscaling", region_name=REGION,
+        aws_access_key_id="AKIDEXAMPLE", aws_secret_access_key="secret"
+    )
+    handlers = {
+        "DescribeAutoScalingGroups": estate.describe_auto_scaling_groups,
+        "DescribeTags": estate.describe_tags,
+    }
+
+    def before_send(request, event_name, **kwargs):
+        body = request.body or b""
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        body = handlers[event_name.split(".")[-1]](parse_qs(body))
+        return AWSResponse(request.url, 200, {}, RawResponse(body))
+
+    client.meta.events.register("before-send", before_send)
+    return client
+
+
+MODES = (
+    ("all", {}),
+    ("tag_filter", {"tag_filter": "true"}),
+    ("two_phase", {"two_phase": "true"}),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--asgs", type=int, default=5000)
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--tags", type=int, default=10)
+    parser.add_argument("--tagged-every", type=int, default=10)
+    parser.add_argument("--probability", default="0.1")
+    parser.add_argument("--trials", type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "src"
+    ))
+    import chaos
+
+    print("%d ASGs, 1 in %d tagged with probability %s, median of %d" % (
+        args.asgs, args.tagged_every, args.probability, args.trials
+    ))
+    print("%-12s %10s %12s %10s" % ("mode", "time (s)", "parsed (KB)",
+                                    "targets"))
+    for mode, env in MODES:
+        for name in ("tag_filter", "two_phase"):
+            os.environ.pop(name, None)
+        os.environ.update(env)
+        times = []
+        for trial in range(args.trials):
+            estate = Estate(args.asgs, args.instances, args.tags,
+                            args.tagged_every, args.probability)
+            client = make_client(estate)
+            random.seed(trial)
+            start = time.perf_counter()
+            targets = chaos.get_targets(client, 0.0)
+            times.append(time.perf_counter() - start)
+        print("%-12s %10.3f %12d %10d" % (
+            mode, statistics.median(times), estate.bytes // 1024,
+            len(targets)
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Throttling benchmark for chaos.handler and the rate_limit setting.
+
+Runs the full handler against bench/fake_aws.py while the fake throttles
+calls, both without and with the rate limiter (see src/chaos_ratelimit.py),
+and reports how the run degrades: its wall time, the API attempts it made,
+how many of them were throttled, how many calls failed after running out of
+retries, and the rate of successful calls.  Each run is in a fresh
+interpreter, so that clients and limiters start afresh.
+
+    PYTHONPATH=src/ python3 bench/bench_throttling.py [--limits none,20,5]
+
+--limits sets the calls per second the fake allows each service in each
+region, standing in for what's left of the account's allowance while other
+tooling is busy (none for no limit), and --throttle the probability of any
+attempt being throttled regardless.  The fake retries throttled attempts
+like botocore's standard retry mode, with delays from --retry-base seconds.
+Settings for chaos.py can be given with --env, eg --env concurrency=4.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+
+
+class Context:
+
+    invoked_function_arn = "arn:aws:lambda:eu-west-1:123456789012:function:x"
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def child(args):
+    sys.path.insert(0, SRC)
+    sys.path.insert(0, BENCH)
+    import chaos
+    import fake_aws
+
+    regions = ["bench-region-%d" % i for i in range(args.regions)]
+    estate = fake_aws.Estate(
+        regions=regions,
+        asgs=args.size // args.regions,
+        instances=args.instances,
+        probability=args.probability,
+    )
+    aws = fake_aws.FakeAWS(
+        estate, latency=args.latency, throttle=args.throttle,
+        limit=args.limit, retry_base=args.retry_base
+    )
+    os.environ.update({
+        "regions": ",".join(regions),
+        "termination_topic_arn":
+            "arn:aws:sns:%s:123456789012:topic" % regions[0],
+        "rate_limit": "" if args.limiter is None else str(args.limiter),
+    })
+    os.environ.update(dict(e.split("=", 1) for e in args.env))
+    chaos.boto3 = aws
+    chaos.import_boto3()
+
+    random.seed(0)
+    failed_run = False
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            chaos.handler({}, Context())
+        except RuntimeError:
+            # Regions that failed, eg because listing them was throttled
+            # too often
+            failed_run = True
+    wall = time.perf_counter() - start
+
+    json.dump({
+        "wall": round(wall, 4),
+        "attempts": sum(aws.calls.values()),
+        "throttles": sum(aws.throttles.values()),
+        "failures": sum(aws.failures.values()),
+        "failed_run": failed_run,
+    }, sys.stdout)
+
+
+def run(args, limit, rate_limit):
+    command = [
+        sys.executable, os.path.abspath(__file__), "--child",
+        "--size", str(args.size),
+        "--regions", str(args.regions),
+        "--instances", str(args.instances),
+        "--probability", args.probability,
+        "--latency", str(args.latency),
+        "--throttle", str(args.throttle),
+        "--retry-base", str(args.retry_base),
+    ]
+    if limit is not None:
+        command += ["--limit", str(limit)]
+    if rate_limit is not None:
+        command += ["--limiter", str(rate_limit)]
+    for e in args.env:
+        command += ["--env", e]
+    return json.loads(subprocess.check_output(command))
+
+
+def report(limit, rate_limit, result):
+    successes = result["attempts"] - result["throttles"]
+    print("%8s %10s %10.3f %9d %10d %9d %10.1f%s" % (
+        "none" if limit is None else "%g" % limit,
+        "off" if rate_limit is None else "%g" % rate_limit,
+        result["wall"], result["attempts"], result["throttles"],
+        result["failures"], successes / max(result["wall"], 1e-9),
+        "   (run failed)" if result["failed_run"] else ""
+    ))
+
+
+def parse_limit(value):
+    return None if value == "none" else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--limits", default="none,20,5",
+                        help="comma separated calls per second allowed by "
+                             "the fake, or none")
+    parser.add_argument("--rate-limit", type=float, default=10.0,
+                        help="rate_limit setting for the runs with the "
+                             "limiter")
+    parser.add_argument("--size", type=int, default=2000,
+                        help="total number of ASGs")
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--instances", type=int, default=3,
+                        help="instances per ASG")
+    parser.add_argument("--probability", default="0.5",
+                        help="termination probability of tagged ASGs")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds added to every API attempt")
+    parser.add_argument("--throttle", type=float, default=0.0,
+                        help="probability of any attempt being throttled")
+    parser.add_argument("--retry-base", type=float, default=1.0,
+                        help="seconds of backoff before the first retry")
+    parser.add_argument("--env", action="append", default=[],
+                        help="NAME=VALUE setting for chaos.py")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--limit", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--limiter", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    print("%8s %10s %10s %9s %10s %9s %10s" % (
+        "limit", "rate_limit", "wall (s)", "attempts", "throttled",
+        "failed", "calls/s"
+    ))
+    for limit in [parse_limit(v) for v in args.limits.split(",")]:
+        for rate_limit in (None, args.rate_limit):
+            report(limit, rate_limit, run(args, limit, rate_limit))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
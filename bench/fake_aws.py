@@ -0,0 +1,409 @@
+"""
+In-process fake of the AWS clients used by chaos.py, for benchmarks.
+
+FakeAWS stands in for the boto3 module (it has a client() function) and
+serves a synthetic estate of Auto Scaling Groups.  ASGs are generated on
+demand from their index rather than held in memory, so very large estates
+are cheap to describe.  Every call can be delayed by a fixed latency and is
+counted per (service, operation).
+
+Throttling can be injected to see how a run degrades under contention for
+the account's API allowance:
+* throttle: the probability of any attempt being throttled;
+* limit: the calls per second each service allows in each region, with a
+  second's worth of burst, beyond which attempts are throttled, as if by an
+  account shared with other tooling.
+
+Throttled attempts are retried the way botocore's standard retry mode does,
+up to max_attempts attempts with "full jitter" exponential backoff from
+retry_base seconds, and then raise ClientError.  The before-send and
+needs-retry events are emitted for every attempt, as botocore does, so
+handlers such as chaos_ratelimit's see the throttling.  Every attempt is
+counted in calls, throttled ones in throttles too, and calls that ran out of
+attempts in failures.
+"""
+import collections
+import random
+import threading
+import time
+import types
+
+
+PROBABILITY_TAG = "chaos-lambda-termination"
+PAGE_SIZE = 100
+
+
+class Estate:
+
+    def __init__(self, regions=("eu-west-1",), asgs=1000, instances=3,
+                 tags=10, tagged_every=10, probability="0.5"):
+        self.regions = list(regions)
+        self.asgs = asgs
+        self.instances = instances
+        self.tags = tags
+        self.tagged_every = tagged_every
+        self.probability = probability
+
+    def asg_name(self, region, index):
+        return "asg-%s-%06d" % (region, index)
+
+    def is_tagged(self, index):
+        return self.tagged_every > 0 and index % self.tagged_every == 0
+
+    def asg(self, region, index):
+        name = self.asg_name(region, index)
+        r = self.regions.index(region)
+        tagged = self.is_tagged(index)
+        tags = [
+            {
+                "ResourceId": name,
+                "ResourceType": "auto-scaling-group",
+                "Key": "tag-%d" % t,
+                "Value": "value-%d-%d" % (index, t),
+                "PropagateAtLaunch": True,
+            }
+            for t in range(self.tags - 1 if tagged else self.tags)
+        ]
+        if tagged:
+            tags.append({
+                "ResourceId": name,
+                "ResourceType": "auto-scaling-group",
+                "Key": PROBABILITY_TAG,
+                "Value": self.probability,
+                "PropagateAtLaunch": False,
+            })
+        return {
+            "AutoScalingGroupName": name,
+            "AutoScalingGroupARN": (
+                "arn:aws:autoscaling:%s:123456789012:autoScalingGroup:"
+                "00000000-0000-0000-0000-%012d:autoScalingGroupName/%s"
+                % (region, index, name)
+            ),
+            "MinSize": self.instances,
+            "MaxSize": self.instances,
+            "DesiredCapacity": self.instances,
+            "AvailabilityZones": [region + "a", region + "b"],
+            "Instances": [
+                {
+                    "InstanceId": "i-%02x%08x%03x" % (r, index, i),
+                    "InstanceType": "t3.micro",
+                    "AvailabilityZone": region + "ab"[i % 2],
+                    "LifecycleState": "InService",
+                    "HealthStatus": "Healthy",
+                    "ProtectedFromScaleIn": False,
+                }
+                for i in range(self.instances)
+            ],
+            "Tags": tags,
+        }
+
+    def indexes(self, filters=None):
+        for f in filters or []:
+            if f["Name"] == "tag-key":
+                if PROBABILITY_TAG not in f["Values"]:
+                    return range(0)
+                if self.tagged_every <= 0:
+                    return range(0)
+                return range(0, self.asgs, self.tagged_every)
+        return range(self.asgs)
+
+
+class Events:
+    """Enough of botocore's event emitter for handlers to be registered."""
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler, unique_id=None):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self.handlers:
+            if event_name == name or event_name.startswith(name + "."):
+                handler(event_name=event_name, **kwargs)
+
+
+class ClientError(Exception):
+    """Enough of botocore's ClientError for its response to be read."""
+
+    def __init__(self, response, operation_name):
+        super(ClientError, self).__init__(
+            "An error occurred (%s) when calling the %s operation: %s" % (
+                response["Error"]["Code"], operation_name,
+                response["Error"]["Message"]
+            )
+        )
+        self.response = response
+        self.operation_name = operation_name
+
+
+class Meta:
+
+    def __init__(self, service, region):
+        self.service_model = types.SimpleNamespace(service_name=service)
+        self.region_name = region
+        self.events = Events()
+
+
+class FakeClient:
+
+    def __init__(self, aws, service, region):
+        self.aws = aws
+        self.meta = Meta(service, region)
+
+    def attempt(self, operation, response):
+        # Returns the parsed response to one attempt
+        service = self.meta.service_model.service_name
+        region = self.meta.region_name
+        self.aws.record(service, operation)
+        if self.aws.latency > 0:
+            time.sleep(self.aws.latency)
+        if self.aws.is_throttled(service, region):
+            self.aws.record_throttle(service, operation)
+            return {
+                "Error": {"Code": "Throttling", "Message": "Rate exceeded"},
+                "ResponseMetadata": {"HTTPStatusCode": 400},
+            }
+        return response
+
+    def call(self, operation, response):
+        service = self.meta.service_model.service_name
+        event = service + "." + operation
+        context = {}
+        model = types.SimpleNamespace(name=operation)
+        self.meta.events.emit(
+            "before-call." + event,
+            model=model,
+            params={},
+            context=context,
+        )
+        attempts = 0
+        while True:
+            attempts += 1
+            self.meta.events.emit("before-send." + event, request=None)
+            parsed = self.attempt(operation, response)
+            self.meta.events.emit(
+                "needs-retry." + event,
+                response=(None, parsed),
+                attempts=attempts,
+                caught_exception=None,
+            )
+            if "Error" not in parsed:
+                break
+            if attempts >= self.aws.max_attempts:
+                parsed["ResponseMetadata"]["RetryAttempts"] = attempts - 1
+                error = ClientError(parsed, operation)
+                self.aws.record_failure(service, operation)
+                self.meta.events.emit(
+                    "after-call-error." + event,
+                    exception=error,
+                    context=context,
+                )
+                raise error
+            time.sleep(self.aws.get_retry_delay(attempts))
+        response.setdefault(
+            "ResponseMetadata",
+            {"HTTPStatusCode": 200, "RetryAttempts": attempts - 1}
+        )
+        self.meta.events.emit(
+            "after-call." + event,
+            http_response=None,
+            parsed=response,
+            model=types.SimpleNamespace(name=operation),
+            context=context,
+        )
+        return response
+
+
+class Paginator:
+
+    def __init__(self, client, method):
+        self.client = client
+        self.method = method
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        token = (PaginationConfig or {}).get("StartingToken", None)
+        while True:
+            if token is not None:
+                kwargs["NextToken"] = token
+            page = self.method(**kwargs)
+            yield page
+            token = page.get("NextToken", None)
+            if token is None:
+                return
+
+
+class FakeAutoScaling(FakeClient):
+
+    def get_paginator(self, name):
+        return Paginator(self, getattr(self, name))
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames=None,
+                                     Filters=None, NextToken=None,
+                                     MaxRecords=PAGE_SIZE):
+        estate = self.aws.estate
+        region = self.meta.region_name
+        if AutoScalingGroupNames is not None:
+            prefix = estate.asg_name(region, 0)[:-6]
+            indexes = [
+                int(name[len(prefix):]) for name in AutoScalingGroupNames
+                if name.startswith(prefix)
+            ]
+            indexes = [i for i in indexes if i < estate.asgs]
+        else:
+            indexes = estate.indexes(Filters)
+        start = int(NextToken or 0)
+        page = indexes[start:start + MaxRecords]
+        response = {
+            "AutoScalingGroups": [estate.asg(region, i) for i in page],
+        }
+        if start + MaxRecords < len(indexes):
+            response["NextToken"] = str(start + MaxRecords)
+        return self.call("DescribeAutoScalingGroups", response)
+
+    def describe_tags(self, Filters=None, NextToken=None,
+                      MaxRecords=PAGE_SIZE):
+        estate = self.aws.estate
+        region = self.meta.region_name
+        keys = None
+        for f in Filters or []:
+            if f["Name"] == "key":
+                keys = f["Values"]
+        if keys is None:
+            indexes = estate.indexes()
+        else:
+            indexes = estate.indexes([{"Name": "tag-key", "Values": keys}])
+        # Tags are generated for one page of ASGs at a time, with the token
+        # being the index of the next ASG
+        start = int(NextToken or 0)
+        tags = []
+        position = start
+        for position in range(start, len(indexes)):
+            if len(tags) >= MaxRecords:
+                break
+            tags += [
+                t for t in estate.asg(region, indexes[position])["Tags"]
+                if keys is None or t["Key"] in keys
+            ]
+        else:
+            position = len(indexes)
+        response = {"Tags": tags}
+        if position < len(indexes):
+            response["NextToken"] = str(position)
+        return self.call("DescribeTags", response)
+
+
+class FakeEC2(FakeClient):
+
+    def terminate_instances(self, InstanceIds):
+        return self.call("TerminateInstances", {
+            "TerminatingInstances": [
+                {
+                    "InstanceId": i,
+                    "CurrentState": {"Code": 32, "Name": "shutting-down"},
+                    "PreviousState": {"Code": 16, "Name": "running"},
+                }
+                for i in InstanceIds
+            ]
+        })
+
+
+class FakeSNS(FakeClient):
+
+    def publish(self, TopicArn, Message):
+        return self.call("Publish", {"MessageId": "m"})
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        return self.call("PublishBatch", {
+            "Successful": [
+                {"Id": e["Id"], "MessageId": "m"}
+                for e in PublishBatchRequestEntries
+            ],
+            "Failed": [],
+        })
+
+
+class FakeSQS(FakeClient):
+
+    def send_message_batch(self, QueueUrl, Entries):
+        return self.call("SendMessageBatch", {
+            "Successful": [{"Id": e["Id"]} for e in Entries],
+            "Failed": [],
+        })
+
+
+class FakeEventBridge(FakeClient):
+
+    def put_events(self, Entries):
+        return self.call("PutEvents", {
+            "FailedEntryCount": 0,
+            "Entries": [{"EventId": "e"} for e in Entries],
+        })
+
+
+CLIENTS = {
+    "autoscaling": FakeAutoScaling,
+    "ec2": FakeEC2,
+    "sns": FakeSNS,
+    "sqs": FakeSQS,
+    "events": FakeEventBridge,
+}
+
+
+class FakeAWS:
+
+    def __init__(self, estate, latency=0.0, throttle=0.0, limit=None,
+                 max_attempts=5, retry_base=1.0, max_retry_delay=20.0):
+        self.estate = estate
+        self.latency = latency
+        self.throttle = throttle
+        self.limit = limit
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.max_retry_delay = max_retry_delay
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self.failures = collections.Counter()
+        # (tokens, time) for each (service, region) while limit is set
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def record(self, service, operation):
+        with self.lock:
+            self.calls[service + ":" + operation] += 1
+
+    def record_throttle(self, service, operation):
+        with self.lock:
+            self.throttles[service + ":" + operation] += 1
+
+    def record_failure(self, service, operation):
+        with self.lock:
+            self.failures[service + ":" + operation] += 1
+
+    def is_throttled(self, service, region):
+        with self.lock:
+            if self.throttle > 0 and self.random.random() < self.throttle:
+                return True
+            if self.limit is None:
+                return False
+            now = time.monotonic()
+            capacity = max(1.0, self.limit)
+            tokens, updated = self.buckets.get(
+                (service, region), (capacity, now)
+            )
+            tokens = min(capacity, tokens + (now - updated) * self.limit)
+            throttled = tokens < 1.0
+            if not throttled:
+                tokens -= 1.0
+            self.buckets[(service, region)] = (tokens, now)
+            return throttled
+
+    def get_retry_delay(self, attempts):
+        with self.lock:
+            return self.random.uniform(0, min(
+                self.max_retry_delay, self.retry_base * 2 ** (attempts - 1)
+            ))
+
+    def client(self, service, region_name=None, config=None, **kwargs):
+        return CLIENTS[service](self, service, region_name)
@@ -0,0 +1,129 @@
+"""
+Replays a capture made with chaos_capture (the capture_path setting).
+
+ReplayAWS stands in for the boto3 module like fake_aws.FakeAWS, but serves
+the Auto Scaling Groups from a capture of a real estate.  Listings made with
+the same filters as the captured run get back the captured pages, optionally
+delayed by their recorded latency.  Any other listing (eg with a different
+tag filter, two-phase selection's DescribeTags or describes by name) is
+answered from all the ASGs captured in the region, with the median recorded
+latency.  Terminations and notifications always succeed, as in fake_aws.
+"""
+import collections
+import gzip
+import json
+import statistics
+import time
+
+import fake_aws
+
+
+class Capture:
+
+    def __init__(self, path):
+        self.pages = collections.defaultdict(list)
+        self.asgs = collections.defaultdict(dict)
+        latencies = []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version", None) != 1:
+                raise ValueError("Unknown capture version in " + path)
+            for line in f:
+                page = json.loads(line)
+                region = page["region"]
+                key = (region, self.filters_key(page["filters"]))
+                self.pages[key].append((page["latency"], page["asgs"]))
+                for asg in page["asgs"]:
+                    self.asgs[region][asg["AutoScalingGroupName"]] = asg
+                latencies.append(page["latency"])
+        self.latency = statistics.median(latencies) if latencies else 0.0
+        self.regions = sorted(self.asgs)
+
+    def filters_key(self, filters):
+        return json.dumps(filters, sort_keys=True)
+
+    def count(self):
+        return sum(len(asgs) for asgs in self.asgs.values())
+
+
+def has_tag(asg, keys):
+    return any(t["Key"] in keys for t in asg.get("Tags", []))
+
+
+class ReplayAutoScaling(fake_aws.FakeClient):
+
+    def get_paginator(self, name):
+        return fake_aws.Paginator(self, getattr(self, name))
+
+    def wait(self, latency):
+        if self.aws.recorded_latency:
+            time.sleep(latency)
+
+    def page(self, items, NextToken, MaxRecords, latency):
+        start = int(NextToken or 0)
+        self.wait(latency)
+        response = {"items": items[start:start + MaxRecords]}
+        if start + MaxRecords < len(items):
+            response["NextToken"] = str(start + MaxRecords)
+        return response
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames=None,
+                                     Filters=None, NextToken=None,
+                                     MaxRecords=fake_aws.PAGE_SIZE):
+        capture = self.aws.capture
+        region = self.meta.region_name
+        recorded = capture.pages.get(
+            (region, capture.filters_key(Filters)), None
+        )
+        if AutoScalingGroupNames is None and recorded is not None:
+            # Replay the captured pages as they were
+            index = int(NextToken or 0)
+            latency, asgs = recorded[index]
+            self.wait(latency)
+            response = {"AutoScalingGroups": asgs}
+            if index + 1 < len(recorded):
+                response["NextToken"] = str(index + 1)
+            return self.call("DescribeAutoScalingGroups", response)
+
+        asgs = list(capture.asgs[region].values())
+        if AutoScalingGroupNames is not None:
+            names = set(AutoScalingGroupNames)
+            asgs = [a for a in asgs if a["AutoScalingGroupName"] in names]
+        for f in Filters or []:
+            if f["Name"] == "tag-key":
+                asgs = [a for a in asgs if has_tag(a, f["Values"])]
+        response = self.page(asgs, NextToken, MaxRecords, capture.latency)
+        response["AutoScalingGroups"] = response.pop("items")
+        return self.call("DescribeAutoScalingGroups", response)
+
+    def describe_tags(self, Filters=None, NextToken=None,
+                      MaxRecords=fake_aws.PAGE_SIZE):
+        keys = None
+        for f in Filters or []:
+            if f["Name"] == "key":
+                keys = f["Values"]
+        tags = [
+            dict(t, ResourceId=asg["AutoScalingGroupName"],
+                 ResourceType="auto-scaling-group")
+            for asg in self.aws.capture.asgs[self.meta.region_name].values()
+            for t in asg.get("Tags", [])
+            if keys is None or t["Key"] in keys
+        ]
+        response = self.page(
+            tags, NextToken, MaxRecords, self.aws.capture.latency
+        )
+        response["Tags"] = response.pop("items")
+        return self.call("DescribeTags", response)
+
+
+class ReplayAWS(fake_aws.FakeAWS):
+
+    def __init__(self, capture, recorded_latency=False):
+        super().__init__(None)
+        self.capture = capture
+        self.recorded_latency = recorded_latency
+
+    def client(self, service, region_name=None, config=None, **kwargs):
+        if service == "autoscaling":
+            return ReplayAutoScaling(self, service, region_name)
+        return super().client(service, region_name, config, **kwargs)
@@ -1,12 +1,90 @@
+import json
+import re
 import sys
 
-from troposphere import Parameter, Ref, Template
-from troposphere.cloudwatch import Alarm, MetricDimension
+from troposphere import FindInMap, Parameter, Ref, Sub, Template
+from troposphere.cloudwatch import Alarm, Dashboard, MetricDimension
 from troposphere.sns import Subscription, Topic
 
 
 METRIC_NAMESPACE = "BBC/CHAOS-LAMBDA"
 
+# The timeouts lambda.py gives the function, in seconds: 900 when sharding
+# (the Shards parameter), 30 otherwise.  The stack's LambdaTimeout parameter
+# picks between thresholds generated for each.
+LAMBDA_TIMEOUTS = [30, 900]
+
+# Performance targets the alarms and dashboard are generated from.  Any of
+# them can be overridden by a JSON file of the same shape, given after the
+# template's path (see ALARM_TARGETS in the Makefile).
+TARGETS = {
+    # Fractions of the timeout that invocations shouldn't exceed, by
+    # statistic
+    "duration": {"Maximum": 0.9, "p99": 0.75, "p95": 0.5},
+    # Fractions of the timeout that a region's run shouldn't exceed, by
+    # statistic, from the RegionDuration metric (see the region_metrics
+    # setting), across all regions
+    "region_duration": {"p99": 0.5},
+    # Regions to alarm on separately, each mapped to any statistics that
+    # differ from region_duration, eg {"eu-west-1": {"p99": 0.25}}
+    "regions": {},
+    # Seconds over which the percentiles are taken
+    "period": 3600,
+    # Days without an invocation before the Liveliness alarm goes off
+    "liveliness_days": 7,
+}
+
+
+def load_targets(path):
+    targets = dict(TARGETS)
+    if path is None:
+        return targets
+    with open(path, "r") as f:
+        overrides = json.load(f)
+    for key, value in overrides.items():
+        if key not in TARGETS:
+            raise ValueError("Unknown target " + key)
+        if isinstance(value, dict) and key != "regions":
+            targets[key] = dict(TARGETS[key], **value)
+        else:
+            targets[key] = value
+    return targets
+
+
+# Threshold names for the Thresholds mapping, by fraction of the timeout
+thresholds = {}
+
+
+def get_threshold_name(fraction):
+    # eg 0.75 gives "Fraction7500"
+    name = "Fraction%d" % round(fraction * 10000)
+    thresholds[name] = fraction
+    return name
+
+
+def get_threshold(fraction):
+    # Milliseconds, as Duration and RegionDuration are measured in, for the
+    # stack's LambdaTimeout
+    return FindInMap(
+        "Thresholds", Ref(lambda_timeout), get_threshold_name(fraction)
+    )
+
+
+def get_statistic(statistic):
+    # Percentiles are extended statistics
+    if re.match(r"^p\d+(\.\d+)?$", statistic):
+        return {"ExtendedStatistic": statistic}
+    return {"Statistic": statistic}
+
+
+def get_title(*parts):
+    # eg ("p99", "eu-west-1") gives "P99EuWest1", for logical IDs
+    words = re.split(r"[^A-Za-z0-9]+", " ".join(parts))
+    return "".join(w[:1].upper() + w[1:] for w in words)
+
+
+targets = load_targets(sys.argv[2] if len(sys.argv) > 2 else None)
+
 t = Template()
 
 t.set_description("Chaos Lambda alarms")
@@ -28,6 +106,17 @@ lambda_function_name = t.add_parameter(
     )
 )
 
+lambda_timeout = t.add_parameter(
+    Parameter(
+        "LambdaTimeout",
+        Description="The lambda function's timeout in seconds (900 if its "
+                    "stack has more than one shard)",
+        Default=str(LAMBDA_TIMEOUTS[0]),
+        AllowedValues=[str(timeout) for timeout in LAMBDA_TIMEOUTS],
+        Type="String",
+    )
+)
+
 alarm_topic = t.add_resource(
     Topic(
         "ChaosLambdaAlarmTopic",
@@ -40,6 +129,13 @@ alarm_topic = t.add_resource(
     )
 )
 
+function_dimensions = [
+    MetricDimension(
+        Name="FunctionName",
+        Value=Ref(lambda_function_name)
+    ),
+]
+
 t.add_resource(
     Alarm(
         "ChaosLambdaErrorAlarm",
@@ -51,12 +147,7 @@ t.add_resource(
                          "information.",
         Namespace="AWS/Lambda",
         MetricName="Errors",
-        Dimensions=[
-            MetricDimension(
-                Name="FunctionName",
-                Value=Ref(lambda_function_name)
-            ),
-        ],
+        Dimensions=function_dimensions,
         Statistic="Sum",
         Period="60",
         EvaluationPeriods="1",
@@ -67,55 +158,188 @@ t.add_resource(
     )
 )
 
-t.add_resource(
-    Alarm(
-        "ChaosLambdaDurationAlarm",
-        AlarmName="chaosLambda/LambdaDuration",
-        AlarmDescription="Enters ALARM state because we have functions taking "
-                         "longer than expected. Please adjust the available "
-                         "lambda process time accordingly, then replay any "
-                         " failed events. See 'Duration' section on the "
-                         " following link: "
-                         "http://docs.aws.amazon.com/lambda/latest/dg/"
-                         "monitoring-functions-metrics.html for more "
-                         "information.",
-        Namespace="AWS/Lambda",
-        MetricName="Duration",
-        Dimensions=[
-            MetricDimension(
-                Name="FunctionName",
-                Value=Ref(lambda_function_name)
-            ),
-        ],
-        Statistic="Maximum",
-        Period="60",
-        EvaluationPeriods="1",
-        Threshold="7000",
-        Unit="Milliseconds",
-        ComparisonOperator="GreaterThanThreshold",
-        AlarmActions=[Ref(alarm_topic), ],
+for statistic, fraction in sorted(targets["duration"].items()):
+    if statistic == "Maximum":
+        # Any single invocation, as soon as it finishes
+        title, name, period = "", "", "60"
+    else:
+        title = name = statistic.upper()
+        period = str(targets["period"])
+    t.add_resource(
+        Alarm(
+            "ChaosLambdaDuration" + title + "Alarm",
+            AlarmName="chaosLambda/LambdaDuration" + name,
+            AlarmDescription=Sub("Enters ALARM state because we have "
+                                 "functions taking longer than expected (%s "
+                                 "of %d%% of the ${LambdaTimeout}s timeout). "
+                                 "Please adjust the available lambda process "
+                                 "time accordingly, then replay any failed "
+                                 "events. See 'Duration' section on the "
+                                 "following link: "
+                                 "http://docs.aws.amazon.com/lambda/latest/"
+                                 "dg/monitoring-functions-metrics.html for "
+                                 "more information." % (
+                                     statistic, round(fraction * 100)
+                                 )),
+            Namespace="AWS/Lambda",
+            MetricName="Duration",
+            Dimensions=function_dimensions,
+            Period=period,
+            EvaluationPeriods="1",
+            Threshold=get_threshold(fraction),
+            Unit="Milliseconds",
+            ComparisonOperator="GreaterThanThreshold",
+            TreatMissingData="notBreaching",
+            AlarmActions=[Ref(alarm_topic), ],
+            **get_statistic(statistic)
+        )
     )
-)
 
-'''
+region_targets = [(None, targets["region_duration"])] + [
+    (region, dict(targets["region_duration"], **overrides))
+    for region, overrides in sorted(targets["regions"].items())
+]
+for region, region_duration in region_targets:
+    for statistic, fraction in sorted(region_duration.items()):
+        if region is None:
+            # Published without dimensions as well as by region
+            title, name, dimensions = "", "", []
+            scope = "a region"
+        else:
+            title, name = get_title(region), "/" + region
+            dimensions = [MetricDimension(Name="Region", Value=region)]
+            scope = region
+        t.add_resource(
+            Alarm(
+                "ChaosLambdaRegionDuration" + get_title(statistic) + title +
+                "Alarm",
+                AlarmName="chaosLambda/RegionDuration" + statistic.upper() +
+                          name,
+                AlarmDescription=Sub("Enters ALARM state because Chaos "
+                                     "Lambda's run of %s is taking longer "
+                                     "than expected (%s of %d%% of the "
+                                     "${LambdaTimeout}s timeout), so the "
+                                     "invocations may soon time out. Needs "
+                                     "the region_metrics setting." % (
+                                         scope, statistic,
+                                         round(fraction * 100)
+                                     )),
+                Namespace=METRIC_NAMESPACE,
+                MetricName="RegionDuration",
+                Dimensions=dimensions,
+                Period=str(targets["period"]),
+                EvaluationPeriods="1",
+                Threshold=get_threshold(fraction),
+                Unit="Milliseconds",
+                ComparisonOperator="GreaterThanThreshold",
+                TreatMissingData="notBreaching",
+                AlarmActions=[Ref(alarm_topic), ],
+                **get_statistic(statistic)
+            )
+        )
+
 t.add_resource(
     Alarm(
         "Liveliness",
         AlarmName="chaosLambda/Liveliness",
         AlarmDescription="Enters ALARM state if the Chaos Lambda hasn't "
-                         "triggered within a seven day window.",
-        Namespace=METRIC_NAMESPACE,
-        MetricName="triggered",
-        EvaluationPeriods="1",
-        Period="604800",
-        Statistic="SampleCount",
+                         "been invoked within a %d day window." %
+                         targets["liveliness_days"],
+        Namespace="AWS/Lambda",
+        MetricName="Invocations",
+        Dimensions=function_dimensions,
+        Period="86400",
+        EvaluationPeriods=str(targets["liveliness_days"]),
+        DatapointsToAlarm=str(targets["liveliness_days"]),
+        Statistic="Sum",
         ComparisonOperator="LessThanThreshold",
         Threshold="1",
-        Unit="None",
+        Unit="Count",
+        # No invocations at all means no data
+        TreatMissingData="breaching",
         AlarmActions=[Ref(alarm_topic)],
     )
 )
-'''
+
+
+def get_annotations(fractions):
+    # Values are substituted into the dashboard's body from the mapping
+    return [
+        {"label": label, "value": "${%s}" % get_threshold_name(fraction)}
+        for label, fraction in sorted(fractions.items())
+    ]
+
+
+def get_widget(title, metrics, y, annotations=None, stat="Sum"):
+    properties = {
+        "title": title,
+        "region": "${AWS::Region}",
+        "view": "timeSeries",
+        "stat": stat,
+        "period": 300,
+        "metrics": metrics,
+    }
+    if annotations is not None:
+        properties["annotations"] = {"horizontal": annotations}
+    return {
+        "type": "metric", "x": 0, "y": y, "width": 24, "height": 6,
+        "properties": properties,
+    }
+
+
+def get_function_metric(name, **options):
+    metric = ["AWS/Lambda", name, "FunctionName", "${LambdaFunctionName}"]
+    return metric + [options] if len(options) != 0 else metric
+
+
+dashboard = {"widgets": [
+    get_widget("Invocation duration (ms)", [
+        get_function_metric("Duration", stat=stat)
+        for stat in ["p50", "p95", "p99", "Maximum"]
+    ], 0, get_annotations(dict(
+        targets["duration"], Timeout=1.0
+    ))),
+    get_widget("Invocations", [
+        get_function_metric(name)
+        for name in ["Invocations", "Errors", "Throttles"]
+    ], 6),
+    get_widget("Region duration (ms)", [
+        [METRIC_NAMESPACE, "RegionDuration", {"label": "All regions"}]
+    ] + [
+        [METRIC_NAMESPACE, "RegionDuration", "Region", region]
+        for region in sorted(targets["regions"])
+    ], 12, get_annotations(targets["region_duration"]), stat="p99"),
+    get_widget("API throttles", [[{
+        "expression": "SEARCH('{%s,Service,Operation,Region} "
+                      "MetricName=\"ApiThrottles\"', 'Sum', 300)" %
+                      METRIC_NAMESPACE,
+        "id": "throttles",
+    }]], 18),
+]}
+
+# The annotations' values are numbers, so their placeholders lose their
+# quotes
+dashboard_body = re.sub(
+    r'"(\$\{Fraction\d+\})"', r"\1", json.dumps(dashboard, sort_keys=True)
+)
+t.add_resource(
+    Dashboard(
+        "ChaosLambdaDashboard",
+        DashboardName=Sub("${LambdaFunctionName}"),
+        DashboardBody=Sub(dashboard_body, **dict(
+            (name, get_threshold(fraction))
+            for name, fraction in thresholds.items()
+        )),
+    )
+)
+
+t.add_mapping("Thresholds", dict(
+    (str(timeout), dict(
+        (name, str(int(round(fraction * timeout * 1000))))
+        for name, fraction in sorted(thresholds.items())
+    ))
+    for timeout in LAMBDA_TIMEOUTS
+))
 
 template = t.to_json(indent=4)
 if len(sys.argv) > 1:
@@ -0,0 +1,84 @@
+import sys
+
+from troposphere import GetAtt, Parameter, Sub, Template
+from troposphere.events import Rule, Target
+from troposphere.iam import Policy, Role
+
+
+t = Template()
+t.set_description(
+    "Forwards Auto Scaling and EC2 events to a Chaos Lambda inventory in "
+    "another region"
+)
+
+t.add_parameter(Parameter(
+    "InventoryRegion",
+    Description="Region of the Chaos Lambda stack that keeps the inventory",
+    Type="String"
+))
+
+event_bus = Sub(
+    "arn:aws:events:${InventoryRegion}:${AWS::AccountId}:event-bus/default"
+)
+
+forwarder_role = t.add_resource(Role(
+    "ChaosLambdaForwarderRole",
+    AssumeRolePolicyDocument={
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Effect": "Allow",
+            "Principal": {
+                "Service": ["events.amazonaws.com"]
+            },
+            "Action": ["sts:AssumeRole"]
+        }]
+    },
+    Policies=[Policy(
+        PolicyName="ChaosLambdaForwarderPolicy",
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": ["events:PutEvents"],
+                "Resource": event_bus
+            }]
+        }
+    )]
+))
+
+# The same patterns as the inventory rules in lambda.py
+forwarded_rules = [
+    ("ChaosLambdaForwarderRule", {
+        "source": ["aws.autoscaling"],
+        "detail-type": [
+            "EC2 Instance Launch Successful",
+            "EC2 Instance Terminate Successful",
+            "AWS API Call via CloudTrail"
+        ]
+    }),
+    ("ChaosLambdaForwarderInstanceRule", {
+        "source": ["aws.ec2"],
+        "detail-type": ["EC2 Instance State-change Notification"],
+        "detail": {"state": ["shutting-down", "terminated"]}
+    }),
+]
+for name, pattern in forwarded_rules:
+    t.add_resource(Rule(
+        name,
+        Description="Forward events to the Chaos Lambda inventory",
+        State="ENABLED",
+        EventPattern=pattern,
+        Targets=[
+            Target(
+                Arn=event_bus,
+                Id=name + "Target",
+                RoleArn=GetAtt(forwarder_role, "Arn")
+            )
+        ]
+    ))
+
+template = t.to_json(indent=4)
+if len(sys.argv) > 1:
+    open(sys.argv[1], "w").write(template + "\n")
+else:
+    print(template)
@@ -1,20 +1,23 @@
-import re
 import sys
 
-from troposphere import GetAtt, Output, Parameter, Ref, Sub, Template
-from troposphere.awslambda import Code, Environment, Function, Permission
+from troposphere import (
+    Equals, GetAtt, If, Not, NoValue, Output, Parameter, Ref, Sub, Template
+)
+from troposphere.awslambda import (
+    Code, Environment, Function, Permission, TracingConfig
+)
+from troposphere.dynamodb import (
+    AttributeDefinition, KeySchema, Table
+)
 from troposphere.logs import LogGroup
-from troposphere.iam import Role, Policy
+from troposphere.iam import Role, Policy, PolicyType
 from troposphere.events import Rule, Target
 from troposphere.sns import Topic
 
 
 if len(sys.argv) > 2:
+    # The inline index.py built by tools/package.py
     source = open(sys.argv[2], "r").read()
-    # Reclaim a few bytes (maximum size is 4096!) by converting four space
-    # indents to single space indents
-    indent_re = re.compile(r"^((?:    ){1,})", re.MULTILINE)
-    source = indent_re.sub(lambda m: " " * (len(m.group(1)) // 4), source)
 else:
     source = None
 
@@ -37,7 +40,10 @@ if source is None:
     lambda_code = Code(S3Bucket=Ref(s3_bucket), S3Key=Ref(s3_key))
     module_name = "chaos"
 else:
-    lambda_code = Code(ZipFile=source)
+    # troposphere still applies the old 4096 character limit to ZipFile, but
+    # CloudFormation now takes inline code up to the template's own size
+    # limit
+    lambda_code = Code(ZipFile=source).no_validation()
     module_name = "index"
 
 chaos_schedule = t.add_parameter(Parameter(
@@ -56,12 +62,139 @@ default_probability = t.add_parameter(Parameter(
     Type="Number"
 ))
 
+tag_filter = t.add_parameter(Parameter(
+    "TagFilter",
+    Description="When DefaultProbability is 0.0, only fetch ASGs that have "
+                "a chaos-lambda-termination tag",
+    Default="false",
+    AllowedValues=["true", "false"],
+    Type="String"
+))
+
+two_phase = t.add_parameter(Parameter(
+    "TwoPhase",
+    Description="When DefaultProbability is 0.0, roll for each tagged ASG "
+                "before fetching its instances",
+    Default="false",
+    AllowedValues=["true", "false"],
+    Type="String"
+))
+
 regions = t.add_parameter(Parameter(
     "Regions",
     Description="Override default region with comma-separated list of regions",
     Type="String"
 ))
 
+concurrency = t.add_parameter(Parameter(
+    "Concurrency",
+    Description="Number of regions to process at the same time",
+    Default=1,
+    MinValue=1,
+    Type="Number"
+))
+
+region_timeout = t.add_parameter(Parameter(
+    "RegionTimeout",
+    Description="Seconds after which a region's targets are no longer "
+                "terminated (blank for no limit)",
+    Default="",
+    Type="String"
+))
+
+if source is None:
+    # The inventory handler lives in its own module, so it's only available
+    # when the code comes from the zip file
+    inventory = t.add_parameter(Parameter(
+        "Inventory",
+        Description="Keep an event-driven inventory of ASGs rather than "
+                    "listing them all on every run",
+        Default="false",
+        AllowedValues=["true", "false"],
+        Type="String"
+    ))
+    t.add_condition("InventoryEnabled", Equals(Ref(inventory), "true"))
+
+    # As is the cross-account support
+    accounts = t.add_parameter(Parameter(
+        "Accounts",
+        Description="Comma-separated list of accounts to target by assuming "
+                    "AccountRole in each (blank for this account only)",
+        Default="",
+        Type="String"
+    ))
+    account_role = t.add_parameter(Parameter(
+        "AccountRole",
+        Description="Name of the role to assume in each of the Accounts",
+        Default="chaos-lambda",
+        Type="String"
+    ))
+    t.add_condition(
+        "AccountsEnabled", Not(Equals(Ref(accounts), ""))
+    )
+
+    # And sharded runs
+    shards = t.add_parameter(Parameter(
+        "Shards",
+        Description="Number of worker invocations to split each region "
+                    "between (1 to process each region in one invocation)",
+        Default=1,
+        MinValue=1,
+        Type="Number"
+    ))
+    t.add_condition("ShardsEnabled", Not(Equals(Ref(shards), 1)))
+
+    # And checkpoints
+    checkpoints = t.add_parameter(Parameter(
+        "Checkpoints",
+        Description="Save the regions left by a run that runs out of time, "
+                    "so that the next run resumes them",
+        Default="false",
+        AllowedValues=["true", "false"],
+        Type="String"
+    ))
+    t.add_condition(
+        "CheckpointsEnabled", Equals(Ref(checkpoints), "true")
+    )
+
+    # And pipelined regions
+    pipeline = t.add_parameter(Parameter(
+        "Pipeline",
+        Description="Terminate each region's targets while its ASGs are "
+                    "still being listed",
+        Default="false",
+        AllowedValues=["true", "false"],
+        Type="String"
+    ))
+
+    # And recovery tracking, which needs a function of its own
+    recovery = t.add_parameter(Parameter(
+        "RecoveryTracking",
+        Description="Measure how long each ASG takes to recover after a "
+                    "termination, in a follow-up invocation",
+        Default="false",
+        AllowedValues=["true", "false"],
+        Type="String"
+    ))
+    t.add_condition("RecoveryEnabled", Equals(Ref(recovery), "true"))
+
+max_terminations = t.add_parameter(Parameter(
+    "MaxTerminations",
+    Description="Maximum number of instances terminated by each run across "
+                "all regions (blank for no limit)",
+    Default="",
+    Type="String"
+))
+
+rate_limit = t.add_parameter(Parameter(
+    "RateLimit",
+    Description="Most AWS API calls per second to make to each service in "
+                "each region, backing off while throttled (blank for no "
+                "limit)",
+    Default="",
+    Type="String"
+))
+
 log_retention_period = t.add_parameter(Parameter(
     "LogRetentionPeriod",
     Description="Log retention period",
@@ -69,6 +202,16 @@ log_retention_period = t.add_parameter(Parameter(
     Type="Number"
 ))
 
+trace_exporter = t.add_parameter(Parameter(
+    "TraceExporter",
+    Description="Where to send a trace of each run's regions, listings and "
+                "terminations",
+    Default="none",
+    AllowedValues=["none", "log", "xray"],
+    Type="String"
+))
+t.add_condition("XRayEnabled", Equals(Ref(trace_exporter), "xray"))
+
 termination_topic = t.add_resource(
     Topic("ChaosLambdaTerminationTopic")
 )
@@ -92,7 +235,8 @@ lambda_policy = Policy(
                 "Action": [
                     "ses:SendEmail",
                     "ec2:TerminateInstances",
-                    "autoscaling:DescribeAutoScalingGroups"
+                    "autoscaling:DescribeAutoScalingGroups",
+                    "autoscaling:DescribeTags"
                 ],
                 "Resource": "*"
             },
@@ -123,6 +267,163 @@ lambda_role = Role(
     Policies=[lambda_policy]
 )
 t.add_resource(lambda_role)
+t.add_resource(PolicyType(
+    "ChaosLambdaXRayPolicy",
+    Condition="XRayEnabled",
+    PolicyName="ChaosLambdaXRayPolicy",
+    PolicyDocument={
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Effect": "Allow",
+            "Action": [
+                "xray:PutTelemetryRecords",
+                "xray:PutTraceSegments"
+            ],
+            "Resource": "*"
+        }]
+    },
+    Roles=[Ref(lambda_role)]
+))
+
+if source is None:
+    inventory_table = t.add_resource(Table(
+        "ChaosLambdaInventoryTable",
+        Condition="InventoryEnabled",
+        AttributeDefinitions=[
+            AttributeDefinition(AttributeName="region", AttributeType="S"),
+            AttributeDefinition(AttributeName="key", AttributeType="S"),
+        ],
+        KeySchema=[
+            KeySchema(AttributeName="region", KeyType="HASH"),
+            KeySchema(AttributeName="key", KeyType="RANGE"),
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    ))
+    t.add_resource(PolicyType(
+        "ChaosLambdaInventoryPolicy",
+        Condition="InventoryEnabled",
+        PolicyName="ChaosLambdaInventoryPolicy",
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": [
+                    "dynamodb:BatchWriteItem",
+                    "dynamodb:GetItem",
+                    "dynamodb:PutItem",
+                    "dynamodb:Query"
+                ],
+                "Resource": GetAtt(inventory_table, "Arn")
+            }, {
+                "Effect": "Allow",
+                "Action": ["autoscaling:DescribeAutoScalingInstances"],
+                "Resource": "*"
+            }]
+        },
+        Roles=[Ref(lambda_role)]
+    ))
+    inventory_table_name = If(
+        "InventoryEnabled", Ref(inventory_table), ""
+    )
+    t.add_resource(PolicyType(
+        "ChaosLambdaAccountsPolicy",
+        Condition="AccountsEnabled",
+        PolicyName="ChaosLambdaAccountsPolicy",
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": ["sts:AssumeRole"],
+                "Resource": Sub("arn:aws:iam::*:role/${AccountRole}")
+            }]
+        },
+        Roles=[Ref(lambda_role)]
+    ))
+    t.add_resource(PolicyType(
+        "ChaosLambdaShardsPolicy",
+        Condition="ShardsEnabled",
+        PolicyName="ChaosLambdaShardsPolicy",
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": ["lambda:InvokeFunction"],
+                "Resource": Sub(
+                    "arn:aws:lambda:${AWS::Region}:${AWS::AccountId}:"
+                    "function:${AWS::StackName}-function"
+                )
+            }]
+        },
+        Roles=[Ref(lambda_role)]
+    ))
+    t.add_resource(PolicyType(
+        "ChaosLambdaRecoveryPolicy",
+        Condition="RecoveryEnabled",
+        PolicyName="ChaosLambdaRecoveryPolicy",
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": ["lambda:InvokeFunction"],
+                "Resource": Sub(
+                    "arn:aws:lambda:${AWS::Region}:${AWS::AccountId}:"
+                    "function:${AWS::StackName}-recovery"
+                )
+            }]
+        },
+        Roles=[Ref(lambda_role)]
+    ))
+    checkpoint_table = t.add_resource(Table(
+        "ChaosLambdaCheckpointTable",
+        Condition="CheckpointsEnabled",
+        AttributeDefinitions=[
+            AttributeDefinition(AttributeName="region", AttributeType="S"),
+            AttributeDefinition(AttributeName="key", AttributeType="S"),
+        ],
+        KeySchema=[
+            KeySchema(AttributeName="region", KeyType="HASH"),
+            KeySchema(AttributeName="key", KeyType="RANGE"),
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    ))
+    t.add_resource(PolicyType(
+        "ChaosLambdaCheckpointPolicy",
+        Condition="CheckpointsEnabled",
+        PolicyName="ChaosLambdaCheckpointPolicy",
+        PolicyDocument={
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": [
+                    "dynamodb:BatchWriteItem",
+                    "dynamodb:GetItem"
+                ],
+                "Resource": GetAtt(checkpoint_table, "Arn")
+            }]
+        },
+        Roles=[Ref(lambda_role)]
+    ))
+    zip_variables = {
+        "accounts": Ref(accounts),
+        "account_role": Ref(account_role),
+        "checkpoint_table": If(
+            "CheckpointsEnabled", Ref(checkpoint_table), ""
+        ),
+        "pipeline": Ref(pipeline),
+        "recovery": Ref(recovery),
+        "recovery_function": If(
+            "RecoveryEnabled", Sub("${AWS::StackName}-recovery"), ""
+        ),
+        "shards": Ref(shards),
+    }
+    # The coordinator waits for its workers, so needs longer to run.  The
+    # alarms template has thresholds for both (see LAMBDA_TIMEOUTS there).
+    # They're strings so that they can also be output.
+    lambda_timeout = If("ShardsEnabled", "900", "30")
+else:
+    inventory_table_name = ""
+    zip_variables = {}
+    lambda_timeout = "30"
 
 lambda_log_group = t.add_resource(LogGroup(
     "ChaosLambdaLogGroup",
@@ -130,21 +431,36 @@ lambda_log_group = t.add_resource(LogGroup(
     RetentionInDays=Ref(log_retention_period),
 ))
 
+lambda_variables = dict(zip_variables, **{
+    "concurrency": Ref(concurrency),
+    "inventory_table": inventory_table_name,
+    "max_terminations": Ref(max_terminations),
+    "prewarm": "true",
+    "probability": Ref(default_probability),
+    "rate_limit": Ref(rate_limit),
+    "region_metrics": "true",
+    "region_timeout": Ref(region_timeout),
+    "regions": Ref(regions),
+    "tag_filter": Ref(tag_filter),
+    "termination_topic_arn": Ref(termination_topic),
+    "trace_exporter": Ref(trace_exporter),
+    "two_phase": Ref(two_phase),
+})
+
 lambda_function = t.add_resource(Function(
     "ChaosLambdaFunction",
     Description="CloudFormation Lambda",
     FunctionName=Sub("${AWS::StackName}-function"),
     Code=lambda_code,
-    Environment=Environment(Variables={
-        "probability": Ref(default_probability),
-        "regions": Ref(regions),
-        "termination_topic_arn": Ref(termination_topic),
-    }),
+    Environment=Environment(Variables=lambda_variables),
     Handler=module_name + ".handler",
     MemorySize=128,
     Role=GetAtt(lambda_role, "Arn"),
     Runtime="python3.11",
-    Timeout=30,
+    Timeout=lambda_timeout,
+    TracingConfig=If(
+        "XRayEnabled", TracingConfig(Mode="Active"), NoValue
+    ),
     DependsOn=lambda_log_group.title
 ))
 
@@ -165,11 +481,105 @@ t.add_resource(Permission(
     Action="lambda:InvokeFunction"
 ))
 
+if source is None:
+    # The recovery tracker polls for up to 15 minutes at a time, so it's a
+    # function of its own rather than raising the scheduled function's timeout
+    recovery_log_group = t.add_resource(LogGroup(
+        "ChaosLambdaRecoveryLogGroup",
+        Condition="RecoveryEnabled",
+        LogGroupName=Sub("/aws/lambda/${AWS::StackName}-recovery"),
+        RetentionInDays=Ref(log_retention_period),
+    ))
+    t.add_resource(Function(
+        "ChaosLambdaRecoveryFunction",
+        Condition="RecoveryEnabled",
+        Description="Tracks how long ASGs take to recover from Chaos Lambda",
+        FunctionName=Sub("${AWS::StackName}-recovery"),
+        Code=lambda_code,
+        Environment=Environment(Variables=lambda_variables),
+        Handler="chaos.handler",
+        MemorySize=128,
+        Role=GetAtt(lambda_role, "Arn"),
+        Runtime="python3.11",
+        Timeout=900,
+        DependsOn=recovery_log_group.title
+    ))
+    inventory_log_group = t.add_resource(LogGroup(
+        "ChaosLambdaInventoryLogGroup",
+        Condition="InventoryEnabled",
+        LogGroupName=Sub("/aws/lambda/${AWS::StackName}-inventory"),
+        RetentionInDays=Ref(log_retention_period),
+    ))
+    inventory_function = t.add_resource(Function(
+        "ChaosLambdaInventoryFunction",
+        Condition="InventoryEnabled",
+        Description="Keeps the Chaos Lambda ASG inventory up to date",
+        FunctionName=Sub("${AWS::StackName}-inventory"),
+        Code=lambda_code,
+        Environment=Environment(Variables={
+            "inventory_table": Ref(inventory_table),
+        }),
+        Handler="chaos_inventory.handler",
+        MemorySize=128,
+        Role=GetAtt(lambda_role, "Arn"),
+        Runtime="python3.11",
+        Timeout=30,
+        DependsOn=inventory_log_group.title
+    ))
+    # Rules only see their own region's events, so other regions forward
+    # theirs with templates/inventory_forwarder.json, which has the same
+    # patterns
+    inventory_rules = [
+        ("ChaosLambdaInventoryRule",
+         "Send Auto Scaling changes to the Chaos Lambda inventory", {
+             "source": ["aws.autoscaling"],
+             "detail-type": [
+                 "EC2 Instance Launch Successful",
+                 "EC2 Instance Terminate Successful",
+                 "AWS API Call via CloudTrail"
+             ]
+         }),
+        ("ChaosLambdaInventoryInstanceRule",
+         "Send EC2 terminations to the Chaos Lambda inventory", {
+             "source": ["aws.ec2"],
+             "detail-type": ["EC2 Instance State-change Notification"],
+             "detail": {"state": ["shutting-down", "terminated"]}
+         }),
+    ]
+    for name, description, pattern in inventory_rules:
+        inventory_rule = t.add_resource(Rule(
+            name,
+            Condition="InventoryEnabled",
+            Description=description,
+            State="ENABLED",
+            EventPattern=pattern,
+            Targets=[
+                Target(
+                    Arn=GetAtt(inventory_function, "Arn"),
+                    Id=name + "Target"
+                )
+            ]
+        ))
+        t.add_resource(Permission(
+            name + "Permission",
+            Condition="InventoryEnabled",
+            FunctionName=GetAtt(inventory_function, "Arn"),
+            SourceArn=GetAtt(inventory_rule, "Arn"),
+            Principal="events.amazonaws.com",
+            Action="lambda:InvokeFunction"
+        ))
+
 t.add_output(Output(
     "ChaosLambdaFunctionOutput",
     Value=Ref(lambda_function),
     Description="The Chaos Lambda Function"
 ))
+t.add_output(Output(
+    "ChaosLambdaTimeoutOutput",
+    Value=lambda_timeout,
+    Description="The Chaos Lambda Function's timeout, for the alarms "
+                "template's LambdaTimeout"
+))
 t.add_output(Output(
     "ChaosLambdaRuleOutput",
     Value=Ref(chaos_lambda_rule),
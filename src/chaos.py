@@ -1,18 +1,200 @@
+import concurrent.futures
+import functools
+import heapq
 import json
+import math
 import os
 import random
+import sys
+import threading
 import time
+import zlib
 
-import boto3
+
+# boto3 accounts for most of the lambda's cold start time, so it isn't
+# imported until the first client is needed (see import_boto3 and prewarm)
+boto3 = None
+Config = None
 
 
 PROBABILITY_TAG = "chaos-lambda-termination"
 DEFAULT_PROBABILITY = 1.0 / 6.0
+TAG_PREFIX = "chaos-lambda-"
+# Maximum number of names in one DescribeAutoScalingGroups call
+ASG_NAME_BATCH_SIZE = 100
+
+# Clients are cached for the lifetime of the container, so warm invocations
+# skip endpoint resolution and service model loading
+clients = {}
+clients_lock = threading.Lock()
+client_stats = {"hits": 0, "created": 0, "create_time": 0.0}
+
+# Set while the pages seen by get_all_asgs are being captured (see
+# chaos_capture)
+capture = {"writer": None}
+
+# Once the run's deadline (a time.monotonic() value) has passed, listings
+# stop before their next page and regions that haven't started are deferred
+run_deadline = {"time": None}
+DEFAULT_DEADLINE_MARGIN = 5.0
+# The NextToken the current thread's listing should resume from, and the one
+# it stopped at if it ran out of time (see chaos_checkpoint).  Also holds
+# the time.monotonic() by which the current region's selection has to
+# finish (see region_budget), and whether it ran out.
+listing = threading.local()
+# Region statuses, from the one that takes precedence when summarising
+# several regions or shards
+STATUSES = ("error", "timeout", "partial", "deferred", "ok")
+# Statuses of regions whose samples count towards max_terminations: a
+# partial region's targets were selected before the deadline, and would be
+# terminated without a cap
+SAMPLED_STATUSES = ("ok", "partial")
+
+# Set while the invocation is being traced (see chaos_trace)
+tracing = {"tracer": None}
+
+# Log lines are buffered and written in batches rather than printed (and
+# flushed) one at a time.  The formatted timestamp only changes once a
+# second, so it's cached too.
+LOG_BUFFER_LINES = 100
+log_buffer = []
+log_lock = threading.Lock()
+log_clock = {"second": None, "timestamp": ""}
+log_settings = {"json": False}
+# Holds the region (and account, for other accounts) being processed by the
+# current thread, for JSON lines
+log_context = threading.local()
+
+
+def get_timestamp():
+    second = int(time.time())
+    if second != log_clock["second"]:
+        log_clock["timestamp"] = time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime(second)
+        )
+        log_clock["second"] = second
+    return log_clock["timestamp"]
+
+
+def write_log():
+    # Must be called with log_lock held
+    if len(log_buffer) != 0:
+        sys.stdout.write("\n".join(log_buffer) + "\n")
+        sys.stdout.flush()
+        del log_buffer[:]
+
+
+def append_log(make_line):
+    with log_lock:
+        log_buffer.append(make_line(get_timestamp()))
+        if len(log_buffer) >= LOG_BUFFER_LINES:
+            write_log()
+
+
+def flush_log():
+    with log_lock:
+        write_log()
+
+
+def log(event, *args, **fields):
+    args = [str(a) for a in args]
+    if not log_settings["json"]:
+        append_log(lambda timestamp: " ".join([timestamp, event] + args))
+        return
+
+    record = {"event": event}
+    for name in ("region", "account"):
+        value = getattr(log_context, name, None)
+        if value is not None:
+            record[name] = value
+    record.update(fields)
+    record["message"] = " ".join(args)
+
+    def make_line(timestamp):
+        record["timestamp"] = timestamp
+        return json.dumps(record)
+
+    append_log(make_line)
+
+
+def log_record(record):
+    # Writes a record (eg an EMF metric) as a JSON line in either format
+    line = json.dumps(record)
+    append_log(lambda timestamp: line)
+
+
+class NoSpan:
+    # Stands in for a chaos_trace.Span when tracing is off, so that spans
+    # cost next to nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def discard(self):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def span(name, **attributes):
+    # A context manager timing the work done in it, as part of whichever
+    # span the current thread is in
+    tracer = tracing["tracer"]
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, attributes)
+
+
+def current_span():
+    tracer = tracing["tracer"]
+    if tracer is None:
+        return NO_SPAN
+    return tracer.current()
+
 
+def resume_span(parent):
+    # Places the spans of the current thread under a span of the thread
+    # that started it
+    tracer = tracing["tracer"]
+    if tracer is not None:
+        tracer.resume(parent)
 
-def log(*args):
-    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    print(timestamp, *args)
+
+def count_api_call(**kwargs):
+    # botocore before-call handler, registered on every client while
+    # tracing is configured
+    tracer = tracing["tracer"]
+    if tracer is not None:
+        tracer.current().count_call()
+
+
+def trace_pages(pages, key, **attributes):
+    # Gives the fetch of each page a span of its own, with the number of
+    # items (eg ASGs) on it
+    if tracing["tracer"] is None:
+        return pages
+    return iter_traced_pages(pages, key, attributes)
+
+
+def iter_traced_pages(pages, key, attributes):
+    pages = iter(pages)
+    while True:
+        with span("list", **attributes) as s:
+            page = next(pages, None)
+            if page is None:
+                s.discard()
+            else:
+                s.set(items=len(page.get(key, [])))
+        if page is None:
+            return
+        yield page
 
 
 def get_asg_tag(asg, name, default=None):
@@ -23,11 +205,18 @@ def get_asg_tag(asg, name, default=None):
     return default
 
 
-def safe_float(s, default):
-    try:
-        return float(s)
-    except ValueError:
-        return default
+def get_policy(value):
+    # The tag value compiled (once per distinct value, see chaos_policy), or
+    # None if it isn't a valid policy
+    import chaos_policy
+    return chaos_policy.compile_policy(value)
+
+
+def get_asg_policy(asg):
+    value = get_asg_tag(asg, PROBABILITY_TAG, None)
+    if value is None:
+        return None
+    return get_policy(value)
 
 
 def get_asg_probability(asg, default):
@@ -35,15 +224,69 @@ def get_asg_probability(asg, default):
     if value is None:
         return default
 
-    probability = safe_float(value, None)
-    if probability is not None and 0.0 <= probability <= 1.0:
-        return probability
+    policy = get_policy(value)
+    if policy is not None:
+        return policy.get_probability(default)
 
     asg_name = asg["AutoScalingGroupName"]
-    log("bad-probability", "[" + value + "]", "in", asg_name)
+    log("bad-probability", "[" + value + "]", "in", asg_name, asg=asg_name)
     return default
 
 
+def get_asg_weight(asg, default):
+    # As get_asg_probability, but without logging bad values a second time
+    policy = get_asg_policy(asg)
+    if policy is None:
+        return default
+    return policy.get_probability(default)
+
+
+def choose_instance_id(asg, instances):
+    # Returns None if the ASG's policy leaves all of its instances alone
+    policy = get_asg_policy(asg)
+    if policy is None:
+        instance = random.choice(instances)
+    else:
+        instance = policy.choose_instance(instances)
+    if instance is None:
+        return None
+    return instance.get("InstanceId", None)
+
+
+class TargetReservoir:
+    """
+    Keeps a weighted random sample of at most `size` of the targets added
+    to it, in a single pass and O(size) memory, using Efraimidis and
+    Spirakis' A-Res algorithm: each target gets the key u ** (1 / weight)
+    for a uniform random u, and the targets with the largest keys are kept.
+    Keys are compared as logarithms so that small weights can't underflow.
+    Samples taken independently can be merged by pushing their keyed items
+    into another reservoir.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.heap = []
+        self.added = 0
+
+    def add(self, target, weight):
+        self.added += 1
+        if weight > 0.0:
+            self.push(math.log(1.0 - random.random()) / weight, target)
+
+    def push(self, key, target):
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, (key, target))
+        elif self.size > 0 and key > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (key, target))
+
+    def items(self):
+        return sorted(self.heap, reverse=True)
+
+    def targets(self):
+        return [target for (key, target) in self.items()]
+
+
 def get_asg_instance_id(asg, default):
     instances = asg.get("Instances", [])
     if len(instances) == 0:
@@ -53,80 +296,902 @@ def get_asg_instance_id(asg, default):
     if random.random() >= probability:
         return None
     else:
-        return random.choice(instances).get("InstanceId", None)
+        return choose_instance_id(asg, instances)
+
+
+def get_asg_filters(default_probability):
+    # With a default probability of zero only tagged ASGs can be targeted, so
+    # DescribeAutoScalingGroups can be asked to leave out all the others.
+    # Tag keys are matched case sensitively by the API, so this is opt-in.
+    if default_probability == 0.0 and get_env_flag("tag_filter"):
+        return [{"Name": "tag-key", "Values": [PROBABILITY_TAG]}]
+    return None
+
+
+def use_two_phase_selection(default_probability):
+    # Only ASGs with a probability tag can be hit when the default is zero,
+    # so DescribeTags can list every candidate without instance data.  As
+    # with get_asg_filters, tag keys are matched case sensitively.
+    return default_probability == 0.0 and get_env_flag("two_phase")
+
+
+def use_pipeline():
+    # Overlaps fetching, selection and termination within a region (see
+    # chaos_pipeline)
+    return get_env_flag("pipeline")
+
+
+def get_tagged_asgs(autoscaling):
+    paginator = autoscaling.get_paginator("describe_tags")
+    pages = trace_pages(paginator.paginate(
+        Filters=[{"Name": "key", "Values": [PROBABILITY_TAG]}]
+    ), "Tags", operation="DescribeTags")
+    asgs = {}
+    for response in pages:
+        for tag in response.get("Tags", []):
+            if tag.get("ResourceType", None) != "auto-scaling-group":
+                continue
+            name = tag["ResourceId"]
+            asg = asgs.get(name, None)
+            if asg is None:
+                asg = asgs[name] = {"AutoScalingGroupName": name, "Tags": []}
+            asg["Tags"].append(tag)
+    return list(asgs.values())
 
 
-def get_all_asgs(autoscaling):
+def get_asgs_by_name(autoscaling, names):
     paginator = autoscaling.get_paginator("describe_auto_scaling_groups")
-    for response in paginator.paginate():
-        for asg in response.get("AutoScalingGroups", []):
-            yield asg
+    for i in range(0, len(names), ASG_NAME_BATCH_SIZE):
+        pages = trace_pages(paginator.paginate(
+            AutoScalingGroupNames=names[i:i + ASG_NAME_BATCH_SIZE],
+            MaxRecords=ASG_NAME_BATCH_SIZE
+        ), "AutoScalingGroups", operation="DescribeAutoScalingGroups")
+        for response in pages:
+            for asg in response.get("AutoScalingGroups", []):
+                yield asg
 
 
-def get_targets(autoscaling, default_probability):
+def get_shard(asg_name, count):
+    # Stable across invocations and processes, unlike hash()
+    return zlib.crc32(asg_name.encode("utf-8")) % count
+
+
+def in_shard(asgs, shard):
+    # shard is an (index, count) pair, or None for every ASG
+    if shard is None:
+        return asgs
+    index, count = shard
+    return (
+        asg for asg in asgs
+        if get_shard(asg["AutoScalingGroupName"], count) == index
+    )
+
+
+def within_budget(asgs):
+    # Stops at the first ASG after the current region's budget has run out,
+    # so that a slow listing stops too
+    end = getattr(listing, "budget_end", None)
+    for asg in asgs:
+        if end is not None and time.monotonic() > end:
+            listing.over_budget = True
+            return
+        yield asg
+
+
+def collect_targets(hits, reservoir=None):
+    # With a reservoir, the targets are sampled into it (weighted by their
+    # ASG's probability) instead of all being returned
     targets = []
-    for asg in get_all_asgs(autoscaling):
-        instance_id = get_asg_instance_id(asg, default_probability)
-        if instance_id is not None:
-            targets.append((asg["AutoScalingGroupName"], instance_id))
+    for target, weight in hits:
+        if reservoir is None:
+            targets.append(target)
+        else:
+            reservoir.add(target, weight)
+    if reservoir is not None:
+        return reservoir.targets()
     return targets
 
 
-def send_notification(sns, instance_id, asg_name):
-    topic = os.environ.get("termination_topic_arn", "").strip()
-    if topic == '':
+def iter_two_phase_targets(autoscaling, default_probability, shard=None):
+    # Phase one rolls for each tagged ASG using only its tags, phase two
+    # fetches instances for the ASGs that were hit.  Each ASG is still hit
+    # with its own probability and then loses a uniformly chosen instance.
+    hit = {}
+    tagged = within_budget(get_tagged_asgs(autoscaling))
+    for asg in in_shard(tagged, shard):
+        probability = get_asg_probability(asg, default_probability)
+        if random.random() < probability:
+            hit[asg["AutoScalingGroupName"]] = probability
+    for asg in within_budget(get_asgs_by_name(autoscaling, list(hit))):
+        instances = asg.get("Instances", [])
+        if len(instances) != 0:
+            instance_id = choose_instance_id(asg, instances)
+            if instance_id is not None:
+                name = asg["AutoScalingGroupName"]
+                # An ASG that wasn't hit can't be sampled
+                yield (name, instance_id), hit.get(name, 0.0)
+
+
+def get_two_phase_targets(autoscaling, default_probability, reservoir=None,
+                          shard=None):
+    return collect_targets(
+        iter_two_phase_targets(autoscaling, default_probability, shard),
+        reservoir
+    )
+
+
+def past_deadline():
+    deadline = run_deadline["time"]
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def resume_pages(paginator, token, region, **kwargs):
+    # Starts from the page after an earlier run's last one, or from the first
+    # page if the token is no longer accepted
+    pages = iter(paginator.paginate(
+        PaginationConfig={"StartingToken": token}, **kwargs
+    ))
+    try:
+        first = next(pages, None)
+    except Exception as e:
+        log("resume-failed", region, "[" + str(e) + "]")
+        pages = iter(paginator.paginate(**kwargs))
+        first = next(pages, None)
+    if first is not None:
+        yield first
+    for page in pages:
+        yield page
+
+
+def get_all_asgs(autoscaling, filters=None, resumable=True):
+    # Unless resumable, lists the region from its first page whatever the
+    # checkpoint.  Either way the listing stops at the deadline, leaving the
+    # NextToken it stopped at in listing.next_token.
+    paginator = autoscaling.get_paginator("describe_auto_scaling_groups")
+    kwargs = {}
+    if filters is not None:
+        kwargs["Filters"] = filters
+    token = None
+    if resumable:
+        token = getattr(listing, "start_token", None)
+        listing.start_token = None
+    if token is None:
+        pages = paginator.paginate(**kwargs)
+    else:
+        pages = resume_pages(
+            paginator, token, autoscaling.meta.region_name, **kwargs
+        )
+    pages = trace_pages(
+        pages, "AutoScalingGroups", operation="DescribeAutoScalingGroups"
+    )
+    writer = capture["writer"]
+    if writer is not None:
+        pages = writer.pages(pages, autoscaling.meta.region_name, filters)
+    if use_pipeline():
+        import chaos_pipeline
+        pages = chaos_pipeline.prefetch(pages)
+    try:
+        for response in pages:
+            for asg in response.get("AutoScalingGroups", []):
+                yield asg
+            token = response.get("NextToken", None)
+            if token is not None and past_deadline():
+                # Out of time, so leave the rest for the next run
+                listing.next_token = token
+                return
+    finally:
+        # Stops any prefetching as soon as the listing stops
+        getattr(pages, "close", lambda: None)()
+
+
+def use_inventory():
+    # Lists ASGs from a DynamoDB inventory (see chaos_inventory)
+    return len(os.environ.get("inventory_table", "").strip()) != 0
+
+
+def get_inventory_asgs(autoscaling, region):
+    # Returns None unless an inventory is configured
+    if not use_inventory():
+        return None
+    import chaos_inventory
+    return chaos_inventory.get_asgs(
+        chaos_inventory.get_store(), autoscaling, region
+    )
+
+
+def iter_targets(autoscaling, default_probability, asgs=None, shard=None):
+    # Yields (target, weight) for each ASG that's hit, as its page arrives
+    if asgs is None and use_two_phase_selection(default_probability):
+        yield from iter_two_phase_targets(
+            autoscaling, default_probability, shard
+        )
         return
+    if asgs is None:
+        filters = get_asg_filters(default_probability)
+        asgs = get_all_asgs(autoscaling, filters)
+    for asg in in_shard(within_budget(asgs), shard):
+        instance_id = get_asg_instance_id(asg, default_probability)
+        if instance_id is not None:
+            target = (asg["AutoScalingGroupName"], instance_id)
+            yield target, get_asg_weight(asg, default_probability)
+
+
+def get_targets(autoscaling, default_probability, asgs=None,
+                reservoir=None, shard=None):
+    if asgs is None and use_two_phase_selection(default_probability):
+        return get_two_phase_targets(
+            autoscaling, default_probability, reservoir, shard
+        )
+    return collect_targets(
+        iter_targets(autoscaling, default_probability, asgs, shard),
+        reservoir
+    )
+
+
+def make_notification(asg_name, instance_id, account=None):
     notification = {
         "event_name": "chaos_lambda.terminating",
         "instance_id": instance_id,
         "asg_name": asg_name,
     }
-    sns.publish(
+    if account is not None:
+        notification["account_id"] = account
+    return notification
+
+
+def publish_sns_batch(sns, topic, notifications):
+    response = sns.publish_batch(
         TopicArn=topic,
-        Message=json.dumps(notification)
+        PublishBatchRequestEntries=[
+            {"Id": str(i), "Message": json.dumps(n)}
+            for i, n in enumerate(notifications)
+        ]
     )
+    return [
+        (notifications[int(f["Id"])], f.get("Code", "unknown"))
+        for f in response.get("Failed", [])
+    ]
 
 
-def terminate_targets(ec2, sns, targets):
-    for asg_name, instance_id in targets:
-        log("targeting", instance_id, "in", asg_name)
+def send_sqs_batch(sqs, queue_url, notifications):
+    response = sqs.send_message_batch(
+        QueueUrl=queue_url,
+        Entries=[
+            {"Id": str(i), "MessageBody": json.dumps(n)}
+            for i, n in enumerate(notifications)
+        ]
+    )
+    return [
+        (notifications[int(f["Id"])], f.get("Code", "unknown"))
+        for f in response.get("Failed", [])
+    ]
+
+
+def put_events_batch(events, event_bus, notifications):
+    response = events.put_events(
+        Entries=[
+            {
+                "Source": "chaos-lambda",
+                "DetailType": n["event_name"],
+                "Detail": json.dumps(n),
+                "EventBusName": event_bus,
+            }
+            for n in notifications
+        ]
+    )
+    # Result entries are in the same order as the request entries
+    return [
+        (n, entry["ErrorCode"])
+        for n, entry in zip(notifications, response.get("Entries", []))
+        if "ErrorCode" in entry
+    ]
+
+
+def get_queue_region(queue_url):
+    # https://sqs.<region>.amazonaws.com/... or https://<region>.queue...
+    host = queue_url.split("/")[2].split(".")
+    return host[1] if host[0] == "sqs" else host[0]
+
+
+# Environment variable -> (service, batch sender, destination -> region).
+# Each sender takes up to NOTIFICATION_BATCH_SIZE notifications and returns
+# a (notification, reason) pair for every entry that couldn't be delivered.
+NOTIFICATION_SINKS = {
+    "termination_topic_arn": (
+        "sns", publish_sns_batch,
+        lambda arn: arn.split(":")[3]
+    ),
+    "termination_queue_url": (
+        "sqs", send_sqs_batch,
+        lambda url: get_queue_region(url)
+    ),
+    "termination_event_bus": (
+        "events", put_events_batch,
+        lambda bus: bus.split(":")[3] if bus.startswith("arn:") else None
+    ),
+}
+NOTIFICATION_BATCH_SIZE = 10
+NOTIFICATION_WORKERS = 8
+
+
+def get_notification_sinks(region):
+    sinks = []
+    for name, (service, send, get_region) in NOTIFICATION_SINKS.items():
+        destination = os.environ.get(name, "").strip()
+        if destination == "":
+            continue
         try:
-            send_notification(sns, instance_id, asg_name)
+            sink_region = get_region(destination) or region
+        except IndexError:
+            sink_region = region
+        client = get_client(service, sink_region)
+        sinks.append((service, functools.partial(send, client, destination)))
+    return sinks
+
+
+def send_notifications(sinks, notifications):
+    batches = [
+        (name, send, notifications[i:i + NOTIFICATION_BATCH_SIZE])
+        for name, send in sinks
+        for i in range(0, len(notifications), NOTIFICATION_BATCH_SIZE)
+    ]
+    if len(batches) == 0:
+        return []
+
+    def send_batch(batch):
+        name, send, entries = batch
+        resume_span(parent)
+        try:
+            return [(name, n, reason) for n, reason in send(entries)]
         except Exception as e:
-            log("Failed to send notification", e)
+            return [(name, n, str(e)) for n in entries]
+
+    with span("notify", notifications=len(notifications)) as s:
+        parent = current_span()
+        workers = min(len(batches), NOTIFICATION_WORKERS)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(send_batch, batches))
+        failures = [failure for result in results for failure in result]
+        s.set(failures=len(failures))
+    for name, n, reason in failures:
+        log(
+            "notification-failed", n["instance_id"], "in", n["asg_name"],
+            "via", name, "[" + reason + "]",
+            asg=n["asg_name"], instance=n["instance_id"]
+        )
+    return failures
+
+
+def get_error_code(parsed):
+    # The error code of a parsed response, or None if the call succeeded
+    return (parsed or {}).get("Error", {}).get("Code", None)
+
+
+def get_exception_error_code(e):
+    # Works for botocore's ClientError without needing to import botocore
+    return get_error_code(getattr(e, "response", None))
+
+
+# Errors worth retrying the same batch for, after botocore's own retries
+THROTTLING_ERRORS = (
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+)
+# Errors caused by individual instances, which are isolated by bisection
+INSTANCE_ERRORS = (
+    "InvalidInstanceID.NotFound",
+    "InvalidInstanceID.Malformed",
+    "IncorrectInstanceState",
+    "OperationNotPermitted",
+)
+TERMINATION_BATCH_SIZE = 50
+TERMINATION_WORKERS = 4
+TERMINATION_ATTEMPTS = 3
+TERMINATION_BACKOFF = 1.0
+
+# Shard workers invoked at once by a coordinator (see chaos_shards), and the
+# longest a worker can run for
+SHARD_WORKERS = 50
+LAMBDA_READ_TIMEOUT = 900
+
+
+def terminate_batch(ec2, instance_ids):
+    # Returns (instance id, state, error) for each instance, with state set
+    # if the instance is terminating and error set if it couldn't be
+    for attempt in range(TERMINATION_ATTEMPTS):
+        try:
+            response = ec2.terminate_instances(InstanceIds=instance_ids)
+        except Exception as e:
+            code = get_exception_error_code(e)
+            retry = attempt + 1 < TERMINATION_ATTEMPTS
+            if code in THROTTLING_ERRORS and retry:
+                # "Full jitter" exponential backoff
+                delay = TERMINATION_BACKOFF * 2 ** attempt
+                time.sleep(random.uniform(0, delay))
+                continue
+            if code in INSTANCE_ERRORS and len(instance_ids) > 1:
+                middle = len(instance_ids) // 2
+                return terminate_batch(ec2, instance_ids[:middle]) + \
+                    terminate_batch(ec2, instance_ids[middle:])
+            return [(i, None, code or str(e)) for i in instance_ids]
+        return [
+            (i["InstanceId"], i["CurrentState"]["Name"], None)
+            for i in response.get("TerminatingInstances", [])
+        ]
+
+
+def terminate_instances(ec2, instance_ids):
+    batches = [
+        instance_ids[i:i + TERMINATION_BATCH_SIZE]
+        for i in range(0, len(instance_ids), TERMINATION_BATCH_SIZE)
+    ]
+
+    def terminate(batch):
+        resume_span(parent)
+        return terminate_batch(ec2, batch)
+
+    with span("terminate", instances=len(instance_ids)) as s:
+        parent = current_span()
+        if len(batches) <= 1:
+            outcomes = [terminate_batch(ec2, batch) for batch in batches]
+        else:
+            workers = min(len(batches), TERMINATION_WORKERS)
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                outcomes = list(executor.map(terminate, batches))
+        outcomes = [outcome for batch in outcomes for outcome in batch]
+        s.set(failures=sum(1 for i, state, error in outcomes if error))
+    return outcomes
+
+
+def terminate_targets(ec2, sinks, targets, account=None):
+    for asg_name, instance_id in targets:
+        log(
+            "targeting", instance_id, "in", asg_name,
+            asg=asg_name, instance=instance_id
+        )
+    send_notifications(sinks, [
+        make_notification(asg_name, instance_id, account)
+        for asg_name, instance_id in targets
+    ])
 
     instance_ids = [instance_id for (asg_name, instance_id) in targets]
-    response = ec2.terminate_instances(InstanceIds=instance_ids)
+    # The targeting lines are written before anything is terminated, in case
+    # the invocation is stopped part way through
+    flush_log()
+    outcomes = terminate_instances(ec2, instance_ids)
 
     results = []
-    for i in response.get("TerminatingInstances", []):
-        results.append((i["InstanceId"], i["CurrentState"]["Name"]))
+    asg_names = dict((i, asg_name) for (asg_name, i) in targets)
+    for instance_id, state, error in outcomes:
+        if error is None:
+            results.append((instance_id, state))
+            log("result", instance_id, "is", state, instance=instance_id)
+        else:
+            asg_name = asg_names.get(instance_id, "unknown")
+            log(
+                "termination-failed", instance_id, "in", asg_name,
+                "[" + error + "]", asg=asg_name, instance=instance_id
+            )
+
+    return results
+
+
+def import_boto3():
+    global boto3, Config
+    if boto3 is None:
+        import boto3
+    if Config is None:
+        from botocore.config import Config
+
+
+def get_client_config(service=None):
+    if service == "lambda":
+        # Invoking a shard worker waits for it to finish, and is never
+        # retried as the worker may already have terminated instances
+        return Config(
+            connect_timeout=5,
+            read_timeout=LAMBDA_READ_TIMEOUT,
+            retries={"total_max_attempts": 1},
+            max_pool_connections=SHARD_WORKERS,
+            tcp_keepalive=True,
+        )
+    # The shared limiters of chaos_ratelimit replace botocore's per client
+    # ones
+    mode = "standard" if get_rate_limit() is not None else "adaptive"
+    return Config(
+        connect_timeout=5,
+        read_timeout=15,
+        retries={"mode": mode, "max_attempts": 5},
+        max_pool_connections=max(10, get_concurrency()),
+        tcp_keepalive=True,
+    )
+
+
+def get_client(service, region, account=None):
+    # Clients for other accounts (see chaos_accounts) are kept separately
+    # for each set of credentials, and replace those for earlier ones
+    key = (service, region)
+    credentials = {}
+    if account is not None:
+        import chaos_accounts
+        c = chaos_accounts.get_credentials(account)
+        key = (service, region, account, c["AccessKeyId"])
+        credentials = {
+            "aws_access_key_id": c["AccessKeyId"],
+            "aws_secret_access_key": c["SecretAccessKey"],
+            "aws_session_token": c["SessionToken"],
+        }
+    # boto3's default session isn't thread safe, so clients are also created
+    # under the lock
+    with clients_lock:
+        client = clients.get(key, None)
+        if client is not None:
+            client_stats["hits"] += 1
+            return client
+        start = time.monotonic()
+        import_boto3()
+        if account is not None:
+            for stale in [k for k in clients if k[:3] == key[:3]]:
+                del clients[stale]
+        client = clients[key] = boto3.client(
+            service,
+            region_name=region,
+            config=get_client_config(service),
+            **credentials
+        )
+        if get_env_flag("api_metrics"):
+            import chaos_metrics
+            chaos_metrics.instrument(client)
+        if get_trace_exporter() != "none":
+            client.meta.events.register("before-call", count_api_call)
+        rate_limit = get_rate_limit()
+        if rate_limit is not None and service != "lambda":
+            # Lambda limits invocations by concurrency rather than by rate
+            import chaos_ratelimit
+            chaos_ratelimit.install(client, rate_limit, account)
+        client_stats["created"] += 1
+        client_stats["create_time"] += time.monotonic() - start
+        return client
+
+
+def log_rate_limits():
+    if get_rate_limit() is None:
+        return
+    import chaos_ratelimit
+    for (service, region, account), s in chaos_ratelimit.take_stats():
+        fields = {
+            "service": service, "region": region,
+            "attempts": s["attempts"], "throttles": s["throttles"],
+            "waited": round(s["waited"], 3), "rate": round(s["rate"], 2),
+        }
+        if account is not None:
+            fields["account"] = account
+        log(
+            "rate-limit", service, "in", region,
+            str(s["attempts"]), "attempts", str(s["throttles"]), "throttled",
+            "waited", "%.3fs" % s["waited"], "at", "%.2f/s" % s["rate"],
+            *in_account(account), **fields
+        )
+
+
+def prewarm():
+    # Creating clients while the lambda container initialises moves the
+    # boto3 import and service model loading out of the first invocation
+    regions = get_regions(None) or [os.environ.get("AWS_REGION", "")]
+    for region in filter(None, regions):
+        for service in ("autoscaling", "ec2"):
+            get_client(service, region)
+        get_notification_sinks(region)
+
+
+def reset_clients():
+    with clients_lock:
+        clients.clear()
+        client_stats.update(hits=0, created=0, create_time=0.0)
 
-    for instance_id, state in results:
-        log("result", instance_id, "is", state)
 
+def terminate_region(region, targets, account=None):
+    # Notifications are always sent from the lambda's own account
+    ec2 = get_client("ec2", region, account)
+    sinks = get_notification_sinks(region)
+    results = terminate_targets(ec2, sinks, targets, account)
+    record_recovery(region, account, targets, results)
     return results
 
 
-def chaos_lambda(regions, default_probability):
-    for region in regions:
-        log("triggered", region)
-        autoscaling = boto3.client("autoscaling", region_name=region)
-        targets = get_targets(autoscaling, default_probability)
-        if len(targets) != 0:
-            ec2 = boto3.client("ec2", region_name=region)
-            sns = boto3.client("sns", region_name=region)
-            terminate_targets(ec2, sns, targets)
+def record_recovery(region, account, targets, results):
+    # Remembers the terminations for a recovery tracker (see chaos_recovery)
+    if get_env_flag("recovery"):
+        import chaos_recovery
+        chaos_recovery.record(region, account, targets, results)
+
+
+def get_shard_name(shard):
+    if shard is None:
+        return None
+    return "%d/%d" % (shard[0] + 1, shard[1])
+
+
+def in_account(account, shard=None):
+    # Extra words for text log lines about work in another account, or on
+    # one shard of a region
+    words = [] if account is None else ["in", account]
+    if shard is not None:
+        words += ["shard", get_shard_name(shard)]
+    return words
+
+
+def chaos_region(region, default_probability, region_budget=None,
+                 reservoir=None, account=None, shard=None, names=None):
+    # With a reservoir the region's targets are only selected, and are
+    # terminated by chaos_lambda once every region has been sampled.  With
+    # names (from a shard coordinator) only those ASGs are described.
+    if past_deadline():
+        return "deferred", []
+    start = time.monotonic()
+    log("triggered", region, *in_account(account, shard))
+    autoscaling = get_client("autoscaling", region, account)
+    # The inventory only covers the lambda's own account
+    asgs = None
+    if names is not None:
+        asgs = get_asgs_by_name(autoscaling, names)
+    elif account is None:
+        asgs = get_inventory_asgs(autoscaling, region)
+    # Whatever was selected before running out of time is still terminated
+    if reservoir is None and region_budget is None and use_pipeline():
+        # Targets are terminated in batches while the listing continues, so
+        # this is only done when there's no budget to judge the selection by
+        import chaos_pipeline
+        with span("select") as s:
+            targets = chaos_pipeline.select_and_terminate(
+                autoscaling, region, default_probability, asgs, account,
+                shard
+            )
+            s.set(targets=len(targets))
+    else:
+        with span("select") as s:
+            targets = get_targets(
+                autoscaling, default_probability, asgs, reservoir, shard
+            )
+            s.set(targets=len(targets))
+        if getattr(listing, "over_budget", False) or \
+                (region_budget is not None and
+                 time.monotonic() - start > region_budget):
+            # Too late to act on a stale selection, so leave it alone, and
+            # nothing was targeted
+            return "timeout", []
+        if len(targets) != 0 and reservoir is None:
+            terminate_region(region, targets, account)
+    status = "ok"
+    if getattr(listing, "next_token", None) is not None:
+        status = "partial"
+    return status, targets
+
+
+def run_region(region, default_probability, region_budget=None,
+               reservoir=None, account=None, shard=None, token=None,
+               names=None):
+    # Leaves the NextToken to resume from in listing.next_token if the
+    # region's listing ran out of time
+    start = time.monotonic()
+    log_context.region = region
+    log_context.account = account
+    listing.start_token = token
+    listing.next_token = None
+    listing.budget_end = None
+    if region_budget is not None:
+        listing.budget_end = start + region_budget
+    listing.over_budget = False
+    try:
+        with span("region", region=region, account=account,
+                  shard=get_shard_name(shard)) as s:
+            try:
+                status, targets = chaos_region(
+                    region, default_probability, region_budget, reservoir,
+                    account, shard, names
+                )
+            except Exception as e:
+                log("region-error", region, e, *in_account(account, shard))
+                status, targets = "error", []
+            s.set(status=status, targets=len(targets))
+        duration = time.monotonic() - start
+        log(
+            "region-result", region, "is", status,
+            "after", "%.3fs" % duration, "with", str(len(targets)), "targets",
+            *in_account(account, shard), duration=round(duration, 3)
+        )
+        record_region_metrics(region, duration)
+    finally:
+        log_context.region = None
+        log_context.account = None
+        listing.budget_end = None
+        listing.over_budget = False
+        flush_log()
+    return region, status, len(targets), duration
+
+
+def map_regions(f, regions, workers):
+    if workers <= 1:
+        return [f(region) for region in regions]
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(f, regions))
+
+
+def get_work_name(account, region):
+    return region if account is None else account + "/" + region
+
+
+def terminate_sampled(items, results, reservoirs, max_terminations,
+                      workers):
+    # Every work item's sample was taken independently, so the overall
+    # sample is made of the largest keys across all of them.  Items are
+    # pushed by index, as ties between keys then compare plain integers.
+    sample = TargetReservoir(max_terminations)
+    hit = 0
+    for i, (region, status, n, t) in enumerate(results):
+        if status in SAMPLED_STATUSES:
+            hit += reservoirs[items[i]].added
+            for key, target in reservoirs[items[i]].items():
+                sample.push(key, (i, target))
+    by_item = {}
+    for i, target in sample.targets():
+        by_item.setdefault(i, []).append(target)
+    log(
+        "capped", str(len(sample.heap)), "of", str(hit), "targets",
+        "at", str(max_terminations)
+    )
+
+    def terminate(i):
+        account, region = items[i]
+        log_context.region = region
+        log_context.account = account
+        try:
+            terminate_region(region, by_item[i], account)
+            return None
+        except Exception as e:
+            log("region-error", region, e, *in_account(account))
+            return get_work_name(account, region)
+        finally:
+            log_context.region = None
+            log_context.account = None
+
+    indexes = sorted(by_item)
+    failed = map_regions(terminate, indexes, min(workers, len(indexes)))
+    return len(sample.heap), [name for name in failed if name]
+
+
+def get_worst_status(a, b):
+    return min(a, b, key=STATUSES.index)
+
+
+def log_account_results(items, results):
+    # An account is only "ok" if all of its regions were
+    summaries = {}
+    for (account, region), (r, status, n, duration) in zip(items, results):
+        if account is None:
+            continue
+        summary = summaries.setdefault(account, ["ok", 0, 0, 0.0])
+        summary[0] = get_worst_status(summary[0], status)
+        summary[1] += 1
+        summary[2] += n
+        summary[3] += duration
+    for account, (status, regions, n, duration) in summaries.items():
+        log(
+            "account-result", account, "is", status,
+            "after", "%.3fs" % duration, "with", str(n), "targets",
+            "in", str(regions), "regions",
+            account=account, duration=round(duration, 3)
+        )
+
+
+def chaos_lambda(regions, default_probability, concurrency=1,
+                 region_budget=None, max_terminations=None, accounts=None,
+                 shards=None, checkpoints=None):
+    # With shards (a chaos_shards.ShardRunner) the work items are handed to
+    # worker invocations, and only the results are collected here.  With
+    # checkpoints (a chaos_checkpoint.Checkpoints) a run that runs out of
+    # time leaves the rest of its work to the next one.
+    start = time.monotonic()
+    # Work items are (account, region) pairs, where an account of None is
+    # the lambda's own
+    if accounts is None:
+        accounts = [None]
+    elif shards is None and any(a is not None for a in accounts):
+        import chaos_accounts
+        chaos_accounts.assume_roles(accounts, concurrency)
+    items = [(account, region) for account in accounts for region in regions]
+    tokens = {}
+    if checkpoints is not None:
+        items, tokens = checkpoints.resume(items)
+    workers = min(concurrency, len(items))
+    reservoirs = {}
+    if max_terminations is not None:
+        reservoirs = dict(
+            (item, TargetReservoir(max_terminations)) for item in items
+        )
+    next_tokens = {}
+
+    def run(item):
+        result = run_region(
+            item[1], default_probability, region_budget,
+            reservoirs.get(item, None), item[0], None, tokens.get(item, None)
+        )
+        next_tokens[item] = listing.next_token
+        return result
+
+    if shards is not None:
+        results = shards.run(
+            items, reservoirs, default_probability, max_terminations, tokens
+        )
+        next_tokens.update(shards.next_tokens)
+    else:
+        results = map_regions(run, items, workers)
+    log_account_results(items, results)
+    if checkpoints is not None:
+        checkpoints.save([
+            (item, next_tokens.get(item, None))
+            for item, (region, status, n, t) in zip(items, results)
+            if status in ("partial", "deferred")
+        ])
+
+    failed = [get_work_name(*item) for item, (region, status, n, t)
+              in zip(items, results) if status == "error"]
+    if max_terminations is None:
+        total = sum(n for (region, status, n, t) in results)
+    else:
+        total, errors = terminate_sampled(
+            items, results, reservoirs, max_terminations, workers
+        )
+        failed += [name for name in errors if name not in failed]
+
+    current_span().set(
+        work_items=len(items), targets=total, failed=len(failed)
+    )
+    duration = time.monotonic() - start
+    log(
+        "completed", str(len(results)), "regions",
+        "after", "%.3fs" % duration, "with", str(total), "targets",
+        duration=round(duration, 3)
+    )
+    log(
+        "client-cache", str(client_stats["hits"]), "hits",
+        str(client_stats["created"]), "created",
+        "in", "%.3fs" % client_stats["create_time"]
+    )
+    log_rate_limits()
+
+    if len(failed) != 0:
+        raise RuntimeError("Chaos Lambda failed in " + ", ".join(failed))
+    return results
 
 
 def get_regions(context):
     v = os.environ.get("regions", "").strip()
     if len(v) == 0:
+        if context is None:
+            return []
         return [context.invoked_function_arn.split(":")[3]]
     else:
         return list(filter(None, [s.strip() for s in v.split(",")]))
 
 
+def get_accounts(context):
+    # None unless other accounts are listed; the lambda's own account is
+    # given as None so that it uses the lambda's own credentials
+    v = os.environ.get("accounts", "").strip()
+    if len(v) == 0:
+        return None
+    own = None
+    if context is not None:
+        own = context.invoked_function_arn.split(":")[4]
+    return [
+        None if account == own else account
+        for account in filter(None, [s.strip() for s in v.split(",")])
+    ]
+
+
 def get_default_probability():
     v = os.environ.get("probability", "").strip()
     if len(v) == 0:
@@ -135,7 +1200,245 @@ def get_default_probability():
         return float(v)
 
 
+def get_env_flag(name):
+    v = os.environ.get(name, "").strip().lower()
+    return v in ("1", "true", "yes", "on")
+
+
+def get_concurrency():
+    v = os.environ.get("concurrency", "").strip()
+    if len(v) == 0:
+        return 1
+    else:
+        return max(1, int(v))
+
+
+def get_region_budget():
+    v = os.environ.get("region_timeout", "").strip()
+    if len(v) == 0:
+        return None
+    else:
+        return float(v)
+
+
+def get_max_terminations():
+    v = os.environ.get("max_terminations", "").strip()
+    if len(v) == 0:
+        return None
+    else:
+        return max(0, int(v))
+
+
+def get_rate_limit():
+    v = os.environ.get("rate_limit", "").strip()
+    if len(v) == 0:
+        return None
+    else:
+        return float(v)
+
+
+def get_shards():
+    v = os.environ.get("shards", "").strip()
+    if len(v) == 0:
+        return 1
+    else:
+        return max(1, int(v))
+
+
+def get_log_format():
+    v = os.environ.get("log_format", "").strip().lower()
+    if v not in ("", "text", "json"):
+        raise ValueError("Unknown log_format " + v)
+    return v or "text"
+
+
+def get_trace_exporter():
+    v = os.environ.get("trace_exporter", "").strip().lower()
+    if v not in ("", "none", "log", "xray"):
+        raise ValueError("Unknown trace_exporter " + v)
+    return v or "none"
+
+
+def start_trace(context, **attributes):
+    # Returns the tracer if one was started; handlers called in-process by a
+    # traced invocation (see chaos_shards.LocalInvoker) are part of its trace
+    exporter = get_trace_exporter()
+    if exporter == "none" or tracing["tracer"] is not None:
+        return None
+    import chaos_trace
+    attributes["request_id"] = getattr(context, "aws_request_id", None)
+    tracer = tracing["tracer"] = chaos_trace.Tracer(exporter, attributes)
+    return tracer
+
+
+def finish_trace(tracer):
+    if tracer is None:
+        return
+    tracing["tracer"] = None
+    import chaos_trace
+    chaos_trace.finish(tracer)
+
+
+def get_output_path(path, suffix):
+    # Files saved to an s3://bucket/key URL are written under /tmp first
+    if not path.startswith("s3://"):
+        return path
+    import tempfile
+    fd, local_path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return local_path
+
+
+def save_output(name, path, local_path, finish):
+    # Calls finish() to complete the file at local_path (see
+    # get_output_path), and uploads it if path is an S3 URL.  Returns whether
+    # it was saved.
+    try:
+        finish()
+        if local_path != path:
+            bucket, key = path[len("s3://"):].split("/", 1)
+            s3 = get_client("s3", os.environ.get("AWS_REGION", ""))
+            with open(local_path, "rb") as f:
+                s3.put_object(Bucket=bucket, Key=key, Body=f)
+    except Exception as e:
+        # Losing the output shouldn't fail the run
+        log(name + "-failed", path, "[" + str(e) + "]")
+        return False
+    finally:
+        if local_path != path:
+            os.remove(local_path)
+    return True
+
+
+def start_capture(context):
+    path = os.environ.get("capture_path", "").strip()
+    if len(path) == 0:
+        return
+    import chaos_capture
+    accounts = []
+    if context is not None:
+        accounts.append(context.invoked_function_arn.split(":")[4])
+    capture["writer"] = chaos_capture.CaptureWriter(path, accounts)
+
+
+def finish_capture():
+    writer = capture["writer"]
+    if writer is None:
+        return
+    capture["writer"] = None
+    if save_output("capture", writer.path, writer.local_path, writer.close):
+        log("captured", str(writer.pages_written), "pages", "to", writer.path)
+
+
+def record_region_metrics(region, duration):
+    if get_env_flag("region_metrics"):
+        import chaos_metrics
+        chaos_metrics.record_region(region, duration)
+
+
+def emit_metrics():
+    if not (get_env_flag("api_metrics") or get_env_flag("region_metrics")):
+        return
+    import chaos_metrics
+    for record in chaos_metrics.emit():
+        log_record(record)
+
+
+def get_deadline(context, remaining=None):
+    # Leaves deadline_margin seconds to terminate whatever has been selected
+    # by the time listing stops.  remaining caps the seconds left, eg at a
+    # shard coordinator's (see chaos_shards).
+    if context is not None:
+        own = context.get_remaining_time_in_millis() / 1000.0
+        remaining = own if remaining is None else min(remaining, own)
+    if remaining is None:
+        return None
+    v = os.environ.get("deadline_margin", "").strip()
+    margin = DEFAULT_DEADLINE_MARGIN if len(v) == 0 else float(v)
+    return time.monotonic() + remaining - margin
+
+
+def get_checkpoints():
+    if len(os.environ.get("checkpoint_table", "").strip()) == 0:
+        return None
+    import chaos_checkpoint
+    return chaos_checkpoint.Checkpoints(chaos_checkpoint.get_store())
+
+
+def get_shard_runner(context):
+    count = get_shards()
+    if count <= 1:
+        return None
+    import chaos_shards
+    return chaos_shards.make_runner(context, count)
+
+
 def handler(event, context):
+    if get_env_flag("profile"):
+        import chaos_profile
+        return chaos_profile.profile(run_handler, event, context)
+    return run_handler(event, context)
+
+
+def start_recovery(context):
+    if get_env_flag("recovery"):
+        import chaos_recovery
+        chaos_recovery.start(context)
+
+
+def run_handler(event, context):
+    log_settings["json"] = get_log_format() == "json"
+    run_deadline["time"] = get_deadline(context)
+    if isinstance(event, dict) and "recovery" in event:
+        import chaos_recovery
+        try:
+            return chaos_recovery.track(event["recovery"], context)
+        finally:
+            run_deadline["time"] = None
+            emit_metrics()
+            flush_log()
+    if isinstance(event, dict) and "shard" in event:
+        import chaos_shards
+        # Workers must finish before their coordinator runs out of time
+        run_deadline["time"] = get_deadline(
+            context, event["shard"].get("remaining", None)
+        )
+        tracer = start_trace(context, shard=True)
+        try:
+            return chaos_shards.run_worker(
+                event["shard"],
+                get_default_probability(),
+                get_region_budget()
+            )
+        finally:
+            run_deadline["time"] = None
+            start_recovery(context)
+            finish_trace(tracer)
+            emit_metrics()
+            flush_log()
     regions = get_regions(context)
     probability = get_default_probability()
-    chaos_lambda(regions, probability)
+    start_capture(context)
+    tracer = start_trace(context)
+    try:
+        chaos_lambda(
+            regions,
+            probability,
+            concurrency=get_concurrency(),
+            region_budget=get_region_budget(),
+            max_terminations=get_max_terminations(),
+            accounts=get_accounts(context),
+            shards=get_shard_runner(context),
+            checkpoints=get_checkpoints()
+        )
+    finally:
+        run_deadline["time"] = None
+        start_recovery(context)
+        finish_trace(tracer)
+        finish_capture()
+        emit_metrics()
+        flush_log()
+
+
+if get_env_flag("prewarm"):
+    prewarm()
@@ -0,0 +1,93 @@
+"""
+Cross-account support for Chaos Lambda.
+
+When the accounts setting lists other AWS accounts, a single deployment
+targets all of them: every account x region pair becomes a work item on the
+same bounded worker pool as the regions of a single account.  Each account is
+reached by assuming a role in it (named by the account_role setting, default
+"chaos-lambda"), and chaos.get_client keeps a separate pool of clients for
+each account.
+
+Credentials are cached for the lifetime of the container, so warm invocations
+don't call STS again.  They're refreshed once they're within REFRESH_MARGIN
+of expiring, which is the longest a lambda can run for, so credentials handed
+out at any point of a run are still valid at its end.
+"""
+import os
+import threading
+import time
+
+import chaos
+
+
+DEFAULT_ROLE = "chaos-lambda"
+SESSION_NAME = "chaos-lambda"
+# Lambda's maximum timeout
+REFRESH_MARGIN = 900.0
+
+credentials = {}
+# One lock per account, so that accounts are assumed concurrently but each
+# one only once
+credentials_locks = {}
+credentials_lock = threading.Lock()
+credentials_stats = {"hits": 0, "assumed": 0}
+
+
+def get_role_arn(account):
+    role = os.environ.get("account_role", "").strip() or DEFAULT_ROLE
+    if role.startswith("arn:"):
+        # A full ARN may name the account as {account}
+        return role.replace("{account}", account)
+    return "arn:aws:iam::%s:role/%s" % (account, role)
+
+
+def get_account_lock(account):
+    with credentials_lock:
+        lock = credentials_locks.get(account, None)
+        if lock is None:
+            lock = credentials_locks[account] = threading.Lock()
+        return lock
+
+
+def get_credentials(account):
+    with get_account_lock(account):
+        cached = credentials.get(account, None)
+        if cached is not None:
+            if cached["Expiration"] - time.time() > REFRESH_MARGIN:
+                credentials_stats["hits"] += 1
+                return cached
+        sts = chaos.get_client("sts", os.environ.get("AWS_REGION", ""))
+        response = sts.assume_role(
+            RoleArn=get_role_arn(account),
+            RoleSessionName=SESSION_NAME
+        )
+        c = response["Credentials"]
+        cached = credentials[account] = {
+            "AccessKeyId": c["AccessKeyId"],
+            "SecretAccessKey": c["SecretAccessKey"],
+            "SessionToken": c["SessionToken"],
+            "Expiration": c["Expiration"].timestamp(),
+        }
+        credentials_stats["assumed"] += 1
+        return cached
+
+
+def assume_roles(accounts, workers):
+    # Assumes every account's role up front and at once, rather than as
+    # each account's first work item happens to start.  Failures are only
+    # logged: the account's work items will try again, and fail, as usual.
+    def assume(account):
+        try:
+            get_credentials(account)
+        except Exception as e:
+            chaos.log("account-error", account, e, account=account)
+
+    accounts = [a for a in accounts if a is not None]
+    chaos.map_regions(assume, accounts, min(workers, len(accounts)))
+
+
+def reset_credentials():
+    with credentials_lock:
+        credentials.clear()
+        credentials_locks.clear()
+        credentials_stats.update(hits=0, assumed=0)
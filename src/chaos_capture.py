@@ -0,0 +1,109 @@
+"""
+Capture of the Auto Scaling Groups seen by Chaos Lambda, so that production
+runs can be replayed offline.
+
+When the capture_path setting is given, every DescribeAutoScalingGroups page
+read by chaos.get_all_asgs is appended to a gzipped NDJSON file as it
+arrives, along with the region, the filters used and the time taken to fetch
+the page.  The first line is a header giving the format version.  AWS
+account IDs in ARNs, and anywhere else the same IDs appear, are replaced with
+000000000000.  capture_path may be a local file or an s3://bucket/key URL, in
+which case the capture is written under /tmp and uploaded when the run ends.
+
+bench/replay_aws.py serves a capture back to chaos.py, and
+bench/bench_handler.py --replay runs the handler against it.
+"""
+import gzip
+import json
+import queue
+import re
+import threading
+import time
+
+import chaos
+
+
+FORMAT_VERSION = 1
+SCRUBBED_ACCOUNT = "000000000000"
+# Much faster than the default of 9 for a little more space
+COMPRESS_LEVEL = 5
+# Pages waiting to be written, bounding the memory used if writing falls
+# behind
+QUEUE_PAGES = 16
+ARN_ACCOUNT_RE = re.compile(r"(arn:[\w-]+:[\w-]*:[\w-]*:)(\d{12})")
+
+
+class CaptureWriter:
+
+    def __init__(self, path, accounts=()):
+        self.path = path
+        self.local_path = chaos.get_output_path(path, ".ndjson.gz")
+        self.accounts = set(a for a in accounts if a)
+        self.file = gzip.open(
+            self.local_path, "wt", compresslevel=COMPRESS_LEVEL,
+            encoding="utf-8"
+        )
+        self.lock = threading.Lock()
+        self.pages_written = 0
+        self.error = None
+        # Pages are encoded and compressed on another thread, which mostly
+        # overlaps with waiting for the next page from the API
+        self.queue = queue.Queue(QUEUE_PAGES)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.write({"version": FORMAT_VERSION, "time": int(time.time())})
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                line = json.dumps(record, separators=(",", ":"), default=str)
+                self.file.write(self.scrub(line) + "\n")
+            except Exception as e:
+                self.error = e
+
+    def scrub(self, line):
+        # Works on the encoded line, which is much faster than walking the
+        # page.  Accounts found in ARNs are also replaced wherever else they
+        # appear, eg in tag values.
+        for m in ARN_ACCOUNT_RE.finditer(line):
+            self.accounts.add(m.group(2))
+        for account in self.accounts:
+            line = line.replace(account, SCRUBBED_ACCOUNT)
+        return line
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def pages(self, pages, region, filters=None):
+        # Passes pages through unchanged, recording each one as it arrives
+        pages = iter(pages)
+        while True:
+            start = time.monotonic()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            latency = time.monotonic() - start
+            self.write({
+                "region": region,
+                "filters": filters,
+                "latency": round(latency, 4),
+                "asgs": page.get("AutoScalingGroups", []),
+            })
+            with self.lock:
+                self.pages_written += 1
+            yield page
+
+    def close(self):
+        # Completes the file at local_path, which chaos.finish_capture then
+        # saves
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
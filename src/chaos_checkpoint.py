@@ -0,0 +1,74 @@
+"""
+Checkpoints that let a run which runs out of time hand the rest of its work
+to the next one.
+
+Each run has a deadline a few seconds (the deadline_margin setting) before
+the lambda would be stopped.  Once it passes, listings stop before fetching
+their next page, regions that haven't started yet are deferred, and whatever
+has already been selected is terminated as usual.  If a checkpoint table is
+configured (the checkpoint_table setting) the regions left unfinished are
+then saved, along with the NextToken each listing stopped at, and the next
+run only processes those regions, starting each listing where the last one
+stopped.  Once a run finishes all its regions the checkpoint is removed, so
+the run after that starts from the beginning again.
+
+Checkpoints are kept in a DynamoDB table with the same key schema as the
+inventory, and chaos_inventory.MemoryStore can stand in for it in tests.
+Sharded runs checkpoint the coordinator's listing of each region, or only
+whole regions with the inventory or two-phase selection, where each shard
+lists separately.
+"""
+import os
+
+import chaos
+import chaos_inventory
+
+
+PARTITION = "checkpoint"
+KEY = "run"
+
+
+def get_store():
+    table = os.environ.get("checkpoint_table", "").strip()
+    region = os.environ.get("AWS_REGION", "")
+    return chaos_inventory.DynamoDBStore(
+        chaos.get_client("dynamodb", region), table
+    )
+
+
+class Checkpoints:
+
+    def __init__(self, store):
+        self.store = store
+
+    def resume(self, items):
+        # Returns the work items left by the last run (or all of them if it
+        # finished) and the NextToken to resume each one's listing from
+        checkpoint = self.store.get(PARTITION, KEY)
+        if checkpoint is None:
+            return items, {}
+        tokens = dict(
+            (tuple(item), token) for item, token in checkpoint["pending"]
+        )
+        # Anything no longer configured is dropped
+        left = [item for item in items if item in tokens]
+        if len(left) == 0:
+            return items, {}
+        chaos.log(
+            "resuming", str(len(left)), "of", str(len(items)), "regions"
+        )
+        return left, tokens
+
+    def save(self, pending):
+        # pending lists (work item, NextToken or None) pairs
+        if len(pending) == 0:
+            self.store.write(PARTITION, {}, [KEY])
+            return
+        self.store.write(PARTITION, {KEY: {"pending": [
+            [list(item), token] for item, token in pending
+        ]}})
+        chaos.log(
+            "checkpoint", str(len(pending)), "regions", "left",
+            str(sum(1 for item, token in pending if token is not None)),
+            "part listed"
+        )
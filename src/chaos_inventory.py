@@ -0,0 +1,383 @@
+"""
+Incremental inventory of Auto Scaling Groups for Chaos Lambda.
+
+Rather than describing every ASG in a region on every run, the scheduled
+handler can read candidates from an inventory that's kept up to date by a
+second entry point, handler() in this module, which consumes Auto Scaling,
+EC2 and CloudTrail events from EventBridge.  Only what target selection
+needs is kept for each ASG: its name, its instances' IDs, availability
+zones, health and lifecycle states (which termination policies depend on,
+see chaos_policy) and its chaos-lambda-* tags.  Whenever the inventory for
+a region is missing or older than the inventory_max_age setting it's rebuilt
+from a full DescribeAutoScalingGroups listing, so missed events are only
+ever stale for a bounded time.  A rebuild that reaches the run's deadline
+only updates the ASGs listed so far, and is tried again by the next run.
+
+Events only ever change one ASG's item.  Removing an instance is a
+conditional write of the item that was read, retried if another event got
+there first, and an EC2 event (which doesn't say which ASG the instance was
+in) has its ASG looked up with DescribeAutoScalingInstances.
+
+Inventories are held in a DynamoDB table named by the inventory_table
+setting, keyed by region (partition key "region") and item key (sort key
+"key").  MemoryStore provides the same interface for tests.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+import chaos
+
+
+ASG_KEY = "asg:"
+RECONCILED_KEY = "meta:reconciled"
+DEFAULT_MAX_AGE = 86400.0
+
+# DynamoDB's BatchWriteItem limit
+WRITE_BATCH_SIZE = 25
+WRITE_ATTEMPTS = 5
+WRITE_BACKOFF = 0.1
+
+# CloudTrail events for calls that can change an ASG's instances or tags
+ASG_CALLS = (
+    "AttachInstances",
+    "CreateAutoScalingGroup",
+    "CreateOrUpdateTags",
+    "DeleteAutoScalingGroup",
+    "DeleteTags",
+    "DetachInstances",
+    "UpdateAutoScalingGroup",
+)
+TERMINATED_STATES = ("shutting-down", "terminated")
+# What's kept of each instance
+INSTANCE_FIELDS = (
+    "InstanceId", "AvailabilityZone", "HealthStatus", "LifecycleState"
+)
+
+
+class MemoryStore:
+    # Values are held as JSON, like DynamoDBStore, so callers always get
+    # copies they're free to modify
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, region, key):
+        with self.lock:
+            value = self.items.get((region, key), None)
+        return None if value is None else json.loads(value)
+
+    def scan(self, region, prefix):
+        with self.lock:
+            items = [
+                (k, v) for ((r, k), v) in self.items.items()
+                if r == region and k.startswith(prefix)
+            ]
+        return dict((k, json.loads(v)) for (k, v) in items)
+
+    def write(self, region, puts, deletes=()):
+        with self.lock:
+            for key, value in puts.items():
+                self.items[(region, key)] = json.dumps(value)
+            for key in deletes:
+                self.items.pop((region, key), None)
+
+    def replace(self, region, key, value, old):
+        with self.lock:
+            current = self.items.get((region, key), None)
+            if current is None or json.loads(current) != old:
+                return False
+            self.items[(region, key)] = json.dumps(value)
+            return True
+
+
+class DynamoDBStore:
+
+    def __init__(self, dynamodb, table):
+        self.dynamodb = dynamodb
+        self.table = table
+
+    def make_key(self, region, key):
+        return {"region": {"S": region}, "key": {"S": key}}
+
+    def get(self, region, key):
+        response = self.dynamodb.get_item(
+            TableName=self.table,
+            Key=self.make_key(region, key),
+            ConsistentRead=True
+        )
+        item = response.get("Item", None)
+        if item is None:
+            return None
+        return json.loads(item["value"]["S"])
+
+    def scan(self, region, prefix):
+        paginator = self.dynamodb.get_paginator("query")
+        pages = paginator.paginate(
+            TableName=self.table,
+            KeyConditionExpression="#r = :r AND begins_with(#k, :p)",
+            ExpressionAttributeNames={"#r": "region", "#k": "key"},
+            ExpressionAttributeValues={
+                ":r": {"S": region},
+                ":p": {"S": prefix},
+            },
+            ConsistentRead=True
+        )
+        items = {}
+        for page in pages:
+            for item in page.get("Items", []):
+                items[item["key"]["S"]] = json.loads(item["value"]["S"])
+        return items
+
+    def write(self, region, puts, deletes=()):
+        requests = [
+            {"PutRequest": {"Item": dict(
+                self.make_key(region, key),
+                value={"S": json.dumps(value, sort_keys=True)}
+            )}}
+            for key, value in puts.items()
+        ] + [
+            {"DeleteRequest": {"Key": self.make_key(region, key)}}
+            for key in deletes
+        ]
+        for i in range(0, len(requests), WRITE_BATCH_SIZE):
+            self.write_batch(requests[i:i + WRITE_BATCH_SIZE])
+
+    def replace(self, region, key, value, old):
+        # Only writes value if the item still holds old (as read by get), and
+        # returns whether it did
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table,
+                Item=dict(
+                    self.make_key(region, key),
+                    value={"S": json.dumps(value, sort_keys=True)}
+                ),
+                ConditionExpression="#v = :v",
+                ExpressionAttributeNames={"#v": "value"},
+                ExpressionAttributeValues={
+                    ":v": {"S": json.dumps(old, sort_keys=True)}
+                }
+            )
+        except Exception as e:
+            code = chaos.get_exception_error_code(e)
+            if code != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+    def write_batch(self, requests):
+        for attempt in range(WRITE_ATTEMPTS):
+            response = self.dynamodb.batch_write_item(
+                RequestItems={self.table: requests}
+            )
+            requests = response.get("UnprocessedItems", {}).get(
+                self.table, []
+            )
+            if len(requests) == 0:
+                return
+            time.sleep(random.uniform(0, WRITE_BACKOFF * 2 ** attempt))
+        raise RuntimeError("%d inventory writes unprocessed in %s" % (
+            len(requests), self.table
+        ))
+
+
+def get_max_age():
+    v = os.environ.get("inventory_max_age", "").strip()
+    if len(v) == 0:
+        return DEFAULT_MAX_AGE
+    else:
+        return float(v)
+
+
+def get_store():
+    table = os.environ.get("inventory_table", "").strip()
+    region = os.environ.get("AWS_REGION", "")
+    return DynamoDBStore(chaos.get_client("dynamodb", region), table)
+
+
+def compact_asg(asg):
+    # Keeps tags in their original order so that the first of any
+    # duplicate keys still wins in chaos.get_asg_tag
+    return {
+        "AutoScalingGroupName": asg["AutoScalingGroupName"],
+        "Instances": [
+            dict((k, i[k]) for k in INSTANCE_FIELDS if k in i)
+            for i in asg.get("Instances", []) if "InstanceId" in i
+        ],
+        "Tags": [
+            {"Key": t["Key"], "Value": t.get("Value", "")}
+            for t in asg.get("Tags", [])
+            if t.get("Key", "")[:len(chaos.TAG_PREFIX)].lower()
+            == chaos.TAG_PREFIX
+        ],
+    }
+
+
+def reconcile(store, autoscaling, region):
+    # Anything missing from the listing is deleted, so it starts from the
+    # region's first page whatever the run's checkpoint.  A listing that
+    # stops at the deadline only updates the ASGs it saw, and leaves the
+    # inventory to be reconciled again.
+    start = time.monotonic()
+    existing = store.scan(region, ASG_KEY)
+    asgs = {}
+    next_token = getattr(chaos.listing, "next_token", None)
+    chaos.listing.next_token = None
+    try:
+        for asg in chaos.get_all_asgs(autoscaling, resumable=False):
+            asgs[ASG_KEY + asg["AutoScalingGroupName"]] = compact_asg(asg)
+        complete = chaos.listing.next_token is None
+    finally:
+        chaos.listing.next_token = next_token
+    puts = dict(
+        (key, asg) for key, asg in asgs.items() if existing.get(key) != asg
+    )
+    changed = len(puts)
+    deletes = []
+    if complete:
+        deletes = [key for key in existing if key not in asgs]
+        puts[RECONCILED_KEY] = {"time": time.time()}
+    store.write(region, puts, deletes)
+    duration = time.monotonic() - start
+    chaos.log(
+        "inventory-reconciled", region, "with", str(len(asgs)), "asgs",
+        str(changed), "changed", str(len(deletes)), "deleted",
+        "after", "%.3fs" % duration, duration=round(duration, 3)
+    )
+    if not complete:
+        # Whatever was stored before is the best guess for the rest
+        return list(dict(existing, **asgs).values())
+    return list(asgs.values())
+
+
+def get_asgs(store, autoscaling, region, max_age=None):
+    if max_age is None:
+        max_age = get_max_age()
+    reconciled = store.get(region, RECONCILED_KEY)
+    if reconciled is None or time.time() - reconciled["time"] > max_age:
+        return reconcile(store, autoscaling, region)
+    return list(store.scan(region, ASG_KEY).values())
+
+
+def refresh_asg(store, autoscaling, region, asg_name):
+    response = autoscaling.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[asg_name]
+    )
+    asgs = response.get("AutoScalingGroups", [])
+    if len(asgs) == 0:
+        store.write(region, {}, [ASG_KEY + asg_name])
+    else:
+        store.write(region, {ASG_KEY + asg_name: compact_asg(asgs[0])})
+
+
+def add_instance(store, autoscaling, region, asg_name, instance_id):
+    # Launch events don't say which state the instance is in, or whether
+    # it's healthy, so the ASG is described again rather than guessed at
+    asg = store.get(region, ASG_KEY + asg_name)
+    if asg is not None:
+        for i in asg["Instances"]:
+            if i["InstanceId"] == instance_id and \
+                    len(i) == len(INSTANCE_FIELDS):
+                return
+    refresh_asg(store, autoscaling, region, asg_name)
+
+
+def get_instance_asg_name(autoscaling, instance_id):
+    # Returns None if the instance isn't (or is no longer) in an ASG, in
+    # which case its ASG's own termination event covers it
+    response = autoscaling.describe_auto_scaling_instances(
+        InstanceIds=[instance_id]
+    )
+    for instance in response.get("AutoScalingInstances", []):
+        return instance["AutoScalingGroupName"]
+    return None
+
+
+def remove_instance(store, region, instance_id, asg_name):
+    key = ASG_KEY + asg_name
+    for attempt in range(WRITE_ATTEMPTS):
+        asg = store.get(region, key)
+        if asg is None:
+            return
+        instances = [
+            i for i in asg["Instances"] if i["InstanceId"] != instance_id
+        ]
+        if len(instances) == len(asg["Instances"]):
+            return
+        if store.replace(region, key, dict(asg, Instances=instances), asg):
+            return
+        time.sleep(random.uniform(0, WRITE_BACKOFF * 2 ** attempt))
+    raise RuntimeError("%s kept changing while removing %s" % (
+        asg_name, instance_id
+    ))
+
+
+def get_cloudtrail_asg_names(detail):
+    if detail.get("errorCode", None) is not None:
+        return []
+    if detail.get("eventName", None) not in ASG_CALLS:
+        return []
+    parameters = detail.get("requestParameters", None) or {}
+    names = [parameters.get("autoScalingGroupName", None)]
+    names += [t.get("resourceId", None) for t in parameters.get("tags", [])]
+    return sorted(set(filter(None, names)))
+
+
+def apply_event(store, event):
+    region = event.get("region", "")
+    detail_type = event.get("detail-type", "")
+    detail = event.get("detail", {})
+    autoscaling = chaos.get_client("autoscaling", region)
+    if detail_type == "EC2 Instance Launch Successful":
+        add_instance(
+            store, autoscaling, region,
+            detail["AutoScalingGroupName"], detail["EC2InstanceId"]
+        )
+    elif detail_type == "EC2 Instance Terminate Successful":
+        remove_instance(
+            store, region, detail["EC2InstanceId"],
+            detail["AutoScalingGroupName"]
+        )
+    elif detail_type == "EC2 Instance State-change Notification":
+        if detail.get("state", None) not in TERMINATED_STATES:
+            return False
+        instance_id = detail["instance-id"]
+        asg_name = get_instance_asg_name(autoscaling, instance_id)
+        if asg_name is None:
+            return False
+        remove_instance(store, region, instance_id, asg_name)
+    elif detail_type == "AWS API Call via CloudTrail":
+        names = get_cloudtrail_asg_names(detail)
+        for asg_name in names:
+            refresh_asg(store, autoscaling, region, asg_name)
+        return len(names) != 0
+    else:
+        return False
+    return True
+
+
+def get_events(event):
+    # Events arrive directly from EventBridge, or batched through SQS
+    if "Records" in event:
+        return [json.loads(record["body"]) for record in event["Records"]]
+    return [event]
+
+
+def handler(event, context, store=None):
+    chaos.log_settings["json"] = chaos.get_log_format() == "json"
+    if store is None:
+        store = get_store()
+    try:
+        for e in get_events(event):
+            applied = apply_event(store, e)
+            chaos.log(
+                "inventory-event", e.get("region", ""),
+                "[" + e.get("detail-type", "") + "]",
+                "applied" if applied else "ignored"
+            )
+    finally:
+        chaos.flush_log()
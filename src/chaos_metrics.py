@@ -0,0 +1,166 @@
+"""
+Per-operation AWS API metrics for Chaos Lambda.
+
+instrument() hooks botocore's before-call, after-call, after-call-error and
+needs-retry events on a client and records the number of calls, latency,
+retries, throttled attempts and errors for each (service, operation,
+region).  record_region() records how long each region's run took, as
+RegionDuration, both by Region and across all regions, for the alarms in
+cloudformation/src/alarms.py.  emit() turns everything recorded since the
+last call into CloudWatch Embedded Metric Format records, which CloudWatch
+Logs converts into metrics without needing a metric filter.
+"""
+import functools
+import threading
+import time
+
+import chaos
+
+
+NAMESPACE = "BBC/CHAOS-LAMBDA"
+DIMENSIONS = ["Service", "Operation", "Region"]
+# Each region's duration, and the durations of all regions together
+REGION_DIMENSIONS = [["Region"], []]
+UNITS = {
+    "ApiCalls": "Count",
+    "ApiRetries": "Count",
+    "ApiThrottles": "Count",
+    "ApiErrors": "Count",
+    "ApiLatency": "Milliseconds",
+    "RegionDuration": "Milliseconds",
+    # See chaos_recovery
+    "RecoveryReplacement": "Seconds",
+    "RecoveryHealthy": "Seconds",
+    "RecoveryTimeouts": "Count",
+}
+# EMF allows at most 100 values for a metric in one record
+MAX_VALUES = 100
+START_KEY = "chaos_lambda_start"
+
+stats = {}
+region_durations = {}
+stats_lock = threading.Lock()
+
+
+def get_stats(service, operation, region):
+    key = (service, operation, region)
+    s = stats.get(key, None)
+    if s is None:
+        s = stats[key] = {
+            "calls": 0,
+            "retries": 0,
+            "throttles": 0,
+            "errors": 0,
+            "latencies": [],
+        }
+    return s
+
+
+def get_operation(event_name):
+    # eg "after-call.auto-scaling.DescribeAutoScalingGroups"
+    return event_name.rsplit(".", 1)[-1]
+
+
+def before_call(context, **kwargs):
+    context[START_KEY] = time.monotonic()
+
+
+def after_call(service, region, event_name, context, parsed=None,
+               exception=None, **kwargs):
+    start = context.pop(START_KEY, None)
+    latency = 0.0 if start is None else time.monotonic() - start
+    metadata = (parsed or {}).get("ResponseMetadata", {})
+    failed = exception is not None or \
+        chaos.get_error_code(parsed) is not None
+    with stats_lock:
+        s = get_stats(service, get_operation(event_name), region)
+        s["calls"] += 1
+        s["retries"] += metadata.get("RetryAttempts", 0)
+        s["errors"] += 1 if failed else 0
+        s["latencies"].append(round(latency * 1000.0, 3))
+
+
+def needs_retry(service, region, event_name, response=None, **kwargs):
+    # Called after every attempt, so throttled attempts that were retried
+    # successfully are counted too
+    if response is None:
+        return None
+    if chaos.get_error_code(response[1]) in chaos.THROTTLING_ERRORS:
+        with stats_lock:
+            get_stats(service, get_operation(event_name), region)[
+                "throttles"
+            ] += 1
+    return None
+
+
+def instrument(client):
+    service = client.meta.service_model.service_name
+    region = client.meta.region_name
+    events = client.meta.events
+    events.register("before-call", before_call)
+    after = functools.partial(after_call, service, region)
+    events.register("after-call", after)
+    events.register("after-call-error", after)
+    events.register("needs-retry", functools.partial(
+        needs_retry, service, region
+    ))
+    return client
+
+
+def record_region(region, duration):
+    with stats_lock:
+        region_durations.setdefault(region, []).append(
+            round(duration * 1000.0, 3)
+        )
+
+
+def make_record(timestamp, dimensions, values, dimension_sets=None):
+    if dimension_sets is None:
+        dimension_sets = [list(dimensions.keys())]
+    record = {
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": dimension_sets,
+                "Metrics": [
+                    {"Name": name, "Unit": UNITS[name]} for name in values
+                ],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update(values)
+    return record
+
+
+def emit(timestamp=None):
+    if timestamp is None:
+        timestamp = int(time.time() * 1000)
+    with stats_lock:
+        collected = sorted(stats.items())
+        stats.clear()
+        durations = sorted(region_durations.items())
+        region_durations.clear()
+
+    records = []
+    for key, s in collected:
+        dimensions = dict(zip(DIMENSIONS, key))
+        latencies = s["latencies"]
+        records.append(make_record(timestamp, dimensions, {
+            "ApiCalls": s["calls"],
+            "ApiRetries": s["retries"],
+            "ApiThrottles": s["throttles"],
+            "ApiErrors": s["errors"],
+            "ApiLatency": latencies[:MAX_VALUES],
+        }))
+        for i in range(MAX_VALUES, len(latencies), MAX_VALUES):
+            records.append(make_record(timestamp, dimensions, {
+                "ApiLatency": latencies[i:i + MAX_VALUES],
+            }))
+    for region, values in durations:
+        for i in range(0, len(values), MAX_VALUES):
+            records.append(make_record(timestamp, {"Region": region}, {
+                "RegionDuration": values[i:i + MAX_VALUES],
+            }, REGION_DIMENSIONS))
+    return records
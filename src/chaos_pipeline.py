@@ -0,0 +1,168 @@
+"""
+Pipelined processing of a region for Chaos Lambda.
+
+Without it, a region's ASGs are listed in full, then its targets are
+selected, and only then are they terminated, so a run takes as long as all
+three put together.  With the pipeline setting, each stage runs alongside the
+others on its own threads, connected by bounded queues:
+
+* prefetch fetches the next PREFETCH_PAGES pages of the listing in the
+  background while the current one is being processed;
+* select_and_terminate selects targets as each page arrives;
+* Terminator sends the notifications and terminations for each batch of
+  chaos.TERMINATION_BATCH_SIZE targets as soon as it's full, on up to
+  chaos.TERMINATION_WORKERS threads.
+
+A region then takes about as long as its slowest stage, which is usually the
+listing.  The queues bound the memory used, and a stage that falls behind
+holds up the ones before it.  The run's deadline is still checked by the
+listing between pages, so a page prefetched after it has passed is dropped.
+
+Terminations can't wait for the whole selection, so a region_timeout can't
+be applied to it: regions with a budget, or with a termination cap (see
+chaos.TargetReservoir), are processed as usual.
+"""
+import queue
+import threading
+
+import chaos
+
+
+PREFETCH_PAGES = 2
+# Batches selected but not yet being terminated
+TERMINATION_QUEUE = 2
+# How often a stage blocked on a full queue checks if it should stop
+POLL_INTERVAL = 0.05
+
+DONE = object()
+
+
+def start_thread(target):
+    # Threads log and trace as part of the region (and account) that started
+    # them
+    region = getattr(chaos.log_context, "region", None)
+    account = getattr(chaos.log_context, "account", None)
+    parent = chaos.current_span()
+
+    def run():
+        chaos.log_context.region = region
+        chaos.log_context.account = account
+        chaos.resume_span(parent)
+        target()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def prefetch(pages, depth=PREFETCH_PAGES):
+    # Yields pages fetched by a background thread, up to depth pages ahead
+    # of the consumer.  Errors are raised where the page would have been.
+    fetched = queue.Queue(depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                fetched.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((DONE, None))
+        except Exception as e:
+            put((DONE, e))
+
+    thread = start_thread(fetch)
+    try:
+        while True:
+            page, error = fetched.get()
+            if page is DONE:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        # Lets the fetcher finish with the page it's on, so that nothing is
+        # still running once the region is done
+        stopped.set()
+        thread.join()
+
+
+class Terminator:
+    """
+    Terminates the targets added to it in batches, in the background, as
+    soon as each batch is full.  close() terminates what's left and waits
+    for every batch to finish.  If a batch fails, the ones after it are
+    skipped and the error is kept in `error`.
+    """
+
+    def __init__(self, region, account=None,
+                 batch_size=chaos.TERMINATION_BATCH_SIZE,
+                 workers=chaos.TERMINATION_WORKERS):
+        self.region = region
+        self.account = account
+        self.batch_size = batch_size
+        self.workers = workers
+        self.batches = queue.Queue(TERMINATION_QUEUE)
+        self.threads = []
+        self.pending = []
+        self.targets = []
+        self.error = None
+
+    def add(self, target):
+        self.targets.append(target)
+        self.pending.append(target)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        if len(self.threads) < self.workers:
+            self.threads.append(start_thread(self.work))
+        self.batches.put(self.pending)
+        self.pending = []
+
+    def work(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                chaos.terminate_region(self.region, batch, self.account)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.flush()
+        for thread in self.threads:
+            self.batches.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def select_and_terminate(autoscaling, region, default_probability,
+                         asgs=None, account=None, shard=None):
+    # As chaos.get_targets followed by chaos.terminate_region, but with the
+    # two overlapping
+    terminator = Terminator(region, account)
+    try:
+        for target, weight in chaos.iter_targets(
+            autoscaling, default_probability, asgs, shard
+        ):
+            terminator.add(target)
+    finally:
+        # Batches already selected are still terminated if selection fails
+        terminator.close()
+    if terminator.error is not None:
+        raise terminator.error
+    return terminator.targets
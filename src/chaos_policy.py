@@ -0,0 +1,206 @@
+"""
+Termination policies for Chaos Lambda, from chaos-lambda-termination tags.
+
+A tag's value is a policy of space separated clauses, eg
+
+    0.5 hours=10-16 days=mon-fri az=eu-west-1a:2,eu-west-1c:0 min_healthy=2
+
+* a probability between 0.0 and 1.0, in place of the default probability;
+* hours=: the hours of the day (UTC) the ASG can be hit in, as ranges of
+  whole hours, so 10-16 is from 10:00 to 15:59 and 22-2 wraps past midnight;
+* days=: the days of the week the ASG can be hit on, as names or ranges of
+  names, eg mon-fri,sun;
+* az=: weights for choosing the instance to terminate by its availability
+  zone, with 1 for zones not listed and 0 to leave a zone alone;
+* min_healthy=: the number of healthy, in service instances the ASG must
+  keep, so that it's only hit if it has more.
+
+Every clause is optional, so a plain probability is still a policy, and
+lists can be separated by / instead of commas.  Outside its hours or days an
+ASG's probability is 0.
+
+Estates tend to share a handful of policies among many ASGs, so each
+distinct value is compiled once by compile_policy, which keeps the last
+CACHE_SIZE policies for the lifetime of the container.  Invalid values
+compile to None.
+"""
+import functools
+import math
+import random
+import re
+import time
+
+
+CACHE_SIZE = 256
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+HEALTHY = "Healthy"
+IN_SERVICE = "InService"
+
+
+class Policy:
+
+    __slots__ = ("probability", "hours", "days", "zones", "min_healthy")
+
+    def __init__(self, probability=None, hours=None, days=None, zones=None,
+                 min_healthy=None):
+        self.probability = probability
+        self.hours = hours
+        self.days = days
+        self.zones = zones
+        self.min_healthy = min_healthy
+
+    def get_probability(self, default, now=None):
+        # now is a time.struct_time in UTC
+        if self.hours is not None or self.days is not None:
+            if now is None:
+                now = time.gmtime()
+            if self.hours is not None and now.tm_hour not in self.hours:
+                return 0.0
+            if self.days is not None and now.tm_wday not in self.days:
+                return 0.0
+        if self.probability is None:
+            return default
+        return self.probability
+
+    def choose_instance(self, instances):
+        # Returns None if the policy leaves every instance alone
+        if self.min_healthy is not None and \
+                count_healthy(instances) <= self.min_healthy:
+            return None
+        if self.zones is None:
+            return random.choice(instances)
+        # Instances of unknown zones are left alone
+        weights = [
+            self.zones.get(i["AvailabilityZone"], 1.0)
+            if "AvailabilityZone" in i else 0.0
+            for i in instances
+        ]
+        if sum(weights) <= 0.0:
+            return None
+        return random.choices(instances, weights)[0]
+
+
+def count_healthy(instances):
+    # Instances without a health or lifecycle state don't count as healthy,
+    # so that min_healthy errs on the side of leaving the ASG alone
+    return sum(
+        1 for i in instances
+        if i.get("HealthStatus", None) == HEALTHY and
+        i.get("LifecycleState", None) == IN_SERVICE
+    )
+
+
+def split_list(value):
+    items = re.split(r"[,/]", value)
+    if any(len(item) == 0 for item in items):
+        raise ValueError("Empty item in " + value)
+    return items
+
+
+def wrap_range(start, end, size):
+    # The values from start up to but excluding end, wrapping around past
+    # size, eg 22 to 2 of 24 gives 22, 23, 0 and 1
+    values = [start % size]
+    i = (start + 1) % size
+    while i != end % size:
+        values.append(i)
+        i = (i + 1) % size
+    return values
+
+
+def parse_hour(value):
+    hour = int(value)
+    if not 0 <= hour <= 24:
+        raise ValueError("Bad hour " + value)
+    return hour
+
+
+def parse_hours(value):
+    # Hour ranges exclude their end, eg 10-16 ends at 15:59
+    selected = set()
+    for item in split_list(value):
+        start, _, end = item.partition("-")
+        start = parse_hour(start)
+        end = start + 1 if end == "" else parse_hour(end)
+        if start == end:
+            raise ValueError("Empty hours " + item)
+        selected.update(wrap_range(start, end, 24))
+    return frozenset(selected)
+
+
+def parse_day(value):
+    return DAYS.index(value.lower())
+
+
+def parse_days(value):
+    # Day ranges include their end, eg mon-fri
+    selected = set()
+    for item in split_list(value):
+        start, _, end = item.partition("-")
+        start = parse_day(start)
+        end = start if end == "" else parse_day(end)
+        selected.update(wrap_range(start, end + 1, 7))
+    return frozenset(selected)
+
+
+def parse_probability(value):
+    probability = float(value)
+    if not 0.0 <= probability <= 1.0:
+        raise ValueError("Probability out of range " + value)
+    return probability
+
+
+def parse_zones(value):
+    zones = {}
+    for item in split_list(value):
+        zone, _, weight = item.rpartition(":")
+        weight = float(weight)
+        if len(zone) == 0 or not 0.0 <= weight < math.inf:
+            raise ValueError("Bad zone weight " + item)
+        zones[zone] = weight
+    return zones
+
+
+def parse_min_healthy(value):
+    count = int(value)
+    if count < 0:
+        raise ValueError("Negative min_healthy " + value)
+    return count
+
+
+CLAUSES = {
+    "hours": parse_hours,
+    "days": parse_days,
+    "az": parse_zones,
+    "min_healthy": parse_min_healthy,
+}
+
+
+def parse_policy(value):
+    # Raises ValueError for anything that isn't a valid policy
+    fields = {}
+    clauses = value.split()
+    if len(clauses) == 0:
+        raise ValueError("Empty policy")
+    for clause in clauses:
+        key, _, v = clause.rpartition("=")
+        key = key.lower()
+        if key == "":
+            key, parse = "probability", parse_probability
+        elif key in CLAUSES:
+            parse = CLAUSES[key]
+        else:
+            raise ValueError("Unknown clause " + clause)
+        name = "zones" if key == "az" else key
+        if name in fields:
+            raise ValueError("Repeated clause " + clause)
+        fields[name] = parse(v)
+    return Policy(**fields)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def compile_policy(value):
+    try:
+        return parse_policy(value)
+    except ValueError:
+        return None
@@ -0,0 +1,236 @@
+"""
+Opt-in profiling of Chaos Lambda invocations.
+
+When the profile setting is on, chaos.handler runs under cProfile and
+tracemalloc, and once it has finished logs:
+
+* the profile_top (default 20) functions with the most cumulative time,
+  across every thread the invocation started;
+* the peak memory traced during the invocation;
+* the profile_top source lines holding the most memory still allocated at
+  the end of the invocation, and at the largest of the samples a thread
+  takes every PEAK_INTERVAL seconds (see PeakSampler).
+
+cProfile only sees the thread it was enabled on, so each thread started
+during the invocation gets a profiler of its own (see threading.setprofile),
+and their statistics are merged at the end.  Both cProfile and tracemalloc
+slow the lambda down considerably, so durations from a profiled invocation
+are only useful relative to each other.
+
+When profile_path is given, the merged statistics are also saved in pstats
+format, to a local file or an s3://bucket/key URL (uploaded from /tmp).  Any
+{request_id} in the path is replaced with the invocation's request ID, so
+that invocations don't overwrite each other.
+"""
+import cProfile
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+import chaos
+
+
+DEFAULT_TOP = 20
+# Frames kept for each traced allocation; only the innermost is reported
+TRACE_FRAMES = 1
+PEAK_INTERVAL = 0.05
+# Snapshots are costly, so the peak is only snapshotted again once traced
+# memory has grown by this factor
+PEAK_GROWTH = 1.25
+
+# Set while an invocation is being profiled, so that handlers called
+# in-process by it (see chaos_shards.LocalInvoker) aren't profiled again
+active = {"profiler": None}
+
+
+def get_top():
+    v = os.environ.get("profile_top", "").strip()
+    if len(v) == 0:
+        return DEFAULT_TOP
+    else:
+        return max(0, int(v))
+
+
+def get_path(context):
+    path = os.environ.get("profile_path", "").strip()
+    if len(path) == 0:
+        return None
+    request_id = getattr(context, "aws_request_id", None) or "local"
+    return path.replace("{request_id}", request_id)
+
+
+class Profiler:
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start_thread(self, *args):
+        # Installed with threading.setprofile, so it's called by each new
+        # thread's first event, and replaces itself with cProfile's own hook
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ only allows one profiler, which sees every thread
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        threading.setprofile(self.start_thread)
+        self.start_thread()
+
+    def stop(self):
+        # Returns None if no thread could be profiled (eg the lambda is
+        # already running under another profiler)
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        if len(profiles) == 0:
+            return None
+        # Disables the invocation's own thread; threads still running keep
+        # their statistics up to this point
+        profiles[0].disable()
+        return pstats.Stats(*profiles)
+
+
+def take_snapshot():
+    # Leaves out the profilers' own statistics
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, module.__file__)
+        for module in (cProfile, pstats, tracemalloc)
+    ])
+
+
+class PeakSampler:
+    # tracemalloc only gives the size of the peak, not what made it up, so
+    # a thread samples traced memory and keeps the allocation statistics of
+    # the largest sample
+
+    def __init__(self, top):
+        self.top = top
+        self.peak = 0
+        self.size = 0
+        self.statistics = []
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(PEAK_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        if current <= self.size * PEAK_GROWTH:
+            return
+        self.statistics = take_snapshot().statistics("lineno")[:self.top]
+        self.size = current
+        # Leaves the snapshot's own allocations out of later peaks
+        tracemalloc.reset_peak()
+
+    def stop(self):
+        # Returns the traced memory now, and at its peak
+        self.stopping.set()
+        self.thread.join()
+        current, peak = tracemalloc.get_traced_memory()
+        return current, max(self.peak, peak)
+
+
+def get_function_name(function):
+    filename, line, name = function
+    if filename == "~":
+        # Built in, eg "<method 'acquire' of '_thread.lock' objects>"
+        return name
+    return "%s:%d(%s)" % (os.path.basename(filename), line, name)
+
+
+def log_functions(stats, top):
+    stats.sort_stats("cumulative")
+    for rank, function in enumerate(stats.fcn_list[:top], 1):
+        calls, primitive, own, cumulative, callers = stats.stats[function]
+        name = get_function_name(function)
+        chaos.log(
+            "profile-function", str(rank), name,
+            "%.3fs" % cumulative, "cumulative", "%.3fs" % own, "own",
+            str(calls), "calls",
+            rank=rank, function=name, cumulative=round(cumulative, 6),
+            own=round(own, 6), calls=calls
+        )
+
+
+def log_allocations(event, statistics):
+    for rank, stat in enumerate(statistics, 1):
+        frame = stat.traceback[0]
+        site = "%s:%d" % (os.path.basename(frame.filename), frame.lineno)
+        chaos.log(
+            event, str(rank), site,
+            "%dKB" % (stat.size // 1024), "in", str(stat.count), "blocks",
+            rank=rank, site=site, size_kb=stat.size // 1024, blocks=stat.count
+        )
+
+
+def log_memory(statistics, peak_statistics, peak, current):
+    chaos.log(
+        "profile-memory", "%dKB" % (peak // 1024), "peak",
+        "%dKB" % (current // 1024), "at end",
+        peak_kb=peak // 1024, current_kb=current // 1024
+    )
+    log_allocations("profile-allocation", statistics)
+    log_allocations("profile-peak-allocation", peak_statistics)
+
+
+def report(stats, memory, path, top):
+    if stats is not None:
+        log_functions(stats, top)
+    log_memory(*memory)
+    if path is None or stats is None:
+        return
+    local_path = chaos.get_output_path(path, ".pstats")
+    if chaos.save_output("profile", path, local_path,
+                         lambda: stats.dump_stats(local_path)):
+        chaos.log("profile-saved", path)
+
+
+def profile(f, event, context):
+    # Calls f(event, context) under the profilers, and logs what they found
+    # even if it fails
+    if active["profiler"] is not None:
+        return f(event, context)
+    top = get_top()
+    path = get_path(context)
+    profiler = active["profiler"] = Profiler()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(TRACE_FRAMES)
+    tracemalloc.reset_peak()
+    # Started before the profiler, which would otherwise profile it too
+    sampler = PeakSampler(top)
+    sampler.start()
+    start = time.monotonic()
+    profiler.start()
+    try:
+        return f(event, context)
+    finally:
+        # Memory is measured first, so that it leaves out the profilers'
+        # statistics
+        current, peak = sampler.stop()
+        statistics = take_snapshot().statistics("lineno")[:top]
+        memory = (statistics, sampler.statistics, peak, current)
+        if not tracing:
+            tracemalloc.stop()
+        stats = profiler.stop()
+        active["profiler"] = None
+        duration = time.monotonic() - start
+        chaos.log(
+            "profiled", "after", "%.3fs" % duration,
+            duration=round(duration, 3)
+        )
+        report(stats, memory, path, top)
+        chaos.flush_log()
@@ -0,0 +1,166 @@
+"""
+Client-side adaptive rate limiting of Chaos Lambda's AWS API calls.
+
+Auto Scaling and EC2 throttle each account as a whole, so a run competes for
+the same allowance as everything else in the account, such as deploy
+tooling.  With the rate_limit setting, install() makes every attempt of
+every call from a client (including botocore's retries) first take a token
+from a RateLimiter shared by all the clients and threads calling the same
+service in the same region of the same account.  Tokens are added at the
+limiter's current rate, up to a second's worth, and callers wait for them.
+
+The rate starts at, and never rises above, rate_limit calls per second.  It
+adapts to the throttling the account is seeing:
+* a throttled attempt multiplies it by BACKOFF, down to MIN_RATE, but only
+  once per BACKOFF_INTERVAL seconds, as the attempts already in flight are
+  likely to be throttled too;
+* a successful attempt adds RAMP_UP calls per second back.
+
+Limiters last for the lifetime of the container, so a warm lambda starts at
+the rate the last run ended with.  botocore's adaptive retry mode keeps a
+limiter of its own for each client, so chaos.get_client_config uses its
+standard mode instead while the setting is on.
+"""
+import functools
+import threading
+import time
+
+import chaos
+
+
+BACKOFF = 0.5
+BACKOFF_INTERVAL = 1.0
+MIN_RATE = 0.5
+RAMP_UP = 0.1
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+
+    def __init__(self, max_rate, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = max(MIN_RATE, max_rate)
+        self.rate = self.max_rate
+        self.tokens = self.get_capacity()
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.backed_off = None
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.attempts = 0
+        self.throttles = 0
+        self.waited = 0.0
+
+    def get_capacity(self):
+        # A second's worth of tokens, and at least one
+        return max(1.0, self.rate)
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(
+            self.get_capacity(), self.tokens + elapsed * self.rate
+        )
+        self.updated = now
+
+    def acquire(self):
+        # Returns the time waited.  The token is taken straight away, and
+        # the wait for it happens outside the lock, so that callers queue up
+        # in order without holding each other up.
+        with self.lock:
+            self.refill(self.clock())
+            self.tokens -= 1.0
+            wait = 0.0 if self.tokens >= 0.0 else -self.tokens / self.rate
+            self.attempts += 1
+            self.waited += wait
+        if wait > 0.0:
+            self.sleep(wait)
+        return wait
+
+    def on_throttle(self):
+        with self.lock:
+            now = self.clock()
+            self.throttles += 1
+            if self.backed_off is not None and \
+                    now - self.backed_off < BACKOFF_INTERVAL:
+                return
+            self.refill(now)
+            self.rate = max(MIN_RATE, self.rate * BACKOFF)
+            self.tokens = min(self.tokens, self.get_capacity())
+            self.backed_off = now
+
+    def on_success(self):
+        with self.lock:
+            self.refill(self.clock())
+            self.rate = min(self.max_rate, self.rate + RAMP_UP)
+
+    def take_stats(self):
+        with self.lock:
+            stats = {
+                "attempts": self.attempts,
+                "throttles": self.throttles,
+                "waited": self.waited,
+                "rate": self.rate,
+            }
+            self.reset_stats()
+        return stats
+
+
+def get_limiter(service, region, account, max_rate):
+    key = (service, region, account)
+    with limiters_lock:
+        limiter = limiters.get(key, None)
+        if limiter is None:
+            limiter = limiters[key] = RateLimiter(max_rate)
+        return limiter
+
+
+def before_send(limiter, **kwargs):
+    # botocore before-send handler, called for every attempt.  Returning
+    # None lets the request be sent as usual.
+    limiter.acquire()
+
+
+def needs_retry(limiter, response=None, **kwargs):
+    # botocore needs-retry handler, called after every attempt.  Returning
+    # None leaves the decision to retry to botocore.  Attempts without a
+    # response (connection errors) say nothing about the rate.
+    if response is None:
+        return None
+    code = chaos.get_error_code(response[1])
+    if code in chaos.THROTTLING_ERRORS:
+        limiter.on_throttle()
+    elif code is None:
+        limiter.on_success()
+    return None
+
+
+def install(client, max_rate, account=None):
+    limiter = get_limiter(
+        client.meta.service_model.service_name, client.meta.region_name,
+        account, max_rate
+    )
+    events = client.meta.events
+    events.register("before-send", functools.partial(before_send, limiter))
+    events.register("needs-retry", functools.partial(needs_retry, limiter))
+    return client
+
+
+def take_stats():
+    # Returns ((service, region, account), stats) for each limiter that was
+    # used since the last call, sorted
+    with limiters_lock:
+        items = sorted(
+            limiters.items(),
+            key=lambda item: (item[0][0], item[0][1], item[0][2] or "")
+        )
+    taken = [(key, limiter.take_stats()) for key, limiter in items]
+    return [(key, stats) for key, stats in taken if stats["attempts"] != 0]
+
+
+def reset():
+    with limiters_lock:
+        limiters.clear()
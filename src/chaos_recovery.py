@@ -0,0 +1,267 @@
+"""
+Recovery tracking for Chaos Lambda: how long each ASG takes to get back to
+its desired capacity after losing an instance.
+
+When the recovery setting is on, every instance terminated successfully is
+recorded by record(), and at the end of the invocation start() hands the
+ASGs they belonged to to a tracker: an asynchronous invocation of the
+function named by the recovery_function setting (or the same function) with
+a {"recovery": ...} event.  The tracker polls only those ASGs,
+with one DescribeAutoScalingGroups call for up to chaos.ASG_NAME_BATCH_SIZE
+of them in each region, POLL_INTERVAL seconds apart at first and backing off
+by BACKOFF up to MAX_POLL_INTERVAL.  For each ASG it notes when it was:
+
+* replaced: back to its desired capacity, not counting the terminated
+  instance or any others that are terminating or detaching;
+* healthy: back to its desired capacity of InService, Healthy instances.
+
+Both are measured from the termination, to the poll that saw them, and are
+logged and published as the RecoveryReplacement and RecoveryHealthy metrics
+(in seconds) by Region, and also by Region and AutoScalingGroupName with the
+recovery_asg_metrics setting (which makes a custom metric of every ASG hit).
+ASGs that aren't healthy within recovery_timeout seconds (default
+DEFAULT_TIMEOUT) are given up on and counted in RecoveryTimeouts.
+
+A tracker about to run out of time passes the ASGs it's still waiting for on
+to a new invocation.  At most MAX_TRACKED terminations are tracked, sampled
+at random from a larger run, so that each poll costs at most MAX_TRACKED /
+ASG_NAME_BATCH_SIZE calls, and fewer if they wouldn't fit in the
+MAX_EVENT_BYTES of an asynchronous invocation's event.  There's nothing to
+invoke when running locally (without a lambda context), so nothing is
+tracked.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+import chaos
+import chaos_metrics
+
+
+DEFAULT_TIMEOUT = 1800.0
+MAX_TRACKED = 1000
+# Lambda's limit on an asynchronous invocation's payload
+MAX_EVENT_BYTES = 256 * 1024
+POLL_INTERVAL = 10.0
+BACKOFF = 1.5
+MAX_POLL_INTERVAL = 60.0
+DIMENSIONS = [["Region"]]
+ASG_DIMENSIONS = [["Region", "AutoScalingGroupName"], ["Region"]]
+# Instances on their way out of the ASG, which won't count towards its
+# capacity for much longer
+LEAVING_STATES = ("Terminating", "Terminated", "Detaching", "Detached")
+
+terminations = []
+terminations_lock = threading.Lock()
+
+
+def get_timeout():
+    v = os.environ.get("recovery_timeout", "").strip()
+    if len(v) == 0:
+        return DEFAULT_TIMEOUT
+    else:
+        return float(v)
+
+
+def record(region, account, targets, results):
+    # Called with the targets given to chaos.terminate_targets and the
+    # (instance_id, state) results of the ones it terminated
+    now = time.time()
+    asg_names = dict((i, asg_name) for (asg_name, i) in targets)
+    with terminations_lock:
+        for instance_id, state in results:
+            terminations.append({
+                "region": region,
+                "account": account,
+                "asg": asg_names.get(instance_id, None),
+                "instance": instance_id,
+                "terminated": now,
+                "replaced": None,
+            })
+
+
+def get_dimensions():
+    if chaos.get_env_flag("recovery_asg_metrics"):
+        return ASG_DIMENSIONS
+    return DIMENSIONS
+
+
+def take_terminations():
+    with terminations_lock:
+        taken = [t for t in terminations if t["asg"] is not None]
+        del terminations[:]
+    return taken
+
+
+class LambdaStarter:
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+
+    def __call__(self, event):
+        client = chaos.get_client("lambda", os.environ.get("AWS_REGION", ""))
+        client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="Event",
+            Payload=json.dumps(event).encode("utf-8")
+        )
+
+
+def make_event(tracked, interval):
+    return {"recovery": {"asgs": tracked, "interval": interval}}
+
+
+def sample_tracked(tracked, interval):
+    # A random sample of at most MAX_TRACKED entries whose event, as
+    # LambdaStarter encodes it, is within MAX_EVENT_BYTES
+    sample = random.sample(tracked, min(len(tracked), MAX_TRACKED))
+    size = len(json.dumps(make_event([], interval)).encode("utf-8"))
+    for i, entry in enumerate(sample):
+        # Entries after the first are separated by ", "
+        size += len(json.dumps(entry).encode("utf-8")) + (2 if i else 0)
+        if size > MAX_EVENT_BYTES:
+            return sample[:i]
+    return sample
+
+
+def hand_over(starter, tracked, interval):
+    try:
+        starter(make_event(tracked, interval))
+    except Exception as e:
+        chaos.log("recovery-failed", "[" + str(e) + "]")
+
+
+def get_function_name(context):
+    # The tracker may be a function of its own, with a longer timeout
+    return os.environ.get("recovery_function", "").strip() or \
+        context.function_name
+
+
+def start(context):
+    # Hands this invocation's terminations to a tracker
+    tracked = take_terminations()
+    if context is None or len(tracked) == 0:
+        return
+    sample = sample_tracked(tracked, POLL_INTERVAL)
+    chaos.log(
+        "recovery-tracking", str(len(sample)), "of", str(len(tracked)),
+        "terminations"
+    )
+    hand_over(
+        LambdaStarter(get_function_name(context)), sample, POLL_INTERVAL
+    )
+
+
+def is_leaving(instance, terminated):
+    state = instance.get("LifecycleState", "")
+    return instance.get("InstanceId", None) == terminated or \
+        state.startswith(LEAVING_STATES)
+
+
+def check(entry, asg, now):
+    # Returns True once the ASG is healthy again
+    desired = asg.get("DesiredCapacity", 0)
+    staying = [
+        i for i in asg.get("Instances", [])
+        if not is_leaving(i, entry["instance"])
+    ]
+    if entry["replaced"] is None and len(staying) >= desired:
+        entry["replaced"] = now
+    if entry["replaced"] is None:
+        return False
+    healthy = sum(
+        1 for i in staying
+        if i.get("LifecycleState", None) == "InService" and
+        i.get("HealthStatus", None) == "Healthy"
+    )
+    return healthy >= desired
+
+
+def report(entry, now):
+    replaced = entry["replaced"] - entry["terminated"]
+    healthy = now - entry["terminated"]
+    chaos.log(
+        "recovered", entry["asg"], "in", entry["region"],
+        "replaced", "after", "%.1fs" % replaced,
+        "healthy", "after", "%.1fs" % healthy,
+        *chaos.in_account(entry["account"]),
+        asg=entry["asg"], replaced=round(replaced, 1),
+        healthy=round(healthy, 1)
+    )
+    return chaos_metrics.make_record(int(now * 1000), {
+        "Region": entry["region"], "AutoScalingGroupName": entry["asg"],
+    }, {
+        "RecoveryReplacement": round(replaced, 1),
+        "RecoveryHealthy": round(healthy, 1),
+    }, get_dimensions())
+
+
+def report_timeout(entry, now):
+    waited = now - entry["terminated"]
+    chaos.log(
+        "recovery-timeout", entry["asg"], "in", entry["region"],
+        "after", "%.1fs" % waited, *chaos.in_account(entry["account"]),
+        asg=entry["asg"]
+    )
+    return chaos_metrics.make_record(int(now * 1000), {
+        "Region": entry["region"], "AutoScalingGroupName": entry["asg"],
+    }, {"RecoveryTimeouts": 1}, get_dimensions())
+
+
+def poll(tracked, timeout):
+    # Returns the entries still to be tracked
+    by_region = {}
+    for entry in tracked:
+        key = (entry["account"], entry["region"])
+        by_region.setdefault(key, []).append(entry)
+    pending = []
+    for (account, region), entries in sorted(
+        by_region.items(), key=lambda item: (item[0][0] or "", item[0][1])
+    ):
+        autoscaling = chaos.get_client("autoscaling", region, account)
+        names = sorted(set(entry["asg"] for entry in entries))
+        asgs = {}
+        try:
+            for asg in chaos.get_asgs_by_name(autoscaling, names):
+                asgs[asg["AutoScalingGroupName"]] = asg
+        except Exception as e:
+            # Try again on the next poll
+            chaos.log(
+                "recovery-failed", "[" + str(e) + "]", "polling", region,
+                *chaos.in_account(account)
+            )
+            pending.extend(entries)
+            continue
+        now = time.time()
+        for entry in entries:
+            asg = asgs.get(entry["asg"], None)
+            if asg is None:
+                # Deleted since, so there's nothing to recover
+                continue
+            if check(entry, asg, now):
+                chaos.log_record(report(entry, now))
+            elif now - entry["terminated"] >= timeout:
+                chaos.log_record(report_timeout(entry, now))
+            else:
+                pending.append(entry)
+    return pending
+
+
+def track(event, context, sleep=time.sleep):
+    # Runs a tracker invocation, until every ASG has recovered or been given
+    # up on, or it's time to pass the rest on
+    tracked = event["asgs"]
+    interval = event.get("interval", POLL_INTERVAL)
+    timeout = get_timeout()
+    while len(tracked) != 0:
+        deadline = chaos.run_deadline["time"]
+        if deadline is not None and time.monotonic() + interval >= deadline:
+            tracked = sample_tracked(tracked, interval)
+            hand_over(LambdaStarter(context.function_name), tracked, interval)
+            return {"tracked": len(tracked), "handed_over": True}
+        sleep(interval)
+        interval = min(interval * BACKOFF, MAX_POLL_INTERVAL)
+        tracked = poll(tracked, timeout)
+    return {"tracked": 0, "handed_over": False}
@@ -0,0 +1,262 @@
+"""
+Sharded runs of Chaos Lambda, for estates too large to process in a single
+invocation.
+
+When the shards setting is greater than one, the scheduled invocation acts
+as a coordinator: every account x region work item is split into that many
+shards, each of which is handed to a worker invocation of the same function.
+ASGs belong to the shard given by a CRC32 of their name (see
+chaos.get_shard), so they always land in the same shard.  All the workers are
+invoked at once, up to chaos.SHARD_WORKERS, and each one selects and
+terminates the targets in its own shard.
+
+The coordinator lists each region's ASGs once and hands every worker the
+names in its shard, which the worker describes by name, rather than having
+each worker list the whole region.  The listing stops at the coordinator's
+deadline like an unsharded one, and the workers then handle the names listed
+so far, leaving the rest of the region to the next run's checkpoint.  With
+the inventory or two-phase selection the workers never describe the whole
+region, so they skip the ASGs outside their shard themselves instead.
+
+The coordinator hands every worker the time it has left, and a worker stops
+listing by the earlier of the coordinator's deadline and its own, so that
+the coordinator is still running to collect the results.  Shards that
+haven't been invoked by the coordinator's deadline are deferred.
+
+Global limits are enforced by the coordinator: with max_terminations set, the
+workers only sample their targets and send the samples back, and the
+coordinator merges them and terminates the overall sample itself, as an
+unsharded run would.
+
+Workers are invoked synchronously with the Lambda Invoke API.  LocalInvoker
+runs them in-process instead, for tests and local runs.
+"""
+import json
+import os
+import time
+
+import chaos
+
+
+class LambdaInvoker:
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+
+    def __call__(self, event):
+        client = chaos.get_client("lambda", os.environ.get("AWS_REGION", ""))
+        response = client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps(event).encode("utf-8")
+        )
+        payload = json.loads(response["Payload"].read() or b"null")
+        if "FunctionError" in response:
+            message = (payload or {}).get("errorMessage", "unknown error")
+            raise RuntimeError(message)
+        return payload
+
+
+class LocalInvoker:
+    # Stand-in for LambdaInvoker that calls a handler in-process, with the
+    # same JSON round trip for the event and the result
+
+    def __init__(self, handler=None):
+        self.handler = handler or chaos.handler
+
+    def __call__(self, event):
+        # The worker's deadline replaces the coordinator's while it runs
+        deadline = chaos.run_deadline["time"]
+        try:
+            result = self.handler(json.loads(json.dumps(event)), None)
+        finally:
+            chaos.run_deadline["time"] = deadline
+        return json.loads(json.dumps(result))
+
+
+def make_shard(account, region, index, count, sample, names=None):
+    shard = {
+        "account": account,
+        "region": region,
+        "index": index,
+        "count": count,
+        "sample": sample,
+    }
+    if names is not None:
+        shard["names"] = names
+    return shard
+
+
+def list_names(account, region, default_probability, token=None):
+    # Returns the names of the ASGs in the region that could be targeted (or
+    # None if the workers won't list the region anyway), and the NextToken
+    # the listing stopped at if it ran out of time.  The listing resumes
+    # from token.
+    if account is None and chaos.use_inventory():
+        return None, None
+    if chaos.use_two_phase_selection(default_probability):
+        return None, None
+    autoscaling = chaos.get_client("autoscaling", region, account)
+    chaos.listing.start_token = token
+    chaos.listing.next_token = None
+    asgs = chaos.get_all_asgs(
+        autoscaling, chaos.get_asg_filters(default_probability)
+    )
+    names = [asg["AutoScalingGroupName"] for asg in asgs]
+    return names, chaos.listing.next_token
+
+
+def split_names(names, count):
+    batches = [[] for index in range(count)]
+    for name in names:
+        batches[chaos.get_shard(name, count)].append(name)
+    return batches
+
+
+def run_worker(shard, default_probability, region_budget):
+    reservoir = None
+    if shard.get("sample", None) is not None:
+        reservoir = chaos.TargetReservoir(shard["sample"])
+    region, status, n, duration = chaos.run_region(
+        shard["region"], default_probability, region_budget, reservoir,
+        shard.get("account", None), (shard["index"], shard["count"]),
+        names=shard.get("names", None)
+    )
+    result = {"status": status, "targets": n, "duration": duration}
+    if reservoir is not None:
+        result["added"] = reservoir.added
+        result["sample"] = reservoir.items()
+    return result
+
+
+class ShardRunner:
+
+    def __init__(self, invoker, count, workers=chaos.SHARD_WORKERS):
+        self.invoker = invoker
+        self.count = count
+        self.workers = workers
+        # The NextToken each work item's listing stopped at in the last run,
+        # for checkpoints
+        self.next_tokens = {}
+
+    def list_item(self, item, default_probability, token=None):
+        # Returns the item's status so far, the names in each of its shards
+        # (or Nones, or None if no shards are to be invoked) and the
+        # NextToken its listing stopped at
+        if chaos.past_deadline():
+            return "deferred", None, token
+        account, region = item
+        chaos.log_context.region = region
+        chaos.log_context.account = account
+        try:
+            names, token = list_names(
+                account, region, default_probability, token
+            )
+        except Exception as e:
+            chaos.log("shard-error", region, e, *chaos.in_account(account))
+            return "error", None, None
+        finally:
+            chaos.log_context.region = None
+            chaos.log_context.account = None
+        if names is None:
+            return "ok", [None] * self.count, None
+        status = "ok" if token is None else "partial"
+        return status, split_names(names, self.count), token
+
+    def invoke(self, shard):
+        account, region = shard["account"], shard["region"]
+        words = chaos.in_account(account, (shard["index"], shard["count"]))
+        start = time.monotonic()
+        chaos.log_context.region = region
+        chaos.log_context.account = account
+        try:
+            deadline = chaos.run_deadline["time"]
+            try:
+                if deadline is None:
+                    result = self.invoker({"shard": shard})
+                elif chaos.past_deadline():
+                    result = {"status": "deferred", "targets": 0}
+                else:
+                    remaining = round(deadline - time.monotonic(), 3)
+                    result = self.invoker(
+                        {"shard": dict(shard, remaining=remaining)}
+                    )
+            except Exception as e:
+                chaos.log("shard-error", region, e, *words)
+                result = {"status": "error", "targets": 0}
+            duration = time.monotonic() - start
+            chaos.log(
+                "shard-result", region, "is", result["status"],
+                "after", "%.3fs" % duration,
+                "with", str(result["targets"]), "targets", *words,
+                duration=round(duration, 3)
+            )
+        finally:
+            chaos.log_context.region = None
+            chaos.log_context.account = None
+        return result, duration
+
+    def run(self, items, reservoirs, default_probability,
+            max_terminations=None, tokens=None):
+        # Returns a result for each work item like chaos.run_region's, and
+        # merges the shards' samples into the items' reservoirs.  tokens
+        # holds the NextToken to resume each item's listing from.
+        start = time.monotonic()
+        tokens = tokens or {}
+        listed = chaos.map_regions(
+            lambda item: self.list_item(
+                item, default_probability, tokens.get(item, None)
+            ),
+            items, min(self.workers, len(items))
+        )
+        self.next_tokens = dict(
+            (item, token) for item, (status, batches, token)
+            in zip(items, listed)
+        )
+        shards = [
+            (item, make_shard(item[0], item[1], index, self.count,
+                              max_terminations, batches[index]))
+            for item, (status, batches, token) in zip(items, listed)
+            if batches is not None
+            for index in range(self.count)
+        ]
+        outcomes = chaos.map_regions(
+            lambda shard: self.invoke(shard[1]),
+            shards, min(self.workers, len(shards))
+        )
+
+        # A work item is only "ok" if its listing and all of its shards
+        # were, and fails without any if its region couldn't be listed
+        merged = {}
+        for item, (status, batches, token) in zip(items, listed):
+            duration = 0.0
+            if batches is None:
+                duration = time.monotonic() - start
+            merged[item] = [status, 0, duration]
+        for (item, shard), (result, duration) in zip(shards, outcomes):
+            summary = merged[item]
+            summary[0] = chaos.get_worst_status(summary[0], result["status"])
+            summary[1] += result["targets"]
+            # Shards run side by side, so the item took as long as the
+            # slowest of them
+            summary[2] = max(summary[2], duration)
+            reservoir = reservoirs.get(item, None)
+            if reservoir is not None and \
+                    result["status"] in chaos.SAMPLED_STATUSES:
+                reservoir.added += result["added"]
+                for key, target in result["sample"]:
+                    reservoir.push(key, tuple(target))
+        return [
+            (item[1], merged[item][0], merged[item][1], merged[item][2])
+            for item in items
+        ]
+
+
+def make_runner(context, count):
+    # Workers are invocations of the coordinator's own function, or run
+    # in-process when there's no function (eg running locally, or a bench's
+    # stand-in context)
+    function_name = getattr(context, "function_name", None)
+    if function_name is None:
+        return ShardRunner(LocalInvoker(), count)
+    return ShardRunner(LambdaInvoker(function_name), count)
@@ -0,0 +1,272 @@
+"""
+Tracing of Chaos Lambda invocations.
+
+When the trace_exporter setting is "log" or "xray", each invocation records
+a tree of timed spans:
+
+    invocation
+      region (one per work item, or shard)
+        select
+          list (one per page of DescribeAutoScalingGroups, DescribeTags...)
+        notify
+        terminate
+
+Each span carries attributes such as the region, the number of items on a
+page, the number of targets and the number of AWS API calls made while it
+(and the spans under it) were running.  Spans started by another thread are
+placed under the invocation, unless the thread carries on the span of the
+thread that started it (see chaos.resume_span).  At most MAX_SPANS are kept;
+the number left out is given by the invocation's dropped_spans attribute.
+
+At the end of the invocation the tree is exported as a single X-Ray segment
+document, with each span as a subsegment and its attributes as annotations:
+
+* "log" writes it as one JSON line, {"event": "trace", "segment": ...};
+* "xray" sends it to the X-Ray daemon, under the lambda's own segment if
+  active tracing is on (and only if the invocation was sampled).  The
+  daemon takes documents of up to MAX_DOCUMENT_BYTES, so subsegments that
+  don't fit in their parent's document are sent as documents of their own.
+
+With the default of "none" no spans are recorded at all, and chaos.span
+returns a shared do-nothing span.
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+import chaos
+
+
+EXPORTERS = ("none", "log", "xray")
+MAX_SPANS = 1000
+DAEMON_ADDRESS = "127.0.0.1:2000"
+DAEMON_HEADER = '{"format": "json", "version": 1}\n'
+# Largest UDP datagram the daemon accepts
+MAX_DOCUMENT_BYTES = 64 * 1024
+
+
+def new_id():
+    return os.urandom(8).hex()
+
+
+def new_trace_id():
+    return "1-%08x-%s" % (int(time.time()), os.urandom(12).hex())
+
+
+def get_trace_header():
+    # eg "Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;
+    # Sampled=1", set by the lambda runtime when active tracing is on
+    header = os.environ.get("_X_AMZN_TRACE_ID", "")
+    return dict(
+        part.split("=", 1) for part in header.split(";") if "=" in part
+    )
+
+
+class Span:
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.id = new_id()
+        self.start = None
+        self.end = None
+        self.calls = 0
+        self.fault = False
+        self.discarded = False
+        self.children = []
+
+    def __enter__(self):
+        self.start = time.time()
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time()
+        self.fault = exc_type is not None
+        self.tracer.pop(self)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def discard(self):
+        self.discarded = True
+
+    def count_call(self):
+        self.calls += 1
+
+
+class Tracer:
+
+    def __init__(self, exporter, attributes=None):
+        self.exporter = exporter
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.spans = 0
+        self.dropped = 0
+        self.root = Span(self, "invocation", dict(attributes or {}))
+        self.root.start = time.time()
+
+    def current(self):
+        stack = getattr(self.local, "stack", None)
+        if not stack:
+            return self.root
+        return stack[-1]
+
+    def span(self, name, attributes):
+        span = Span(self, name, attributes)
+        parent = self.current()
+        with self.lock:
+            if self.spans < MAX_SPANS:
+                parent.children.append(span)
+                self.spans += 1
+            else:
+                self.dropped += 1
+        return span
+
+    def push(self, span):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(span)
+
+    def pop(self, span):
+        stack = getattr(self.local, "stack", None)
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def resume(self, span):
+        if isinstance(span, Span):
+            self.local.stack = [span]
+
+    def finish(self):
+        self.root.end = time.time()
+        if self.dropped != 0:
+            self.root.set(dropped_spans=self.dropped)
+        return make_document(self.root, self.root.end)[0]
+
+
+def make_document(span, now):
+    # Returns the span as an X-Ray (sub)segment, and the number of API calls
+    # made under it
+    children = []
+    calls = span.calls
+    with span.tracer.lock:
+        spans = list(span.children)
+    for child in spans:
+        if child.discarded or child.start is None:
+            continue
+        document, child_calls = make_document(child, now)
+        children.append(document)
+        calls += child_calls
+    annotations = dict(
+        (k, v) for k, v in span.attributes.items() if v is not None
+    )
+    annotations["api_calls"] = calls
+    document = {
+        "name": span.name,
+        "id": span.id,
+        "start_time": round(span.start, 6),
+        # Spans still running on other threads end with the invocation
+        "end_time": round(span.end if span.end is not None else now, 6),
+        "annotations": annotations,
+    }
+    if span.fault:
+        document["fault"] = True
+    if len(children) != 0:
+        document["subsegments"] = children
+    return document, calls
+
+
+def export_log(document):
+    chaos.log_record({"event": "trace", "segment": document})
+
+
+def get_daemon_address():
+    # Either "host:port" or "tcp:host:port udp:host:port"
+    address = os.environ.get("AWS_XRAY_DAEMON_ADDRESS", "") or DAEMON_ADDRESS
+    for part in address.split():
+        if part.startswith("udp:"):
+            address = part[len("udp:"):]
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def encode(document):
+    return json.dumps(document, separators=(",", ":")).encode("utf-8")
+
+
+def split_document(document, trace_id):
+    # Yields the document with as many of its subsegments as fit, then the
+    # others as subsegments of it in documents of their own, split likewise
+    size = len(DAEMON_HEADER) + len(encode(document))
+    if size <= MAX_DOCUMENT_BYTES:
+        yield document
+        return
+    children = document.pop("subsegments", [])
+    size = len(DAEMON_HEADER) + len(encode(document))
+    if size > MAX_DOCUMENT_BYTES:
+        raise ValueError("Span of %d bytes is too large" % size)
+    # Leaves room for the subsegments list's name and brackets, and a comma
+    # between each of them
+    size += len(',"subsegments":[]')
+    kept, detached = [], []
+    for child in children:
+        child_size = len(encode(child)) + (1 if kept else 0)
+        if size + child_size <= MAX_DOCUMENT_BYTES:
+            kept.append(child)
+            size += child_size
+        else:
+            detached.append(child)
+    if len(kept) != 0:
+        document["subsegments"] = kept
+    yield document
+    for child in detached:
+        child.update(
+            trace_id=trace_id, parent_id=document["id"], type="subsegment"
+        )
+        yield from split_document(child, trace_id)
+
+
+def export_xray(document):
+    header = get_trace_header()
+    if header.get("Sampled", None) == "0":
+        return
+    if "Root" in header and "Parent" in header:
+        # A subsegment of the segment the lambda runtime sends
+        document["trace_id"] = header["Root"]
+        document["parent_id"] = header["Parent"]
+        document["type"] = "subsegment"
+    else:
+        document["trace_id"] = new_trace_id()
+    # Everything is split before anything is sent, so that a span too large
+    # to send at all loses the whole trace rather than part of it
+    datagrams = [
+        (DAEMON_HEADER.encode("utf-8") + encode(d))
+        for d in split_document(document, document["trace_id"])
+    ]
+    address = get_daemon_address()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for data in datagrams:
+            sock.sendto(data, address)
+    finally:
+        sock.close()
+
+
+EXPORT = {
+    "log": export_log,
+    "xray": export_xray,
+}
+
+
+def finish(tracer):
+    document = tracer.finish()
+    try:
+        EXPORT[tracer.exporter](document)
+    except Exception as e:
+        # Losing the trace shouldn't fail the run
+        chaos.log("trace-failed", tracer.exporter, "[" + str(e) + "]")
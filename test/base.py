@@ -4,6 +4,60 @@ from unittest import TestCase
 from unittest.mock import Mock, patch
 
 
+def make_asg(name, instances=None, tags=(), **fields):
+    # instances are instance ids or instance dicts, by default one instance
+    # named after the ASG
+    if instances is None:
+        instances = ["i-" + name]
+    instances = [
+        {"InstanceId": i, "AvailabilityZone": "sp-moonbase-1a",
+         "HealthStatus": "Healthy", "LifecycleState": "InService",
+         "ProtectedFromScaleIn": False} if isinstance(i, str) else i
+        for i in instances
+    ]
+    asg = {
+        "AutoScalingGroupName": name,
+        "MinSize": len(instances),
+        "DesiredCapacity": len(instances),
+        "Instances": instances,
+        "Tags": [
+            {"ResourceId": name, "Key": k, "Value": v,
+             "PropagateAtLaunch": False}
+            for k, v in tags
+        ],
+    }
+    asg.update(fields)
+    return asg
+
+
+def make_asgs(count):
+    return [make_asg("asg-%d" % i, ["i-%d" % i]) for i in range(count)]
+
+
+class FakeEvents:
+    # Stands in for a botocore client's event system
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event_name, handler):
+        self.handlers.setdefault(event_name, []).append(handler)
+
+    def emit(self, event_name, **kwargs):
+        return [
+            handler(event_name=event_name, **kwargs)
+            for handler in self.handlers.get(event_name.split(".")[0], [])
+        ]
+
+
+def make_client(service="autoscaling", region="sp-moonbase-1"):
+    client = Mock()
+    client.meta.service_model.service_name = service
+    client.meta.region_name = region
+    client.meta.events = FakeEvents()
+    return client
+
+
 class PatchingTestCase(TestCase):
 
     patch_list = ()
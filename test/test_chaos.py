@@ -1,5 +1,8 @@
 import json
+import os
+import random
 import re
+import time
 
 from unittest import mock
 
@@ -11,6 +14,127 @@ with mocked_imports([
     import chaos
 
 
+class TestLog(PatchingTestCase):
+
+    patch_list = (
+        "chaos.sys",
+        "chaos.time",
+    )
+
+    def setUp(self):
+        super(TestLog, self).setUp()
+        self.time.time.return_value = 1449842841.5
+        self.time.strftime.side_effect = time.strftime
+        self.time.gmtime.side_effect = time.gmtime
+        chaos.log_clock.update(second=None, timestamp="")
+
+    def tearDown(self):
+        del chaos.log_buffer[:]
+        chaos.log_settings["json"] = False
+        chaos.log_context.region = None
+        chaos.log_context.account = None
+        super(TestLog, self).tearDown()
+
+    def get_output(self):
+        chaos.flush_log()
+        return "".join(
+            args[0] for args, kwargs in self.sys.stdout.write.call_args_list
+        )
+
+    def test_writes_timestamp_event_and_arguments(self):
+        chaos.log("bad-probability", "[not often]", "in", "asg-1")
+        self.assertEqual(
+            self.get_output(),
+            "2015-12-11T14:07:21Z bad-probability [not often] in asg-1\n"
+        )
+
+    def test_converts_arguments_to_strings(self):
+        chaos.log("region-error", "sp-moonbase-1", ValueError("bad"), 3)
+        self.assertEqual(
+            self.get_output(),
+            "2015-12-11T14:07:21Z region-error sp-moonbase-1 bad 3\n"
+        )
+
+    def test_buffers_lines_until_flushed(self):
+        chaos.log("triggered", "sp-moonbase-1")
+        chaos.log("triggered", "sp-moonbase-2")
+        self.assertEqual(self.sys.stdout.write.call_count, 0)
+        self.assertEqual(self.get_output(), (
+            "2015-12-11T14:07:21Z triggered sp-moonbase-1\n"
+            "2015-12-11T14:07:21Z triggered sp-moonbase-2\n"
+        ))
+        self.assertEqual(self.sys.stdout.write.call_count, 1)
+        self.sys.stdout.flush.assert_called_once_with()
+
+    def test_writes_full_buffers_without_waiting_for_flush(self):
+        for i in range(chaos.LOG_BUFFER_LINES):
+            chaos.log("triggered", "sp-moonbase-1")
+        self.assertEqual(self.sys.stdout.write.call_count, 1)
+        self.assertEqual(len(chaos.log_buffer), 0)
+
+    def test_flush_does_nothing_if_buffer_empty(self):
+        chaos.flush_log()
+        self.assertEqual(self.sys.stdout.write.call_count, 0)
+
+    def test_formats_timestamp_once_per_second(self):
+        for t in (1449842841.1, 1449842841.9, 1449842842.0):
+            self.time.time.return_value = t
+            chaos.log("triggered", "sp-moonbase-1")
+        self.assertEqual(self.time.strftime.call_count, 2)
+        self.assertEqual(self.get_output(), (
+            "2015-12-11T14:07:21Z triggered sp-moonbase-1\n"
+            "2015-12-11T14:07:21Z triggered sp-moonbase-1\n"
+            "2015-12-11T14:07:22Z triggered sp-moonbase-1\n"
+        ))
+
+    def test_writes_json_lines_with_fields_and_region(self):
+        chaos.log_settings["json"] = True
+        chaos.log_context.region = "sp-moonbase-1"
+        chaos.log(
+            "targeting", "i-1", "in", "asg-1", asg="asg-1", instance="i-1"
+        )
+        self.assertEqual(json.loads(self.get_output()), {
+            "timestamp": "2015-12-11T14:07:21Z",
+            "event": "targeting",
+            "region": "sp-moonbase-1",
+            "asg": "asg-1",
+            "instance": "i-1",
+            "message": "i-1 in asg-1",
+        })
+
+    def test_writes_account_if_in_another_account(self):
+        chaos.log_settings["json"] = True
+        chaos.log_context.region = "sp-moonbase-1"
+        chaos.log_context.account = "111111111111"
+        chaos.log("triggered", "sp-moonbase-1")
+        self.assertEqual(json.loads(self.get_output()), {
+            "timestamp": "2015-12-11T14:07:21Z",
+            "event": "triggered",
+            "region": "sp-moonbase-1",
+            "account": "111111111111",
+            "message": "sp-moonbase-1",
+        })
+
+    def test_leaves_out_region_if_not_known(self):
+        chaos.log_settings["json"] = True
+        chaos.log("completed", "1", "regions", duration=1.5)
+        self.assertEqual(json.loads(self.get_output()), {
+            "timestamp": "2015-12-11T14:07:21Z",
+            "event": "completed",
+            "duration": 1.5,
+            "message": "1 regions",
+        })
+
+    def test_log_record_writes_json_in_either_format(self):
+        chaos.log_record({"a": 1})
+        chaos.log_settings["json"] = True
+        chaos.log_record({"b": 2})
+        self.assertEqual(
+            [json.loads(line) for line in self.get_output().splitlines()],
+            [{"a": 1}, {"b": 2}]
+        )
+
+
 class TestGetASGTag(PatchingTestCase):
 
     def test_finds_tag_key_case_insensitively(self):
@@ -29,16 +153,21 @@ class TestGetASGTag(PatchingTestCase):
         asg = {"Tags": [{"Key": "name"}]}
         self.assertEqual(chaos.get_asg_tag(asg, "name"), "")
 
+    def test_returns_first_matching_tag(self):
+        asg = {"Tags": [
+            {"Key": "Name", "Value": "first"},
+            {"Key": "NAME", "Value": "second"},
+            {"Key": "Chaos-Lambda-X", "Value": "first"},
+            {"Key": "chaos-lambda-x", "Value": "second"}
+        ]}
+        self.assertEqual(chaos.get_asg_tag(asg, "name"), "first")
+        self.assertEqual(chaos.get_asg_tag(asg, "chaos-lambda-x"), "first")
 
-class TestSafeFloat(PatchingTestCase):
-
-    def test_returns_float_if_string_is_valid(self):
-        self.assertEqual(chaos.safe_float("1.0", 0.5), 1.0)
-        self.assertEqual(chaos.safe_float("0.0", 0.5), 0.0)
-        self.assertEqual(chaos.safe_float(" 1.0 ", 0.5), 1.0)
-
-    def test_returns_default_if_string_is_invalid(self):
-        self.assertEqual(chaos.safe_float("not a number", 0.5), 0.5)
+    def test_finds_chaos_lambda_tags_case_insensitively(self):
+        asg = {"Tags": [{"Key": "Chaos-Lambda-Termination", "Value": "1"}]}
+        for name in ("chaos-lambda-termination", "CHAOS-LAMBDA-TERMINATION"):
+            self.assertEqual(chaos.get_asg_tag(asg, name), "1")
+        self.assertEqual(chaos.get_asg_tag(asg, "chaos-lambda-x", "d"), "d")
 
 
 class TestGetASGProbability(PatchingTestCase):
@@ -193,11 +322,474 @@ class TestGetAllASGs(PatchingTestCase):
             mock.sentinel.two
         ]))
 
+    def test_passes_filters_to_paginator(self):
+        autoscaling = mock.Mock()
+        paginator = autoscaling.get_paginator.return_value
+        paginator.paginate.return_value = iter([])
+        filters = [{"Name": "tag-key", "Values": ["x"]}]
+        list(chaos.get_all_asgs(autoscaling, filters))
+        paginator.paginate.assert_called_once_with(Filters=filters)
+
+
+class TestPastDeadline(PatchingTestCase):
+
+    patch_list = (
+        "time.monotonic",
+    )
+
+    def test_only_past_deadline_once_it_has_passed(self):
+        self.monotonic.return_value = 100.0
+        for deadline, expected in ((None, False), (101.0, False),
+                                   (100.0, True), (99.0, True)):
+            with mock.patch.dict(chaos.run_deadline, {"time": deadline}):
+                self.assertEqual(chaos.past_deadline(), expected)
+
+
+class TestDeadlines(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+        "chaos.past_deadline",
+    )
+
+    def setUp(self):
+        super(TestDeadlines, self).setUp()
+        self.autoscaling = mock.Mock()
+        self.paginator = self.autoscaling.get_paginator.return_value
+        self.paginator.paginate.return_value = iter([
+            {"AutoScalingGroups": [mock.sentinel.one], "NextToken": "t1"},
+            {"AutoScalingGroups": [mock.sentinel.two], "NextToken": "t2"},
+            {"AutoScalingGroups": [mock.sentinel.three]},
+        ])
+        chaos.listing.start_token = None
+        chaos.listing.next_token = None
+
+    def tearDown(self):
+        chaos.listing.start_token = None
+        chaos.listing.next_token = None
+        super(TestDeadlines, self).tearDown()
+
+    def test_stops_listing_before_next_page_once_past_deadline(self):
+        self.past_deadline.side_effect = [False, True]
+        asgs = list(chaos.get_all_asgs(self.autoscaling))
+        self.assertEqual(asgs, [mock.sentinel.one, mock.sentinel.two])
+        self.assertEqual(chaos.listing.next_token, "t2")
+
+    def test_lists_everything_if_deadline_not_reached(self):
+        self.past_deadline.return_value = False
+        self.assertEqual(len(list(chaos.get_all_asgs(self.autoscaling))), 3)
+        self.assertIsNone(chaos.listing.next_token)
+
+    def test_resumes_listing_from_token(self):
+        self.past_deadline.return_value = False
+        chaos.listing.start_token = "t1"
+        list(chaos.get_all_asgs(self.autoscaling))
+        self.paginator.paginate.assert_called_once_with(
+            PaginationConfig={"StartingToken": "t1"}
+        )
+        self.assertIsNone(chaos.listing.start_token)
+
+    def test_lists_from_first_page_if_token_rejected(self):
+        self.past_deadline.return_value = False
+
+        def pages():
+            raise Exception("bad token")
+            yield
+        self.paginator.paginate.side_effect = [
+            pages(), iter([{"AutoScalingGroups": [mock.sentinel.one]}])
+        ]
+        chaos.listing.start_token = "t1"
+        filters = [{"Name": "tag-key", "Values": ["x"]}]
+        asgs = list(chaos.get_all_asgs(self.autoscaling, filters))
+        self.assertEqual(asgs, [mock.sentinel.one])
+        self.paginator.paginate.assert_called_with(Filters=filters)
+        self.log.assert_called_once_with(
+            "resume-failed", self.autoscaling.meta.region_name, "[bad token]"
+        )
+
+    @mock.patch("chaos.get_client")
+    def test_defers_regions_not_started_before_deadline(self, get_client):
+        self.past_deadline.return_value = True
+        self.assertEqual(chaos.chaos_region("r-1", 0), ("deferred", []))
+        self.assertEqual(get_client.call_count, 0)
+
+    @mock.patch("chaos.terminate_region")
+    @mock.patch("chaos.get_client")
+    def test_terminates_targets_of_part_listed_regions(self, get_client,
+                                                       terminate_region):
+        self.past_deadline.side_effect = [False, True]
+        with mock.patch("chaos.get_asg_instance_id") as get_asg_instance_id:
+            get_asg_instance_id.side_effect = lambda asg, default: "i-1"
+            get_client.return_value = self.autoscaling
+            self.autoscaling.get_paginator.return_value.paginate \
+                .return_value = iter([
+                    {"AutoScalingGroups": [{"AutoScalingGroupName": "a"}],
+                     "NextToken": "t1"},
+                    {"AutoScalingGroups": []},
+                ])
+            with mock.patch.dict("os.environ", {"inventory_table": ""}):
+                result = chaos.run_region("r-1", 1.0)
+        self.assertEqual(result[:3], ("r-1", "partial", 1))
+        self.assertEqual(chaos.listing.next_token, "t1")
+        terminate_region.assert_called_once_with("r-1", [("a", "i-1")], None)
+
+
+class TestRegionBudget(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+        "chaos.terminate_region",
+        "time.monotonic",
+    )
+
+    def setUp(self):
+        super(TestRegionBudget, self).setUp()
+        self.now = 0.0
+        self.monotonic.side_effect = lambda: self.now
+        self.pages = 0
+        paginator = self.get_client.return_value.get_paginator.return_value
+        paginator.paginate.side_effect = self.paginate
+        self.environ = mock.patch.dict("os.environ", {
+            "inventory_table": "", "two_phase": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super(TestRegionBudget, self).tearDown()
+
+    def paginate(self, **kwargs):
+        # Every page takes three seconds
+        for i in range(10):
+            self.now += 3.0
+            self.pages += 1
+            yield {"AutoScalingGroups": [{
+                "AutoScalingGroupName": "asg-%d" % i,
+                "Instances": [{"InstanceId": "i-%d" % i}],
+            }], "NextToken": "t%d" % i}
+
+    def test_stops_slow_listing_once_over_budget(self):
+        result = chaos.run_region("r-1", 1.0, region_budget=5.0)
+        self.assertEqual(result[:3], ("r-1", "timeout", 0))
+        self.assertEqual(self.pages, 2)
+        self.assertEqual(self.terminate_region.call_count, 0)
+        region_result = [c[0] for c in self.log.call_args_list
+                         if c[0][0] == "region-result"]
+        self.assertEqual(region_result[0][6:9], ("with", "0", "targets"))
+
+    @mock.patch("chaos.flush_log")
+    def test_writes_log_at_end_of_region(self, flush_log):
+        chaos.run_region("r-1", 1.0, region_budget=5.0)
+        flush_log.assert_called_once_with()
+
+    def test_lists_everything_within_budget(self):
+        result = chaos.run_region("r-1", 1.0, region_budget=60.0)
+        self.assertEqual(result[:3], ("r-1", "ok", 10))
+        self.assertEqual(self.pages, 10)
+        self.assertIsNone(chaos.listing.budget_end)
+
+
+class TestGetASGFilters(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_env_flag",
+    )
+
+    def test_filters_by_probability_tag_key_if_opted_in(self):
+        self.get_env_flag.return_value = True
+        self.assertEqual(chaos.get_asg_filters(0.0), [
+            {"Name": "tag-key", "Values": [chaos.PROBABILITY_TAG]}
+        ])
+        self.get_env_flag.assert_called_once_with("tag_filter")
+
+    def test_returns_None_if_not_opted_in(self):
+        self.get_env_flag.return_value = False
+        self.assertEqual(chaos.get_asg_filters(0.0), None)
+
+    def test_returns_None_if_untagged_asgs_can_be_targeted(self):
+        self.get_env_flag.return_value = True
+        self.assertEqual(chaos.get_asg_filters(0.1), None)
+
+
+class TestUseTwoPhaseSelection(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_env_flag",
+    )
+
+    def test_used_if_opted_in_and_default_probability_zero(self):
+        self.get_env_flag.return_value = True
+        self.assertTrue(chaos.use_two_phase_selection(0.0))
+        self.get_env_flag.assert_called_once_with("two_phase")
+
+    def test_not_used_if_not_opted_in(self):
+        self.get_env_flag.return_value = False
+        self.assertFalse(chaos.use_two_phase_selection(0.0))
+
+    def test_not_used_if_untagged_asgs_can_be_targeted(self):
+        self.get_env_flag.return_value = True
+        self.assertFalse(chaos.use_two_phase_selection(0.1))
+
+
+class TestGetTaggedASGs(PatchingTestCase):
+
+    def test_groups_probability_tags_by_asg(self):
+        autoscaling = mock.Mock()
+        paginator = autoscaling.get_paginator.return_value
+        tags = [
+            {"ResourceId": "a", "ResourceType": "auto-scaling-group",
+             "Key": chaos.PROBABILITY_TAG, "Value": "0.1"},
+            {"ResourceId": "b", "ResourceType": "auto-scaling-group",
+             "Key": chaos.PROBABILITY_TAG, "Value": "0.2"},
+            {"ResourceId": "x", "ResourceType": "something-else",
+             "Key": chaos.PROBABILITY_TAG, "Value": "0.3"},
+        ]
+        paginator.paginate.return_value = [
+            {"Tags": tags[:1]}, {"Tags": tags[1:]}
+        ]
+        self.assertEqual(chaos.get_tagged_asgs(autoscaling), [
+            {"AutoScalingGroupName": "a", "Tags": [tags[0]]},
+            {"AutoScalingGroupName": "b", "Tags": [tags[1]]},
+        ])
+        autoscaling.get_paginator.assert_called_once_with("describe_tags")
+        paginator.paginate.assert_called_once_with(Filters=[
+            {"Name": "key", "Values": [chaos.PROBABILITY_TAG]}
+        ])
+
+
+class TestGetASGsByName(PatchingTestCase):
+
+    def test_describes_asgs_in_batches_of_names(self):
+        autoscaling = mock.Mock()
+        paginator = autoscaling.get_paginator.return_value
+        paginator.paginate.side_effect = lambda **kwargs: [{
+            "AutoScalingGroups": [
+                {"AutoScalingGroupName": name}
+                for name in kwargs["AutoScalingGroupNames"]
+            ]
+        }]
+        names = ["asg-%d" % i for i in range(chaos.ASG_NAME_BATCH_SIZE + 1)]
+        asgs = list(chaos.get_asgs_by_name(autoscaling, names))
+        self.assertEqual([a["AutoScalingGroupName"] for a in asgs], names)
+        self.assertEqual(
+            [len(c[1]["AutoScalingGroupNames"])
+             for c in paginator.paginate.call_args_list],
+            [chaos.ASG_NAME_BATCH_SIZE, 1]
+        )
+
+    def test_makes_no_calls_for_no_names(self):
+        autoscaling = mock.Mock()
+        self.assertEqual(list(chaos.get_asgs_by_name(autoscaling, [])), [])
+        self.assertEqual(
+            autoscaling.get_paginator.return_value.paginate.call_count, 0
+        )
+
+
+class TestGetTwoPhaseTargets(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_asgs_by_name",
+        "chaos.get_tagged_asgs",
+        "chaos.log",
+        "chaos.random",
+    )
+
+    def make_tagged(self, name, value):
+        return {"AutoScalingGroupName": name, "Tags": [
+            {"Key": chaos.PROBABILITY_TAG, "Value": value}
+        ]}
+
+    def test_only_describes_asgs_that_were_hit(self):
+        autoscaling = mock.Mock()
+        self.get_tagged_asgs.return_value = [
+            self.make_tagged("a", "0.5"),
+            self.make_tagged("b", "0.2"),
+            self.make_tagged("c", "1.0"),
+        ]
+        self.random.random.side_effect = [0.4, 0.4, 0.99]
+        self.get_asgs_by_name.return_value = []
+        chaos.get_two_phase_targets(autoscaling, 0.0)
+        self.get_asgs_by_name.assert_called_once_with(autoscaling, ["a", "c"])
+
+    def test_only_rolls_for_asgs_in_shard(self):
+        names = ["asg-%d" % i for i in range(20)]
+        self.get_tagged_asgs.return_value = [
+            self.make_tagged(name, "1.0") for name in names
+        ]
+        self.random.random.return_value = 0.0
+        self.get_asgs_by_name.return_value = []
+        chaos.get_two_phase_targets(mock.Mock(), 0.0, shard=(0, 3))
+        self.get_asgs_by_name.assert_called_once_with(mock.ANY, [
+            name for name in names if chaos.get_shard(name, 3) == 0
+        ])
+
+    def test_uses_default_for_bad_probability_values(self):
+        self.get_tagged_asgs.return_value = [self.make_tagged("a", "often")]
+        self.random.random.return_value = 0.0
+        self.get_asgs_by_name.return_value = []
+        chaos.get_two_phase_targets(mock.Mock(), 0.0)
+        self.get_asgs_by_name.assert_called_once_with(mock.ANY, [])
+        self.log.assert_called_once_with(
+            "bad-probability", "[often]", "in", "a", asg="a"
+        )
+
+    def test_samples_targets_into_reservoir_by_probability(self):
+        self.get_tagged_asgs.return_value = [
+            self.make_tagged("a", "0.5"), self.make_tagged("b", "0.2")
+        ]
+        self.random.random.return_value = 0.0
+        self.random.choice.side_effect = lambda instances: instances[0]
+        self.get_asgs_by_name.return_value = [
+            {"AutoScalingGroupName": "b", "Instances": [
+                {"InstanceId": "i-22222222"}
+            ]},
+        ]
+        reservoir = mock.Mock()
+        targets = chaos.get_two_phase_targets(mock.Mock(), 0.0, reservoir)
+        reservoir.add.assert_called_once_with(("b", "i-22222222"), 0.2)
+        self.assertEqual(targets, reservoir.targets.return_value)
+
+    def test_picks_a_random_instance_from_each_hit_asg(self):
+        self.get_tagged_asgs.return_value = []
+        self.random.choice.side_effect = lambda instances: instances[-1]
+        self.get_asgs_by_name.return_value = [
+            {"AutoScalingGroupName": "a", "Instances": [
+                {"InstanceId": "i-11111111"}, {"InstanceId": "i-22222222"}
+            ]},
+            {"AutoScalingGroupName": "b", "Instances": []},
+        ]
+        targets = chaos.get_two_phase_targets(mock.Mock(), 0.0)
+        self.assertEqual(targets, [("a", "i-22222222")])
+
+
+class TestGetEnvFlag(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+    )
+
+    def test_recognises_true_values(self):
+        for value in ("1", "true", "True", " yes ", "ON"):
+            self.os.environ.get.return_value = value
+            self.assertTrue(chaos.get_env_flag("name"))
+
+    def test_everything_else_is_false(self):
+        for value in ("", "0", "false", "no", "blah"):
+            self.os.environ.get.return_value = value
+            self.assertFalse(chaos.get_env_flag("name"))
+
+
+class TestGetASGWeight(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+    )
+
+    def make_asg(self, value):
+        return {"AutoScalingGroupName": "a", "Tags": [
+            {"Key": chaos.PROBABILITY_TAG, "Value": value}
+        ]}
+
+    def test_returns_probability_from_tag(self):
+        self.assertEqual(chaos.get_asg_weight(self.make_asg("0.25"), 0.5),
+                         0.25)
+
+    def test_returns_default_for_missing_or_bad_values(self):
+        for asg in ({"Tags": []}, self.make_asg("often"),
+                    self.make_asg("1.5")):
+            self.assertEqual(chaos.get_asg_weight(asg, 0.5), 0.5)
+        self.assertEqual(self.log.call_count, 0)
+
+
+class TestTargetReservoir(PatchingTestCase):
+
+    def test_keeps_targets_with_largest_keys(self):
+        reservoir = chaos.TargetReservoir(2)
+        for key, target in ((-3.0, "a"), (-1.0, "b"), (-2.0, "c"),
+                            (-0.5, "d")):
+            reservoir.push(key, target)
+        self.assertEqual(reservoir.targets(), ["d", "b"])
+        self.assertEqual(reservoir.items(), [(-0.5, "d"), (-1.0, "b")])
+
+    def test_keeps_everything_below_size(self):
+        reservoir = chaos.TargetReservoir(10)
+        for i in range(3):
+            reservoir.add(("a", "i-%d" % i), 0.5)
+        self.assertEqual(len(reservoir.targets()), 3)
+        self.assertEqual(reservoir.added, 3)
+
+    def test_never_keeps_zero_weight_targets(self):
+        reservoir = chaos.TargetReservoir(10)
+        reservoir.add("a", 0.0)
+        self.assertEqual(reservoir.targets(), [])
+        self.assertEqual(reservoir.added, 1)
+
+    def test_keeps_nothing_if_size_is_zero(self):
+        reservoir = chaos.TargetReservoir(0)
+        reservoir.add("a", 1.0)
+        self.assertEqual(reservoir.targets(), [])
+
+    def test_memory_is_bounded_by_size(self):
+        reservoir = chaos.TargetReservoir(5)
+        for i in range(10000):
+            reservoir.add(i, 0.5)
+        self.assertEqual(len(reservoir.heap), 5)
+
+    @mock.patch("chaos.random")
+    def test_samples_in_proportion_to_weight(self, random_):
+        rng = random.Random(1)
+        random_.random.side_effect = rng.random
+        counts = {"heavy": 0, "light": 0}
+        for i in range(10000):
+            reservoir = chaos.TargetReservoir(1)
+            reservoir.add("heavy", 0.8)
+            reservoir.add("light", 0.2)
+            counts[reservoir.targets()[0]] += 1
+        self.assertAlmostEqual(counts["heavy"] / 10000.0, 0.8, delta=0.02)
+
+    def test_merging_samples_matches_single_sample(self):
+        keys = [(-0.1 * i, "t%d" % i) for i in range(20)]
+        single = chaos.TargetReservoir(5)
+        parts = [chaos.TargetReservoir(5), chaos.TargetReservoir(5)]
+        for i, (key, target) in enumerate(keys):
+            single.push(key, target)
+            parts[i % 2].push(key, target)
+        merged = chaos.TargetReservoir(5)
+        for part in parts:
+            for key, target in part.items():
+                merged.push(key, target)
+        self.assertEqual(merged.items(), single.items())
+
+
+class TestGetShard(PatchingTestCase):
+
+    def test_uses_stable_hash_of_asg_name(self):
+        self.assertEqual(chaos.get_shard("asg-1", 1000), 498)
+        self.assertEqual(chaos.get_shard("asg-1", 1), 0)
+
+    def test_spreads_asgs_across_shards(self):
+        shards = [chaos.get_shard("asg-%d" % i, 4) for i in range(1000)]
+        for shard in range(4):
+            self.assertTrue(200 < shards.count(shard) < 300)
+
+    def test_in_shard_keeps_only_asgs_in_shard(self):
+        asgs = [{"AutoScalingGroupName": "asg-%d" % i} for i in range(100)]
+        kept = [list(chaos.in_shard(asgs, (i, 3))) for i in range(3)]
+        self.assertEqual(sum(len(k) for k in kept), 100)
+        for i in range(3):
+            self.assertTrue(all(
+                chaos.get_shard(asg["AutoScalingGroupName"], 3) == i
+                for asg in kept[i]
+            ))
+        self.assertIs(chaos.in_shard(asgs, None), asgs)
+
 
 class TestGetTargets(PatchingTestCase):
 
     patch_list = (
         "chaos.get_all_asgs",
+        "chaos.get_asg_filters",
         "chaos.get_asg_instance_id",
     )
 
@@ -205,13 +797,32 @@ class TestGetTargets(PatchingTestCase):
         autoscaling = mock.Mock()
         self.get_all_asgs.return_value = iter([])
         chaos.get_targets(autoscaling, 0)
-        self.get_all_asgs.assert_called_once_with(autoscaling)
+        self.get_asg_filters.assert_called_once_with(0)
+        self.get_all_asgs.assert_called_once_with(
+            autoscaling,
+            self.get_asg_filters.return_value
+        )
 
     def test_returns_empty_list_if_no_auto_scaling_groups(self):
         autoscaling = mock.Mock()
         self.get_all_asgs.return_value = iter([])
         self.assertEqual(chaos.get_targets(autoscaling, 0), [])
 
+    def test_only_considers_asgs_in_shard(self):
+        autoscaling = mock.Mock()
+        self.get_asg_instance_id.side_effect = lambda asg, default: \
+            asg["Instances"][0]
+        asgs = [
+            {"AutoScalingGroupName": "asg-%d" % i, "Instances": ["i-%d" % i]}
+            for i in range(20)
+        ]
+        self.get_all_asgs.return_value = iter(asgs)
+        targets = chaos.get_targets(autoscaling, 0, shard=(1, 2))
+        self.assertEqual(targets, [
+            (asg["AutoScalingGroupName"], asg["Instances"][0])
+            for asg in asgs if chaos.get_shard(asg["AutoScalingGroupName"], 2)
+        ])
+
     def test_passes_default_probability_to_get_asg_instance_id(self):
         autoscaling = mock.Mock()
         asg = {"AutoScalingGroupName": "a", "Instances": ["i-11111111"]}
@@ -249,10 +860,75 @@ class TestGetTargets(PatchingTestCase):
         targets = chaos.get_targets(autoscaling, 0)
         self.assertEqual(targets, [("b", "i-22222222")])
 
+    @mock.patch("chaos.get_two_phase_targets")
+    @mock.patch("chaos.use_two_phase_selection")
+    def test_uses_two_phase_selection_if_enabled(self, use, two_phase):
+        autoscaling = mock.Mock()
+        use.return_value = True
+        targets = chaos.get_targets(autoscaling, 0)
+        use.assert_called_once_with(0)
+        two_phase.assert_called_once_with(autoscaling, 0, None, None)
+        self.assertEqual(targets, two_phase.return_value)
+        self.assertEqual(self.get_all_asgs.call_count, 0)
+
+    def test_samples_hit_asgs_into_reservoir_by_probability(self):
+        autoscaling = mock.Mock()
+        self.get_asg_instance_id.side_effect = lambda asg, default: \
+            asg["Instances"][0]
+        asgs = [
+            {"AutoScalingGroupName": "a", "Instances": ["i-11111111"],
+             "Tags": [{"Key": chaos.PROBABILITY_TAG, "Value": "0.25"}]},
+            {"AutoScalingGroupName": "b", "Instances": ["i-22222222"]},
+        ]
+        reservoir = mock.Mock()
+        targets = chaos.get_targets(autoscaling, 0.5, asgs, reservoir)
+        self.assertEqual(reservoir.add.call_args_list, [
+            mock.call(("a", "i-11111111"), 0.25),
+            mock.call(("b", "i-22222222"), 0.5),
+        ])
+        self.assertEqual(targets, reservoir.targets.return_value)
+
+    def test_uses_given_asgs_instead_of_listing_them(self):
+        autoscaling = mock.Mock()
+        self.get_asg_instance_id.side_effect = lambda asg, default: \
+            asg["Instances"][0]
+        asgs = [{"AutoScalingGroupName": "a", "Instances": ["i-11111111"]}]
+        targets = chaos.get_targets(autoscaling, 0, asgs)
+        self.assertEqual(targets, [("a", "i-11111111")])
+        self.assertEqual(self.get_all_asgs.call_count, 0)
+
+
+class TestGetInventoryASGs(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+        "chaos_inventory.get_asgs",
+        "chaos_inventory.get_store",
+    )
+
+    def test_returns_None_if_no_inventory_table(self):
+        self.os.environ.get.return_value = ""
+        autoscaling = mock.Mock()
+        self.assertEqual(
+            chaos.get_inventory_asgs(autoscaling, "sp-moonbase-1"), None
+        )
+        self.os.environ.get.assert_called_once_with("inventory_table", "")
+        self.assertEqual(self.get_asgs.call_count, 0)
+
+    def test_reads_asgs_from_inventory_store(self):
+        self.os.environ.get.return_value = "table"
+        autoscaling = mock.Mock()
+        asgs = chaos.get_inventory_asgs(autoscaling, "sp-moonbase-1")
+        self.assertEqual(asgs, self.get_asgs.return_value)
+        self.get_asgs.assert_called_once_with(
+            self.get_store.return_value, autoscaling, "sp-moonbase-1"
+        )
+
 
 class TestTerminateTargets(PatchingTestCase):
 
     patch_list = (
+        "chaos.flush_log",
         "chaos.log",
         "chaos.os"
     )
@@ -267,9 +943,8 @@ class TestTerminateTargets(PatchingTestCase):
 
     def test_terminates_target_instances(self):
         ec2 = mock.Mock()
-        sns = mock.Mock()
         ec2.terminate_instances.return_value = {}
-        chaos.terminate_targets(ec2, sns, [
+        chaos.terminate_targets(ec2, [], [
             ("a", "i-11111111"),
             ("b", "i-22222222")
         ])
@@ -277,11 +952,19 @@ class TestTerminateTargets(PatchingTestCase):
             InstanceIds=["i-11111111", "i-22222222"]
         )
 
+    def test_writes_log_before_terminating(self):
+        calls = []
+        self.flush_log.side_effect = lambda: calls.append("flush")
+        ec2 = mock.Mock()
+        ec2.terminate_instances.side_effect = \
+            lambda **kwargs: calls.append("terminate") or {}
+        chaos.terminate_targets(ec2, [], [("a", "i-11111111")])
+        self.assertEqual(calls, ["flush", "terminate"])
+
     def test_parseable_log_line_for_each_targeted_instance(self):
         ec2 = mock.Mock()
-        sns = mock.Mock()
         ec2.terminate_instances.return_value = {}
-        chaos.terminate_targets(ec2, sns, [
+        chaos.terminate_targets(ec2, [], [
             ("asg-name-one", "i-00000000"),
             ("second-asg", "i-11111111"),
             ("the-third-asg", "i-22222222")
@@ -295,7 +978,6 @@ class TestTerminateTargets(PatchingTestCase):
 
     def test_parseable_log_line_for_each_termination_result(self):
         ec2 = mock.Mock()
-        sns = mock.Mock()
         # We're cheating here and returning results that are unrelated to the
         # list passed to terminate_targets
         ec2.terminate_instances.return_value = {
@@ -305,7 +987,7 @@ class TestTerminateTargets(PatchingTestCase):
                 {"InstanceId": "i-22222222", "CurrentState": {"Name": "s3"}}
             ]
         }
-        chaos.terminate_targets(ec2, sns, [("a", "i-11111111")])
+        chaos.terminate_targets(ec2, [], [("a", "i-11111111")])
         logged = self.get_log_lines("result")
         self.assertEqual(set((part[1], part[3]) for part in logged), set([
             ("i-00000000", "s1"),
@@ -315,7 +997,6 @@ class TestTerminateTargets(PatchingTestCase):
 
     def test_returns_termination_results(self):
         ec2 = mock.Mock()
-        sns = mock.Mock()
         # We're cheating here and returning results that are unrelated to the
         # list passed to terminate_targets
         ec2.terminate_instances.return_value = {
@@ -325,47 +1006,49 @@ class TestTerminateTargets(PatchingTestCase):
                 {"InstanceId": "i-22222222", "CurrentState": {"Name": "s3"}}
             ]
         }
-        results = chaos.terminate_targets(ec2, sns, [])
+        results = chaos.terminate_targets(ec2, [], [("a", "i-11111111")])
         self.assertEqual(set(results), set([
             ("i-00000000", "s1"),
             ("i-11111111", "s2"),
             ("i-22222222", "s3")
         ]))
 
-    def test_sends_notification_per_instance(self):
-        self.os.environ.get.return_value = "MyTestTopic"
+    def test_sends_notification_per_instance_before_terminating(self):
+        calls = []
+        sink = mock.Mock(side_effect=lambda n: calls.append("notify") or [])
         ec2 = mock.Mock()
-        sns = mock.Mock()
-        ec2.terminate_instances.return_value = {
-            "TerminatingInstances": []
-        }
-        chaos.terminate_targets(ec2, sns, [("a1", "i1"), ("a2", "i2")])
-        sns.publish.assert_any_call(
-            TopicArn="MyTestTopic",
-            Message=MatchJson({
-                "event_name": "chaos_lambda.terminating",
-                "asg_name": "a1",
-                "instance_id": "i1"
-            })
-        )
-        sns.publish.assert_any_call(
-            TopicArn="MyTestTopic",
-            Message=MatchJson({
-                "event_name": "chaos_lambda.terminating",
-                "asg_name": "a2",
-                "instance_id": "i2"
-            })
-        )
-        self.assertEqual(2, sns.publish.call_count)
+        ec2.terminate_instances.side_effect = \
+            lambda **kwargs: calls.append("terminate") or {}
+        chaos.terminate_targets(ec2, [("sns", sink)], [
+            ("a1", "i1"),
+            ("a2", "i2")
+        ])
+        sink.assert_called_once_with([
+            {"event_name": "chaos_lambda.terminating",
+             "asg_name": "a1", "instance_id": "i1"},
+            {"event_name": "chaos_lambda.terminating",
+             "asg_name": "a2", "instance_id": "i2"}
+        ])
+        self.assertEqual(calls, ["notify", "terminate"])
 
-    def test_handles_sns_exception(self):
-        self.os.environ.get.return_value = "MyTestTopic"
+    def test_includes_account_in_notifications_for_other_accounts(self):
+        sink = mock.Mock(return_value=[])
         ec2 = mock.Mock()
-        sns = mock.Mock()
         ec2.terminate_instances.return_value = {}
+        chaos.terminate_targets(
+            ec2, [("sns", sink)], [("a1", "i1")], "111111111111"
+        )
+        sink.assert_called_once_with([
+            {"event_name": "chaos_lambda.terminating",
+             "asg_name": "a1", "instance_id": "i1",
+             "account_id": "111111111111"}
+        ])
 
-        sns.publish.side_effect = Exception("boom")
-        chaos.terminate_targets(ec2, sns, [
+    def test_handles_notification_exception(self):
+        ec2 = mock.Mock()
+        ec2.terminate_instances.return_value = {}
+        sink = mock.Mock(side_effect=Exception("boom"))
+        chaos.terminate_targets(ec2, [("sns", sink)], [
             ("a", "i-11111111"),
             ("b", "i-22222222")
         ])
@@ -373,6 +1056,320 @@ class TestTerminateTargets(PatchingTestCase):
             InstanceIds=["i-11111111", "i-22222222"]
         )
 
+    def test_parseable_log_line_for_each_failed_termination(self):
+        ec2 = mock.Mock()
+        ec2.terminate_instances.side_effect = \
+            ClientError("UnauthorizedOperation")
+        chaos.terminate_targets(ec2, [], [
+            ("asg-name-one", "i-00000000"),
+            ("second-asg", "i-11111111")
+        ])
+        logged = self.get_log_lines("termination-failed")
+        self.assertEqual(set((p[1], p[3], p[4]) for p in logged), set([
+            ("i-00000000", "asg-name-one", "[UnauthorizedOperation]"),
+            ("i-11111111", "second-asg", "[UnauthorizedOperation]")
+        ]))
+        self.assertEqual(self.get_log_lines("result"), [])
+
+
+class ClientError(Exception):
+    '''
+    Stand-in for botocore.exceptions.ClientError, which carries the AWS error
+    code in its response attribute.
+    '''
+    def __init__(self, code):
+        super(ClientError, self).__init__(code)
+        self.response = {"Error": {"Code": code, "Message": code}}
+
+
+class FakeEC2:
+    '''
+    Terminates any instance whose id doesn't start with "i-bad", failing the
+    whole request with InvalidInstanceID.NotFound otherwise.
+    '''
+    def __init__(self):
+        self.requests = []
+
+    def terminate_instances(self, InstanceIds):
+        self.requests.append(InstanceIds)
+        if any(i.startswith("i-bad") for i in InstanceIds):
+            raise ClientError("InvalidInstanceID.NotFound")
+        return {"TerminatingInstances": [
+            {"InstanceId": i, "CurrentState": {"Name": "shutting-down"}}
+            for i in InstanceIds
+        ]}
+
+
+class TestGetErrorCode(PatchingTestCase):
+
+    def test_reads_code_of_parsed_response(self):
+        self.assertEqual(
+            chaos.get_error_code({"Error": {"Code": "Throttling"}}),
+            "Throttling"
+        )
+        self.assertIsNone(chaos.get_error_code({}))
+        self.assertIsNone(chaos.get_error_code(None))
+
+    def test_reads_code_of_client_errors(self):
+        self.assertEqual(
+            chaos.get_exception_error_code(ClientError("Throttling")),
+            "Throttling"
+        )
+        self.assertIsNone(chaos.get_exception_error_code(Exception("boom")))
+
+
+class TestTerminateInstances(PatchingTestCase):
+
+    patch_list = (
+        "time.sleep",
+    )
+
+    def test_splits_instances_into_bounded_batches(self):
+        ec2 = FakeEC2()
+        ids = ["i-%d" % i for i in range(chaos.TERMINATION_BATCH_SIZE * 2 + 1)]
+        outcomes = chaos.terminate_instances(ec2, ids)
+        self.assertEqual(
+            sorted(len(r) for r in ec2.requests),
+            [1, chaos.TERMINATION_BATCH_SIZE, chaos.TERMINATION_BATCH_SIZE]
+        )
+        self.assertEqual(
+            sorted(outcomes),
+            sorted((i, "shutting-down", None) for i in ids)
+        )
+
+    def test_makes_no_requests_for_no_instances(self):
+        ec2 = FakeEC2()
+        self.assertEqual(chaos.terminate_instances(ec2, []), [])
+        self.assertEqual(ec2.requests, [])
+
+    def test_bisects_out_invalid_instance_ids(self):
+        ec2 = FakeEC2()
+        ids = ["i-1", "i-2", "i-bad-3", "i-4", "i-5", "i-bad-6", "i-7"]
+        outcomes = chaos.terminate_instances(ec2, ids)
+        self.assertEqual(sorted(outcomes), sorted(
+            (i, None, "InvalidInstanceID.NotFound") if "bad" in i
+            else (i, "shutting-down", None)
+            for i in ids
+        ))
+        # Far fewer requests than one per instance
+        self.assertTrue(len(ec2.requests) < 2 * len(ids))
+
+    def test_retries_throttled_requests_with_backoff(self):
+        ec2 = mock.Mock()
+        ec2.terminate_instances.side_effect = [
+            ClientError("RequestLimitExceeded"),
+            ClientError("RequestLimitExceeded"),
+            {"TerminatingInstances": [
+                {"InstanceId": "i-1", "CurrentState": {"Name": "stopping"}}
+            ]}
+        ]
+        outcomes = chaos.terminate_instances(ec2, ["i-1"])
+        self.assertEqual(outcomes, [("i-1", "stopping", None)])
+        self.assertEqual(self.sleep.call_count, 2)
+        delays = [c[0][0] for c in self.sleep.call_args_list]
+        self.assertTrue(0 <= delays[0] <= chaos.TERMINATION_BACKOFF)
+        self.assertTrue(0 <= delays[1] <= chaos.TERMINATION_BACKOFF * 2)
+
+    def test_gives_up_after_repeated_throttling(self):
+        ec2 = mock.Mock()
+        ec2.terminate_instances.side_effect = \
+            ClientError("RequestLimitExceeded")
+        outcomes = chaos.terminate_instances(ec2, ["i-1", "i-2"])
+        self.assertEqual(outcomes, [
+            ("i-1", None, "RequestLimitExceeded"),
+            ("i-2", None, "RequestLimitExceeded")
+        ])
+        self.assertEqual(ec2.terminate_instances.call_count,
+                         chaos.TERMINATION_ATTEMPTS)
+
+    def test_does_not_bisect_other_errors(self):
+        ec2 = mock.Mock()
+        ec2.terminate_instances.side_effect = Exception("connection reset")
+        outcomes = chaos.terminate_instances(ec2, ["i-1", "i-2"])
+        self.assertEqual(ec2.terminate_instances.call_count, 1)
+        self.assertEqual(set(o[2] for o in outcomes),
+                         set(["connection reset"]))
+
+
+class TestSendNotifications(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+    )
+
+    def get_log_lines(self, name):
+        lines = []
+        for args, kwargs in self.log.call_args_list:
+            parts = re.findall(r"\[.*?\]|[^ ]+", " ".join(args))
+            if parts[0] == name:
+                lines.append(parts)
+        return lines
+
+    def make_notifications(self, count):
+        return [chaos.make_notification("asg-%d" % i, "i-%d" % i)
+                for i in range(count)]
+
+    def test_sends_notifications_in_batches_of_ten(self):
+        sink = mock.Mock(return_value=[])
+        notifications = self.make_notifications(25)
+        chaos.send_notifications([("sns", sink)], notifications)
+        batches = sorted((c[0][0] for c in sink.call_args_list), key=len)
+        self.assertEqual([len(b) for b in batches], [5, 10, 10])
+        sent = [n for batch in batches for n in batch]
+        self.assertEqual(
+            sorted(n["instance_id"] for n in sent),
+            sorted(n["instance_id"] for n in notifications)
+        )
+
+    def test_sends_to_every_sink(self):
+        sns = mock.Mock(return_value=[])
+        sqs = mock.Mock(return_value=[])
+        notifications = self.make_notifications(3)
+        chaos.send_notifications([("sns", sns), ("sqs", sqs)], notifications)
+        sns.assert_called_once_with(notifications)
+        sqs.assert_called_once_with(notifications)
+
+    def test_does_nothing_without_sinks(self):
+        self.assertEqual(
+            chaos.send_notifications([], self.make_notifications(3)), []
+        )
+
+    def test_reports_failed_entries(self):
+        notifications = self.make_notifications(3)
+        sink = mock.Mock(return_value=[(notifications[1], "Throttled")])
+        failures = chaos.send_notifications([("sns", sink)], notifications)
+        self.assertEqual(failures, [("sns", notifications[1], "Throttled")])
+        logged = self.get_log_lines("notification-failed")
+        self.assertEqual(
+            [(p[1], p[3], p[5], p[6]) for p in logged],
+            [("i-1", "asg-1", "sns", "[Throttled]")]
+        )
+
+    def test_reports_every_entry_of_a_failed_batch(self):
+        notifications = self.make_notifications(12)
+
+        def send(entries):
+            if len(entries) == 10:
+                raise Exception("boom")
+            return []
+        failures = chaos.send_notifications([("sqs", send)], notifications)
+        self.assertEqual(len(failures), 10)
+        self.assertEqual(set(f[2] for f in failures), set(["boom"]))
+        self.assertEqual(len(self.get_log_lines("notification-failed")), 10)
+
+
+class TestNotificationSenders(PatchingTestCase):
+
+    def setUp(self):
+        super(TestNotificationSenders, self).setUp()
+        self.notifications = [
+            chaos.make_notification("a1", "i1"),
+            chaos.make_notification("a2", "i2"),
+        ]
+
+    def test_publishes_batch_to_sns(self):
+        sns = mock.Mock()
+        sns.publish_batch.return_value = {
+            "Successful": [{"Id": "0"}],
+            "Failed": [{"Id": "1", "Code": "Throttled"}]
+        }
+        failures = chaos.publish_sns_batch(sns, "MyTestTopic",
+                                           self.notifications)
+        sns.publish_batch.assert_called_once_with(
+            TopicArn="MyTestTopic",
+            PublishBatchRequestEntries=[
+                {"Id": "0", "Message": MatchJson(self.notifications[0])},
+                {"Id": "1", "Message": MatchJson(self.notifications[1])}
+            ]
+        )
+        self.assertEqual(failures, [(self.notifications[1], "Throttled")])
+
+    def test_sends_batch_to_sqs(self):
+        sqs = mock.Mock()
+        sqs.send_message_batch.return_value = {
+            "Failed": [{"Id": "0", "Code": "AccessDenied"}]
+        }
+        failures = chaos.send_sqs_batch(sqs, "https://queue",
+                                        self.notifications)
+        sqs.send_message_batch.assert_called_once_with(
+            QueueUrl="https://queue",
+            Entries=[
+                {"Id": "0", "MessageBody": MatchJson(self.notifications[0])},
+                {"Id": "1", "MessageBody": MatchJson(self.notifications[1])}
+            ]
+        )
+        self.assertEqual(failures, [(self.notifications[0], "AccessDenied")])
+
+    def test_puts_events_to_eventbridge(self):
+        events = mock.Mock()
+        events.put_events.return_value = {
+            "FailedEntryCount": 1,
+            "Entries": [{"EventId": "e"}, {"ErrorCode": "InternalFailure"}]
+        }
+        failures = chaos.put_events_batch(events, "bus", self.notifications)
+        entries = events.put_events.call_args[1]["Entries"]
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]["EventBusName"], "bus")
+        self.assertEqual(entries[0]["DetailType"], "chaos_lambda.terminating")
+        self.assertEqual(entries[1]["Detail"],
+                         MatchJson(self.notifications[1]))
+        self.assertEqual(failures,
+                         [(self.notifications[1], "InternalFailure")])
+
+
+class TestGetNotificationSinks(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.os",
+    )
+
+    def set_environment(self, env):
+        self.os.environ.get.side_effect = \
+            lambda name, default: env.get(name, default)
+
+    def test_returns_no_sinks_if_nothing_configured(self):
+        self.set_environment({})
+        self.assertEqual(chaos.get_notification_sinks("r-1"), [])
+
+    def test_uses_client_in_topic_region(self):
+        self.set_environment({
+            "termination_topic_arn": "arn:aws:sns:sp-moonbase-1:1234:topic"
+        })
+        sinks = chaos.get_notification_sinks("r-1")
+        self.get_client.assert_called_once_with("sns", "sp-moonbase-1")
+        self.assertEqual([name for name, send in sinks], ["sns"])
+        sinks[0][1]([])
+        self.get_client.return_value.publish_batch.assert_called_once_with(
+            TopicArn="arn:aws:sns:sp-moonbase-1:1234:topic",
+            PublishBatchRequestEntries=[]
+        )
+
+    def test_uses_client_in_queue_region(self):
+        for url in ("https://sqs.sp-moonbase-1.amazonaws.com/1234/q",
+                    "https://sp-moonbase-1.queue.amazonaws.com/1234/q"):
+            self.get_client.reset_mock()
+            self.set_environment({"termination_queue_url": url})
+            chaos.get_notification_sinks("r-1")
+            self.get_client.assert_called_once_with("sqs", "sp-moonbase-1")
+
+    def test_uses_target_region_for_event_bus_name(self):
+        self.set_environment({"termination_event_bus": "default"})
+        chaos.get_notification_sinks("r-1")
+        self.get_client.assert_called_once_with("events", "r-1")
+
+    def test_returns_sink_for_each_configured_destination(self):
+        self.set_environment({
+            "termination_topic_arn": "arn:aws:sns:r-1:1234:topic",
+            "termination_queue_url": "https://sqs.r-1.amazonaws.com/1234/q",
+            "termination_event_bus": "arn:aws:events:r-1:1234:event-bus/b",
+        })
+        sinks = chaos.get_notification_sinks("r-1")
+        self.assertEqual(
+            sorted(name for name, send in sinks),
+            ["events", "sns", "sqs"]
+        )
+
 
 class MatchJson:
     '''
@@ -405,7 +1402,9 @@ class MatchJson:
 class TestChaosLambda(PatchingTestCase):
 
     patch_list = (
+        "chaos.Config",
         "chaos.boto3",
+        "chaos.get_notification_sinks",
         "chaos.get_targets",
         "chaos.log",
         "chaos.terminate_targets",
@@ -413,10 +1412,11 @@ class TestChaosLambda(PatchingTestCase):
 
     def setUp(self):
         super(TestChaosLambda, self).setUp()
+        chaos.reset_clients()
         self.clients = {}
         self.boto3.client.side_effect = self.make_client
 
-    def make_client(self, name, region_name):
+    def make_client(self, name, region_name, config=None):
         c = self.clients.get(name, None)
         if c is not None:
             self.assertEqual(c.region_name, region_name)
@@ -424,10 +1424,32 @@ class TestChaosLambda(PatchingTestCase):
             c = self.clients[name] = mock.Mock(region_name=region_name)
         return c
 
+    def get_log_lines(self, name):
+        lines = []
+        for args, kwargs in self.log.call_args_list:
+            parts = re.findall(r"\[.*?\]|[^ ]+", " ".join(map(str, args)))
+            if parts[0] == name:
+                lines.append(parts)
+        return lines
+
     def test_parseable_log_line_for_trigger(self):
         self.get_targets.return_value = []
         chaos.chaos_lambda(["sp-moonbase-1"], 0)
-        self.log.assert_called_once_with("triggered", "sp-moonbase-1")
+        self.log.assert_any_call("triggered", "sp-moonbase-1")
+        self.assertEqual(self.get_log_lines("triggered"), [
+            ["triggered", "sp-moonbase-1"]
+        ])
+
+    def test_sets_log_region_while_processing_region(self):
+        regions = []
+
+        def get_targets(autoscaling, default, asgs, reservoir, shard):
+            regions.append(chaos.log_context.region)
+            return []
+        self.get_targets.side_effect = get_targets
+        chaos.chaos_lambda(["sp-moonbase-1"], 0)
+        self.assertEqual(regions, ["sp-moonbase-1"])
+        self.assertEqual(chaos.log_context.region, None)
 
     def test_does_nothing_if_no_targets(self):
         self.get_targets.return_value = []
@@ -451,10 +1473,475 @@ class TestChaosLambda(PatchingTestCase):
         targets = [("a", "i-11111111"), ("b", "i-22222222")]
         self.get_targets.return_value = targets
         ec2 = self.make_client("ec2", region_name="sp-moonbase-1")
-        sns = self.make_client("sns", region_name="sp-moonbase-1")
         chaos.chaos_lambda(["sp-moonbase-1"], 0)
         # Above triggers self.make_client, which checks the region name
-        self.terminate_targets.assert_called_once_with(ec2, sns, targets)
+        self.get_notification_sinks.assert_called_once_with("sp-moonbase-1")
+        self.terminate_targets.assert_called_once_with(
+            ec2,
+            self.get_notification_sinks.return_value,
+            targets,
+            None
+        )
+
+    def test_parseable_log_line_for_each_region_result(self):
+        self.get_targets.side_effect = lambda autoscaling, *args: \
+            [("a", "i-11111111")] if autoscaling.region_name == "r-1" else []
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config: \
+            mock.Mock(region_name=region_name)
+        chaos.chaos_lambda(["r-1", "r-2"], 0)
+        logged = self.get_log_lines("region-result")
+        self.assertEqual(
+            set((p[1], p[3], p[7]) for p in logged),
+            set([("r-1", "ok", "1"), ("r-2", "ok", "0")])
+        )
+        self.assertTrue(all(re.match(r"^\d+\.\d{3}s$", p[5]) for p in logged))
+
+    @mock.patch("chaos_metrics.record_region")
+    def test_records_region_durations_if_enabled(self, record_region):
+        self.get_targets.return_value = []
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config: \
+            mock.Mock(region_name=region_name)
+        with mock.patch.dict("os.environ", {"region_metrics": "true"}):
+            chaos.chaos_lambda(["r-1", "r-2"], 0)
+        self.assertEqual(
+            sorted(c[0][0] for c in record_region.call_args_list),
+            ["r-1", "r-2"]
+        )
+        with mock.patch.dict("os.environ", {"region_metrics": ""}):
+            chaos.chaos_lambda(["r-1"], 0)
+        self.assertEqual(record_region.call_count, 2)
+
+    def test_logs_completion_summary(self):
+        self.get_targets.return_value = [("a", "i-11111111")]
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config: \
+            mock.Mock(region_name=region_name)
+        chaos.chaos_lambda(["r-1", "r-2", "r-3"], 0)
+        logged = self.get_log_lines("completed")
+        self.assertEqual(len(logged), 1)
+        self.assertEqual((logged[0][1], logged[0][6]), ("3", "3"))
+
+    def test_processes_every_region_concurrently(self):
+        self.get_targets.side_effect = lambda autoscaling, *args: \
+            [("a", "i-" + autoscaling.region_name)]
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config: \
+            mock.Mock(region_name=region_name)
+        regions = ["r-1", "r-2", "r-3", "r-4"]
+        results = chaos.chaos_lambda(regions, 0, concurrency=3)
+        self.assertEqual([r[0] for r in results], regions)
+        self.assertEqual(self.terminate_targets.call_count, 4)
+        terminated = set(c[0][2][0][1] for c in
+                         self.terminate_targets.call_args_list)
+        self.assertEqual(terminated, set("i-" + r for r in regions))
+
+    def test_isolates_failures_to_a_single_region(self):
+        def get_targets(autoscaling, default, asgs, reservoir, shard):
+            if autoscaling.region_name == "r-2":
+                raise Exception("boom")
+            return [("a", "i-11111111")]
+        self.get_targets.side_effect = get_targets
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config: \
+            mock.Mock(region_name=region_name)
+        with self.assertRaises(RuntimeError):
+            chaos.chaos_lambda(["r-1", "r-2", "r-3"], 0, concurrency=2)
+        self.assertEqual(self.terminate_targets.call_count, 2)
+        statuses = dict((p[1], p[3]) for p in
+                        self.get_log_lines("region-result"))
+        self.assertEqual(statuses, {"r-1": "ok", "r-2": "error", "r-3": "ok"})
+
+    @mock.patch("time.monotonic")
+    def test_skips_termination_if_region_budget_exceeded(self, monotonic):
+        clock = iter(range(0, 100, 10))
+        monotonic.side_effect = lambda: next(clock)
+        self.get_targets.return_value = [("a", "i-11111111")]
+        results = chaos.chaos_lambda(["sp-moonbase-1"], 0, region_budget=5)
+        self.assertEqual(self.terminate_targets.call_count, 0)
+        self.assertEqual(results[0][1:3], ("timeout", 0))
+        self.assertEqual(self.get_log_lines("completed")[0][6], "0")
+
+    def sample_targets(self, weights):
+        # weights maps region to a list of (target, key) for the reservoir
+        def get_targets(autoscaling, default, asgs, reservoir, shard):
+            for target, key in weights[autoscaling.region_name]:
+                reservoir.added += 1
+                reservoir.push(key, target)
+            return reservoir.targets()
+        self.get_targets.side_effect = get_targets
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config: \
+            mock.Mock(region_name=region_name)
+
+    def get_terminated(self):
+        return dict(
+            (c[0][0].region_name, c[0][2])
+            for c in self.terminate_targets.call_args_list
+        )
+
+    def test_terminates_targets_with_largest_keys_across_regions(self):
+        self.sample_targets({
+            "r-1": [(("a", "i-1"), -0.1), (("b", "i-2"), -3.0)],
+            "r-2": [(("c", "i-3"), -0.2), (("d", "i-4"), -0.3)],
+            "r-3": [(("e", "i-5"), -5.0)],
+        })
+        chaos.chaos_lambda(["r-1", "r-2", "r-3"], 0, max_terminations=3)
+        self.assertEqual(self.get_terminated(), {
+            "r-1": [("a", "i-1")],
+            "r-2": [("c", "i-3"), ("d", "i-4")],
+        })
+        self.assertEqual(self.get_log_lines("capped"), [
+            ["capped", "3", "of", "5", "targets", "at", "3"]
+        ])
+        self.assertEqual(self.get_log_lines("completed")[0][6], "3")
+
+    def test_terminates_nothing_if_cap_is_zero(self):
+        self.sample_targets({"r-1": [(("a", "i-1"), -0.1)]})
+        chaos.chaos_lambda(["r-1"], 0, max_terminations=0)
+        self.assertEqual(self.terminate_targets.call_count, 0)
+
+    def test_leaves_out_regions_that_failed_or_timed_out(self):
+        self.sample_targets({
+            "r-1": [(("a", "i-1"), -0.1)],
+            "r-2": [(("b", "i-2"), -0.01)],
+        })
+        real_chaos_region = chaos.chaos_region
+
+        def chaos_region(region, *args):
+            status, targets = real_chaos_region(region, *args)
+            return ("timeout" if region == "r-2" else status), targets
+        with mock.patch("chaos.chaos_region", chaos_region):
+            chaos.chaos_lambda(["r-1", "r-2"], 0, max_terminations=2)
+        self.assertEqual(self.get_terminated(), {"r-1": [("a", "i-1")]})
+
+    def test_includes_regions_that_stopped_at_the_deadline(self):
+        self.sample_targets({
+            "r-1": [(("a", "i-1"), -0.1)],
+            "r-2": [(("b", "i-2"), -0.01)],
+        })
+        real_chaos_region = chaos.chaos_region
+
+        def chaos_region(region, *args):
+            status, targets = real_chaos_region(region, *args)
+            return ("partial" if region == "r-2" else status), targets
+        with mock.patch("chaos.chaos_region", chaos_region):
+            chaos.chaos_lambda(["r-1", "r-2"], 0, max_terminations=2)
+        self.assertEqual(self.get_terminated(), {
+            "r-1": [("a", "i-1")], "r-2": [("b", "i-2")],
+        })
+
+    def test_reports_regions_that_fail_to_terminate(self):
+        self.sample_targets({
+            "r-1": [(("a", "i-1"), -0.1)],
+            "r-2": [(("b", "i-2"), -0.2)],
+        })
+        self.terminate_targets.side_effect = \
+            lambda ec2, sinks, targets, account: \
+            1 / 0 if ec2.region_name == "r-2" else []
+        with self.assertRaises(RuntimeError) as cm:
+            chaos.chaos_lambda(["r-1", "r-2"], 0, max_terminations=2)
+        self.assertIn("r-2", str(cm.exception))
+        self.assertNotIn("r-1", str(cm.exception))
+
+    def run_accounts(self, accounts, **kwargs):
+        self.boto3.client.side_effect = \
+            lambda name, region_name, config, **credentials: mock.Mock(
+                region_name=region_name,
+                key=credentials.get("aws_access_key_id", None)
+            )
+        with mock.patch("chaos_accounts.get_credentials") as get_credentials:
+            get_credentials.side_effect = lambda account: {
+                "AccessKeyId": "key-" + account,
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+            }
+            return chaos.chaos_lambda(
+                ["r-1", "r-2"], 0, accounts=accounts, **kwargs
+            )
+
+    def test_processes_every_region_of_every_account(self):
+        self.get_targets.side_effect = lambda autoscaling, *args: \
+            [("a", "i-%s-%s" % (autoscaling.key, autoscaling.region_name))]
+        results = self.run_accounts([None, "1", "2"], concurrency=4)
+        self.assertEqual([r[0] for r in results], ["r-1", "r-2"] * 3)
+        terminated = set(
+            (c[0][0].key, c[0][0].region_name, c[0][2][0][1], c[0][3])
+            for c in self.terminate_targets.call_args_list
+        )
+        self.assertEqual(terminated, set([
+            (key, region, "i-%s-%s" % (key, region), account)
+            for key, account in ((None, None), ("key-1", "1"),
+                                 ("key-2", "2"))
+            for region in ("r-1", "r-2")
+        ]))
+        self.assertEqual(self.get_log_lines("triggered").count(
+            ["triggered", "r-1", "in", "1"]
+        ), 1)
+
+    def test_logs_result_for_each_other_account(self):
+        def get_targets(autoscaling, *args):
+            if autoscaling.key == "key-2" and autoscaling.region_name == "r-2":
+                raise Exception("boom")
+            return [("a", "i-1")]
+        self.get_targets.side_effect = get_targets
+        with self.assertRaises(RuntimeError) as cm:
+            self.run_accounts([None, "1", "2"])
+        self.assertEqual(str(cm.exception), "Chaos Lambda failed in 2/r-2")
+        logged = self.get_log_lines("account-result")
+        self.assertEqual(
+            sorted((p[1], p[3], p[7], p[10]) for p in logged),
+            [("1", "ok", "2", "2"), ("2", "error", "1", "2")]
+        )
+        self.assertTrue(all(re.match(r"^\d+\.\d{3}s$", p[5]) for p in logged))
+        statuses = dict(((p[1], p[-1]), p[3]) for p in
+                        self.get_log_lines("region-result"))
+        self.assertEqual(statuses[("r-2", "2")], "error")
+
+    def test_samples_targets_across_accounts(self):
+        def get_targets(autoscaling, default, asgs, reservoir, shard):
+            key = -0.1 if autoscaling.key == "key-1" else -1.0
+            reservoir.added += 1
+            reservoir.push(key, ("a", "i-%s" % autoscaling.key))
+            return reservoir.targets()
+        self.get_targets.side_effect = get_targets
+        self.run_accounts([None, "1"], max_terminations=2)
+        self.assertEqual(
+            sorted((c[0][0].region_name, c[0][3])
+                   for c in self.terminate_targets.call_args_list),
+            [("r-1", "1"), ("r-2", "1")]
+        )
+
+    def test_saves_regions_left_unfinished_to_checkpoint(self):
+        def run_region(region, *args):
+            status = {"r-1": "ok", "r-2": "partial", "r-3": "deferred"}
+            chaos.listing.next_token = "t" if region == "r-2" else None
+            return region, status[region], 0, 0.0
+        checkpoints = mock.Mock()
+        checkpoints.resume.side_effect = lambda items: (items, {})
+        with mock.patch("chaos.run_region", run_region):
+            chaos.chaos_lambda(
+                ["r-1", "r-2", "r-3"], 0, checkpoints=checkpoints
+            )
+        checkpoints.save.assert_called_once_with([
+            ((None, "r-2"), "t"), ((None, "r-3"), None)
+        ])
+
+    def test_resumes_regions_from_checkpoint(self):
+        calls = []
+
+        def run_region(region, default, budget, reservoir, account, shard,
+                       token):
+            calls.append((region, token))
+            chaos.listing.next_token = None
+            return region, "ok", 0, 0.0
+        checkpoints = mock.Mock()
+        checkpoints.resume.return_value = (
+            [(None, "r-2")], {(None, "r-2"): "t"}
+        )
+        with mock.patch("chaos.run_region", run_region):
+            results = chaos.chaos_lambda(
+                ["r-1", "r-2"], 0, checkpoints=checkpoints
+            )
+        checkpoints.resume.assert_called_once_with(
+            [(None, "r-1"), (None, "r-2")]
+        )
+        self.assertEqual(calls, [("r-2", "t")])
+        self.assertEqual([r[0] for r in results], ["r-2"])
+        checkpoints.save.assert_called_once_with([])
+
+    def test_logs_client_cache_counters(self):
+        self.get_targets.return_value = []
+        chaos.chaos_lambda(["sp-moonbase-1"], 0)
+        chaos.chaos_lambda(["sp-moonbase-1"], 0)
+        logged = self.get_log_lines("client-cache")
+        self.assertEqual((logged[-1][1], logged[-1][3]), ("1", "1"))
+
+
+class TestGetClient(PatchingTestCase):
+
+    patch_list = (
+        "chaos.Config",
+        "chaos.boto3",
+        "chaos.get_client_config",
+    )
+
+    def setUp(self):
+        super(TestGetClient, self).setUp()
+        chaos.reset_clients()
+        self.boto3.client.side_effect = lambda *args, **kwargs: mock.Mock()
+
+    def tearDown(self):
+        chaos.reset_clients()
+        super(TestGetClient, self).tearDown()
+
+    def test_creates_client_with_region_and_config(self):
+        chaos.get_client("ec2", "sp-moonbase-1")
+        self.boto3.client.assert_called_once_with(
+            "ec2",
+            region_name="sp-moonbase-1",
+            config=self.get_client_config.return_value
+        )
+
+    def test_reuses_client_for_same_service_and_region(self):
+        a = chaos.get_client("ec2", "sp-moonbase-1")
+        b = chaos.get_client("ec2", "sp-moonbase-1")
+        self.assertIs(a, b)
+        self.assertEqual(self.boto3.client.call_count, 1)
+
+    def test_creates_separate_clients_per_service_and_region(self):
+        clients = set([
+            chaos.get_client("ec2", "sp-moonbase-1"),
+            chaos.get_client("ec2", "re-gion-1"),
+            chaos.get_client("sns", "sp-moonbase-1"),
+        ])
+        self.assertEqual(len(clients), 3)
+
+    @mock.patch("chaos_metrics.instrument")
+    def test_instruments_new_clients_if_api_metrics_enabled(self, instrument):
+        with mock.patch("chaos.get_env_flag") as get_env_flag:
+            get_env_flag.return_value = True
+            client = chaos.get_client("ec2", "sp-moonbase-1")
+            chaos.get_client("ec2", "sp-moonbase-1")
+            get_env_flag.assert_called_once_with("api_metrics")
+        instrument.assert_called_once_with(client)
+
+    @mock.patch("chaos_accounts.get_credentials")
+    def test_creates_clients_for_other_accounts(self, get_credentials):
+        get_credentials.return_value = {
+            "AccessKeyId": "key",
+            "SecretAccessKey": "secret",
+            "SessionToken": "token",
+        }
+        own = chaos.get_client("ec2", "sp-moonbase-1")
+        a = chaos.get_client("ec2", "sp-moonbase-1", "111111111111")
+        b = chaos.get_client("ec2", "sp-moonbase-1", "111111111111")
+        self.assertIsNot(own, a)
+        self.assertIs(a, b)
+        get_credentials.assert_called_with("111111111111")
+        self.boto3.client.assert_called_with(
+            "ec2",
+            region_name="sp-moonbase-1",
+            config=self.get_client_config.return_value,
+            aws_access_key_id="key",
+            aws_secret_access_key="secret",
+            aws_session_token="token"
+        )
+
+    @mock.patch("chaos_accounts.get_credentials")
+    def test_replaces_clients_when_credentials_change(self, get_credentials):
+        get_credentials.side_effect = [
+            {"AccessKeyId": k, "SecretAccessKey": "s", "SessionToken": "t"}
+            for k in ("old", "old", "new")
+        ]
+        a = chaos.get_client("ec2", "sp-moonbase-1", "111111111111")
+        b = chaos.get_client("ec2", "sp-moonbase-1", "111111111111")
+        c = chaos.get_client("ec2", "sp-moonbase-1", "111111111111")
+        self.assertIs(a, b)
+        self.assertIsNot(b, c)
+        self.assertEqual(len(chaos.clients), 1)
+
+    def test_counts_cache_hits_and_creations(self):
+        chaos.get_client("ec2", "sp-moonbase-1")
+        chaos.get_client("ec2", "sp-moonbase-1")
+        chaos.get_client("ec2", "sp-moonbase-1")
+        chaos.get_client("sns", "sp-moonbase-1")
+        self.assertEqual(chaos.client_stats["hits"], 2)
+        self.assertEqual(chaos.client_stats["created"], 2)
+        self.assertGreaterEqual(chaos.client_stats["create_time"], 0.0)
+
+
+class TestImportBoto3(PatchingTestCase):
+
+    def test_boto3_is_not_imported_with_the_module(self):
+        self.assertIsNone(chaos.Config)
+
+    def test_imports_boto3_and_botocore_config_on_demand(self):
+        modules = ["boto3", "botocore", "botocore.config"]
+        with mock.patch.object(chaos, "boto3", None), \
+                mock.patch.object(chaos, "Config", None), \
+                mocked_imports(modules) as mocks:
+            chaos.import_boto3()
+            self.assertIs(chaos.boto3, mocks["boto3"])
+            self.assertIs(chaos.Config, mocks["botocore.config"].Config)
+
+
+class TestPrewarm(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.get_notification_sinks",
+        "chaos.get_regions",
+        "chaos.os",
+    )
+
+    def test_creates_clients_for_configured_regions(self):
+        self.get_regions.return_value = ["r-1", "r-2"]
+        chaos.prewarm()
+        self.get_regions.assert_called_once_with(None)
+        self.assertEqual(
+            set(c[0] for c in self.get_client.call_args_list),
+            set((service, region)
+                for service in ("autoscaling", "ec2")
+                for region in ("r-1", "r-2"))
+        )
+        self.assertEqual(
+            set(c[0][0] for c in self.get_notification_sinks.call_args_list),
+            set(["r-1", "r-2"])
+        )
+
+    def test_falls_back_to_lambda_region(self):
+        self.get_regions.return_value = []
+        self.os.environ.get.return_value = "sp-moonbase-1"
+        chaos.prewarm()
+        self.os.environ.get.assert_called_once_with("AWS_REGION", "")
+        self.assertEqual(
+            set(c[0][1] for c in self.get_client.call_args_list),
+            set(["sp-moonbase-1"])
+        )
+
+    def test_does_nothing_without_a_region(self):
+        self.get_regions.return_value = []
+        self.os.environ.get.return_value = ""
+        chaos.prewarm()
+        self.assertEqual(self.get_client.call_count, 0)
+
+
+class TestGetClientConfig(PatchingTestCase):
+
+    patch_list = (
+        "chaos.Config",
+        "chaos.get_concurrency",
+    )
+
+    def test_uses_adaptive_retries_and_bounded_timeouts(self):
+        self.get_concurrency.return_value = 1
+        chaos.get_client_config()
+        kwargs = self.Config.call_args[1]
+        self.assertEqual(kwargs["retries"]["mode"], "adaptive")
+        self.assertTrue(kwargs["connect_timeout"] > 0)
+        self.assertTrue(kwargs["read_timeout"] > 0)
+        self.assertTrue(kwargs["tcp_keepalive"])
+
+    @mock.patch.dict("os.environ", {"rate_limit": "10"})
+    def test_uses_standard_retries_with_shared_rate_limits(self):
+        self.get_concurrency.return_value = 1
+        chaos.get_client_config()
+        kwargs = self.Config.call_args[1]
+        self.assertEqual(kwargs["retries"]["mode"], "standard")
+
+    def test_never_retries_lambda_invocations(self):
+        self.get_concurrency.return_value = 1
+        chaos.get_client_config("lambda")
+        kwargs = self.Config.call_args[1]
+        self.assertEqual(kwargs["retries"], {"total_max_attempts": 1})
+        self.assertEqual(kwargs["read_timeout"], chaos.LAMBDA_READ_TIMEOUT)
+
+    def test_sizes_connection_pool_for_concurrency(self):
+        self.get_concurrency.return_value = 32
+        chaos.get_client_config()
+        self.assertEqual(self.Config.call_args[1]["max_pool_connections"], 32)
 
 
 class TestGetRegions(PatchingTestCase):
@@ -478,6 +1965,10 @@ class TestGetRegions(PatchingTestCase):
             result = chaos.get_regions(context)
             self.assertEqual(result, [region])
 
+    def test_returns_empty_list_without_regions_variable_or_context(self):
+        self.os.environ.get.return_value = ""
+        self.assertEqual(chaos.get_regions(None), [])
+
     def test_reads_from_comma_separated_regions_variable_if_set(self):
         self.os.environ.get.return_value = "re-gion-1,sp-moonbase-1"
         result = chaos.get_regions(mock.Mock())
@@ -489,6 +1980,37 @@ class TestGetRegions(PatchingTestCase):
         self.assertEqual(result, ["sp-moonbase-1", "re-gion-1"])
 
 
+class TestGetAccounts(PatchingTestCase):
+
+    def setUp(self):
+        super(TestGetAccounts, self).setUp()
+        self.context = mock.Mock(
+            invoked_function_arn="arn:aws:lambda:r:111111111111:function:f"
+        )
+
+    def test_returns_none_if_not_set(self):
+        with mock.patch.dict("os.environ", {"accounts": " "}):
+            self.assertIsNone(chaos.get_accounts(self.context))
+
+    def test_reads_comma_separated_accounts(self):
+        with mock.patch.dict("os.environ",
+                             {"accounts": " 222222222222,,333333333333 "}):
+            self.assertEqual(
+                chaos.get_accounts(self.context),
+                ["222222222222", "333333333333"]
+            )
+
+    def test_gives_lambdas_own_account_as_none(self):
+        with mock.patch.dict("os.environ",
+                             {"accounts": "111111111111,222222222222"}):
+            self.assertEqual(
+                chaos.get_accounts(self.context), [None, "222222222222"]
+            )
+            self.assertEqual(
+                chaos.get_accounts(None), ["111111111111", "222222222222"]
+            )
+
+
 class TestGetDefaultProbability(PatchingTestCase):
 
     patch_list = (
@@ -517,21 +2039,265 @@ class TestGetDefaultProbability(PatchingTestCase):
         self.assertEqual(p, 0.1)
 
 
+class TestGetConcurrency(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+    )
+
+    def test_defaults_to_one_worker(self):
+        self.os.environ.get.return_value = ""
+        self.assertEqual(chaos.get_concurrency(), 1)
+        self.os.environ.get.assert_called_once_with("concurrency", "")
+
+    def test_returns_integer_value_of_concurrency_variable(self):
+        self.os.environ.get.return_value = " 6\n"
+        self.assertEqual(chaos.get_concurrency(), 6)
+
+    def test_never_returns_less_than_one_worker(self):
+        self.os.environ.get.return_value = "0"
+        self.assertEqual(chaos.get_concurrency(), 1)
+
+
+class TestGetRegionBudget(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+    )
+
+    def test_returns_None_if_no_region_timeout_variable(self):
+        self.os.environ.get.return_value = ""
+        self.assertEqual(chaos.get_region_budget(), None)
+        self.os.environ.get.assert_called_once_with("region_timeout", "")
+
+    def test_returns_float_value_of_region_timeout_variable(self):
+        self.os.environ.get.return_value = " 12.5 "
+        self.assertEqual(chaos.get_region_budget(), 12.5)
+
+
+class TestGetMaxTerminations(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+    )
+
+    def test_returns_None_if_no_max_terminations_variable(self):
+        self.os.environ.get.return_value = ""
+        self.assertEqual(chaos.get_max_terminations(), None)
+        self.os.environ.get.assert_called_once_with("max_terminations", "")
+
+    def test_returns_int_value_of_max_terminations_variable(self):
+        self.os.environ.get.return_value = " 5 "
+        self.assertEqual(chaos.get_max_terminations(), 5)
+
+    def test_never_returns_less_than_zero(self):
+        self.os.environ.get.return_value = "-1"
+        self.assertEqual(chaos.get_max_terminations(), 0)
+
+
+class TestGetShards(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+    )
+
+    def test_returns_1_if_no_shards_variable(self):
+        self.os.environ.get.return_value = ""
+        self.assertEqual(chaos.get_shards(), 1)
+        self.os.environ.get.assert_called_once_with("shards", "")
+
+    def test_returns_int_value_of_shards_variable(self):
+        self.os.environ.get.return_value = " 8 "
+        self.assertEqual(chaos.get_shards(), 8)
+
+    def test_never_returns_less_than_one(self):
+        self.os.environ.get.return_value = "0"
+        self.assertEqual(chaos.get_shards(), 1)
+
+
+class TestGetDeadline(PatchingTestCase):
+
+    patch_list = (
+        "time.monotonic",
+    )
+
+    def test_returns_none_without_context(self):
+        self.assertIsNone(chaos.get_deadline(None))
+
+    def test_leaves_margin_before_lambda_would_be_stopped(self):
+        self.monotonic.return_value = 100.0
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 30000
+        with mock.patch.dict("os.environ", {"deadline_margin": ""}):
+            self.assertEqual(
+                chaos.get_deadline(context),
+                130.0 - chaos.DEFAULT_DEADLINE_MARGIN
+            )
+        with mock.patch.dict("os.environ", {"deadline_margin": " 10 "}):
+            self.assertEqual(chaos.get_deadline(context), 120.0)
+
+    def test_caps_remaining_time(self):
+        self.monotonic.return_value = 100.0
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 30000
+        with mock.patch.dict("os.environ", {"deadline_margin": "5"}):
+            self.assertEqual(chaos.get_deadline(context, 10.0), 105.0)
+            self.assertEqual(chaos.get_deadline(context, 60.0), 125.0)
+            self.assertEqual(chaos.get_deadline(None, 10.0), 105.0)
+
+
+class TestGetCheckpoints(PatchingTestCase):
+
+    def test_returns_none_unless_table_set(self):
+        with mock.patch.dict("os.environ", {"checkpoint_table": ""}):
+            self.assertIsNone(chaos.get_checkpoints())
+
+    @mock.patch("chaos.get_client")
+    def test_uses_table_from_environment(self, get_client):
+        with mock.patch.dict("os.environ", {"checkpoint_table": "t"}):
+            checkpoints = chaos.get_checkpoints()
+        self.assertEqual(checkpoints.store.table, "t")
+        self.assertEqual(checkpoints.store.dynamodb, get_client.return_value)
+
+
+class TestGetShardRunner(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_shards",
+    )
+
+    def test_returns_none_unless_sharded(self):
+        self.get_shards.return_value = 1
+        self.assertIsNone(chaos.get_shard_runner(mock.Mock()))
+
+    def test_invokes_own_function(self):
+        self.get_shards.return_value = 4
+        runner = chaos.get_shard_runner(mock.Mock(function_name="f"))
+        self.assertEqual(runner.count, 4)
+        self.assertEqual(runner.invoker.function_name, "f")
+
+    def test_runs_workers_in_process_without_context(self):
+        import chaos_shards
+        self.get_shards.return_value = 4
+        runner = chaos.get_shard_runner(None)
+        self.assertIsInstance(runner.invoker, chaos_shards.LocalInvoker)
+        runner = chaos.get_shard_runner(object())
+        self.assertIsInstance(runner.invoker, chaos_shards.LocalInvoker)
+
+
+class TestGetLogFormat(PatchingTestCase):
+
+    patch_list = (
+        "chaos.os",
+    )
+
+    def test_returns_text_if_no_log_format_variable(self):
+        self.os.environ.get.return_value = ""
+        self.assertEqual(chaos.get_log_format(), "text")
+        self.os.environ.get.assert_called_once_with("log_format", "")
+
+    def test_returns_lowercased_log_format(self):
+        self.os.environ.get.return_value = " JSON "
+        self.assertEqual(chaos.get_log_format(), "json")
+
+    def test_raises_error_for_unknown_format(self):
+        self.os.environ.get.return_value = "xml"
+        with self.assertRaises(ValueError):
+            chaos.get_log_format()
+
+
+class TestSaveOutput(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+    )
+
+    def test_leaves_local_files_in_place(self):
+        finish = mock.Mock()
+        self.assertTrue(chaos.save_output("x", "/tmp/x", "/tmp/x", finish))
+        finish.assert_called_once_with()
+        self.assertFalse(self.get_client.called)
+
+    def test_logs_failure_and_removes_temporary_file(self):
+        self.get_client.return_value.put_object.side_effect = \
+            Exception("denied")
+        local_path = chaos.get_output_path("s3://bucket/x", ".x")
+        self.assertTrue(local_path.endswith(".x"))
+        self.assertFalse(chaos.save_output(
+            "x", "s3://bucket/x", local_path, mock.Mock()
+        ))
+        self.log.assert_called_once_with("x-failed", "s3://bucket/x",
+                                         "[denied]")
+        self.assertFalse(os.path.exists(local_path))
+
+
+class TestEmitMetrics(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_env_flag",
+        "chaos.log_record",
+        "chaos_metrics.emit",
+    )
+
+    def test_does_nothing_unless_enabled(self):
+        self.get_env_flag.return_value = False
+        chaos.emit_metrics()
+        self.assertEqual(self.get_env_flag.call_args_list, [
+            mock.call("api_metrics"), mock.call("region_metrics")
+        ])
+        self.assertEqual(self.emit.call_count, 0)
+
+    def test_emits_region_metrics_alone(self):
+        self.get_env_flag.side_effect = lambda name: name == "region_metrics"
+        self.emit.return_value = [{"a": 1}]
+        chaos.emit_metrics()
+        self.log_record.assert_called_once_with({"a": 1})
+
+    def test_logs_each_record(self):
+        self.get_env_flag.return_value = True
+        self.emit.return_value = [{"a": 1}, {"b": 2}]
+        chaos.emit_metrics()
+        self.assertEqual(self.log_record.call_args_list, [
+            mock.call({"a": 1}), mock.call({"b": 2})
+        ])
+
+
 class TestHandler(PatchingTestCase):
 
     patch_list = (
         "chaos.chaos_lambda",
+        "chaos.emit_metrics",
+        "chaos.flush_log",
+        "chaos.get_accounts",
+        "chaos.get_checkpoints",
+        "chaos.get_concurrency",
+        "chaos.get_deadline",
         "chaos.get_default_probability",
+        "chaos.get_log_format",
+        "chaos.get_max_terminations",
+        "chaos.get_region_budget",
         "chaos.get_regions",
+        "chaos.get_shard_runner",
     )
 
+    def tearDown(self):
+        chaos.log_settings["json"] = False
+        super(TestHandler, self).tearDown()
+
     def test_passes_along_the_region_list(self):
         context = mock.sentinel.context
         chaos.handler(None, context)
         self.get_regions.assert_called_once_with(context)
         self.chaos_lambda.assert_called_once_with(
             self.get_regions.return_value,
-            mock.ANY
+            mock.ANY,
+            concurrency=mock.ANY,
+            region_budget=mock.ANY,
+            max_terminations=mock.ANY,
+            accounts=mock.ANY,
+            shards=mock.ANY,
+            checkpoints=mock.ANY
         )
 
     def test_passes_along_the_default_probability(self):
@@ -539,5 +2305,118 @@ class TestHandler(PatchingTestCase):
         self.get_default_probability.assert_called_once_with()
         self.chaos_lambda.assert_called_once_with(
             mock.ANY,
-            self.get_default_probability.return_value
+            self.get_default_probability.return_value,
+            concurrency=mock.ANY,
+            region_budget=mock.ANY,
+            max_terminations=mock.ANY,
+            accounts=mock.ANY,
+            shards=mock.ANY,
+            checkpoints=mock.ANY
+        )
+
+    def test_emits_api_metrics_even_if_run_fails(self):
+        self.chaos_lambda.side_effect = RuntimeError("boom")
+        with self.assertRaises(RuntimeError):
+            chaos.handler(None, mock.Mock())
+        self.emit_metrics.assert_called_once_with()
+        self.flush_log.assert_called_once_with()
+
+    def test_selects_the_log_format(self):
+        self.get_log_format.return_value = "json"
+        chaos.handler(None, mock.Mock())
+        self.assertTrue(chaos.log_settings["json"])
+        self.get_log_format.return_value = "text"
+        chaos.handler(None, mock.Mock())
+        self.assertFalse(chaos.log_settings["json"])
+
+    def test_passes_along_the_concurrency_and_region_budget(self):
+        chaos.handler(None, mock.Mock())
+        self.chaos_lambda.assert_called_once_with(
+            mock.ANY,
+            mock.ANY,
+            concurrency=self.get_concurrency.return_value,
+            region_budget=self.get_region_budget.return_value,
+            max_terminations=mock.ANY,
+            accounts=mock.ANY,
+            shards=mock.ANY,
+            checkpoints=mock.ANY
+        )
+
+    def test_passes_along_the_termination_cap(self):
+        chaos.handler(None, mock.Mock())
+        self.get_max_terminations.assert_called_once_with()
+        self.chaos_lambda.assert_called_once_with(
+            mock.ANY,
+            mock.ANY,
+            concurrency=mock.ANY,
+            region_budget=mock.ANY,
+            max_terminations=self.get_max_terminations.return_value,
+            accounts=mock.ANY,
+            shards=mock.ANY,
+            checkpoints=mock.ANY
+        )
+
+    def test_sets_deadline_for_the_run(self):
+        deadlines = []
+        self.chaos_lambda.side_effect = \
+            lambda *args, **kwargs: deadlines.append(dict(chaos.run_deadline))
+        context = mock.Mock()
+        chaos.handler(None, context)
+        self.get_deadline.assert_called_once_with(context)
+        self.assertEqual(deadlines, [{"time": self.get_deadline.return_value}])
+        self.assertIsNone(chaos.run_deadline["time"])
+
+    def test_passes_along_the_checkpoints(self):
+        chaos.handler(None, mock.Mock())
+        self.assertEqual(
+            self.chaos_lambda.call_args[1]["checkpoints"],
+            self.get_checkpoints.return_value
+        )
+
+    def test_passes_along_the_shard_runner(self):
+        context = mock.Mock()
+        chaos.handler(None, context)
+        self.get_shard_runner.assert_called_once_with(context)
+        self.assertEqual(
+            self.chaos_lambda.call_args[1]["shards"],
+            self.get_shard_runner.return_value
+        )
+
+    @mock.patch("chaos_shards.run_worker")
+    def test_runs_shard_worker_for_shard_events(self, run_worker):
+        shard = {"region": "r-1", "index": 0, "count": 2}
+        result = chaos.handler({"shard": shard}, mock.Mock())
+        self.assertEqual(result, run_worker.return_value)
+        run_worker.assert_called_once_with(
+            shard,
+            self.get_default_probability.return_value,
+            self.get_region_budget.return_value
+        )
+        self.assertEqual(self.chaos_lambda.call_count, 0)
+        self.flush_log.assert_called_once_with()
+
+    @mock.patch("chaos_shards.run_worker")
+    def test_shard_workers_stop_by_coordinators_deadline(self, run_worker):
+        deadlines = []
+        run_worker.side_effect = \
+            lambda *args: deadlines.append(dict(chaos.run_deadline))
+        context = mock.Mock()
+        shard = {"region": "r-1", "index": 0, "count": 2, "remaining": 60.0}
+        chaos.handler({"shard": shard}, context)
+        self.get_deadline.assert_called_with(context, 60.0)
+        self.assertEqual(deadlines, [{"time": self.get_deadline.return_value}])
+
+    def test_passes_along_the_accounts(self):
+        context = mock.Mock()
+        chaos.handler(None, context)
+        self.get_accounts.assert_called_once_with(context)
+        self.chaos_lambda.assert_called_once_with(
+            mock.ANY,
+            mock.ANY,
+            concurrency=mock.ANY,
+            region_budget=mock.ANY,
+            max_terminations=mock.ANY,
+            accounts=self.get_accounts.return_value,
+            shards=mock.ANY,
+            checkpoints=mock.ANY
         )
@@ -0,0 +1,152 @@
+import datetime
+import threading
+import time
+
+from unittest import mock
+
+from base import PatchingTestCase
+
+import chaos_accounts
+
+
+def make_credentials(key, expires_in):
+    expiration = datetime.datetime.fromtimestamp(
+        time.time() + expires_in, datetime.timezone.utc
+    )
+    return {"Credentials": {
+        "AccessKeyId": key,
+        "SecretAccessKey": "secret-" + key,
+        "SessionToken": "token-" + key,
+        "Expiration": expiration,
+    }}
+
+
+class TestGetRoleArn(PatchingTestCase):
+
+    def test_defaults_to_chaos_lambda_role(self):
+        with mock.patch.dict("os.environ", {"account_role": ""}):
+            self.assertEqual(
+                chaos_accounts.get_role_arn("111111111111"),
+                "arn:aws:iam::111111111111:role/chaos-lambda"
+            )
+
+    def test_uses_role_name_from_environment(self):
+        with mock.patch.dict("os.environ", {"account_role": " chaos/x "}):
+            self.assertEqual(
+                chaos_accounts.get_role_arn("111111111111"),
+                "arn:aws:iam::111111111111:role/chaos/x"
+            )
+
+    def test_fills_in_account_of_full_arn(self):
+        role = "arn:aws-cn:iam::{account}:role/chaos"
+        with mock.patch.dict("os.environ", {"account_role": role}):
+            self.assertEqual(
+                chaos_accounts.get_role_arn("111111111111"),
+                "arn:aws-cn:iam::111111111111:role/chaos"
+            )
+
+
+class TestGetCredentials(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+    )
+
+    def setUp(self):
+        super(TestGetCredentials, self).setUp()
+        chaos_accounts.reset_credentials()
+        self.sts = self.get_client.return_value
+        self.keys = iter("key-%d" % i for i in range(100))
+        self.expires_in = 3600
+        self.sts.assume_role.side_effect = lambda **kwargs: \
+            make_credentials(next(self.keys), self.expires_in)
+
+    def tearDown(self):
+        chaos_accounts.reset_credentials()
+        super(TestGetCredentials, self).tearDown()
+
+    def test_assumes_role_in_account(self):
+        with mock.patch.dict("os.environ", {"AWS_REGION": "sp-moonbase-1"}):
+            c = chaos_accounts.get_credentials("111111111111")
+        self.get_client.assert_called_once_with("sts", "sp-moonbase-1")
+        self.sts.assume_role.assert_called_once_with(
+            RoleArn=chaos_accounts.get_role_arn("111111111111"),
+            RoleSessionName="chaos-lambda"
+        )
+        self.assertEqual(
+            (c["AccessKeyId"], c["SecretAccessKey"], c["SessionToken"]),
+            ("key-0", "secret-key-0", "token-key-0")
+        )
+        self.assertAlmostEqual(c["Expiration"], time.time() + 3600, delta=5)
+
+    def test_reuses_credentials_until_shortly_before_they_expire(self):
+        a = chaos_accounts.get_credentials("111111111111")
+        b = chaos_accounts.get_credentials("111111111111")
+        self.assertIs(a, b)
+        self.assertEqual(chaos_accounts.credentials_stats["hits"], 1)
+        a["Expiration"] = time.time() + chaos_accounts.REFRESH_MARGIN - 1
+        c = chaos_accounts.get_credentials("111111111111")
+        self.assertEqual(c["AccessKeyId"], "key-1")
+        self.assertEqual(chaos_accounts.credentials_stats["assumed"], 2)
+
+    def test_keeps_credentials_for_each_account(self):
+        a = chaos_accounts.get_credentials("111111111111")
+        b = chaos_accounts.get_credentials("222222222222")
+        self.assertNotEqual(a["AccessKeyId"], b["AccessKeyId"])
+        self.assertIs(chaos_accounts.get_credentials("111111111111"), a)
+
+    def test_assumes_each_role_once_when_called_concurrently(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def assume_role(**kwargs):
+            started.set()
+            release.wait(5)
+            return make_credentials("key", 3600)
+        self.sts.assume_role.side_effect = assume_role
+        threads = [
+            threading.Thread(
+                target=chaos_accounts.get_credentials,
+                args=("111111111111",)
+            )
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.sts.assume_role.call_count, 1)
+
+    def test_does_not_cache_failures(self):
+        self.sts.assume_role.side_effect = [
+            Exception("denied"), make_credentials("key", 3600)
+        ]
+        with self.assertRaises(Exception):
+            chaos_accounts.get_credentials("111111111111")
+        c = chaos_accounts.get_credentials("111111111111")
+        self.assertEqual(c["AccessKeyId"], "key")
+
+
+class TestAssumeRoles(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+        "chaos_accounts.get_credentials",
+    )
+
+    def test_assumes_role_in_every_other_account(self):
+        chaos_accounts.assume_roles(["1", None, "2", "3"], 2)
+        self.assertEqual(
+            sorted(c[0][0] for c in self.get_credentials.call_args_list),
+            ["1", "2", "3"]
+        )
+
+    def test_logs_accounts_that_fail(self):
+        self.get_credentials.side_effect = \
+            lambda account: 1 / 0 if account == "2" else {}
+        chaos_accounts.assume_roles(["1", "2"], 1)
+        self.log.assert_called_once_with(
+            "account-error", "2", mock.ANY, account="2"
+        )
@@ -0,0 +1,172 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from unittest import mock
+
+from base import PatchingTestCase
+
+import chaos
+import chaos_capture
+
+
+ARN = (
+    "arn:aws:autoscaling:sp-moonbase-1:123456789012:autoScalingGroup:"
+    "00000000-0000-0000-0000-000000000000:autoScalingGroupName/asg-a"
+)
+
+
+def make_page(*names):
+    return {"AutoScalingGroups": [
+        {
+            "AutoScalingGroupName": name,
+            "AutoScalingGroupARN": ARN,
+            "Instances": [{"InstanceId": "i-11111111"}],
+            "Tags": [{"Key": "owner", "Value": "123456789012"}],
+        }
+        for name in names
+    ]}
+
+
+class CaptureTestCase(PatchingTestCase):
+
+    def setUp(self):
+        super(CaptureTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "capture.ndjson.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(CaptureTestCase, self).tearDown()
+
+    def read(self, path=None):
+        with gzip.open(path or self.path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+
+class TestCaptureWriter(CaptureTestCase):
+
+    def test_passes_pages_through_unchanged(self):
+        writer = chaos_capture.CaptureWriter(self.path)
+        pages = [make_page("a"), make_page("b")]
+        self.assertEqual(
+            list(writer.pages(iter(pages), "sp-moonbase-1")), pages
+        )
+        writer.close()
+
+    def test_writes_header_then_one_line_per_page(self):
+        writer = chaos_capture.CaptureWriter(self.path)
+        filters = [{"Name": "tag-key", "Values": ["x"]}]
+        list(writer.pages(
+            [make_page("a", "b"), make_page("c")], "sp-moonbase-1", filters
+        ))
+        writer.close()
+        lines = self.read()
+        self.assertEqual(lines[0]["version"], chaos_capture.FORMAT_VERSION)
+        self.assertEqual(
+            [[a["AutoScalingGroupName"] for a in line["asgs"]]
+             for line in lines[1:]],
+            [["a", "b"], ["c"]]
+        )
+        self.assertEqual(
+            [(line["region"], line["filters"]) for line in lines[1:]],
+            [("sp-moonbase-1", filters)] * 2
+        )
+        self.assertEqual(writer.pages_written, 2)
+
+    @mock.patch("time.monotonic")
+    def test_records_time_taken_to_fetch_each_page(self, monotonic):
+        monotonic.side_effect = [10.0, 10.25, 11.0, 11.5, 12.0]
+        writer = chaos_capture.CaptureWriter(self.path)
+        list(writer.pages([make_page("a"), make_page("b")], "r"))
+        writer.close()
+        self.assertEqual([line["latency"] for line in self.read()[1:]],
+                         [0.25, 0.5])
+
+    def test_scrubs_account_ids_wherever_they_appear(self):
+        writer = chaos_capture.CaptureWriter(self.path)
+        list(writer.pages([make_page("a")], "r"))
+        writer.close()
+        asg = self.read()[1]["asgs"][0]
+        self.assertEqual(
+            asg["AutoScalingGroupARN"],
+            ARN.replace("123456789012", chaos_capture.SCRUBBED_ACCOUNT)
+        )
+        self.assertEqual(asg["Tags"][0]["Value"],
+                         chaos_capture.SCRUBBED_ACCOUNT)
+
+    def test_scrubs_given_accounts_before_any_arn_is_seen(self):
+        writer = chaos_capture.CaptureWriter(self.path, ["999999999999"])
+        page = {"AutoScalingGroups": [{
+            "AutoScalingGroupName": "a",
+            "Tags": [{"Key": "account", "Value": "999999999999"}],
+        }]}
+        list(writer.pages([page], "r"))
+        writer.close()
+        self.assertEqual(self.read()[1]["asgs"][0]["Tags"][0]["Value"],
+                         chaos_capture.SCRUBBED_ACCOUNT)
+
+    @mock.patch("chaos.log")
+    @mock.patch("chaos.get_client")
+    def test_uploads_s3_captures_when_finished(self, get_client, log):
+        s3 = get_client.return_value
+        bodies = []
+        s3.put_object.side_effect = \
+            lambda Bucket, Key, Body: bodies.append(Body.read())
+        writer = chaos_capture.CaptureWriter("s3://bucket/path/c.ndjson.gz")
+        list(writer.pages([make_page("a")], "r"))
+        chaos.capture["writer"] = writer
+        chaos.finish_capture()
+        s3.put_object.assert_called_once_with(
+            Bucket="bucket", Key="path/c.ndjson.gz", Body=mock.ANY
+        )
+        self.assertEqual(len(gzip.decompress(bodies[0]).splitlines()), 2)
+        self.assertFalse(os.path.exists(writer.local_path))
+
+
+class TestCapturingHandler(CaptureTestCase):
+
+    patch_list = (
+        "chaos.chaos_lambda",
+        "chaos.emit_metrics",
+        "chaos.flush_log",
+        "chaos.get_deadline",
+        "chaos.log",
+    )
+
+    def test_captures_pages_listed_during_run(self):
+        context = mock.Mock(
+            invoked_function_arn="arn:aws:lambda:r:123456789012:function:f"
+        )
+
+        def chaos_lambda(*args, **kwargs):
+            autoscaling = mock.Mock()
+            autoscaling.meta.region_name = "r"
+            autoscaling.get_paginator.return_value.paginate.return_value = [
+                make_page("a")
+            ]
+            list(chaos.get_all_asgs(autoscaling))
+        self.chaos_lambda.side_effect = chaos_lambda
+        with mock.patch.dict("os.environ", {"capture_path": self.path}):
+            chaos.handler(None, context)
+        self.assertEqual(chaos.capture["writer"], None)
+        self.assertEqual(len(self.read()), 2)
+        self.log.assert_any_call("captured", "1", "pages", "to", self.path)
+
+    def test_logs_failure_to_save_capture_without_failing(self):
+        with mock.patch.dict("os.environ", {"capture_path": self.path}):
+            with mock.patch("chaos_capture.CaptureWriter") as writer:
+                writer.return_value.close.side_effect = Exception("no")
+                writer.return_value.path = self.path
+                writer.return_value.local_path = self.path
+                chaos.handler(None, None)
+        self.log.assert_any_call("capture-failed", self.path, "[no]")
+        self.flush_log.assert_called_once_with()
+
+    def test_does_not_capture_unless_enabled(self):
+        with mock.patch.dict("os.environ", {"capture_path": ""}):
+            with mock.patch("chaos_capture.CaptureWriter") as writer:
+                chaos.handler(None, None)
+        self.assertEqual(writer.call_count, 0)
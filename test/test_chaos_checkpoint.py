@@ -0,0 +1,115 @@
+from unittest import mock
+
+from base import PatchingTestCase
+
+import chaos
+import chaos_checkpoint
+import chaos_inventory
+
+
+ITEMS = [(None, "r-1"), (None, "r-2"), ("111111111111", "r-1")]
+
+
+class TestCheckpoints(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+    )
+
+    def setUp(self):
+        super(TestCheckpoints, self).setUp()
+        self.store = chaos_inventory.MemoryStore()
+        self.checkpoints = chaos_checkpoint.Checkpoints(self.store)
+
+    def test_runs_everything_without_a_checkpoint(self):
+        self.assertEqual(self.checkpoints.resume(ITEMS), (ITEMS, {}))
+
+    def test_resumes_regions_left_by_last_run(self):
+        self.checkpoints.save([
+            (("111111111111", "r-1"), "t"), ((None, "r-2"), None)
+        ])
+        self.log.assert_called_once_with(
+            "checkpoint", "2", "regions", "left", "1", "part listed"
+        )
+        items, tokens = self.checkpoints.resume(ITEMS)
+        self.assertEqual(items, [(None, "r-2"), ("111111111111", "r-1")])
+        self.assertEqual(tokens, {
+            ("111111111111", "r-1"): "t", (None, "r-2"): None
+        })
+        self.log.assert_called_with("resuming", "2", "of", "3", "regions")
+
+    def test_ignores_regions_no_longer_configured(self):
+        self.checkpoints.save([((None, "r-9"), "t")])
+        self.assertEqual(self.checkpoints.resume(ITEMS), (ITEMS, {}))
+
+    def test_removes_checkpoint_once_everything_has_run(self):
+        self.checkpoints.save([((None, "r-2"), None)])
+        self.checkpoints.save([])
+        self.assertIsNone(
+            self.store.get(chaos_checkpoint.PARTITION, chaos_checkpoint.KEY)
+        )
+
+
+class TestResumedRun(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+        "chaos.past_deadline",
+        "chaos.terminate_region",
+    )
+
+    def setUp(self):
+        super(TestResumedRun, self).setUp()
+        pages = [
+            {"AutoScalingGroups": [
+                {"AutoScalingGroupName": name, "Instances": [
+                    {"InstanceId": "i-" + name}
+                ]}
+            ], "NextToken": token}
+            for name, token in (("a", "t1"), ("b", "t2"), ("c", None))
+        ]
+        self.paginate = self.get_client.return_value.get_paginator \
+            .return_value.paginate
+        self.paginate.side_effect = lambda PaginationConfig=None: \
+            iter(pages[int((PaginationConfig or {}).get(
+                "StartingToken", "t0"
+            )[1]):])
+        self.environ = mock.patch.dict("os.environ", {
+            "inventory_table": "", "two_phase": "", "tag_filter": ""
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super(TestResumedRun, self).tearDown()
+
+    def get_terminated(self):
+        return [
+            target for c in self.terminate_region.call_args_list
+            for target in c[0][1]
+        ]
+
+    def test_next_run_carries_on_where_the_last_stopped(self):
+        checkpoints = chaos_checkpoint.Checkpoints(
+            chaos_inventory.MemoryStore()
+        )
+        # Runs out of time after the first page of r-1, before r-2 starts
+        self.past_deadline.side_effect = [False, True, True]
+        chaos.chaos_lambda(["r-1", "r-2"], 1.0, checkpoints=checkpoints)
+        self.assertEqual(self.get_terminated(), [("a", "i-a")])
+
+        self.past_deadline.side_effect = None
+        self.past_deadline.return_value = False
+        self.terminate_region.reset_mock()
+        results = chaos.chaos_lambda(
+            ["r-1", "r-2"], 1.0, checkpoints=checkpoints
+        )
+        self.assertEqual([r[:2] for r in results],
+                         [("r-1", "ok"), ("r-2", "ok")])
+        self.assertEqual(self.get_terminated(), [
+            ("b", "i-b"), ("c", "i-c"),
+            ("a", "i-a"), ("b", "i-b"), ("c", "i-c"),
+        ])
+        self.assertEqual(checkpoints.resume([(None, "r-1")]),
+                         ([(None, "r-1")], {}))
@@ -0,0 +1,475 @@
+import json
+import os
+
+from unittest import mock
+
+from base import PatchingTestCase, make_asg
+
+import chaos
+import chaos_inventory
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fixtures")
+
+
+class FakeAutoScaling:
+
+    def __init__(self, asgs):
+        self.asgs = dict((asg["AutoScalingGroupName"], asg) for asg in asgs)
+        self.calls = []
+
+    def get_paginator(self, name):
+        paginator = mock.Mock()
+        paginator.paginate.side_effect = lambda **kwargs: [
+            {"AutoScalingGroups": list(self.asgs.values())}
+        ]
+        return paginator
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.calls.append(AutoScalingGroupNames)
+        return {"AutoScalingGroups": [
+            self.asgs[name] for name in AutoScalingGroupNames
+            if name in self.asgs
+        ]}
+
+    def describe_auto_scaling_instances(self, InstanceIds):
+        return {"AutoScalingInstances": [
+            {"InstanceId": i["InstanceId"],
+             "AutoScalingGroupName": asg["AutoScalingGroupName"]}
+            for asg in self.asgs.values() for i in asg["Instances"]
+            if i["InstanceId"] in InstanceIds
+        ]}
+
+
+class InventoryTestCase(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+    )
+
+    def setUp(self):
+        super(InventoryTestCase, self).setUp()
+        self.store = chaos_inventory.MemoryStore()
+        self.autoscaling = FakeAutoScaling([
+            make_asg("asg-a", ["i-a1", "i-a2"],
+                     [("Name", "a"), ("chaos-lambda-termination", "0.1")]),
+            make_asg("asg-b", ["i-b1", "i-b2"]),
+            make_asg("asg-c", ["i-c1"]),
+        ])
+        self.get_client.return_value = self.autoscaling
+
+    def get_inventory(self, region="sp-moonbase-1"):
+        return self.store.scan(region, chaos_inventory.ASG_KEY)
+
+
+class TestCompactASG(PatchingTestCase):
+
+    def test_keeps_only_name_instances_and_chaos_tags(self):
+        asg = make_asg("asg-a", ["i-a1"], [
+            ("Name", "a"),
+            ("Chaos-Lambda-Termination", "0.1"),
+            ("chaos-lambda-termination", "0.2"),
+        ])
+        self.assertEqual(chaos_inventory.compact_asg(asg), {
+            "AutoScalingGroupName": "asg-a",
+            "Instances": [{
+                "InstanceId": "i-a1", "AvailabilityZone": "sp-moonbase-1a",
+                "HealthStatus": "Healthy", "LifecycleState": "InService",
+            }],
+            "Tags": [
+                {"Key": "Chaos-Lambda-Termination", "Value": "0.1"},
+                {"Key": "chaos-lambda-termination", "Value": "0.2"},
+            ],
+        })
+
+
+class TestReconcile(InventoryTestCase):
+
+    def test_stores_every_asg_and_reconcile_time(self):
+        asgs = chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        self.assertEqual(
+            sorted(a["AutoScalingGroupName"] for a in asgs),
+            ["asg-a", "asg-b", "asg-c"]
+        )
+        self.assertEqual(
+            sorted(self.get_inventory()),
+            ["asg:asg-a", "asg:asg-b", "asg:asg-c"]
+        )
+        self.assertNotEqual(
+            self.store.get("sp-moonbase-1", chaos_inventory.RECONCILED_KEY),
+            None
+        )
+
+    def test_removes_asgs_that_no_longer_exist(self):
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        del self.autoscaling.asgs["asg-c"]
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        self.assertEqual(
+            sorted(self.get_inventory()), ["asg:asg-a", "asg:asg-b"]
+        )
+
+    def test_only_writes_changed_asgs(self):
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        self.autoscaling.asgs["asg-b"] = make_asg("asg-b", ["i-b3"])
+        with mock.patch.object(self.store, "write") as write:
+            chaos_inventory.reconcile(
+                self.store, self.autoscaling, "sp-moonbase-1"
+            )
+        puts, deletes = write.call_args[0][1:]
+        self.assertEqual(
+            sorted(puts), ["asg:asg-b", chaos_inventory.RECONCILED_KEY]
+        )
+        self.assertEqual(deletes, [])
+
+    def paginate(self, *pages):
+        paginator = mock.Mock()
+        paginator.paginate.return_value = list(pages)
+        return mock.patch.object(
+            self.autoscaling, "get_paginator", return_value=paginator
+        )
+
+    def test_lists_from_first_page_whatever_the_checkpoint(self):
+        pages = [
+            {"AutoScalingGroups": [self.autoscaling.asgs["asg-a"]],
+             "NextToken": "t1"},
+            {"AutoScalingGroups": [self.autoscaling.asgs["asg-b"]]},
+        ]
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        with self.paginate(*pages) as get_paginator:
+            chaos.listing.start_token = "checkpointed"
+            try:
+                chaos_inventory.reconcile(
+                    self.store, self.autoscaling, "sp-moonbase-1"
+                )
+            finally:
+                chaos.listing.start_token = None
+        get_paginator.return_value.paginate.assert_called_once_with()
+        self.assertEqual(
+            sorted(self.get_inventory()), ["asg:asg-a", "asg:asg-b"]
+        )
+
+    def test_keeps_inventory_if_listing_stops_at_the_deadline(self):
+        pages = [
+            {"AutoScalingGroups": [self.autoscaling.asgs["asg-a"]],
+             "NextToken": "t1"},
+            {"AutoScalingGroups": [self.autoscaling.asgs["asg-b"]]},
+        ]
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        reconciled = self.store.get(
+            "sp-moonbase-1", chaos_inventory.RECONCILED_KEY
+        )
+        self.store.write(
+            "sp-moonbase-1", {}, [chaos_inventory.RECONCILED_KEY]
+        )
+        with self.paginate(*pages), \
+                mock.patch.dict(chaos.run_deadline, {"time": 0.0}):
+            asgs = chaos_inventory.reconcile(
+                self.store, self.autoscaling, "sp-moonbase-1"
+            )
+        # The rest of the run's listing is none of the reconcile's business
+        self.assertIsNone(getattr(chaos.listing, "next_token", None))
+        self.assertEqual(len(asgs), 3)
+        self.assertEqual(
+            sorted(self.get_inventory()),
+            ["asg:asg-a", "asg:asg-b", "asg:asg-c"]
+        )
+        # Left to be reconciled again
+        self.assertIsNone(
+            self.store.get("sp-moonbase-1", chaos_inventory.RECONCILED_KEY)
+        )
+        self.assertIsNotNone(reconciled)
+        self.assertIsNone(
+            self.store.get("sp-moonbase-1", chaos_inventory.RECONCILED_KEY)
+        )
+
+
+class TestGetASGs(InventoryTestCase):
+
+    def test_reconciles_if_region_never_reconciled(self):
+        asgs = chaos_inventory.get_asgs(
+            self.store, self.autoscaling, "sp-moonbase-1", max_age=60
+        )
+        self.assertEqual(len(asgs), 3)
+        self.assertEqual(len(self.get_inventory()), 3)
+
+    def test_reads_inventory_without_listing_asgs_if_fresh(self):
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        self.autoscaling.asgs.clear()
+        asgs = chaos_inventory.get_asgs(
+            self.store, self.autoscaling, "sp-moonbase-1", max_age=60
+        )
+        self.assertEqual(len(asgs), 3)
+
+    @mock.patch("time.time")
+    def test_reconciles_if_inventory_older_than_max_age(self, time_):
+        time_.return_value = 1000.0
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+        del self.autoscaling.asgs["asg-c"]
+        time_.return_value = 1061.0
+        asgs = chaos_inventory.get_asgs(
+            self.store, self.autoscaling, "sp-moonbase-1", max_age=60
+        )
+        self.assertEqual(len(asgs), 2)
+
+    def test_inventory_asgs_work_with_target_selection(self):
+        asgs = chaos_inventory.get_asgs(
+            self.store, self.autoscaling, "sp-moonbase-1", max_age=60
+        )
+        probabilities = dict(
+            (a["AutoScalingGroupName"], chaos.get_asg_probability(a, 0.5))
+            for a in asgs
+        )
+        self.assertEqual(probabilities, {
+            "asg-a": 0.1, "asg-b": 0.5, "asg-c": 0.5
+        })
+
+    def test_inventory_asgs_follow_policies(self):
+        self.autoscaling.asgs["asg-a"] = make_asg(
+            "asg-a", ["i-a1", "i-a2"],
+            [("chaos-lambda-termination", "1.0 min_healthy=2")]
+        )
+        self.autoscaling.asgs["asg-b"] = make_asg(
+            "asg-b", ["i-b1"],
+            [("chaos-lambda-termination", "1.0 az=sp-moonbase-1a:0")]
+        )
+        asgs = dict(
+            (a["AutoScalingGroupName"], a)
+            for a in chaos_inventory.get_asgs(
+                self.store, self.autoscaling, "sp-moonbase-1", max_age=60
+            )
+        )
+        self.assertIsNone(chaos.get_asg_instance_id(asgs["asg-a"], 0.0))
+        self.assertIsNone(chaos.get_asg_instance_id(asgs["asg-b"], 0.0))
+        self.assertEqual(chaos.get_asg_instance_id(asgs["asg-c"], 1.0), "i-c1")
+
+
+class TestHandler(InventoryTestCase):
+
+    patch_list = InventoryTestCase.patch_list + (
+        "chaos.flush_log",
+    )
+
+    def setUp(self):
+        super(TestHandler, self).setUp()
+        chaos_inventory.reconcile(
+            self.store, self.autoscaling, "sp-moonbase-1"
+        )
+
+    def replay(self, name):
+        with open(os.path.join(FIXTURES, name)) as f:
+            events = json.load(f)
+        for event in events:
+            chaos_inventory.handler(event, None, store=self.store)
+        return events
+
+    def get_instance_ids(self):
+        return dict(
+            (asg["AutoScalingGroupName"],
+             [i["InstanceId"] for i in asg["Instances"]])
+            for asg in self.get_inventory().values()
+        )
+
+    def test_replayed_events_keep_inventory_current(self):
+        self.autoscaling.asgs["asg-b"] = make_asg(
+            "asg-b", ["i-b1", "i-b2"], [("chaos-lambda-termination", "0.5")]
+        )
+        self.autoscaling.asgs["asg-a"] = make_asg(
+            "asg-a", ["i-a1", "i-a2", "i-a3"]
+        )
+        del self.autoscaling.asgs["asg-c"]
+        self.replay("inventory_events.json")
+        self.assertEqual(self.get_instance_ids(), {
+            "asg-a": ["i-a2", "i-a3"],
+            "asg-b": ["i-b1"],
+        })
+        self.assertEqual(
+            self.get_inventory()["asg:asg-b"]["Tags"],
+            [{"Key": "chaos-lambda-termination", "Value": "0.5"}]
+        )
+        # Launches and CloudTrail events need the ASG to be described again
+        self.assertEqual(
+            self.autoscaling.calls, [["asg-a"], ["asg-b"], ["asg-c"]]
+        )
+
+    def test_logs_whether_each_event_was_applied(self):
+        events = self.replay("inventory_events.json")
+        results = [c[0][-1] for c in self.log.call_args_list
+                   if c[0][0] == "inventory-event"]
+        self.assertEqual(len(results), len(events))
+        self.assertEqual(results, [
+            "applied", "applied", "applied", "applied", "applied",
+            "ignored", "ignored"
+        ])
+        self.assertEqual(self.flush_log.call_count, len(events))
+
+    def test_launch_in_unknown_asg_describes_it(self):
+        self.autoscaling.asgs["asg-d"] = make_asg("asg-d", ["i-d1"])
+        chaos_inventory.handler({
+            "detail-type": "EC2 Instance Launch Successful",
+            "region": "sp-moonbase-1",
+            "detail": {"AutoScalingGroupName": "asg-d",
+                       "EC2InstanceId": "i-d1"},
+        }, None, store=self.store)
+        self.assertEqual(self.get_instance_ids()["asg-d"], ["i-d1"])
+
+    def test_ignores_instances_outside_asgs(self):
+        chaos_inventory.handler({
+            "detail-type": "EC2 Instance State-change Notification",
+            "region": "sp-moonbase-1",
+            "detail": {"instance-id": "i-x1", "state": "terminated"},
+        }, None, store=self.store)
+        self.assertEqual(self.log.call_args[0][-1], "ignored")
+
+    @mock.patch("time.sleep")
+    def test_retries_removal_if_asg_changes_meanwhile(self, sleep):
+        replace = self.store.replace
+        replaces = []
+
+        def race(region, key, value, old):
+            replaces.append(key)
+            if len(replaces) == 1:
+                # Another event adds an instance between the read and write
+                self.store.write(region, {key: dict(old, Instances=(
+                    old["Instances"] + [{"InstanceId": "i-b3"}]
+                ))})
+            return replace(region, key, value, old)
+        with mock.patch.object(self.store, "replace", side_effect=race):
+            chaos_inventory.remove_instance(
+                self.store, "sp-moonbase-1", "i-b1", "asg-b"
+            )
+        self.assertEqual(replaces, ["asg:asg-b", "asg:asg-b"])
+        self.assertEqual(self.get_instance_ids()["asg-b"], ["i-b2", "i-b3"])
+
+    def test_accepts_events_batched_through_sqs(self):
+        event = {
+            "detail-type": "EC2 Instance Terminate Successful",
+            "region": "sp-moonbase-1",
+            "detail": {"AutoScalingGroupName": "asg-c",
+                       "EC2InstanceId": "i-c1"},
+        }
+        chaos_inventory.handler(
+            {"Records": [{"body": json.dumps(event)}]}, None, store=self.store
+        )
+        self.assertEqual(self.get_instance_ids()["asg-c"], [])
+
+
+class TestDynamoDBStore(PatchingTestCase):
+
+    patch_list = (
+        "time.sleep",
+    )
+
+    def setUp(self):
+        super(TestDynamoDBStore, self).setUp()
+        self.dynamodb = mock.Mock()
+        self.dynamodb.batch_write_item.return_value = {}
+        self.store = chaos_inventory.DynamoDBStore(self.dynamodb, "table")
+
+    def test_get_decodes_stored_json(self):
+        self.dynamodb.get_item.return_value = {"Item": {
+            "region": {"S": "r"}, "key": {"S": "k"}, "value": {"S": "[1]"}
+        }}
+        self.assertEqual(self.store.get("r", "k"), [1])
+        self.dynamodb.get_item.assert_called_once_with(
+            TableName="table",
+            Key={"region": {"S": "r"}, "key": {"S": "k"}},
+            ConsistentRead=True
+        )
+
+    def test_get_returns_None_if_no_item(self):
+        self.dynamodb.get_item.return_value = {}
+        self.assertEqual(self.store.get("r", "k"), None)
+
+    def test_scan_queries_region_for_key_prefix(self):
+        paginator = self.dynamodb.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {"Items": [{"key": {"S": "asg:a"}, "value": {"S": "1"}}]},
+            {"Items": [{"key": {"S": "asg:b"}, "value": {"S": "2"}}]},
+        ]
+        self.assertEqual(self.store.scan("r", "asg:"),
+                         {"asg:a": 1, "asg:b": 2})
+        self.dynamodb.get_paginator.assert_called_once_with("query")
+        kwargs = paginator.paginate.call_args[1]
+        self.assertEqual(kwargs["ExpressionAttributeValues"], {
+            ":r": {"S": "r"}, ":p": {"S": "asg:"}
+        })
+
+    def test_replace_writes_only_if_value_unchanged(self):
+        self.assertTrue(self.store.replace("r", "k", {"b": 2, "a": 1}, [1]))
+        self.dynamodb.put_item.assert_called_once_with(
+            TableName="table",
+            Item={"region": {"S": "r"}, "key": {"S": "k"},
+                  "value": {"S": '{"a": 1, "b": 2}'}},
+            ConditionExpression="#v = :v",
+            ExpressionAttributeNames={"#v": "value"},
+            ExpressionAttributeValues={":v": {"S": "[1]"}}
+        )
+
+    def test_replace_returns_False_if_value_changed(self):
+        error = Exception("conditional check failed")
+        error.response = {
+            "Error": {"Code": "ConditionalCheckFailedException"}
+        }
+        self.dynamodb.put_item.side_effect = error
+        self.assertFalse(self.store.replace("r", "k", 2, 1))
+        self.dynamodb.put_item.side_effect = Exception("denied")
+        with self.assertRaises(Exception):
+            self.store.replace("r", "k", 2, 1)
+
+    def test_write_batches_puts_and_deletes(self):
+        puts = dict(("k%d" % i, i) for i in range(30))
+        self.store.write("r", puts, ["d1"])
+        batches = [
+            c[1]["RequestItems"]["table"]
+            for c in self.dynamodb.batch_write_item.call_args_list
+        ]
+        self.assertEqual([len(b) for b in batches], [25, 6])
+        self.assertEqual(batches[0][0], {"PutRequest": {"Item": {
+            "region": {"S": "r"}, "key": {"S": "k0"}, "value": {"S": "0"}
+        }}})
+        self.assertEqual(batches[1][-1], {"DeleteRequest": {"Key": {
+            "region": {"S": "r"}, "key": {"S": "d1"}
+        }}})
+
+    def test_write_retries_unprocessed_items(self):
+        request = {"DeleteRequest": {"Key": {
+            "region": {"S": "r"}, "key": {"S": "d1"}
+        }}}
+        self.dynamodb.batch_write_item.side_effect = [
+            {"UnprocessedItems": {"table": [request]}},
+            {"UnprocessedItems": {}},
+        ]
+        self.store.write("r", {}, ["d1"])
+        self.assertEqual(self.dynamodb.batch_write_item.call_count, 2)
+        self.assertEqual(
+            self.dynamodb.batch_write_item.call_args[1],
+            {"RequestItems": {"table": [request]}}
+        )
+
+    def test_write_raises_error_if_items_stay_unprocessed(self):
+        self.dynamodb.batch_write_item.side_effect = \
+            lambda RequestItems: {"UnprocessedItems": RequestItems}
+        with self.assertRaises(RuntimeError):
+            self.store.write("r", {}, ["d1"])
+        self.assertEqual(
+            self.dynamodb.batch_write_item.call_count,
+            chaos_inventory.WRITE_ATTEMPTS
+        )
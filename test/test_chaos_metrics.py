@@ -0,0 +1,158 @@
+from unittest import mock
+
+from base import PatchingTestCase, make_client
+
+import chaos_metrics
+
+
+def call(client, operation, parsed=None, exception=None, attempts=()):
+    context = {}
+    events = client.meta.events
+    event = client.meta.service_model.service_name + "." + operation
+    events.emit("before-call." + event, model=None, params={},
+                context=context)
+    for response in attempts:
+        events.emit("needs-retry." + event, response=(None, response),
+                    attempts=1)
+    if exception is not None:
+        events.emit("after-call-error." + event, exception=exception,
+                    context=context)
+    else:
+        events.emit("after-call." + event, http_response=None,
+                    parsed=parsed or {}, model=None, context=context)
+
+
+class MetricsTestCase(PatchingTestCase):
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        chaos_metrics.stats.clear()
+        chaos_metrics.region_durations.clear()
+
+    def tearDown(self):
+        chaos_metrics.stats.clear()
+        chaos_metrics.region_durations.clear()
+        super(MetricsTestCase, self).tearDown()
+
+
+class TestInstrument(MetricsTestCase):
+
+    def test_registers_handlers_for_call_events(self):
+        client = make_client()
+        self.assertIs(chaos_metrics.instrument(client), client)
+        self.assertEqual(set(client.meta.events.handlers), set([
+            "before-call", "after-call", "after-call-error", "needs-retry"
+        ]))
+
+    def test_counts_calls_per_operation_and_region(self):
+        a = chaos_metrics.instrument(make_client(region="r-1"))
+        b = chaos_metrics.instrument(make_client(region="r-2"))
+        call(a, "DescribeAutoScalingGroups")
+        call(a, "DescribeAutoScalingGroups")
+        call(b, "DescribeAutoScalingGroups")
+        call(b, "DescribeTags")
+        calls = dict((k, s["calls"]) for k, s in chaos_metrics.stats.items())
+        self.assertEqual(calls, {
+            ("autoscaling", "DescribeAutoScalingGroups", "r-1"): 2,
+            ("autoscaling", "DescribeAutoScalingGroups", "r-2"): 1,
+            ("autoscaling", "DescribeTags", "r-2"): 1,
+        })
+
+    @mock.patch("time.monotonic")
+    def test_records_latency_in_milliseconds(self, monotonic):
+        monotonic.side_effect = [10.0, 10.25]
+        client = chaos_metrics.instrument(make_client())
+        call(client, "DescribeAutoScalingGroups")
+        s = chaos_metrics.stats[
+            ("autoscaling", "DescribeAutoScalingGroups", "sp-moonbase-1")
+        ]
+        self.assertEqual(s["latencies"], [250.0])
+
+    def test_counts_retries_throttles_and_errors(self):
+        client = chaos_metrics.instrument(make_client(service="ec2"))
+        throttled = {"Error": {"Code": "RequestLimitExceeded"}}
+        call(client, "TerminateInstances", attempts=[throttled, throttled, {}],
+             parsed={"ResponseMetadata": {"RetryAttempts": 2}})
+        call(client, "TerminateInstances",
+             parsed={"Error": {"Code": "UnauthorizedOperation"}})
+        call(client, "TerminateInstances", exception=Exception("timeout"))
+        s = chaos_metrics.stats[("ec2", "TerminateInstances",
+                                 "sp-moonbase-1")]
+        self.assertEqual(
+            (s["calls"], s["retries"], s["throttles"], s["errors"]),
+            (3, 2, 2, 2)
+        )
+
+    def test_never_changes_retry_decisions(self):
+        client = chaos_metrics.instrument(make_client())
+        result = client.meta.events.emit(
+            "needs-retry.autoscaling.DescribeAutoScalingGroups",
+            response=(None, {"Error": {"Code": "Throttling"}}),
+        )
+        self.assertEqual(result, [None])
+
+
+class TestEmit(MetricsTestCase):
+
+    def test_returns_nothing_if_no_calls_recorded(self):
+        self.assertEqual(chaos_metrics.emit(), [])
+
+    def test_returns_embedded_metric_format_record_per_operation(self):
+        client = chaos_metrics.instrument(make_client())
+        call(client, "DescribeAutoScalingGroups")
+        call(client, "DescribeAutoScalingGroups")
+        records = chaos_metrics.emit(timestamp=1234)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        directive = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(record["_aws"]["Timestamp"], 1234)
+        self.assertEqual(directive["Namespace"], chaos_metrics.NAMESPACE)
+        self.assertEqual(directive["Dimensions"],
+                         [["Service", "Operation", "Region"]])
+        self.assertEqual(
+            set(m["Name"] for m in directive["Metrics"]),
+            set(["ApiCalls", "ApiRetries", "ApiThrottles", "ApiErrors",
+                 "ApiLatency"])
+        )
+        self.assertEqual(record["Service"], "autoscaling")
+        self.assertEqual(record["Operation"], "DescribeAutoScalingGroups")
+        self.assertEqual(record["Region"], "sp-moonbase-1")
+        self.assertEqual(record["ApiCalls"], 2)
+        self.assertEqual(len(record["ApiLatency"]), 2)
+
+    def test_splits_latencies_into_records_of_at_most_100_values(self):
+        client = chaos_metrics.instrument(make_client())
+        for i in range(250):
+            call(client, "DescribeAutoScalingGroups")
+        records = chaos_metrics.emit()
+        self.assertEqual([len(r["ApiLatency"]) for r in records],
+                         [100, 100, 50])
+        self.assertEqual(records[0]["ApiCalls"], 250)
+        self.assertNotIn("ApiCalls", records[1])
+        self.assertEqual(
+            [m["Name"] for m in
+             records[1]["_aws"]["CloudWatchMetrics"][0]["Metrics"]],
+            ["ApiLatency"]
+        )
+
+    def test_resets_recorded_stats(self):
+        client = chaos_metrics.instrument(make_client())
+        call(client, "DescribeAutoScalingGroups")
+        chaos_metrics.emit()
+        self.assertEqual(chaos_metrics.emit(), [])
+
+    def test_returns_region_durations_by_region_and_overall(self):
+        chaos_metrics.record_region("sp-moonbase-1", 1.5)
+        chaos_metrics.record_region("sp-moonbase-1", 0.25)
+        chaos_metrics.record_region("re-gion-1", 2.0)
+        records = chaos_metrics.emit(timestamp=1234)
+        self.assertEqual(
+            [(r["Region"], r["RegionDuration"]) for r in records],
+            [("re-gion-1", [2000.0]), ("sp-moonbase-1", [1500.0, 250.0])]
+        )
+        directive = records[0]["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(directive["Dimensions"], [["Region"], []])
+        self.assertEqual(directive["Metrics"], [
+            {"Name": "RegionDuration", "Unit": "Milliseconds"}
+        ])
+        self.assertEqual(chaos_metrics.emit(), [])
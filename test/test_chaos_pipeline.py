@@ -0,0 +1,208 @@
+import itertools
+import threading
+import time
+
+from unittest import mock
+
+from base import PatchingTestCase, make_asg
+
+import chaos
+import chaos_pipeline
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+class TestPrefetch(PatchingTestCase):
+
+    def test_yields_every_page_in_order(self):
+        pages = [{"n": i} for i in range(10)]
+        self.assertEqual(list(chaos_pipeline.prefetch(iter(pages))), pages)
+
+    def test_raises_errors_where_the_page_would_have_been(self):
+        def pages():
+            yield 1
+            raise ValueError("boom")
+        seen = []
+        with self.assertRaises(ValueError):
+            for page in chaos_pipeline.prefetch(pages()):
+                seen.append(page)
+        self.assertEqual(seen, [1])
+
+    def test_fetches_ahead_of_the_consumer(self):
+        fetched = []
+
+        def pages():
+            for i in itertools.count():
+                fetched.append(i)
+                yield i
+        pages = chaos_pipeline.prefetch(pages(), depth=2)
+        self.assertEqual(next(pages), 0)
+        self.assertTrue(wait_for(lambda: len(fetched) >= 3))
+        pages.close()
+        # No more than the queue's worth, plus the page waiting to go in it
+        self.assertLessEqual(len(fetched), 5)
+        count = len(fetched)
+        time.sleep(0.1)
+        self.assertEqual(len(fetched), count)
+
+    def test_fetches_as_part_of_the_current_region(self):
+        regions = []
+
+        def pages():
+            regions.append(chaos.log_context.region)
+            yield 1
+        chaos.log_context.region = "r-1"
+        try:
+            list(chaos_pipeline.prefetch(pages()))
+        finally:
+            chaos.log_context.region = None
+        self.assertEqual(regions, ["r-1"])
+
+
+class TestTerminator(PatchingTestCase):
+
+    patch_list = (
+        "chaos.terminate_region",
+    )
+
+    def test_terminates_targets_in_batches(self):
+        terminator = chaos_pipeline.Terminator("r-1", "1", batch_size=2)
+        for target in "abcde":
+            terminator.add(target)
+        terminator.close()
+        self.assertEqual(terminator.targets, list("abcde"))
+        self.assertEqual(
+            sorted(c[0] for c in self.terminate_region.call_args_list),
+            [("r-1", ["a", "b"], "1"), ("r-1", ["c", "d"], "1"),
+             ("r-1", ["e"], "1")]
+        )
+
+    def test_terminates_each_batch_as_soon_as_it_is_full(self):
+        terminated = threading.Event()
+        self.terminate_region.side_effect = \
+            lambda region, targets, account: terminated.set()
+        terminator = chaos_pipeline.Terminator("r-1", batch_size=2)
+        terminator.add("a")
+        terminator.add("b")
+        self.assertTrue(terminated.wait(5))
+        terminator.close()
+
+    def test_skips_batches_after_one_fails(self):
+        self.terminate_region.side_effect = Exception("boom")
+        terminator = chaos_pipeline.Terminator(
+            "r-1", batch_size=1, workers=1
+        )
+        for target in "abc":
+            terminator.add(target)
+        terminator.close()
+        self.assertEqual(str(terminator.error), "boom")
+        self.assertEqual(self.terminate_region.call_count, 1)
+
+    def test_nothing_to_terminate(self):
+        terminator = chaos_pipeline.Terminator("r-1")
+        terminator.close()
+        self.assertEqual(terminator.threads, [])
+        self.assertFalse(self.terminate_region.called)
+
+
+class TestSelectAndTerminate(PatchingTestCase):
+
+    patch_list = (
+        "chaos.terminate_region",
+    )
+
+    def setUp(self):
+        super(TestSelectAndTerminate, self).setUp()
+        self.terminated = threading.Event()
+        self.terminate_region.side_effect = \
+            lambda region, targets, account: self.terminated.set()
+
+    def select_and_terminate(self, asgs):
+        return chaos_pipeline.select_and_terminate(
+            mock.Mock(), "r-1", 1.0, asgs
+        )
+
+    def test_terminates_while_still_selecting(self):
+        def asgs():
+            for i in range(chaos.TERMINATION_BATCH_SIZE):
+                yield make_asg(str(i))
+            # The first batch is terminated before the rest is listed
+            self.assertTrue(self.terminated.wait(5))
+            yield make_asg("last")
+        targets = self.select_and_terminate(asgs())
+        self.assertEqual(len(targets), chaos.TERMINATION_BATCH_SIZE + 1)
+        self.assertEqual(self.terminate_region.call_count, 2)
+
+    def test_terminates_what_was_selected_before_selection_failed(self):
+        def asgs():
+            yield make_asg("a")
+            raise ValueError("boom")
+        with self.assertRaises(ValueError):
+            self.select_and_terminate(asgs())
+        self.terminate_region.assert_called_once_with(
+            "r-1", [("a", "i-a")], None
+        )
+
+    def test_raises_termination_errors(self):
+        self.terminate_region.side_effect = Exception("boom")
+        with self.assertRaises(Exception):
+            self.select_and_terminate([make_asg("a")])
+
+
+class TestPipelinedRegion(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+        "chaos.terminate_region",
+    )
+
+    def setUp(self):
+        super(TestPipelinedRegion, self).setUp()
+        self.get_client.return_value.get_paginator.return_value \
+            .paginate.return_value = [
+                {"AutoScalingGroups": [make_asg("a")], "NextToken": "t"},
+                {"AutoScalingGroups": [make_asg("b")]},
+            ]
+        self.environ = mock.patch.dict("os.environ", {
+            "pipeline": "true", "inventory_table": "", "two_phase": "",
+            "tag_filter": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super(TestPipelinedRegion, self).tearDown()
+
+    def test_region_is_pipelined(self):
+        with mock.patch("chaos_pipeline.prefetch",
+                        side_effect=chaos_pipeline.prefetch) as prefetch:
+            results = chaos.chaos_lambda(["r-1"], 1.0)
+        self.assertEqual(results[0][:3], ("r-1", "ok", 2))
+        self.assertTrue(prefetch.called)
+        self.terminate_region.assert_called_once_with(
+            "r-1", [("a", "i-a"), ("b", "i-b")], None
+        )
+
+    @mock.patch("chaos_pipeline.select_and_terminate")
+    def test_regions_with_a_budget_are_not_pipelined(self, select):
+        results = chaos.chaos_lambda(["r-1"], 1.0, region_budget=60.0)
+        self.assertEqual(results[0][:3], ("r-1", "ok", 2))
+        self.assertFalse(select.called)
+
+    @mock.patch("chaos_pipeline.select_and_terminate")
+    def test_capped_runs_are_not_pipelined(self, select):
+        chaos.chaos_lambda(["r-1"], 1.0, max_terminations=1)
+        self.assertFalse(select.called)
+        self.assertEqual(self.terminate_region.call_count, 1)
+
+    @mock.patch("chaos.past_deadline")
+    def test_listing_still_stops_at_the_deadline(self, past_deadline):
+        past_deadline.side_effect = [False, True]
+        results = chaos.chaos_lambda(["r-1"], 1.0)
+        self.assertEqual(results[0][:3], ("r-1", "partial", 1))
@@ -0,0 +1,179 @@
+import time
+
+from unittest import mock
+
+from base import PatchingTestCase
+
+import chaos
+import chaos_policy
+
+
+def at(day, hour):
+    # 2024-01-01 was a Monday
+    return time.struct_time((2024, 1, 1 + day, hour, 30, 0, day, 1 + day, 0))
+
+
+def make_instance(instance_id, zone="a", health="Healthy",
+                  state="InService"):
+    return {
+        "InstanceId": instance_id, "AvailabilityZone": zone,
+        "HealthStatus": health, "LifecycleState": state,
+    }
+
+
+class TestCompilePolicy(PatchingTestCase):
+
+    def setUp(self):
+        super(TestCompilePolicy, self).setUp()
+        chaos_policy.compile_policy.cache_clear()
+
+    def test_plain_probability_is_a_policy(self):
+        policy = chaos_policy.compile_policy(" 0.25 ")
+        self.assertEqual(policy.get_probability(0.5), 0.25)
+        self.assertIsNone(policy.hours)
+        self.assertIsNone(policy.zones)
+
+    def test_parses_every_clause(self):
+        policy = chaos_policy.compile_policy(
+            "0.5 hours=10-16,22-2 days=mon-wed/Sat "
+            "az=eu-west-1a:2,eu-west-1c:0 min_healthy=2"
+        )
+        self.assertEqual(policy.probability, 0.5)
+        self.assertEqual(
+            sorted(policy.hours), [0, 1, 10, 11, 12, 13, 14, 15, 22, 23]
+        )
+        self.assertEqual(sorted(policy.days), [0, 1, 2, 5])
+        self.assertEqual(policy.zones, {"eu-west-1a": 2.0, "eu-west-1c": 0.0})
+        self.assertEqual(policy.min_healthy, 2)
+
+    def test_day_ranges_wrap_around(self):
+        policy = chaos_policy.compile_policy("days=fri-mon")
+        self.assertEqual(sorted(policy.days), [0, 4, 5, 6])
+        policy = chaos_policy.compile_policy("days=mon-sun")
+        self.assertEqual(sorted(policy.days), list(range(7)))
+
+    def test_whole_day_of_hours(self):
+        policy = chaos_policy.compile_policy("hours=0-24")
+        self.assertEqual(sorted(policy.hours), list(range(24)))
+
+    def test_invalid_values_compile_to_none(self):
+        for value in ("", "blah", "-42", "1.2", "0.1 0.2", "hours=10-10",
+                      "hours=9-25", "days=someday", "az=a:-1", "az=:1",
+                      "az=a:inf", "min_healthy=-1", "mode=fast",
+                      "hours=10-16 hours=1-2", "days=mon,,tue"):
+            self.assertIsNone(chaos_policy.compile_policy(value), value)
+
+    def test_compiles_each_value_once(self):
+        with mock.patch("chaos_policy.parse_policy") as parse_policy:
+            for i in range(10):
+                chaos_policy.compile_policy("0.5 hours=10-16")
+                chaos_policy.compile_policy("blah")
+        self.assertEqual(parse_policy.call_args_list, [
+            mock.call("0.5 hours=10-16"), mock.call("blah")
+        ])
+
+    def test_cache_is_bounded(self):
+        for i in range(chaos_policy.CACHE_SIZE + 10):
+            chaos_policy.compile_policy("min_healthy=%d" % i)
+        info = chaos_policy.compile_policy.cache_info()
+        self.assertEqual(info.currsize, chaos_policy.CACHE_SIZE)
+
+
+class TestPolicyProbability(PatchingTestCase):
+
+    def test_uses_default_without_a_probability(self):
+        policy = chaos_policy.Policy(min_healthy=1)
+        self.assertEqual(policy.get_probability(0.5), 0.5)
+
+    def test_is_zero_outside_its_hours_and_days(self):
+        policy = chaos_policy.compile_policy("0.5 hours=10-16 days=mon-fri")
+        self.assertEqual(policy.get_probability(0.1, at(0, 10)), 0.5)
+        self.assertEqual(policy.get_probability(0.1, at(4, 15)), 0.5)
+        self.assertEqual(policy.get_probability(0.1, at(0, 16)), 0.0)
+        self.assertEqual(policy.get_probability(0.1, at(0, 9)), 0.0)
+        self.assertEqual(policy.get_probability(0.1, at(5, 12)), 0.0)
+
+    @mock.patch("time.gmtime")
+    def test_uses_current_time(self, gmtime):
+        gmtime.return_value = at(6, 12)
+        policy = chaos_policy.compile_policy("days=sun")
+        self.assertEqual(policy.get_probability(0.1), 0.1)
+        gmtime.return_value = at(0, 12)
+        self.assertEqual(policy.get_probability(0.1), 0.0)
+
+
+class TestPolicyChooseInstance(PatchingTestCase):
+
+    def test_keeps_minimum_healthy_instances(self):
+        policy = chaos_policy.Policy(min_healthy=2)
+        instances = [
+            make_instance("i-1"),
+            make_instance("i-2"),
+            make_instance("i-3", health="Unhealthy"),
+            make_instance("i-4", state="Pending"),
+        ]
+        self.assertIsNone(policy.choose_instance(instances))
+        instances.append(make_instance("i-5"))
+        self.assertIn(policy.choose_instance(instances), instances)
+
+    def test_weights_instances_by_zone(self):
+        policy = chaos_policy.compile_policy("az=a:0,b:3")
+        instances = [make_instance("i-1", "a"), make_instance("i-2", "b"),
+                     make_instance("i-3", "c")]
+        chosen = set(
+            policy.choose_instance(instances)["InstanceId"]
+            for i in range(200)
+        )
+        self.assertEqual(chosen, set(["i-2", "i-3"]))
+
+    def test_instances_missing_fields_are_left_alone(self):
+        instances = [{"InstanceId": "i-1"}, {"InstanceId": "i-2"}]
+        policy = chaos_policy.Policy(min_healthy=1)
+        self.assertIsNone(policy.choose_instance(instances))
+        policy = chaos_policy.compile_policy("az=b:1")
+        self.assertIsNone(policy.choose_instance(instances))
+        instances.append(make_instance("i-3", "a"))
+        self.assertEqual(policy.choose_instance(instances)["InstanceId"],
+                         "i-3")
+
+    def test_leaves_excluded_zones_alone(self):
+        policy = chaos_policy.compile_policy("az=a:0")
+        self.assertIsNone(policy.choose_instance([make_instance("i-1")]))
+
+
+class TestASGPolicy(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+    )
+
+    def make_asg(self, value, instances):
+        return {
+            "AutoScalingGroupName": "asg", "Instances": instances,
+            "Tags": [{"Key": chaos.PROBABILITY_TAG, "Value": value}],
+        }
+
+    def test_targets_only_within_policy(self):
+        asg = self.make_asg("1.0 az=a:0", [
+            make_instance("i-1", "a"), make_instance("i-2", "b")
+        ])
+        self.assertEqual(chaos.get_asg_instance_id(asg, 0.0), "i-2")
+        asg = self.make_asg("1.0 min_healthy=1", [make_instance("i-1")])
+        self.assertIsNone(chaos.get_asg_instance_id(asg, 0.0))
+        self.assertEqual(self.log.call_count, 0)
+
+    @mock.patch("time.gmtime")
+    def test_weight_follows_policy(self, gmtime):
+        gmtime.return_value = at(5, 12)
+        asg = self.make_asg("0.5 days=mon-fri", [])
+        self.assertEqual(chaos.get_asg_probability(asg, 0.1), 0.0)
+        self.assertEqual(chaos.get_asg_weight(asg, 0.1), 0.0)
+        gmtime.return_value = at(4, 12)
+        self.assertEqual(chaos.get_asg_weight(asg, 0.1), 0.5)
+
+    def test_logs_bad_policies(self):
+        asg = self.make_asg("0.5 hours=often", [make_instance("i-1")])
+        self.assertEqual(chaos.get_asg_probability(asg, 0.1), 0.1)
+        self.log.assert_called_once_with(
+            "bad-probability", "[0.5 hours=often]", "in", "asg", asg="asg"
+        )
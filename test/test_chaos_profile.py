@@ -0,0 +1,202 @@
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from unittest import mock
+
+from base import PatchingTestCase
+
+import chaos
+import chaos_profile
+
+
+def work_in_thread():
+    return sum(range(1000))
+
+
+def run_with_thread(event, context):
+    thread = threading.Thread(target=work_in_thread)
+    thread.start()
+    thread.join()
+    # Something to find among the allocations
+    return [bytearray(1024) for i in range(100)]
+
+
+class TestGetTop(PatchingTestCase):
+
+    def test_defaults_to_twenty(self):
+        with mock.patch.dict("os.environ", {"profile_top": ""}):
+            self.assertEqual(chaos_profile.get_top(), 20)
+
+    def test_reads_environment(self):
+        with mock.patch.dict("os.environ", {"profile_top": " 5 "}):
+            self.assertEqual(chaos_profile.get_top(), 5)
+
+
+class TestGetPath(PatchingTestCase):
+
+    def test_none_unless_set(self):
+        with mock.patch.dict("os.environ", {"profile_path": ""}):
+            self.assertIsNone(chaos_profile.get_path(None))
+
+    def test_fills_in_request_id(self):
+        context = mock.Mock(aws_request_id="abc")
+        with mock.patch.dict("os.environ", {
+            "profile_path": "s3://bucket/{request_id}.pstats"
+        }):
+            self.assertEqual(
+                chaos_profile.get_path(context), "s3://bucket/abc.pstats"
+            )
+            self.assertEqual(
+                chaos_profile.get_path(None), "s3://bucket/local.pstats"
+            )
+
+
+class TestPeakSampler(PatchingTestCase):
+
+    def setUp(self):
+        super(TestPeakSampler, self).setUp()
+        tracemalloc.start()
+
+    def tearDown(self):
+        tracemalloc.stop()
+        super(TestPeakSampler, self).tearDown()
+
+    def test_keeps_allocations_of_largest_sample(self):
+        sampler = chaos_profile.PeakSampler(5)
+        sampler.sample()
+        held = [bytearray(1024) for i in range(1000)]
+        sampler.sample()
+        del held
+        sampler.sample()
+        self.assertGreaterEqual(sampler.peak, 1000 * 1024)
+        self.assertEqual(len(sampler.statistics), 5)
+        self.assertGreaterEqual(sampler.statistics[0].size, 1000 * 1024)
+
+
+class TestProfile(PatchingTestCase):
+
+    patch_list = (
+        "chaos.flush_log",
+        "chaos.get_client",
+        "chaos.log",
+    )
+
+    def setUp(self):
+        super(TestProfile, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.environ = mock.patch.dict("os.environ", {
+            "profile_top": "", "profile_path": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.directory)
+        super(TestProfile, self).tearDown()
+
+    def get_logged(self, name):
+        return [
+            c for c in self.log.call_args_list if c[0][0] == name
+        ]
+
+    def test_returns_result_and_logs_profile(self):
+        result = chaos_profile.profile(run_with_thread, {}, None)
+        self.assertEqual(len(result), 100)
+        functions = [c[1]["function"]
+                     for c in self.get_logged("profile-function")]
+        self.assertEqual(len(functions), 20)
+        self.assertTrue(any("run_with_thread" in f for f in functions))
+        self.assertEqual(len(self.get_logged("profiled")), 1)
+        memory = self.get_logged("profile-memory")[0][1]
+        self.assertGreaterEqual(memory["peak_kb"], 100)
+        self.assertTrue(self.get_logged("profile-allocation"))
+        self.flush_log.assert_called_once_with()
+
+    def test_logs_allocations_near_the_peak(self):
+        def peak_then_free(event, context):
+            held = [bytearray(1024) for i in range(1000)]
+            time.sleep(0.05)
+            del held
+        with mock.patch.object(chaos_profile, "PEAK_INTERVAL", 0.001):
+            chaos_profile.profile(peak_then_free, {}, None)
+        allocations = self.get_logged("profile-peak-allocation")
+        self.assertGreaterEqual(allocations[0][1]["size_kb"], 1000)
+        memory = self.get_logged("profile-memory")[0][1]
+        self.assertGreaterEqual(memory["peak_kb"], 1000)
+
+    def test_profiles_threads_started_by_the_invocation(self):
+        path = os.path.join(self.directory, "{request_id}.pstats")
+        context = mock.Mock(aws_request_id="abc")
+        with mock.patch.dict("os.environ", {"profile_path": path}):
+            chaos_profile.profile(run_with_thread, {}, context)
+        saved = os.path.join(self.directory, "abc.pstats")
+        self.log.assert_any_call("profile-saved", saved)
+        stats = pstats.Stats(saved)
+        self.assertIn("work_in_thread", [
+            name for (filename, line, name) in stats.stats
+        ])
+
+    def test_uploads_to_s3(self):
+        s3 = self.get_client.return_value
+        with mock.patch.dict("os.environ", {
+            "profile_path": "s3://bucket/profiles/run.pstats",
+            "AWS_REGION": "sp-moonbase-1",
+        }):
+            chaos_profile.profile(run_with_thread, {}, None)
+        self.get_client.assert_called_once_with("s3", "sp-moonbase-1")
+        kwargs = s3.put_object.call_args[1]
+        self.assertEqual(kwargs["Bucket"], "bucket")
+        self.assertEqual(kwargs["Key"], "profiles/run.pstats")
+        self.log.assert_any_call(
+            "profile-saved", "s3://bucket/profiles/run.pstats"
+        )
+
+    def test_logs_failures_to_save(self):
+        self.get_client.return_value.put_object.side_effect = \
+            Exception("denied")
+        with mock.patch.dict("os.environ", {
+            "profile_path": "s3://bucket/run.pstats"
+        }):
+            chaos_profile.profile(run_with_thread, {}, None)
+        self.log.assert_any_call(
+            "profile-failed", "s3://bucket/run.pstats", "[denied]"
+        )
+
+    def test_logs_profile_of_failed_invocation(self):
+        def fail(event, context):
+            raise ValueError("boom")
+        with self.assertRaises(ValueError):
+            chaos_profile.profile(fail, {}, None)
+        self.assertTrue(self.get_logged("profile-function"))
+        self.assertIsNone(chaos_profile.active["profiler"])
+
+    def test_nested_invocations_are_not_profiled_again(self):
+        def outer(event, context):
+            return chaos_profile.profile(lambda e, c: "inner", event, context)
+        self.assertEqual(chaos_profile.profile(outer, {}, None), "inner")
+        self.assertEqual(len(self.get_logged("profiled")), 1)
+
+
+class TestProfiledHandler(PatchingTestCase):
+
+    patch_list = (
+        "chaos.run_handler",
+        "chaos_profile.profile",
+    )
+
+    def test_profiles_handler_when_enabled(self):
+        with mock.patch.dict("os.environ", {"profile": "true"}):
+            result = chaos.handler({}, None)
+        self.profile.assert_called_once_with(chaos.run_handler, {}, None)
+        self.assertEqual(result, self.profile.return_value)
+
+    def test_runs_handler_directly_otherwise(self):
+        with mock.patch.dict("os.environ", {"profile": ""}):
+            chaos.handler({}, None)
+        self.assertFalse(self.profile.called)
+        self.run_handler.assert_called_once_with({}, None)
@@ -0,0 +1,201 @@
+from unittest import mock
+
+from base import PatchingTestCase, make_client
+
+import chaos
+import chaos_ratelimit
+
+
+THROTTLED = {"Error": {"Code": "Throttling"}}
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+def attempt(client, parsed):
+    events = client.meta.events
+    event = client.meta.service_model.service_name + ".DescribeThings"
+    responses = events.emit("before-send." + event, request=None)
+    responses += events.emit(
+        "needs-retry." + event, response=(None, parsed), attempts=1
+    )
+    return responses
+
+
+class RateLimitTestCase(PatchingTestCase):
+
+    def setUp(self):
+        super(RateLimitTestCase, self).setUp()
+        chaos_ratelimit.reset()
+
+    def tearDown(self):
+        chaos_ratelimit.reset()
+        super(RateLimitTestCase, self).tearDown()
+
+
+class TestRateLimiter(RateLimitTestCase):
+
+    def setUp(self):
+        super(TestRateLimiter, self).setUp()
+        self.clock = FakeClock()
+        self.limiter = chaos_ratelimit.RateLimiter(
+            4.0, self.clock, self.clock.sleep
+        )
+
+    def test_allows_a_burst_then_paces_calls(self):
+        waits = [self.limiter.acquire() for i in range(6)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 0.0, 0.25, 0.5])
+        self.assertEqual(self.clock.sleeps, [0.25, 0.5])
+
+    def test_refills_over_time(self):
+        for i in range(4):
+            self.limiter.acquire()
+        self.clock.now += 0.5
+        self.assertEqual(self.limiter.acquire(), 0.0)
+        self.assertEqual(self.limiter.acquire(), 0.0)
+        self.assertEqual(self.limiter.acquire(), 0.25)
+
+    def test_backs_off_once_per_interval(self):
+        self.limiter.on_throttle()
+        self.limiter.on_throttle()
+        self.assertEqual(self.limiter.rate, 2.0)
+        self.clock.now += chaos_ratelimit.BACKOFF_INTERVAL
+        self.limiter.on_throttle()
+        self.assertEqual(self.limiter.rate, 1.0)
+        self.assertEqual(self.limiter.tokens, 1.0)
+        for i in range(10):
+            self.clock.now += chaos_ratelimit.BACKOFF_INTERVAL
+            self.limiter.on_throttle()
+        self.assertEqual(self.limiter.rate, chaos_ratelimit.MIN_RATE)
+
+    def test_ramps_up_to_its_maximum(self):
+        self.limiter.on_throttle()
+        self.limiter.on_success()
+        self.assertAlmostEqual(
+            self.limiter.rate, 2.0 + chaos_ratelimit.RAMP_UP
+        )
+        for i in range(100):
+            self.limiter.on_success()
+        self.assertEqual(self.limiter.rate, 4.0)
+
+    def test_takes_and_resets_stats(self):
+        for i in range(5):
+            self.limiter.acquire()
+        self.limiter.on_throttle()
+        self.assertEqual(self.limiter.take_stats(), {
+            "attempts": 5, "throttles": 1, "waited": 0.25, "rate": 2.0,
+        })
+        self.assertEqual(self.limiter.take_stats()["attempts"], 0)
+
+
+class TestInstall(RateLimitTestCase):
+
+    def test_limits_every_attempt(self):
+        client = chaos_ratelimit.install(make_client(), 8.0)
+        limiter = chaos_ratelimit.limiters[
+            ("autoscaling", "sp-moonbase-1", None)
+        ]
+        with mock.patch.object(limiter, "acquire") as acquire:
+            self.assertEqual(attempt(client, THROTTLED), [None, None])
+            self.assertEqual(attempt(client, {}), [None, None])
+        self.assertEqual(acquire.call_count, 2)
+        self.assertEqual(limiter.throttles, 1)
+        self.assertEqual(limiter.rate, 4.0 + chaos_ratelimit.RAMP_UP)
+
+    def test_ignores_other_errors(self):
+        client = chaos_ratelimit.install(make_client(), 8.0)
+        limiter = chaos_ratelimit.limiters[
+            ("autoscaling", "sp-moonbase-1", None)
+        ]
+        limiter.rate = 4.0
+        attempt(client, {"Error": {"Code": "ValidationError"}})
+        client.meta.events.emit(
+            "needs-retry.autoscaling.DescribeThings", response=None,
+            caught_exception=Exception("timeout")
+        )
+        self.assertEqual(limiter.rate, 4.0)
+        self.assertEqual(limiter.throttles, 0)
+
+    def test_shares_limiter_by_service_region_and_account(self):
+        for client in [make_client(), make_client(), make_client("ec2"),
+                       make_client(region="re-gion-1")]:
+            chaos_ratelimit.install(client, 8.0)
+        chaos_ratelimit.install(make_client(), 8.0, "111")
+        self.assertEqual(sorted(chaos_ratelimit.limiters, key=str), [
+            ("autoscaling", "re-gion-1", None),
+            ("autoscaling", "sp-moonbase-1", "111"),
+            ("autoscaling", "sp-moonbase-1", None),
+            ("ec2", "sp-moonbase-1", None),
+        ])
+
+    def test_takes_stats_of_used_limiters(self):
+        client = chaos_ratelimit.install(make_client(), 8.0)
+        chaos_ratelimit.install(make_client("ec2"), 8.0)
+        attempt(client, THROTTLED)
+        (key, stats), = chaos_ratelimit.take_stats()
+        self.assertEqual(key, ("autoscaling", "sp-moonbase-1", None))
+        self.assertEqual((stats["attempts"], stats["throttles"]), (1, 1))
+        self.assertEqual(chaos_ratelimit.take_stats(), [])
+
+
+class TestClientRateLimit(RateLimitTestCase):
+
+    patch_list = (
+        "chaos.Config",
+        "chaos.boto3",
+        "chaos.log",
+    )
+
+    def setUp(self):
+        super(TestClientRateLimit, self).setUp()
+        chaos.reset_clients()
+        self.boto3.client.side_effect = \
+            lambda service, region_name, **kwargs: make_client(
+                service, region_name
+            )
+        self.environ = mock.patch.dict("os.environ", {"rate_limit": "8"})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        chaos.reset_clients()
+        super(TestClientRateLimit, self).tearDown()
+
+    def test_installs_on_new_clients_if_enabled(self):
+        client = chaos.get_client("ec2", "sp-moonbase-1")
+        self.assertIn("before-send", client.meta.events.handlers)
+        self.assertEqual(
+            chaos_ratelimit.limiters[("ec2", "sp-moonbase-1", None)].max_rate,
+            8.0
+        )
+        client = chaos.get_client("lambda", "sp-moonbase-1")
+        self.assertNotIn("before-send", client.meta.events.handlers)
+        with mock.patch.dict("os.environ", {"rate_limit": ""}):
+            client = chaos.get_client("sns", "sp-moonbase-1")
+        self.assertNotIn("before-send", client.meta.events.handlers)
+
+    def test_logs_limiters_used(self):
+        client = chaos.get_client("ec2", "sp-moonbase-1")
+        attempt(client, THROTTLED)
+        chaos.log_rate_limits()
+        self.log.assert_called_once_with(
+            "rate-limit", "ec2", "in", "sp-moonbase-1", "1", "attempts",
+            "1", "throttled", "waited", "0.000s", "at", "4.00/s",
+            service="ec2", region="sp-moonbase-1", attempts=1, throttles=1,
+            waited=0.0, rate=4.0
+        )
+        self.log.reset_mock()
+        with mock.patch.dict("os.environ", {"rate_limit": ""}):
+            attempt(client, THROTTLED)
+            chaos.log_rate_limits()
+        self.assertFalse(self.log.called)
@@ -0,0 +1,335 @@
+import json
+
+from unittest import mock
+
+from base import PatchingTestCase, make_asg
+
+import chaos
+import chaos_recovery
+
+
+def make_instance(instance_id, state="InService", health="Healthy"):
+    return {
+        "InstanceId": instance_id, "LifecycleState": state,
+        "HealthStatus": health,
+    }
+
+
+def make_entry(asg="a", instance="i-1", region="r-1", terminated=1000.0):
+    return {
+        "region": region, "account": None, "asg": asg, "instance": instance,
+        "terminated": terminated, "replaced": None,
+    }
+
+
+class RecoveryTestCase(PatchingTestCase):
+
+    def setUp(self):
+        super(RecoveryTestCase, self).setUp()
+        del chaos_recovery.terminations[:]
+
+    def tearDown(self):
+        del chaos_recovery.terminations[:]
+        super(RecoveryTestCase, self).tearDown()
+
+
+class TestRecord(RecoveryTestCase):
+
+    @mock.patch("time.time", return_value=1000.0)
+    def test_records_terminated_instances(self, time):
+        chaos_recovery.record(
+            "r-1", "111", [("a", "i-1"), ("b", "i-2")],
+            [("i-1", "shutting-down")]
+        )
+        self.assertEqual(chaos_recovery.take_terminations(), [{
+            "region": "r-1", "account": "111", "asg": "a", "instance": "i-1",
+            "terminated": 1000.0, "replaced": None,
+        }])
+        self.assertEqual(chaos_recovery.take_terminations(), [])
+
+    @mock.patch("chaos_recovery.record")
+    @mock.patch("chaos.terminate_targets")
+    @mock.patch("chaos.get_notification_sinks")
+    @mock.patch("chaos.get_client")
+    def test_terminate_region_records_if_enabled(self, get_client, sinks,
+                                                 terminate_targets, record):
+        targets = [("a", "i-1")]
+        terminate_targets.return_value = [("i-1", "shutting-down")]
+        with mock.patch.dict("os.environ", {"recovery": ""}):
+            chaos.terminate_region("r-1", targets)
+        self.assertFalse(record.called)
+        with mock.patch.dict("os.environ", {"recovery": "true"}):
+            chaos.terminate_region("r-1", targets)
+        record.assert_called_once_with(
+            "r-1", None, targets, [("i-1", "shutting-down")]
+        )
+
+
+class TestStart(RecoveryTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+    )
+
+    def setUp(self):
+        super(TestStart, self).setUp()
+        self.context = mock.Mock(function_name="chaos-function")
+        self.invoke = self.get_client.return_value.invoke
+
+    def get_event(self):
+        kwargs = self.invoke.call_args[1]
+        self.assertEqual(kwargs["FunctionName"], "chaos-function")
+        self.assertEqual(kwargs["InvocationType"], "Event")
+        return json.loads(kwargs["Payload"].decode("utf-8"))
+
+    def test_does_nothing_without_terminations_or_context(self):
+        chaos_recovery.start(self.context)
+        chaos_recovery.record("r-1", None, [("a", "i-1")], [("i-1", "x")])
+        chaos_recovery.start(None)
+        self.assertFalse(self.invoke.called)
+        self.assertEqual(chaos_recovery.terminations, [])
+
+    def test_invokes_tracker_with_terminations(self):
+        chaos_recovery.record("r-1", None, [("a", "i-1")], [("i-1", "x")])
+        chaos_recovery.start(self.context)
+        event = self.get_event()["recovery"]
+        self.assertEqual(event["interval"], chaos_recovery.POLL_INTERVAL)
+        self.assertEqual([e["asg"] for e in event["asgs"]], ["a"])
+        self.log.assert_called_once_with(
+            "recovery-tracking", "1", "of", "1", "terminations"
+        )
+
+    @mock.patch("chaos_recovery.MAX_TRACKED", 2)
+    def test_tracks_a_sample_of_large_runs(self):
+        targets = [("asg-%d" % i, "i-%d" % i) for i in range(5)]
+        chaos_recovery.record(
+            "r-1", None, targets, [(i, "x") for (a, i) in targets]
+        )
+        chaos_recovery.start(self.context)
+        self.assertEqual(len(self.get_event()["recovery"]["asgs"]), 2)
+        self.log.assert_called_once_with(
+            "recovery-tracking", "2", "of", "5", "terminations"
+        )
+
+    @mock.patch("chaos_recovery.MAX_EVENT_BYTES", 1000)
+    def test_tracks_only_what_fits_in_the_event(self):
+        # Entries of the same size, so that any would be the next one
+        targets = [("asg-%02d" % i, "i-%02d" % i) for i in range(20)]
+        chaos_recovery.record(
+            "r-1", None, targets, [(i, "x") for (a, i) in targets]
+        )
+        chaos_recovery.start(self.context)
+        payload = self.invoke.call_args[1]["Payload"]
+        self.assertLessEqual(len(payload), 1000)
+        # The next entry wouldn't have fitted
+        asgs = self.get_event()["recovery"]["asgs"]
+        n = len(asgs)
+        self.assertGreater(len(payload) + 2 + len(json.dumps(asgs[0])), 1000)
+        self.log.assert_called_once_with(
+            "recovery-tracking", str(n), "of", "20", "terminations"
+        )
+
+    def test_invokes_recovery_function_if_set(self):
+        chaos_recovery.record("r-1", None, [("a", "i-1")], [("i-1", "x")])
+        with mock.patch.dict("os.environ", {"recovery_function": "tracker"}):
+            chaos_recovery.start(self.context)
+        self.assertEqual(
+            self.invoke.call_args[1]["FunctionName"], "tracker"
+        )
+
+    def test_logs_failure_to_invoke(self):
+        self.invoke.side_effect = Exception("denied")
+        chaos_recovery.record("r-1", None, [("a", "i-1")], [("i-1", "x")])
+        chaos_recovery.start(self.context)
+        self.log.assert_called_with("recovery-failed", "[denied]")
+
+
+class TestCheck(RecoveryTestCase):
+
+    def test_replaced_then_healthy(self):
+        entry = make_entry()
+        terminating = make_instance("i-1", "Terminating")
+        asg = make_asg("a", [terminating, make_instance("i-2")])
+        self.assertFalse(chaos_recovery.check(entry, asg, 1010.0))
+        self.assertIsNone(entry["replaced"])
+        asg = make_asg("a", [terminating, make_instance("i-2"),
+                             make_instance("i-3", "Pending")],
+                       DesiredCapacity=2)
+        self.assertFalse(chaos_recovery.check(entry, asg, 1020.0))
+        self.assertEqual(entry["replaced"], 1020.0)
+        asg = make_asg("a", [make_instance("i-2"), make_instance("i-3")])
+        self.assertTrue(chaos_recovery.check(entry, asg, 1030.0))
+        self.assertEqual(entry["replaced"], 1020.0)
+
+    def test_terminated_instance_never_counts(self):
+        # The ASG may not have noticed the termination yet
+        entry = make_entry()
+        asg = make_asg("a", [make_instance("i-1")])
+        self.assertFalse(chaos_recovery.check(entry, asg, 1010.0))
+
+    def test_unhealthy_instances_are_not_healthy(self):
+        entry = make_entry()
+        asg = make_asg("a", [make_instance("i-2", health="Unhealthy")])
+        self.assertFalse(chaos_recovery.check(entry, asg, 1010.0))
+        self.assertEqual(entry["replaced"], 1010.0)
+
+
+class TestTrack(RecoveryTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+        "chaos.log_record",
+        "time.time",
+    )
+
+    def setUp(self):
+        super(TestTrack, self).setUp()
+        self.clock = [1000.0]
+        self.time.side_effect = lambda: self.clock[0]
+        self.paginate = self.get_client.return_value.get_paginator \
+            .return_value.paginate
+        self.environ = mock.patch.dict("os.environ", {
+            "recovery_timeout": "", "recovery_asg_metrics": "",
+        })
+        self.environ.start()
+        self.sleeps = []
+
+    def tearDown(self):
+        self.environ.stop()
+        chaos.run_deadline["time"] = None
+        super(TestTrack, self).tearDown()
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.clock[0] += seconds
+
+    def set_states(self, *states):
+        self.paginate.side_effect = [
+            [{"AutoScalingGroups": asgs}] for asgs in states
+        ]
+
+    def get_records(self):
+        return [c[0][0] for c in self.log_record.call_args_list]
+
+    def test_polls_with_backoff_until_recovered(self):
+        self.set_states(
+            [make_asg("a", [make_instance("i-1", "Terminating")])],
+            [make_asg("a", [make_instance("i-2", "Pending")])],
+            [make_asg("a", [make_instance("i-2")])],
+        )
+        result = chaos_recovery.track(
+            {"asgs": [make_entry()], "interval": 10.0}, None, self.sleep
+        )
+        self.assertEqual(result, {"tracked": 0, "handed_over": False})
+        self.assertEqual(self.sleeps, [10.0, 15.0, 22.5])
+        self.paginate.assert_called_with(
+            AutoScalingGroupNames=["a"], MaxRecords=mock.ANY
+        )
+        record, = self.get_records()
+        self.assertEqual(record["Region"], "r-1")
+        self.assertEqual(record["AutoScalingGroupName"], "a")
+        self.assertEqual(record["RecoveryReplacement"], 25.0)
+        self.assertEqual(record["RecoveryHealthy"], 47.5)
+        self.assertEqual(
+            record["_aws"]["CloudWatchMetrics"][0]["Dimensions"],
+            chaos_recovery.DIMENSIONS
+        )
+        self.log.assert_called_once_with(
+            "recovered", "a", "in", "r-1", "replaced", "after", "25.0s",
+            "healthy", "after", "47.5s", asg="a", replaced=25.0,
+            healthy=47.5
+        )
+
+    def test_publishes_by_asg_if_enabled(self):
+        self.set_states([make_asg("a", [make_instance("i-2")])])
+        with mock.patch.dict("os.environ", {"recovery_asg_metrics": "true"}):
+            chaos_recovery.track({"asgs": [make_entry()]}, None, self.sleep)
+        record, = self.get_records()
+        self.assertEqual(
+            record["_aws"]["CloudWatchMetrics"][0]["Dimensions"],
+            [["Region", "AutoScalingGroupName"], ["Region"]]
+        )
+
+    def test_polls_each_region_once_per_round(self):
+        self.set_states(
+            [make_asg("a", [make_instance("i-3")]),
+             make_asg("b", [make_instance("i-4")])],
+            [make_asg("c", [make_instance("i-5")])],
+        )
+        chaos_recovery.track({"asgs": [
+            make_entry("a", "i-1"), make_entry("b", "i-2"),
+            make_entry("c", "i-6", "r-2"),
+        ]}, None, self.sleep)
+        self.assertEqual(self.paginate.call_count, 2)
+        self.assertEqual(len(self.get_records()), 3)
+
+    def test_gives_up_after_timeout(self):
+        stuck = [make_asg("a", [make_instance("i-1", "Terminating")])]
+        self.set_states(*([stuck] * 100))
+        with mock.patch.dict("os.environ", {"recovery_timeout": "60"}):
+            chaos_recovery.track({"asgs": [make_entry()]}, None, self.sleep)
+        record, = self.get_records()
+        self.assertEqual(record["RecoveryTimeouts"], 1)
+        self.assertEqual(self.log.call_args[0][0], "recovery-timeout")
+
+    def test_forgets_deleted_asgs(self):
+        self.set_states([])
+        chaos_recovery.track({"asgs": [make_entry()]}, None, self.sleep)
+        self.assertEqual(self.get_records(), [])
+
+    def test_retries_failed_polls(self):
+        self.paginate.side_effect = [
+            Exception("throttled"),
+            [{"AutoScalingGroups": [make_asg("a", [make_instance("i-2")])]}],
+        ]
+        chaos_recovery.track({"asgs": [make_entry()]}, None, self.sleep)
+        self.log.assert_any_call(
+            "recovery-failed", "[throttled]", "polling", "r-1"
+        )
+        self.assertEqual(len(self.get_records()), 1)
+
+    @mock.patch("time.monotonic", return_value=100.0)
+    def test_hands_over_before_running_out_of_time(self, monotonic):
+        chaos.run_deadline["time"] = 105.0
+        context = mock.Mock(function_name="chaos-function")
+        result = chaos_recovery.track(
+            {"asgs": [make_entry()], "interval": 15.0}, context, self.sleep
+        )
+        self.assertEqual(result, {"tracked": 1, "handed_over": True})
+        self.assertEqual(self.sleeps, [])
+        kwargs = self.get_client.return_value.invoke.call_args[1]
+        event = json.loads(kwargs["Payload"].decode("utf-8"))
+        self.assertEqual(event["recovery"]["interval"], 15.0)
+        self.assertEqual(event["recovery"]["asgs"], [make_entry()])
+
+
+class TestRecoveryHandler(PatchingTestCase):
+
+    patch_list = (
+        "chaos.chaos_lambda",
+        "chaos.flush_log",
+        "chaos.get_deadline",
+        "chaos_recovery.start",
+        "chaos_recovery.track",
+    )
+
+    def test_runs_tracker_for_recovery_events(self):
+        event = {"recovery": {"asgs": []}}
+        result = chaos.handler(event, mock.sentinel.context)
+        self.track.assert_called_once_with(
+            event["recovery"], mock.sentinel.context
+        )
+        self.assertEqual(result, self.track.return_value)
+        self.assertFalse(self.chaos_lambda.called)
+
+    @mock.patch("chaos.get_regions")
+    def test_starts_tracker_after_run_if_enabled(self, get_regions):
+        with mock.patch.dict("os.environ", {"recovery": "true"}):
+            chaos.handler({}, mock.sentinel.context)
+        self.start.assert_called_once_with(mock.sentinel.context)
+        self.start.reset_mock()
+        with mock.patch.dict("os.environ", {"recovery": ""}):
+            chaos.handler({}, mock.sentinel.context)
+        self.assertFalse(self.start.called)
@@ -0,0 +1,429 @@
+import io
+import json
+import re
+
+from unittest import mock
+
+from base import PatchingTestCase, make_asgs
+
+import chaos
+import chaos_checkpoint
+import chaos_inventory
+import chaos_shards
+
+
+class FakeClients:
+
+    def __init__(self, asgs):
+        self.asgs = asgs
+        self.terminated = []
+        self.autoscaling = mock.Mock()
+        self.autoscaling.get_paginator.return_value.paginate.side_effect = \
+            self.paginate
+        self.ec2 = mock.Mock()
+        self.ec2.terminate_instances.side_effect = self.terminate_instances
+
+    def paginate(self, AutoScalingGroupNames=None, **kwargs):
+        asgs = self.asgs
+        if AutoScalingGroupNames is not None:
+            asgs = [a for a in asgs
+                    if a["AutoScalingGroupName"] in AutoScalingGroupNames]
+        return [{"AutoScalingGroups": asgs}]
+
+    def get_listings(self):
+        # Calls that listed the whole region rather than named ASGs
+        paginate = self.autoscaling.get_paginator.return_value.paginate
+        return [c for c in paginate.call_args_list
+                if "AutoScalingGroupNames" not in c[1]]
+
+    def terminate_instances(self, InstanceIds):
+        self.terminated.extend(InstanceIds)
+        return {"TerminatingInstances": [
+            {"InstanceId": i, "CurrentState": {"Name": "shutting-down"}}
+            for i in InstanceIds
+        ]}
+
+    def get_client(self, service, region, account=None):
+        return getattr(self, service)
+
+
+class TestLambdaInvoker(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+    )
+
+    def test_invokes_function_and_returns_its_result(self):
+        client = self.get_client.return_value
+        client.invoke.return_value = {"Payload": io.BytesIO(b'{"a": 1}')}
+        invoker = chaos_shards.LambdaInvoker("chaos-function")
+        self.assertEqual(invoker({"shard": {}}), {"a": 1})
+        client.invoke.assert_called_once_with(
+            FunctionName="chaos-function",
+            InvocationType="RequestResponse",
+            Payload=b'{"shard": {}}'
+        )
+
+    def test_raises_function_errors(self):
+        self.get_client.return_value.invoke.return_value = {
+            "FunctionError": "Unhandled",
+            "Payload": io.BytesIO(b'{"errorMessage": "boom"}'),
+        }
+        invoker = chaos_shards.LambdaInvoker("chaos-function")
+        with self.assertRaises(RuntimeError) as cm:
+            invoker({"shard": {}})
+        self.assertEqual(str(cm.exception), "boom")
+
+
+class TestLocalInvoker(PatchingTestCase):
+
+    def test_passes_events_and_results_through_json(self):
+        handler = mock.Mock(return_value={"sample": [(1.0, ("a", "i"))]})
+        result = chaos_shards.LocalInvoker(handler)({"shard": (1, 2)})
+        handler.assert_called_once_with({"shard": [1, 2]}, None)
+        self.assertEqual(result, {"sample": [[1.0, ["a", "i"]]]})
+
+    def test_restores_coordinators_deadline(self):
+        def handler(event, context):
+            chaos.run_deadline["time"] = None
+            return {}
+        chaos.run_deadline["time"] = 100.0
+        try:
+            chaos_shards.LocalInvoker(handler)({"shard": {}})
+            self.assertEqual(chaos.run_deadline["time"], 100.0)
+        finally:
+            chaos.run_deadline["time"] = None
+
+
+class TestRunWorker(PatchingTestCase):
+
+    patch_list = (
+        "chaos.run_region",
+    )
+
+    def test_runs_region_for_one_shard(self):
+        self.run_region.return_value = ("r-1", "ok", 2, 1.5)
+        shard = chaos_shards.make_shard("1", "r-1", 2, 4, None)
+        result = chaos_shards.run_worker(shard, 0.5, 10.0)
+        self.run_region.assert_called_once_with(
+            "r-1", 0.5, 10.0, None, "1", (2, 4), names=None
+        )
+        self.assertEqual(
+            result, {"status": "ok", "targets": 2, "duration": 1.5}
+        )
+
+    def test_passes_names_from_coordinator(self):
+        self.run_region.return_value = ("r-1", "ok", 0, 1.0)
+        shard = chaos_shards.make_shard(None, "r-1", 0, 2, None, ["a", "b"])
+        chaos_shards.run_worker(shard, 0.5, None)
+        self.run_region.assert_called_once_with(
+            "r-1", 0.5, None, None, None, (0, 2), names=["a", "b"]
+        )
+
+    def test_returns_sample_if_asked_for_one(self):
+        def run_region(region, default, budget, reservoir, account, shard,
+                       names):
+            reservoir.add(("a", "i-1"), 1.0)
+            reservoir.add(("b", "i-2"), 1.0)
+            return region, "ok", 1, 1.0
+        self.run_region.side_effect = run_region
+        shard = chaos_shards.make_shard(None, "r-1", 0, 4, 1)
+        result = chaos_shards.run_worker(shard, 0.5, None)
+        self.assertEqual(result["added"], 2)
+        self.assertEqual(len(result["sample"]), 1)
+
+
+class TestListNames(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_all_asgs",
+        "chaos.get_client",
+    )
+
+    def setUp(self):
+        super(TestListNames, self).setUp()
+        self.get_all_asgs.return_value = make_asgs(2)
+        self.environ = mock.patch.dict("os.environ", {
+            "inventory_table": "", "two_phase": "", "tag_filter": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super(TestListNames, self).tearDown()
+
+    def test_lists_whole_region(self):
+        names, token = chaos_shards.list_names("1", "r-1", 0.5)
+        self.assertEqual(names, ["asg-0", "asg-1"])
+        self.assertIsNone(token)
+        self.get_client.assert_called_once_with("autoscaling", "r-1", "1")
+        self.get_all_asgs.assert_called_once_with(
+            self.get_client.return_value, None
+        )
+
+    def test_leaves_listing_to_workers_that_dont_list_the_region(self):
+        with mock.patch.dict("os.environ", {"inventory_table": "t"}):
+            self.assertEqual(
+                chaos_shards.list_names(None, "r-1", 0.5), (None, None)
+            )
+            # The inventory only covers the lambda's own account
+            names, token = chaos_shards.list_names("1", "r-1", 0.5)
+            self.assertIsNotNone(names)
+        with mock.patch.dict("os.environ", {"two_phase": "true"}):
+            self.assertEqual(
+                chaos_shards.list_names(None, "r-1", 0.0), (None, None)
+            )
+        self.assertEqual(self.get_all_asgs.call_count, 1)
+
+    def test_splits_names_by_shard(self):
+        names = ["asg-%d" % i for i in range(20)]
+        batches = chaos_shards.split_names(names, 3)
+        self.assertEqual(sorted(sum(batches, [])), sorted(names))
+        for index, batch in enumerate(batches):
+            for name in batch:
+                self.assertEqual(chaos.get_shard(name, 3), index)
+
+
+class TestShardRunner(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log",
+        "chaos_shards.list_names",
+    )
+
+    def setUp(self):
+        super(TestShardRunner, self).setUp()
+        self.list_names.return_value = (None, None)
+
+    def get_log_lines(self, name):
+        lines = []
+        for args, kwargs in self.log.call_args_list:
+            parts = re.findall(r"\[.*?\]|[^ ]+", " ".join(map(str, args)))
+            if parts[0] == name:
+                lines.append(parts)
+        return lines
+
+    def test_invokes_every_shard_of_every_item(self):
+        events = []
+
+        def invoker(event):
+            events.append(event["shard"])
+            return {"status": "ok", "targets": event["shard"]["index"]}
+        runner = chaos_shards.ShardRunner(invoker, 3)
+        results = runner.run([(None, "r-1"), ("1", "r-2")], {}, 1.0)
+        self.assertEqual(
+            sorted((s["account"] or "", s["region"], s["index"], s["count"])
+                   for s in events),
+            sorted((a, r, i, 3) for a, r in (("", "r-1"), ("1", "r-2"))
+                   for i in range(3))
+        )
+        self.assertEqual([r[:3] for r in results],
+                         [("r-1", "ok", 3), ("r-2", "ok", 3)])
+        self.assertEqual(
+            sorted((p[1], p[-1]) for p in self.get_log_lines("shard-result")),
+            sorted([("r-1", "1/3"), ("r-1", "2/3"), ("r-1", "3/3"),
+                    ("r-2", "1/3"), ("r-2", "2/3"), ("r-2", "3/3")])
+        )
+
+    def test_item_fails_if_any_of_its_shards_fails(self):
+        def invoker(event):
+            if event["shard"]["index"] == 1:
+                raise Exception("boom")
+            return {"status": "ok", "targets": 1}
+        runner = chaos_shards.ShardRunner(invoker, 2)
+        results = runner.run([(None, "r-1")], {}, 1.0)
+        self.assertEqual(results[0][:3], ("r-1", "error", 1))
+        self.assertEqual(self.get_log_lines("shard-error"), [
+            ["shard-error", "r-1", "boom", "shard", "2/2"]
+        ])
+
+    def test_hands_each_shard_its_names(self):
+        names = ["asg-%d" % i for i in range(10)]
+        self.list_names.return_value = (names, None)
+        events = []
+
+        def invoker(event):
+            events.append(event["shard"])
+            return {"status": "ok", "targets": 0}
+        runner = chaos_shards.ShardRunner(invoker, 3, workers=1)
+        runner.run([("1", "r-1")], {}, 0.5, tokens={("1", "r-1"): "t"})
+        self.list_names.assert_called_once_with("1", "r-1", 0.5, "t")
+        self.assertEqual(
+            [s["names"] for s in events], chaos_shards.split_names(names, 3)
+        )
+
+    @mock.patch("time.monotonic")
+    def test_hands_workers_the_time_left(self, monotonic):
+        monotonic.return_value = 100.0
+        events = []
+
+        def invoker(event):
+            events.append(event["shard"])
+            return {"status": "ok", "targets": 0}
+        runner = chaos_shards.ShardRunner(invoker, 2)
+        chaos.run_deadline["time"] = 160.0
+        try:
+            runner.run([(None, "r-1")], {}, 1.0)
+            self.assertEqual([s["remaining"] for s in events], [60.0, 60.0])
+            monotonic.return_value = 170.0
+            results = runner.run([(None, "r-1")], {}, 1.0)
+        finally:
+            chaos.run_deadline["time"] = None
+        self.assertEqual(len(events), 2)
+        self.assertEqual(results[0][:3], ("r-1", "deferred", 0))
+
+    def test_item_is_partial_if_its_listing_stopped_early(self):
+        self.list_names.return_value = (["asg-1"], "t")
+        invoker = mock.Mock(return_value={"status": "ok", "targets": 1})
+        runner = chaos_shards.ShardRunner(invoker, 2)
+        results = runner.run([(None, "r-1")], {}, 1.0)
+        self.assertEqual(results[0][:3], ("r-1", "partial", 2))
+        self.assertEqual(runner.next_tokens, {(None, "r-1"): "t"})
+
+    def test_defers_items_not_listed_by_the_deadline(self):
+        invoker = mock.Mock()
+        runner = chaos_shards.ShardRunner(invoker, 2)
+        chaos.run_deadline["time"] = 0.0
+        try:
+            results = runner.run(
+                [(None, "r-1")], {}, 1.0, tokens={(None, "r-1"): "t"}
+            )
+        finally:
+            chaos.run_deadline["time"] = None
+        self.assertEqual(results[0][:3], ("r-1", "deferred", 0))
+        self.assertFalse(self.list_names.called)
+        self.assertFalse(invoker.called)
+        self.assertEqual(runner.next_tokens, {(None, "r-1"): "t"})
+
+    def test_item_fails_if_its_region_cant_be_listed(self):
+        self.list_names.side_effect = Exception("denied")
+        invoker = mock.Mock()
+        runner = chaos_shards.ShardRunner(invoker, 2)
+        results = runner.run([(None, "r-1")], {}, 1.0)
+        self.assertEqual(results[0][:3], ("r-1", "error", 0))
+        self.assertFalse(invoker.called)
+        self.assertEqual(self.get_log_lines("shard-error"), [
+            ["shard-error", "r-1", "denied"]
+        ])
+
+    def test_merges_samples_into_reservoirs(self):
+        samples = {
+            0: [[-0.1, ["a", "i-1"]], [-2.0, ["b", "i-2"]]],
+            1: [[-0.2, ["c", "i-3"]]],
+        }
+
+        def invoker(event):
+            shard = event["shard"]
+            self.assertEqual(shard["sample"], 2)
+            return {"status": "ok", "targets": 2, "added": 5,
+                    "sample": samples[shard["index"]]}
+        reservoirs = {(None, "r-1"): chaos.TargetReservoir(2)}
+        runner = chaos_shards.ShardRunner(invoker, 2)
+        runner.run([(None, "r-1")], reservoirs, 1.0, 2)
+        reservoir = reservoirs[(None, "r-1")]
+        self.assertEqual(reservoir.added, 10)
+        self.assertEqual(reservoir.targets(), [("a", "i-1"), ("c", "i-3")])
+
+    def test_merges_samples_of_shards_that_stopped_at_the_deadline(self):
+        samples = {
+            0: [[-0.1, ["a", "i-1"]]],
+            1: [[-0.2, ["c", "i-3"]]],
+            2: [[-0.01, ["d", "i-4"]]],
+        }
+
+        def invoker(event):
+            index = event["shard"]["index"]
+            return {"status": ["ok", "partial", "timeout"][index],
+                    "targets": 1, "added": 1, "sample": samples[index]}
+        reservoirs = {(None, "r-1"): chaos.TargetReservoir(3)}
+        runner = chaos_shards.ShardRunner(invoker, 3)
+        runner.run([(None, "r-1")], reservoirs, 1.0, 3)
+        reservoir = reservoirs[(None, "r-1")]
+        self.assertEqual(reservoir.added, 2)
+        self.assertEqual(reservoir.targets(), [("a", "i-1"), ("c", "i-3")])
+
+
+class TestShardedRun(PatchingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.get_notification_sinks",
+        "chaos.log",
+    )
+
+    def setUp(self):
+        super(TestShardedRun, self).setUp()
+        self.clients = FakeClients(make_asgs(40))
+        self.get_client.side_effect = self.clients.get_client
+        self.get_notification_sinks.return_value = []
+        self.environ = mock.patch.dict("os.environ", {
+            "probability": "1.0",
+            "inventory_table": "",
+            "two_phase": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super(TestShardedRun, self).tearDown()
+
+    def test_every_asg_is_handled_by_exactly_one_shard(self):
+        runner = chaos_shards.ShardRunner(chaos_shards.LocalInvoker(), 4)
+        results = chaos.chaos_lambda(["r-1"], 1.0, shards=runner)
+        self.assertEqual(results[0][:3], ("r-1", "ok", 40))
+        self.assertEqual(sorted(self.clients.terminated),
+                         sorted("i-%d" % i for i in range(40)))
+        # Only the coordinator listed the region
+        self.assertEqual(len(self.clients.get_listings()), 1)
+
+    def test_coordinator_enforces_termination_cap(self):
+        runner = chaos_shards.ShardRunner(chaos_shards.LocalInvoker(), 4)
+        chaos.chaos_lambda(["r-1"], 1.0, max_terminations=5, shards=runner)
+        self.assertEqual(len(self.clients.terminated), 5)
+        self.log.assert_any_call(
+            "capped", "5", "of", "40", "targets", "at", "5"
+        )
+
+    def test_coordinator_resumes_listing_from_checkpoint(self):
+        pages = [
+            {"AutoScalingGroups": self.clients.asgs[:20], "NextToken": "t"},
+            {"AutoScalingGroups": self.clients.asgs[20:]},
+        ]
+
+        def paginate(AutoScalingGroupNames=None, PaginationConfig=None,
+                     **kwargs):
+            if AutoScalingGroupNames is not None:
+                return self.clients.paginate(AutoScalingGroupNames)
+            if PaginationConfig is not None:
+                return pages[1:]
+            # The first run runs out of time after the first page
+            chaos.run_deadline["time"] = 0.0
+            return pages
+        paginator = self.clients.autoscaling.get_paginator.return_value
+        paginator.paginate.side_effect = paginate
+        checkpoints = chaos_checkpoint.Checkpoints(
+            chaos_inventory.MemoryStore()
+        )
+        runner = chaos_shards.ShardRunner(chaos_shards.LocalInvoker(), 4)
+        try:
+            results = chaos.chaos_lambda(
+                ["r-1"], 1.0, shards=runner, checkpoints=checkpoints
+            )
+        finally:
+            chaos.run_deadline["time"] = None
+        # Out of time, so no worker was invoked
+        self.assertEqual(results[0][:3], ("r-1", "partial", 0))
+        self.assertEqual(self.clients.terminated, [])
+        results = chaos.chaos_lambda(
+            ["r-1"], 1.0, shards=runner, checkpoints=checkpoints
+        )
+        self.assertEqual(results[0][:3], ("r-1", "ok", 20))
+        self.assertEqual(sorted(self.clients.terminated),
+                         sorted("i-%d" % i for i in range(20, 40)))
+
+    def test_shard_results_survive_json(self):
+        shard = chaos_shards.make_shard(None, "r-1", 0, 2, 3)
+        result = chaos_shards.LocalInvoker()({"shard": shard})
+        self.assertEqual(json.loads(json.dumps(result)), result)
+        self.assertEqual(len(result["sample"]), 3)
+        self.assertEqual(self.clients.terminated, [])
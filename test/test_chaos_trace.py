@@ -0,0 +1,383 @@
+import json
+import threading
+
+from unittest import mock
+
+from base import PatchingTestCase, make_asg
+
+import chaos
+import chaos_trace
+
+
+def get_subsegments(document, name):
+    return [
+        s for s in document.get("subsegments", []) if s["name"] == name
+    ]
+
+
+class TracingTestCase(PatchingTestCase):
+
+    def start_tracer(self, exporter="log"):
+        tracer = chaos.tracing["tracer"] = chaos_trace.Tracer(
+            exporter, {"request_id": "abc"}
+        )
+        return tracer
+
+    def tearDown(self):
+        chaos.tracing["tracer"] = None
+        super(TracingTestCase, self).tearDown()
+
+
+class TestGetTraceExporter(PatchingTestCase):
+
+    def test_defaults_to_none(self):
+        with mock.patch.dict("os.environ", {"trace_exporter": ""}):
+            self.assertEqual(chaos.get_trace_exporter(), "none")
+
+    def test_reads_environment(self):
+        with mock.patch.dict("os.environ", {"trace_exporter": " XRay "}):
+            self.assertEqual(chaos.get_trace_exporter(), "xray")
+
+    def test_rejects_unknown_exporters(self):
+        with mock.patch.dict("os.environ", {"trace_exporter": "zipkin"}):
+            with self.assertRaises(ValueError):
+                chaos.get_trace_exporter()
+
+
+class TestSpans(TracingTestCase):
+
+    def test_spans_are_nothing_without_a_tracer(self):
+        with chaos.span("region", region="r-1") as s:
+            s.set(targets=1)
+        self.assertIs(s, chaos.NO_SPAN)
+        self.assertIs(chaos.current_span(), chaos.NO_SPAN)
+        pages = [{"Tags": []}]
+        self.assertIs(chaos.trace_pages(pages, "Tags"), pages)
+
+    def test_spans_nest(self):
+        tracer = self.start_tracer()
+        with chaos.span("region", region="r-1"):
+            with chaos.span("select") as select:
+                chaos.count_api_call()
+                select.set(targets=2)
+            chaos.count_api_call()
+        document = tracer.finish()
+        self.assertEqual(document["name"], "invocation")
+        self.assertEqual(document["annotations"], {
+            "request_id": "abc", "api_calls": 2
+        })
+        region, = get_subsegments(document, "region")
+        self.assertEqual(region["annotations"], {
+            "region": "r-1", "api_calls": 2
+        })
+        select, = get_subsegments(region, "select")
+        self.assertEqual(select["annotations"], {
+            "targets": 2, "api_calls": 1
+        })
+        self.assertLessEqual(region["start_time"], select["start_time"])
+        self.assertLessEqual(select["end_time"], region["end_time"])
+
+    def test_failed_spans_are_faults(self):
+        tracer = self.start_tracer()
+        with self.assertRaises(ValueError):
+            with chaos.span("region"):
+                raise ValueError("boom")
+        region, = get_subsegments(tracer.finish(), "region")
+        self.assertTrue(region["fault"])
+
+    def test_threads_resume_their_parent_span(self):
+        tracer = self.start_tracer()
+
+        def work(parent):
+            chaos.resume_span(parent)
+            with chaos.span("terminate"):
+                pass
+
+        with chaos.span("region"):
+            parent = chaos.current_span()
+            threads = [
+                threading.Thread(target=work, args=(parent,)),
+                threading.Thread(target=work, args=(None,)),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        document = tracer.finish()
+        region, = get_subsegments(document, "region")
+        self.assertEqual(len(get_subsegments(region, "terminate")), 1)
+        self.assertEqual(len(get_subsegments(document, "terminate")), 1)
+
+    def test_pages_get_spans_of_their_own(self):
+        tracer = self.start_tracer()
+        pages = [{"Tags": [1, 2]}, {"Tags": [3]}]
+        traced = chaos.trace_pages(pages, "Tags", operation="DescribeTags")
+        self.assertEqual(list(traced), pages)
+        lists = get_subsegments(tracer.finish(), "list")
+        self.assertEqual([s["annotations"]["items"] for s in lists], [2, 1])
+        self.assertEqual(
+            lists[0]["annotations"]["operation"], "DescribeTags"
+        )
+
+    @mock.patch("chaos_trace.MAX_SPANS", 3)
+    def test_spans_are_limited(self):
+        tracer = self.start_tracer()
+        for i in range(5):
+            with chaos.span("list"):
+                pass
+        document = tracer.finish()
+        self.assertEqual(len(document["subsegments"]), 3)
+        self.assertEqual(document["annotations"]["dropped_spans"], 2)
+
+
+class TestTracedRegion(TracingTestCase):
+
+    patch_list = (
+        "chaos.get_client",
+        "chaos.log",
+        "chaos.terminate_region",
+    )
+
+    def setUp(self):
+        super(TestTracedRegion, self).setUp()
+        self.get_client.return_value.get_paginator.return_value \
+            .paginate.return_value = [
+                {"AutoScalingGroups": [make_asg("a")], "NextToken": "t"},
+                {"AutoScalingGroups": [make_asg("b")]},
+            ]
+        self.environ = mock.patch.dict("os.environ", {
+            "pipeline": "", "inventory_table": "", "two_phase": "",
+            "tag_filter": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        super(TestTracedRegion, self).tearDown()
+
+    def get_region(self, tracer):
+        region, = get_subsegments(tracer.finish(), "region")
+        return region
+
+    def test_region_is_traced(self):
+        tracer = self.start_tracer()
+        chaos.chaos_lambda(["r-1"], 1.0)
+        region = self.get_region(tracer)
+        self.assertEqual(region["annotations"]["region"], "r-1")
+        self.assertEqual(region["annotations"]["status"], "ok")
+        self.assertEqual(region["annotations"]["targets"], 2)
+        select, = get_subsegments(region, "select")
+        lists = get_subsegments(select, "list")
+        self.assertEqual([s["annotations"]["items"] for s in lists], [1, 1])
+
+    def test_pipelined_listing_is_traced_under_the_region(self):
+        tracer = self.start_tracer()
+        with mock.patch.dict("os.environ", {"pipeline": "true"}):
+            chaos.chaos_lambda(["r-1"], 1.0)
+        select, = get_subsegments(self.get_region(tracer), "select")
+        self.assertEqual(len(get_subsegments(select, "list")), 2)
+
+
+class TestExportLog(PatchingTestCase):
+
+    patch_list = (
+        "chaos.log_record",
+    )
+
+    def test_writes_segment_as_a_record(self):
+        chaos_trace.export_log({"name": "invocation"})
+        self.log_record.assert_called_once_with({
+            "event": "trace", "segment": {"name": "invocation"}
+        })
+
+
+class TestExportXRay(PatchingTestCase):
+
+    patch_list = (
+        "socket.socket",
+    )
+
+    def export(self, environ):
+        document = {"name": "invocation", "id": "1234"}
+        with mock.patch.dict("os.environ", environ):
+            chaos_trace.export_xray(document)
+        return document
+
+    def get_sent(self):
+        data, address = self.socket.return_value.sendto.call_args[0]
+        header, body = data.decode("utf-8").split("\n", 1)
+        self.assertEqual(json.loads(header), {"format": "json", "version": 1})
+        return json.loads(body), address
+
+    def test_sends_subsegment_of_the_lambda_segment(self):
+        self.export({
+            "_X_AMZN_TRACE_ID": "Root=1-5-abc;Parent=def;Sampled=1",
+            "AWS_XRAY_DAEMON_ADDRESS": "169.254.79.129:2000",
+        })
+        document, address = self.get_sent()
+        self.assertEqual(address, ("169.254.79.129", 2000))
+        self.assertEqual(document["trace_id"], "1-5-abc")
+        self.assertEqual(document["parent_id"], "def")
+        self.assertEqual(document["type"], "subsegment")
+
+    def test_sends_segment_of_its_own_without_active_tracing(self):
+        self.export({
+            "_X_AMZN_TRACE_ID": "",
+            "AWS_XRAY_DAEMON_ADDRESS": "tcp:1.2.3.4:2000 udp:1.2.3.5:2001",
+        })
+        document, address = self.get_sent()
+        self.assertEqual(address, ("1.2.3.5", 2001))
+        self.assertTrue(document["trace_id"].startswith("1-"))
+        self.assertNotIn("parent_id", document)
+
+    def test_skips_unsampled_invocations(self):
+        self.export({"_X_AMZN_TRACE_ID": "Root=1-5-abc;Sampled=0"})
+        self.assertFalse(self.socket.called)
+
+    @mock.patch("chaos_trace.MAX_DOCUMENT_BYTES", 10)
+    def test_rejects_spans_too_large_to_send(self):
+        with self.assertRaises(ValueError):
+            self.export({"_X_AMZN_TRACE_ID": ""})
+        self.assertFalse(self.socket.called)
+
+    @mock.patch("chaos_trace.MAX_DOCUMENT_BYTES", 600)
+    def test_sends_subsegments_that_dont_fit_separately(self):
+        def make_span(name, children=()):
+            span = {"name": name, "id": name, "annotations": {"x": "y" * 50}}
+            if children:
+                span["subsegments"] = list(children)
+            return span
+        document = make_span("invocation", [
+            make_span("r-%d" % i, [make_span("s-%d-%d" % (i, j))
+                                   for j in range(3)])
+            for i in range(4)
+        ])
+        with mock.patch.dict("os.environ", {
+            "_X_AMZN_TRACE_ID": "Root=1-5-abc;Parent=def;Sampled=1",
+        }):
+            chaos_trace.export_xray(document)
+        sendto = self.socket.return_value.sendto
+        sent = [c[0][0] for c in sendto.call_args_list]
+        self.assertGreater(len(sent), 1)
+        self.assertTrue(all(len(data) <= 600 for data in sent))
+        parents = {}
+
+        def walk(span, parent_id):
+            parents[span["id"]] = parent_id
+            for child in span.get("subsegments", []):
+                walk(child, span["id"])
+        for data in sent:
+            span = json.loads(data.decode("utf-8").split("\n", 1)[1])
+            self.assertEqual(span["trace_id"], "1-5-abc")
+            self.assertEqual(span["type"], "subsegment")
+            walk(span, span["parent_id"])
+        # Every span is sent once, under its own parent
+        self.assertEqual(len(parents), 17)
+        self.assertEqual(parents["invocation"], "def")
+        self.assertEqual(parents["r-3"], "invocation")
+        self.assertEqual(parents["s-3-2"], "r-3")
+
+
+class TestTracedHandler(PatchingTestCase):
+
+    patch_list = (
+        "chaos.chaos_lambda",
+        "chaos.emit_metrics",
+        "chaos.finish_capture",
+        "chaos.flush_log",
+        "chaos.get_deadline",
+        "chaos.get_regions",
+        "chaos.get_shard_runner",
+        "chaos.log",
+        "chaos.log_record",
+        "chaos.start_capture",
+    )
+
+    def setUp(self):
+        super(TestTracedHandler, self).setUp()
+        self.environ = mock.patch.dict("os.environ", {
+            "trace_exporter": "log", "profile": "",
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        chaos.tracing["tracer"] = None
+        super(TestTracedHandler, self).tearDown()
+
+    def get_segment(self):
+        record, = [
+            c[0][0] for c in self.log_record.call_args_list
+            if c[0][0]["event"] == "trace"
+        ]
+        return record["segment"]
+
+    def test_exports_trace_of_each_invocation(self):
+        def run(*args, **kwargs):
+            with chaos.span("region", region="r-1"):
+                pass
+        self.chaos_lambda.side_effect = run
+        chaos.handler({}, mock.Mock(aws_request_id="abc"))
+        segment = self.get_segment()
+        self.assertEqual(segment["annotations"]["request_id"], "abc")
+        self.assertEqual(len(get_subsegments(segment, "region")), 1)
+        self.assertIsNone(chaos.tracing["tracer"])
+
+    def test_exports_trace_of_failed_invocation(self):
+        self.chaos_lambda.side_effect = ValueError("boom")
+        with self.assertRaises(ValueError):
+            chaos.handler({}, mock.Mock(aws_request_id="abc"))
+        self.assertEqual(self.get_segment()["name"], "invocation")
+        self.assertIsNone(chaos.tracing["tracer"])
+
+    def test_nested_invocations_share_the_trace(self):
+        def run(*args, **kwargs):
+            if self.chaos_lambda.call_count == 1:
+                chaos.handler({}, mock.Mock(aws_request_id="inner"))
+        self.chaos_lambda.side_effect = run
+        chaos.handler({}, mock.Mock(aws_request_id="outer"))
+        self.assertEqual(self.chaos_lambda.call_count, 2)
+        self.assertEqual(
+            self.get_segment()["annotations"]["request_id"], "outer"
+        )
+
+    def test_logs_failures_to_export(self):
+        with mock.patch.dict("chaos_trace.EXPORT", {
+            "log": mock.Mock(side_effect=Exception("boom"))
+        }):
+            chaos.handler({}, mock.Mock(aws_request_id="abc"))
+        self.log.assert_any_call("trace-failed", "log", "[boom]")
+
+
+class TestCountedClients(PatchingTestCase):
+
+    patch_list = (
+        "chaos.Config",
+        "chaos.boto3",
+        "chaos.get_client_config",
+    )
+
+    def setUp(self):
+        super(TestCountedClients, self).setUp()
+        chaos.reset_clients()
+        self.boto3.client.side_effect = lambda *args, **kwargs: mock.Mock()
+
+    def tearDown(self):
+        chaos.reset_clients()
+        super(TestCountedClients, self).tearDown()
+
+    def test_counts_calls_if_tracing_enabled(self):
+        with mock.patch.dict("os.environ", {
+            "trace_exporter": "xray", "api_metrics": ""
+        }):
+            client = chaos.get_client("ec2", "sp-moonbase-1")
+        client.meta.events.register.assert_called_once_with(
+            "before-call", chaos.count_api_call
+        )
+
+    def test_leaves_clients_alone_otherwise(self):
+        with mock.patch.dict("os.environ", {
+            "trace_exporter": "", "api_metrics": ""
+        }):
+            client = chaos.get_client("ec2", "sp-moonbase-1")
+        self.assertFalse(client.meta.events.register.called)
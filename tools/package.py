@@ -0,0 +1,211 @@
+"""
+Builds the deployment artifacts for Chaos Lambda from src/.
+
+    python3.11 tools/package.py zip chaos-lambda.zip
+    python3 tools/package.py inline build/index.py
+    python3 tools/package.py source chaos-lambda.zip
+
+Only the modules the lambda's handlers can import are included: those
+reachable from ENTRY_POINTS by import statements, including the ones that
+chaos.py imports lazily.
+
+zip builds the zip file deployment package.  Each module is compiled ahead
+of time to optimized (-OO) bytecode, and shipped as a sourceless .pyc in
+place of its source, so the runtime loads it without compiling it (the
+function's directory is read only, so it can't cache bytecode itself).
+Bytecode only loads on the Python version that wrote it, so this must be run
+with the same version as RUNTIME.
+
+inline builds the single index.py for the standalone template's ZipFile
+property.  The modules' sources are minified (docstrings and comments
+removed), compressed and base85 encoded, and index.py imports them from
+memory.  The code can grow to several modules, limited only by the size of
+the template.
+
+source builds a zip file of the modules' sources, as earlier versions of the
+Makefile did.  Tracebacks from it include source lines.
+"""
+import argparse
+import ast
+import base64
+import importlib.util
+import json
+import marshal
+import os
+import sys
+import zipfile
+import zlib
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# The modules holding the handlers named by the CloudFormation templates
+ENTRY_POINTS = ("chaos", "chaos_inventory")
+# Runtime of the lambda functions in cloudformation/src/lambda.py
+RUNTIME = (3, 11)
+# Fixed so that identical sources build identical zip files
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+LOADER = '''\
+import base64
+import importlib.machinery
+import json
+import sys
+import zlib
+
+MODULES = json.loads(zlib.decompress(base64.b85decode(
+    "%s"
+)))
+
+
+class Loader:
+
+    @staticmethod
+    def find_spec(name, path=None, target=None):
+        if name in MODULES:
+            return importlib.machinery.ModuleSpec(
+                name, Loader, origin=name + ".py"
+            )
+
+    @staticmethod
+    def create_module(spec):
+        return None
+
+    @staticmethod
+    def exec_module(module):
+        source = MODULES[module.__name__]
+        exec(compile(source, module.__spec__.origin, "exec"), module.__dict__)
+
+
+sys.meta_path.insert(0, Loader)
+
+from chaos import handler  # noqa: E402
+'''
+
+
+def read_source(name, src=SRC):
+    with open(os.path.join(src, name + ".py"), "r") as f:
+        return f.read()
+
+
+def get_imports(source):
+    names = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names.add(node.module.split(".")[0])
+    return names
+
+
+def get_modules(entry_points=ENTRY_POINTS, src=SRC):
+    # Follows imports of other modules in src, wherever they appear
+    local = set(
+        name[:-3] for name in os.listdir(src) if name.endswith(".py")
+    )
+    modules = set()
+    pending = list(entry_points)
+    while len(pending) != 0:
+        name = pending.pop()
+        if name in modules:
+            continue
+        modules.add(name)
+        pending.extend(get_imports(read_source(name, src)) & local)
+    return sorted(modules)
+
+
+def strip_docstrings(tree):
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef,
+                                 ast.AsyncFunctionDef)):
+            continue
+        body = node.body
+        if len(body) != 0 and isinstance(body[0], ast.Expr) and \
+                isinstance(body[0].value, ast.Constant) and \
+                isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+    return tree
+
+
+def minify(source):
+    # Unparsing drops the comments and formatting along with the docstrings
+    return ast.unparse(strip_docstrings(ast.parse(source)))
+
+
+def compile_module(name, source):
+    # The same bytes py_compile would write for an unchecked hash-based
+    # .pyc, which (unlike a timestamp-based one) doesn't change with the
+    # source file's modification time
+    code = compile(source, name + ".py", "exec", dont_inherit=True,
+                   optimize=2)
+    data = bytearray(importlib.util.MAGIC_NUMBER)
+    data.extend((1).to_bytes(4, "little"))
+    data.extend(importlib.util.source_hash(source.encode("utf-8")))
+    data.extend(marshal.dumps(code))
+    return bytes(data)
+
+
+def write_zip(path, files):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in files:
+            info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            z.writestr(info, data)
+
+
+def build_zip(path, src=SRC):
+    if sys.version_info[:2] != RUNTIME:
+        raise SystemExit(
+            "Bytecode for the python%d.%d runtime must be built with Python "
+            "%d.%d, not %d.%d" % (RUNTIME + RUNTIME + sys.version_info[:2])
+        )
+    write_zip(path, [
+        (name + ".pyc", compile_module(name, read_source(name, src)))
+        for name in get_modules(src=src)
+    ])
+
+
+def build_source_zip(path, src=SRC):
+    write_zip(path, [
+        (name + ".py", read_source(name, src).encode("utf-8"))
+        for name in get_modules(src=src)
+    ])
+
+
+def get_inline_source(src=SRC):
+    modules = dict(
+        (name, minify(read_source(name, src)))
+        for name in get_modules(src=src)
+    )
+    data = zlib.compress(json.dumps(modules, sort_keys=True).encode(), 9)
+    return LOADER % base64.b85encode(data).decode("ascii")
+
+
+def build_inline(path, src=SRC):
+    with open(path, "w") as f:
+        f.write(get_inline_source(src))
+
+
+BUILDERS = {
+    "zip": build_zip,
+    "inline": build_inline,
+    "source": build_source_zip,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("kind", choices=sorted(BUILDERS))
+    parser.add_argument("path")
+    args = parser.parse_args()
+    directory = os.path.dirname(args.path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    BUILDERS[args.kind](args.path)
+
+
+if __name__ == "__main__":
+    main()